@@ -11,6 +11,8 @@
 // CHANGES:
 // 1/22/16: Changed the progam so it only estimates template parameters, I did this to estimate the r9.4
 //          model which is a 1D chemistry
+// --paramsTable: only estimate the read's parameters the way signalMachine does and print them as rows of the
+//          nanopore params table, used for the batch estimation in signalAlignLib
 //
 
 #include <getopt.h>
@@ -74,6 +76,13 @@ void printEstimateOfParams(NanoporeRead *npRead, StateMachine *sM, double thresh
             threshold, strand, readLabel);
 }
 
+void printParamsTableRow(NanoporeReadAdjustmentParameters *params, char *readLabel, char *strand) {
+    // readLabel | strand | scale | shift | var | scale_sd | var_sd | drift, same order as the npRead header,
+    // %g so that the drift (which is small) keeps its precision
+    fprintf(stdout, "%s\t%s\t%.10g\t%.10g\t%.10g\t%.10g\t%.10g\t%.10g\n", readLabel, strand,
+            params->scale, params->shift, params->var, params->scale_sd, params->var_sd, params->drift);
+}
+
 void printEventMeansAndParams(NanoporeRead *npRead, stList *templateKmers, stList *complementKmers) {
     char *t_modelState, *c_modelState;
     // kmer | mean | stDev | start | prob | scale | shift | var | drift | strand
@@ -144,6 +153,9 @@ int main(int argc, char *argv[]) {
     char *templateModelFile = stString_print("../models/testModelR9_template.model");
     char *complementModelFile = stString_print("../models/testModelR9_complement_pop2.model");
     double threshold = 0.8;
+    char *readLabel = NULL;
+    bool paramsTable = FALSE;
+    bool complementModelGiven = FALSE;
 
     int key;
     while (1) {
@@ -153,11 +165,13 @@ int main(int argc, char *argv[]) {
                 {"complementModel",         required_argument,  0,  'C'},
                 {"npRead",                  required_argument,  0,  'q'},
                 {"threshold",               required_argument,  0,  'D'},
+                {"readLabel",               required_argument,  0,  'L'},
+                {"paramsTable",             no_argument,        0,  'P'},
                 {0, 0, 0, 0} };
 
         int option_index = 0;
 
-        key = getopt_long(argc, argv, "h:T:C:q:f:b:D:m:",
+        key = getopt_long(argc, argv, "h:T:C:q:f:b:D:m:L:P",
                           long_options, &option_index);
 
         if (key == -1) {
@@ -173,6 +187,13 @@ int main(int argc, char *argv[]) {
                 break;
             case 'C':
                 complementModelFile = stString_copy(optarg);
+                complementModelGiven = TRUE;
+                break;
+            case 'L':
+                readLabel = stString_copy(optarg);
+                break;
+            case 'P':
+                paramsTable = TRUE;
                 break;
             case 'q':
                 npReadFile = stString_copy(optarg);
@@ -194,6 +215,27 @@ int main(int argc, char *argv[]) {
     // read in the .npRead file
     NanoporeRead *npRead = nanopore_loadNanoporeReadFromFile(npReadFile);
 
+    if (paramsTable) {
+        // estimate like signalMachine does, the events aren't used after so they aren't adjusted for drift
+        if (readLabel == NULL) {
+            readLabel = stString_copy(npReadFile);
+        }
+        signalUtils_estimateNanoporeParamsFromTable(templateModelFile, npRead, &npRead->templateParams,
+                                                    ASSIGNMENT_THRESHOLD, signalUtils_templateOneDAssignmentsFromRead,
+                                                    nanopore_dontAdjustEvents);
+        printParamsTableRow(&npRead->templateParams, readLabel, "t");
+        if (complementModelGiven && (npRead->nbComplementEvents > 0)) {
+            signalUtils_estimateNanoporeParamsFromTable(complementModelFile, npRead, &npRead->complementParams,
+                                                        ASSIGNMENT_THRESHOLD,
+                                                        signalUtils_complementOneDAssignmentsFromRead,
+                                                        nanopore_dontAdjustEvents);
+            printParamsTableRow(&npRead->complementParams, readLabel, "c");
+        }
+        nanopore_nanoporeReadDestruct(npRead);
+        free(readLabel);
+        return 0;
+    }
+
     // build state machines (to use the look up table)
     StateMachine *sMt = getStateMachine3(templateModelFile);
     //StateMachine *sMc = getStateMachine3(complementModelFile);
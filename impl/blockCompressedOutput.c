@@ -0,0 +1,137 @@
+#include <stdio.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <stdarg.h>
+#include <string.h>
+#include <inttypes.h>
+#include <zlib.h>
+#include "sonLib.h"
+#include "blockCompressedOutput.h"
+
+#define BLOCK_HEADER_SIZE 18
+#define BLOCK_FOOTER_SIZE 8
+
+struct _blockWriter {
+    FILE *fH;
+    bool compress;
+    char *buffer;           // records of the current block
+    int64_t length;
+    unsigned char *block;   // compressed block
+};
+
+BlockWriter *blockWriter_open(const char *path, bool compress) {
+    FILE *fH = fopen(path, compress ? "ab" : "a");
+    if (fH == NULL) {
+        st_errAbort("blockWriter_open: couldn't open %s\n", path);
+    }
+    BlockWriter *writer = st_malloc(sizeof(BlockWriter));
+    writer->fH = fH;
+    writer->compress = compress;
+    writer->buffer = st_malloc((BLOCK_INPUT_SIZE + 1) * sizeof(char));
+    writer->length = 0;
+    writer->block = compress ? st_malloc(BLOCK_MAX_SIZE * sizeof(unsigned char)) : NULL;
+    return writer;
+}
+
+static void blockWriter_putUint16(unsigned char *bytes, uint16_t value) {
+    bytes[0] = (unsigned char) (value & 0xFF);
+    bytes[1] = (unsigned char) ((value >> 8) & 0xFF);
+}
+
+static void blockWriter_putUint32(unsigned char *bytes, uint32_t value) {
+    for (int64_t i = 0; i < 4; i++) {
+        bytes[i] = (unsigned char) ((value >> (8 * i)) & 0xFF);
+    }
+}
+
+// raw deflate of the input into output, returns the compressed length or -1 if it doesn't fit
+static int64_t blockWriter_deflate(char *input, int64_t length, unsigned char *output, int64_t outputSize,
+                                   int level) {
+    z_stream stream;
+    stream.zalloc = Z_NULL;
+    stream.zfree = Z_NULL;
+    stream.opaque = Z_NULL;
+    if (deflateInit2(&stream, level, Z_DEFLATED, -15, 8, Z_DEFAULT_STRATEGY) != Z_OK) {
+        st_errAbort("blockWriter_deflate: couldn't initialize zlib\n");
+    }
+    stream.next_in = (Bytef *) input;
+    stream.avail_in = (uInt) length;
+    stream.next_out = output;
+    stream.avail_out = (uInt) outputSize;
+    int status = deflate(&stream, Z_FINISH);
+    int64_t compressedLength = (int64_t) stream.total_out;
+    deflateEnd(&stream);
+    return status == Z_STREAM_END ? compressedLength : -1;
+}
+
+void blockWriter_flush(BlockWriter *writer) {
+    if (writer->length == 0) {
+        return;
+    }
+    if (!writer->compress) {
+        fwrite(writer->buffer, 1, writer->length, writer->fH);
+        writer->length = 0;
+        return;
+    }
+    unsigned char *block = writer->block;
+    int64_t space = BLOCK_MAX_SIZE - BLOCK_HEADER_SIZE - BLOCK_FOOTER_SIZE;
+    int64_t compressedLength = blockWriter_deflate(writer->buffer, writer->length, block + BLOCK_HEADER_SIZE,
+                                                   space, Z_DEFAULT_COMPRESSION);
+    if (compressedLength < 0) {
+        // stored blocks always fit, a full block grows by a few bytes
+        compressedLength = blockWriter_deflate(writer->buffer, writer->length, block + BLOCK_HEADER_SIZE, space,
+                                               Z_NO_COMPRESSION);
+        if (compressedLength < 0) {
+            st_errAbort("blockWriter_flush: couldn't fit the block\n");
+        }
+    }
+    int64_t blockSize = BLOCK_HEADER_SIZE + compressedLength + BLOCK_FOOTER_SIZE;
+
+    // gzip header with the BGZF extra field, the block size minus one
+    block[0] = 31;
+    block[1] = 139;
+    block[2] = 8;    // deflate
+    block[3] = 4;    // FEXTRA
+    blockWriter_putUint32(block + 4, 0);  // mtime
+    block[8] = 0;
+    block[9] = 255;  // unknown OS
+    blockWriter_putUint16(block + 10, 6);
+    block[12] = 'B';
+    block[13] = 'C';
+    blockWriter_putUint16(block + 14, 2);
+    blockWriter_putUint16(block + 16, (uint16_t) (blockSize - 1));
+
+    uLong crc = crc32(crc32(0L, Z_NULL, 0), (const Bytef *) writer->buffer, (uInt) writer->length);
+    blockWriter_putUint32(block + BLOCK_HEADER_SIZE + compressedLength, (uint32_t) crc);
+    blockWriter_putUint32(block + BLOCK_HEADER_SIZE + compressedLength + 4, (uint32_t) writer->length);
+
+    fwrite(block, 1, blockSize, writer->fH);
+    writer->length = 0;
+}
+
+void blockWriter_printf(BlockWriter *writer, const char *fmt, ...) {
+    va_list args;
+    int64_t space = BLOCK_INPUT_SIZE - writer->length;
+    va_start(args, fmt);
+    int64_t n = vsnprintf(writer->buffer + writer->length, space + 1, fmt, args);
+    va_end(args);
+    if (n > space) {
+        // doesn't fit, start a new block with it
+        blockWriter_flush(writer);
+        va_start(args, fmt);
+        n = vsnprintf(writer->buffer, BLOCK_INPUT_SIZE + 1, fmt, args);
+        va_end(args);
+        if (n > BLOCK_INPUT_SIZE) {
+            st_errAbort("blockWriter_printf: record of %"PRId64" bytes is bigger than a block\n", n);
+        }
+    }
+    writer->length += n;
+}
+
+void blockWriter_close(BlockWriter *writer) {
+    blockWriter_flush(writer);
+    fclose(writer->fH);
+    free(writer->buffer);
+    free(writer->block);
+    free(writer);
+}
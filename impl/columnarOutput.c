@@ -0,0 +1,421 @@
+#include <stdio.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+#include <inttypes.h>
+#include <zlib.h>
+#include "sonLib.h"
+#include "columnarOutput.h"
+
+typedef struct _column {
+    char *name;
+    ColumnType type;
+    char *data;
+    int64_t length;    // bytes used
+    int64_t capacity;  // bytes allocated
+} Column;
+
+struct _columnarBlock {
+    char *format;
+    stList *metadata;  // "key=value" strings
+    stList *columns;
+};
+
+static const char *columnar_typeName(ColumnType type) {
+    switch (type) {
+        case columnInt32:
+            return "i4";
+        case columnInt64:
+            return "i8";
+        case columnDouble:
+            return "f8";
+        default:
+            st_errAbort("columnar_typeName: unknown column type %i\n", type);
+    }
+    return NULL;
+}
+
+static int64_t columnar_typeSize(ColumnType type) {
+    switch (type) {
+        case columnInt32:
+            return sizeof(int32_t);
+        case columnInt64:
+            return sizeof(int64_t);
+        case columnDouble:
+            return sizeof(double);
+        default:
+            st_errAbort("columnar_typeSize: unknown column type %i\n", type);
+    }
+    return 0;
+}
+
+static void column_destruct(Column *column) {
+    free(column->name);
+    free(column->data);
+    free(column);
+}
+
+static void column_append(Column *column, void *value, int64_t size) {
+    if (column->length + size > column->capacity) {
+        int64_t capacity = column->capacity == 0 ? 1024 * size : 2 * column->capacity;
+        char *data = st_malloc(capacity);
+        if (column->length > 0) {
+            memcpy(data, column->data, column->length);
+        }
+        free(column->data);
+        column->data = data;
+        column->capacity = capacity;
+    }
+    memcpy(column->data + column->length, value, size);
+    column->length += size;
+}
+
+ColumnarBlock *columnarBlock_construct(const char *format) {
+    ColumnarBlock *block = st_malloc(sizeof(ColumnarBlock));
+    block->format = stString_copy(format);
+    block->metadata = stList_construct3(0, free);
+    block->columns = stList_construct3(0, (void (*)(void *)) column_destruct);
+    return block;
+}
+
+void columnarBlock_destruct(ColumnarBlock *block) {
+    free(block->format);
+    stList_destruct(block->metadata);
+    stList_destruct(block->columns);
+    free(block);
+}
+
+void columnarBlock_addMetadata(ColumnarBlock *block, const char *key, const char *value) {
+    if (strchr(value, '\n') != NULL || strchr(key, '=') != NULL) {
+        st_errAbort("columnarBlock_addMetadata: can't store %s=%s in the header\n", key, value);
+    }
+    stList_append(block->metadata, stString_print("%s=%s", key, value));
+}
+
+int64_t columnarBlock_addColumn(ColumnarBlock *block, const char *name, ColumnType type) {
+    if (columnarBlock_getRowNumber(block) > 0) {
+        st_errAbort("columnarBlock_addColumn: can't add column %s to a block that has rows\n", name);
+    }
+    Column *column = st_malloc(sizeof(Column));
+    column->name = stString_copy(name);
+    column->type = type;
+    column->data = NULL;
+    column->length = 0;
+    column->capacity = 0;
+    stList_append(block->columns, column);
+    return stList_length(block->columns) - 1;
+}
+
+static Column *columnarBlock_getColumn(ColumnarBlock *block, int64_t column, ColumnType type) {
+    Column *c = stList_get(block->columns, column);
+    if (c->type != type) {
+        st_errAbort("columnarBlock: column %s is %s, not %s\n", c->name, columnar_typeName(c->type),
+                    columnar_typeName(type));
+    }
+    return c;
+}
+
+void columnarBlock_appendInt32(ColumnarBlock *block, int64_t column, int32_t value) {
+    column_append(columnarBlock_getColumn(block, column, columnInt32), &value, sizeof(int32_t));
+}
+
+void columnarBlock_appendInt64(ColumnarBlock *block, int64_t column, int64_t value) {
+    column_append(columnarBlock_getColumn(block, column, columnInt64), &value, sizeof(int64_t));
+}
+
+void columnarBlock_appendDouble(ColumnarBlock *block, int64_t column, double value) {
+    column_append(columnarBlock_getColumn(block, column, columnDouble), &value, sizeof(double));
+}
+
+int64_t columnarBlock_getRowNumber(ColumnarBlock *block) {
+    if (stList_length(block->columns) == 0) {
+        return 0;
+    }
+    Column *column = stList_get(block->columns, 0);
+    return column->length / columnar_typeSize(column->type);
+}
+
+static void columnar_writeUint32(FILE *fH, uint32_t value) {
+    // the format is little-endian
+    unsigned char bytes[4];
+    for (int64_t i = 0; i < 4; i++) {
+        bytes[i] = (unsigned char) ((value >> (8 * i)) & 0xFF);
+    }
+    fwrite(bytes, 1, 4, fH);
+}
+
+static void columnar_writeUint64(FILE *fH, uint64_t value) {
+    unsigned char bytes[8];
+    for (int64_t i = 0; i < 8; i++) {
+        bytes[i] = (unsigned char) ((value >> (8 * i)) & 0xFF);
+    }
+    fwrite(bytes, 1, 8, fH);
+}
+
+static char *columnarBlock_makeHeader(ColumnarBlock *block, bool compress) {
+    int64_t rows = columnarBlock_getRowNumber(block);
+    char *columns = stString_copy("");
+    for (int64_t i = 0; i < stList_length(block->columns); i++) {
+        Column *column = stList_get(block->columns, i);
+        if (column->length / columnar_typeSize(column->type) != rows) {
+            st_errAbort("columnarBlock_write: column %s has %"PRId64" rows, should have %"PRId64"\n", column->name,
+                        column->length / columnar_typeSize(column->type), rows);
+        }
+        char *s = stString_print("%s%s%s:%s", columns, i == 0 ? "" : ",", column->name,
+                                 columnar_typeName(column->type));
+        free(columns);
+        columns = s;
+    }
+    char *header = stString_print("format=%s\nrows=%"PRId64"\ncompression=%s\ncolumns=%s\n", block->format, rows,
+                                  compress ? "zlib" : "none", columns);
+    free(columns);
+    for (int64_t i = 0; i < stList_length(block->metadata); i++) {
+        char *s = stString_print("%s%s\n", header, (char *) stList_get(block->metadata, i));
+        free(header);
+        header = s;
+    }
+    return header;
+}
+
+void columnarBlock_write(ColumnarBlock *block, FILE *fH, bool compress) {
+    char *header = columnarBlock_makeHeader(block, compress);
+    int64_t headerLength = (int64_t) strlen(header);
+
+    fwrite(COLUMNAR_MAGIC, 1, 4, fH);
+    columnar_writeUint32(fH, COLUMNAR_VERSION);
+    columnar_writeUint32(fH, (uint32_t) headerLength);
+    fwrite(header, 1, headerLength, fH);
+
+    for (int64_t i = 0; i < stList_length(block->columns); i++) {
+        Column *column = stList_get(block->columns, i);
+        if (!compress) {
+            columnar_writeUint64(fH, (uint64_t) column->length);
+            if (column->length > 0) {
+                fwrite(column->data, 1, column->length, fH);
+            }
+            continue;
+        }
+        uLongf compressedLength = compressBound((uLong) column->length);
+        Bytef *compressed = st_malloc(compressedLength);
+        if (compress2(compressed, &compressedLength, (const Bytef *) column->data, (uLong) column->length,
+                      Z_DEFAULT_COMPRESSION) != Z_OK) {
+            st_errAbort("columnarBlock_write: couldn't compress column %s\n", column->name);
+        }
+        columnar_writeUint64(fH, (uint64_t) compressedLength);
+        fwrite(compressed, 1, compressedLength, fH);
+        free(compressed);
+    }
+    free(header);
+}
+
+static bool columnar_readUint32(FILE *fH, uint32_t *value) {
+    unsigned char bytes[4];
+    if (fread(bytes, 1, 4, fH) != 4) {
+        return FALSE;
+    }
+    *value = 0;
+    for (int64_t i = 3; i >= 0; i--) {
+        *value = (*value << 8) | bytes[i];
+    }
+    return TRUE;
+}
+
+static bool columnar_readUint64(FILE *fH, uint64_t *value) {
+    unsigned char bytes[8];
+    if (fread(bytes, 1, 8, fH) != 8) {
+        return FALSE;
+    }
+    *value = 0;
+    for (int64_t i = 7; i >= 0; i--) {
+        *value = (*value << 8) | bytes[i];
+    }
+    return TRUE;
+}
+
+static ColumnType columnar_typeFromName(const char *name) {
+    if (stString_eq(name, "i4")) {
+        return columnInt32;
+    }
+    if (stString_eq(name, "i8")) {
+        return columnInt64;
+    }
+    if (stString_eq(name, "f8")) {
+        return columnDouble;
+    }
+    st_errAbort("columnarBlock_read: unknown column type %s\n", name);
+    return columnDouble;
+}
+
+ColumnarBlock *columnarBlock_read(FILE *fH) {
+    char magic[4];
+    size_t n = fread(magic, 1, 4, fH);
+    if (n == 0) {
+        return NULL;
+    }
+    if (n != 4 || memcmp(magic, COLUMNAR_MAGIC, 4) != 0) {
+        st_errAbort("columnarBlock_read: not a columnar block\n");
+    }
+    uint32_t version, headerLength;
+    if (!columnar_readUint32(fH, &version) || !columnar_readUint32(fH, &headerLength)) {
+        st_errAbort("columnarBlock_read: truncated block\n");
+    }
+    if (version != COLUMNAR_VERSION) {
+        st_errAbort("columnarBlock_read: unsupported version %"PRIu32"\n", version);
+    }
+    char *header = st_malloc((headerLength + 1) * sizeof(char));
+    if (fread(header, 1, headerLength, fH) != headerLength) {
+        st_errAbort("columnarBlock_read: truncated header\n");
+    }
+    header[headerLength] = '\0';
+
+    // the header lines, everything but format, rows, compression and columns is metadata
+    ColumnarBlock *block = NULL;
+    int64_t rows = -1;
+    bool compressed = FALSE;
+    stList *columns = NULL;
+    stList *metadata = stList_construct3(0, free);
+    stList *lines = stString_splitByString(header, "\n");
+    for (int64_t i = 0; i < stList_length(lines); i++) {
+        char *line = stList_get(lines, i);
+        char *value = strchr(line, '=');
+        if (value == NULL) {
+            continue;
+        }
+        *value = '\0';
+        value++;
+        if (stString_eq(line, "format")) {
+            block = columnarBlock_construct(value);
+        } else if (stString_eq(line, "rows")) {
+            rows = (int64_t) strtoll(value, NULL, 10);
+        } else if (stString_eq(line, "compression")) {
+            compressed = stString_eq(value, "zlib");
+        } else if (stString_eq(line, "columns")) {
+            columns = strlen(value) == 0 ? stList_construct3(0, free) : stString_splitByString(value, ",");
+        } else {
+            stList_append(metadata, stString_print("%s=%s", line, value));
+        }
+    }
+    stList_destruct(lines);
+    free(header);
+    if (block == NULL || rows < 0 || columns == NULL) {
+        st_errAbort("columnarBlock_read: incomplete header\n");
+    }
+    stList_destruct(block->metadata);
+    block->metadata = metadata;
+
+    // all the columns go in before any of them gets its rows
+    for (int64_t i = 0; i < stList_length(columns); i++) {
+        char *name = stList_get(columns, i);
+        char *type = strchr(name, ':');
+        if (type == NULL) {
+            st_errAbort("columnarBlock_read: column %s doesn't have a type\n", name);
+        }
+        *type = '\0';
+        columnarBlock_addColumn(block, name, columnar_typeFromName(type + 1));
+    }
+    stList_destruct(columns);
+
+    for (int64_t i = 0; i < stList_length(block->columns); i++) {
+        Column *column = stList_get(block->columns, i);
+        char *name = column->name;
+        uint64_t storedLength;
+        if (!columnar_readUint64(fH, &storedLength)) {
+            st_errAbort("columnarBlock_read: truncated column %s\n", name);
+        }
+        char *stored = st_malloc(storedLength > 0 ? storedLength : 1);
+        if (fread(stored, 1, storedLength, fH) != storedLength) {
+            st_errAbort("columnarBlock_read: truncated column %s\n", name);
+        }
+        column->length = rows * columnar_typeSize(column->type);
+        column->capacity = column->length;
+        if (!compressed) {
+            if ((int64_t) storedLength != column->length) {
+                st_errAbort("columnarBlock_read: column %s should have %"PRId64" rows\n", name, rows);
+            }
+            column->data = stored;
+            continue;
+        }
+        column->data = st_malloc(column->length > 0 ? column->length : 1);
+        uLongf length = (uLongf) column->length;
+        if (uncompress((Bytef *) column->data, &length, (const Bytef *) stored, (uLong) storedLength) != Z_OK ||
+            (int64_t) length != column->length) {
+            st_errAbort("columnarBlock_read: couldn't decompress column %s\n", name);
+        }
+        free(stored);
+    }
+    return block;
+}
+
+const char *columnarBlock_getFormat(ColumnarBlock *block) {
+    return block->format;
+}
+
+char *columnarBlock_getMetadata(ColumnarBlock *block, const char *key) {
+    int64_t keyLength = (int64_t) strlen(key);
+    for (int64_t i = 0; i < stList_length(block->metadata); i++) {
+        char *entry = stList_get(block->metadata, i);
+        if (strncmp(entry, key, keyLength) == 0 && entry[keyLength] == '=') {
+            return entry + keyLength + 1;
+        }
+    }
+    return NULL;
+}
+
+int64_t columnarBlock_getColumnIndex(ColumnarBlock *block, const char *name) {
+    for (int64_t i = 0; i < stList_length(block->columns); i++) {
+        Column *column = stList_get(block->columns, i);
+        if (stString_eq(column->name, name)) {
+            return i;
+        }
+    }
+    return -1;
+}
+
+int32_t *columnarBlock_getInt32s(ColumnarBlock *block, int64_t column) {
+    return (int32_t *) columnarBlock_getColumn(block, column, columnInt32)->data;
+}
+
+int64_t *columnarBlock_getInt64s(ColumnarBlock *block, int64_t column) {
+    return (int64_t *) columnarBlock_getColumn(block, column, columnInt64)->data;
+}
+
+double *columnarBlock_getDoubles(ColumnarBlock *block, int64_t column) {
+    return (double *) columnarBlock_getColumn(block, column, columnDouble)->data;
+}
+
+char *columnar_kmerAlphabet(const char *baseAlphabet, int64_t baseAlphabetSize, stList *sequences) {
+    bool seen[256] = { 0 };
+    char *alphabet = st_malloc(257 * sizeof(char));
+    int64_t size = 0;
+    for (int64_t i = 0; i < baseAlphabetSize; i++) {
+        unsigned char c = (unsigned char) baseAlphabet[i];
+        if (!seen[c]) {
+            seen[c] = TRUE;
+            alphabet[size++] = (char) c;
+        }
+    }
+    for (int64_t s = 0; s < stList_length(sequences); s++) {
+        const unsigned char *sequence = stList_get(sequences, s);
+        for (int64_t i = 0; sequence[i] != '\0'; i++) {
+            if (!seen[sequence[i]]) {
+                seen[sequence[i]] = TRUE;
+                alphabet[size++] = (char) sequence[i];
+            }
+        }
+    }
+    alphabet[size] = '\0';
+    return alphabet;
+}
+
+int64_t columnar_kmerId(const char *kmer, const char *alphabet, int64_t kmerLength) {
+    int64_t alphabetSize = (int64_t) strlen(alphabet);
+    int64_t id = 0;
+    for (int64_t i = 0; i < kmerLength; i++) {
+        const char *c = strchr(alphabet, kmer[i]);
+        if (c == NULL || kmer[i] == '\0') {
+            return -1;
+        }
+        id = id * alphabetSize + (c - alphabet);
+    }
+    return id;
+}
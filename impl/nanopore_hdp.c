@@ -23,6 +23,7 @@
 #include <string.h>
 #include <inttypes.h>
 #include "pairwiseAligner.h"
+#include "columnarOutput.h"
 #include "hdp_math_utils.h"
 
 
@@ -197,9 +198,108 @@ void update_nhdp_from_alignment(NanoporeHDP* nhdp, const char* alignment_filepat
     update_nhdp_from_alignment_with_filter(nhdp, alignment_filepath, has_header, NULL);
 }
 
+static bool is_assignments_file(const char* filepath) {
+    FILE* file = fopen(filepath, "rb");
+    if (file == NULL) {
+        return false;
+    }
+    char magic[4];
+    bool columnar = fread(magic, 1, 4, file) == 4 && memcmp(magic, COLUMNAR_MAGIC, 4) == 0;
+    fclose(file);
+    return columnar;
+}
+
+void update_nhdp_from_assignments(NanoporeHDP* nhdp, const char* assignments_filepath, const char* strand_filter) {
+    
+    stList* signal_list = stList_construct3(0, &free);
+    stList* dp_id_list = stList_construct3(0, &free);
+    
+    FILE* assignments_file = fopen(assignments_filepath, "rb");
+    if (assignments_file == NULL) {
+        fprintf(stderr, "Assignments %s file does not exist.\n", assignments_filepath);
+        exit(EXIT_FAILURE);
+    }
+    
+    char* kmer = (char*) malloc(sizeof(char) * (nhdp->kmer_length + 1));
+    kmer[nhdp->kmer_length] = '\0';
+    int64_t* dp_id_ptr;
+    double* signal_ptr;
+    
+    ColumnarBlock* block = columnarBlock_read(assignments_file);
+    while (block != NULL) {
+        char* strand = columnarBlock_getMetadata(block, "strand");
+        char* alphabet = columnarBlock_getMetadata(block, "kmer_alphabet");
+        char* kmer_length_str = columnarBlock_getMetadata(block, "kmer_length");
+        int64_t kmer_column = columnarBlock_getColumnIndex(block, "kmer");
+        int64_t mean_column = columnarBlock_getColumnIndex(block, "event_mean");
+        if (strcmp(columnarBlock_getFormat(block), "assignments") != 0 || strand == NULL || alphabet == NULL ||
+            kmer_length_str == NULL || kmer_column < 0 || mean_column < 0) {
+            fprintf(stderr, "%s is not an assignments file.\n", assignments_filepath);
+            exit(EXIT_FAILURE);
+        }
+        if (strtoll(kmer_length_str, NULL, 10) != nhdp->kmer_length) {
+            fprintf(stderr, "Assignments in %s have kmer length %s, the HDP has %"PRId64".\n",
+                    assignments_filepath, kmer_length_str, nhdp->kmer_length);
+            exit(EXIT_FAILURE);
+        }
+        
+        if (strand_filter == NULL || strcmp(strand, strand_filter) == 0) {
+            int64_t rows = columnarBlock_getRowNumber(block);
+            int64_t* kmer_ids = columnarBlock_getInt64s(block, kmer_column);
+            double* means = columnarBlock_getDoubles(block, mean_column);
+            int64_t alphabet_size = (int64_t) strlen(alphabet);
+            // ids in the HDP's alphabet can be used as they are, the others go through the kmer
+            bool same_alphabet = strcmp(alphabet, nhdp->alphabet) == 0;
+            
+            for (int64_t i = 0; i < rows; i++) {
+                signal_ptr = (double*) malloc(sizeof(double));
+                dp_id_ptr = (int64_t*) malloc(sizeof(int64_t));
+                *signal_ptr = means[i];
+                if (same_alphabet) {
+                    *dp_id_ptr = kmer_ids[i];
+                }
+                else {
+                    int64_t* word = get_word(kmer_ids[i], alphabet_size, nhdp->kmer_length);
+                    for (int64_t j = 0; j < nhdp->kmer_length; j++) {
+                        kmer[j] = alphabet[word[j]];
+                    }
+                    free(word);
+                    *dp_id_ptr = kmer_id(kmer, nhdp->alphabet, nhdp->alphabet_size, nhdp->kmer_length);
+                }
+                
+                stList_append(signal_list, signal_ptr);
+                stList_append(dp_id_list, dp_id_ptr);
+            }
+        }
+        
+        columnarBlock_destruct(block);
+        block = columnarBlock_read(assignments_file);
+    }
+    
+    free(kmer);
+    fclose(assignments_file);
+    
+    int64_t data_length;
+    
+    double* signal = stList_toDoublePtr(signal_list, &data_length);
+    int64_t* dp_ids = stList_toIntPtr(dp_id_list, &data_length);
+    
+    stList_destruct(signal_list);
+    stList_destruct(dp_id_list);
+    
+    reset_hdp_data(nhdp->hdp);
+    pass_data_to_hdp(nhdp->hdp, signal, dp_ids, data_length);
+}
+
 void update_nhdp_from_alignment_with_filter(NanoporeHDP* nhdp, const char* alignment_filepath,
                                             bool has_header, const char* strand_filter) {
     
+    // compact assignments (makeBuildAlignments.py) are read as they are, without the text
+    if (is_assignments_file(alignment_filepath)) {
+        update_nhdp_from_assignments(nhdp, alignment_filepath, strand_filter);
+        return;
+    }
+    
     stList* signal_list = stList_construct3(0, &free);
     stList* dp_id_list = stList_construct3(0, &free);
     
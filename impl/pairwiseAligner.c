@@ -15,6 +15,7 @@
 #include <assert.h>
 #include <stdbool.h>
 #include <inttypes.h>
+#include <pthread.h>
 #include "discreteHmm.h"
 #include "bioioC.h"
 #include "pairwiseAlignment.h"
@@ -504,6 +505,18 @@ Path *path_construct(char *kmer, int64_t stateNumber, int64_t kmerLength) {
     path->stateNumber = stateNumber;
     path->kmerLength = kmerLength;
     path->cells = st_calloc(stateNumber, sizeof(double));
+    path->ownsCells = TRUE;
+    return path;
+}
+
+Path *path_construct2(char *kmer, int64_t stateNumber, int64_t kmerLength, double *cells) {
+    // path with its cells in a buffer owned by someone else (the DpDiagonal)
+    Path *path = st_malloc(sizeof(Path));
+    path->kmer = kmer;
+    path->stateNumber = stateNumber;
+    path->kmerLength = kmerLength;
+    path->cells = cells;
+    path->ownsCells = FALSE;
     return path;
 }
 
@@ -594,7 +607,9 @@ void path_copyCells(Path *master, Path *copy) {
 }
 
 void path_destruct(Path *path) {
-    free(path->cells);
+    if (path->ownsCells) {
+        free(path->cells);
+    }
     free(path);
 }
 
@@ -604,6 +619,26 @@ void path_destruct(Path *path) {
 /////////////////////////////////////////////////////////////////////////////////////////////////////////
 HDCell *hdCell_construct(void *nucleotideSequence, int64_t stateNumber, int64_t nbBaseOptions, char *baseOptions,
                          int64_t kmerLength) {
+    return hdCell_construct2(nucleotideSequence, stateNumber, nbBaseOptions, baseOptions, kmerLength, NULL);
+}
+
+int64_t hdCell_countPaths(void *nucleotideSequence, int64_t nbBaseOptions, int64_t kmerLength) {
+    if (nucleotideSequence == NULL) {
+        return 1;
+    }
+    int64_t nbDegeneratePositions = 0;
+    for (int64_t i = 0; i < kmerLength; i++) {
+        char n = *((char *)nucleotideSequence + i);
+        if (strchr(AMBIG_BASE, n)) { // same test as path_findDegeneratePositions
+            nbDegeneratePositions++;
+        }
+    }
+    return intPow(nbBaseOptions, nbDegeneratePositions);
+}
+
+HDCell *hdCell_construct2(void *nucleotideSequence, int64_t stateNumber, int64_t nbBaseOptions, char *baseOptions,
+                          int64_t kmerLength, double *cells) {
+    // if cells isn't NULL the paths keep their cells there, one after the other, stateNumber doubles each
     char *kmer_i;
     if (nucleotideSequence != NULL) {
         kmer_i = (char *)st_malloc((kmerLength) * sizeof(char));
@@ -633,16 +668,19 @@ HDCell *hdCell_construct(void *nucleotideSequence, int64_t stateNumber, int64_t
         stList *patterns = path_listPotentialKmers(nbDegeneratePositions, nbBaseOptions, baseOptions);
         for (int64_t i = 0; i < cell->numberOfPaths; i++) {
             char *pattern = stList_get(patterns, i);
-            Path *path = path_construct(hdCell_getSubstitutedKmer(degeneratePositions, nbDegeneratePositions, pattern,
-                                                                  kmer_i), stateNumber, kmerLength);
+            char *kmer = hdCell_getSubstitutedKmer(degeneratePositions, nbDegeneratePositions, pattern, kmer_i);
+            Path *path = cells == NULL ? path_construct(kmer, stateNumber, kmerLength)
+                                       : path_construct2(kmer, stateNumber, kmerLength, cells + i * stateNumber);
             cell->paths[i] = path;
         }
     } else {
         char *onePathKmer = stString_copy(kmer_i);
-        Path *path = path_construct(onePathKmer, stateNumber, kmerLength);
+        Path *path = cells == NULL ? path_construct(onePathKmer, stateNumber, kmerLength)
+                                   : path_construct2(onePathKmer, stateNumber, kmerLength, cells);
         cell->paths[0] = path;
     }
 
+    cell->cells = cells;
     cell->init = TRUE;
     free(kmer_i);
 
@@ -691,6 +729,70 @@ double hdCell_totalProbability(HDCell *cell1, HDCell *cell2) {
     return totalProbability;
 }
 
+static int hdCell_cmpScores(const void *a, const void *b) {
+    // sorts path probabilities biggest first
+    double x = *(const double *) a, y = *(const double *) b;
+    return x < y ? 1 : (x > y ? -1 : 0);
+}
+
+int64_t hdCell_prunePaths(HDCell *cell, double threshold, int64_t beamWidth, double *droppedMass) {
+    /*
+     * Drops the paths of a (forward) cell that have less than threshold of the cell's probability, or that aren't
+     * in the beamWidth most probable paths. The most probable path is always kept. Returns the number of paths
+     * dropped and puts the fraction of the cell's probability they had into droppedMass.
+     */
+    *droppedMass = 0.0;
+    if (cell->numberOfPaths <= 1) {
+        return 0;
+    }
+    double *scores = st_malloc(sizeof(double) * cell->numberOfPaths);
+    double cellTotal = LOG_ZERO;
+    int64_t best = 0;
+    for (int64_t i = 0; i < cell->numberOfPaths; i++) {
+        Path *path = hdCell_getPath(cell, i);
+        scores[i] = LOG_ZERO;
+        for (int64_t s = 0; s < path->stateNumber; s++) {
+            scores[i] = logAdd(scores[i], path->cells[s]);
+        }
+        cellTotal = logAdd(cellTotal, scores[i]);
+        best = scores[i] > scores[best] ? i : best;
+    }
+    if (cellTotal == LOG_ZERO) { // nothing has reached this cell yet
+        free(scores);
+        return 0;
+    }
+    double beamCutoff = LOG_ZERO;
+    if (beamWidth > 0 && cell->numberOfPaths > beamWidth) {
+        double *sorted = st_malloc(sizeof(double) * cell->numberOfPaths);
+        memcpy(sorted, scores, sizeof(double) * cell->numberOfPaths);
+        qsort(sorted, cell->numberOfPaths, sizeof(double), hdCell_cmpScores);
+        beamCutoff = sorted[beamWidth - 1];
+        free(sorted);
+    }
+    int64_t kept = 0;
+    for (int64_t i = 0; i < cell->numberOfPaths; i++) {
+        Path *path = cell->paths[i];
+        double fraction = exp(scores[i] - cellTotal);
+        if (i == best || (fraction >= threshold && scores[i] >= beamCutoff)) {
+            if (cell->cells != NULL && kept != i) {
+                // slide the kept path's cells down so the buffer can still be indexed by path number
+                double *keptCells = cell->cells + kept * path->stateNumber;
+                memcpy(keptCells, path->cells, sizeof(double) * path->stateNumber);
+                path->cells = keptCells;
+            }
+            cell->paths[kept++] = path;
+        } else {
+            *droppedMass += fraction;
+            free(path->kmer);
+            path_destruct(path);
+        }
+    }
+    int64_t dropped = cell->numberOfPaths - kept;
+    cell->numberOfPaths = kept;
+    free(scores);
+    return dropped;
+}
+
 /////////////////////////////////////////////////////////////////////////////////////////////////////////
 //Cell calculations
 //A cell is a set of states associated with an x, y coordinate.
@@ -834,8 +936,11 @@ static void cell_calculateUpdateExpectation(StateMachine *sM,
 //  Test: Pass
 /////////////////////////////////////////////////////////////////////////////////////////////////////////
 
-DpDiagonal *dpDiagonal_construct(Diagonal diagonal, int64_t stateNumber, int64_t kmerLength,
-                                 Sequence *nucleotideSequence) {
+// byte alignment of the contiguous cell buffers, a cache line
+#define DP_CELL_ALIGNMENT 64
+
+static DpDiagonal *dpDiagonal_construct2(Diagonal diagonal, int64_t stateNumber, int64_t kmerLength,
+                                         Sequence *nucleotideSequence, bool contiguous) {
     if (nucleotideSequence->type != kmer) {  // todo will need to change this for nuc/nuc alignments
         st_errAbort("dpDiagonal_construct: got illegal sequence type %i", nucleotideSequence->type);
     }
@@ -855,6 +960,9 @@ DpDiagonal *dpDiagonal_construct(Diagonal diagonal, int64_t stateNumber, int64_t
     dpDiagonal->kmerLength = kmerLength;
     dpDiagonal->sequence = nucleotideSequence;
     dpDiagonal->totalPaths = 0;
+    dpDiagonal->cellBuffer = NULL;
+    dpDiagonal->cellBufferLength = 0;
+    dpDiagonal->cellMemory = NULL;
     assert(diagonal_getWidth(diagonal) >= 0);
 
     int64_t nCells = diagonal_getWidth(diagonal);
@@ -864,26 +972,51 @@ DpDiagonal *dpDiagonal_construct(Diagonal diagonal, int64_t stateNumber, int64_t
     int64_t maxXmy = diagonal_getMaxXmy(diagonal);
     int64_t xay = diagonal_getXay(diagonal);
 
+    if (contiguous) {
+        // count the paths first so all of the cells go in one aligned buffer, laid out cell by cell, path by path
+        for (int64_t i = xmy; i <= maxXmy; i += 2) {
+            int64_t x = diagonal_getXCoordinate(xay, i);
+            void *k = sequence_getKmerWithBoundsCheck(nucleotideSequence, (x - 1));
+            dpDiagonal->cellBufferLength += hdCell_countPaths(k, nucleotideSequence->nbDegenerateBases,
+                                                              kmerLength) * stateNumber;
+        }
+        dpDiagonal->cellMemory = st_malloc(sizeof(double) * dpDiagonal->cellBufferLength + DP_CELL_ALIGNMENT);
+        dpDiagonal->cellBuffer = (double *) (((uintptr_t) dpDiagonal->cellMemory + DP_CELL_ALIGNMENT - 1)
+                                             & ~((uintptr_t) DP_CELL_ALIGNMENT - 1));
+    }
+
     while (xmy <= maxXmy) {
         int64_t x = diagonal_getXCoordinate(xay, xmy);
 
         void *k = sequence_getKmerWithBoundsCheck(nucleotideSequence, (x - 1));
 
-        HDCell *hdCell = hdCell_construct(k, stateNumber, nucleotideSequence->nbDegenerateBases,
-                                          nucleotideSequence->degenerateBases, kmerLength);
+        double *cells = contiguous ? dpDiagonal->cellBuffer + dpDiagonal->totalPaths * stateNumber : NULL;
+        HDCell *hdCell = hdCell_construct2(k, stateNumber, nucleotideSequence->nbDegenerateBases,
+                                           nucleotideSequence->degenerateBases, kmerLength, cells);
 
         dpDiagonal->totalPaths += hdCell->numberOfPaths;
         dpDiagonal_assignCell(dpDiagonal, hdCell, xmy);
 
         xmy += 2;
     }
+    assert(!contiguous || dpDiagonal->totalPaths * stateNumber == dpDiagonal->cellBufferLength);
     return dpDiagonal;
 }
 
+DpDiagonal *dpDiagonal_construct(Diagonal diagonal, int64_t stateNumber, int64_t kmerLength,
+                                 Sequence *nucleotideSequence) {
+    return dpDiagonal_construct2(diagonal, stateNumber, kmerLength, nucleotideSequence, FALSE);
+}
+
+DpDiagonal *dpDiagonal_constructContiguous(Diagonal diagonal, int64_t stateNumber, int64_t kmerLength,
+                                           Sequence *nucleotideSequence) {
+    return dpDiagonal_construct2(diagonal, stateNumber, kmerLength, nucleotideSequence, TRUE);
+}
+
 DpDiagonal *dpDiagonal_clone(DpDiagonal *diagonal) {
-    // make empty dpDiagonal
-    DpDiagonal *diagonal2 = dpDiagonal_construct(diagonal->diagonal, diagonal->stateNumber, diagonal->kmerLength,
-                                                 diagonal->sequence);
+    // make empty dpDiagonal, with the same layout
+    DpDiagonal *diagonal2 = dpDiagonal_construct2(diagonal->diagonal, diagonal->stateNumber, diagonal->kmerLength,
+                                                  diagonal->sequence, diagonal->cellBuffer != NULL);
 
     // copy the cells (doubles) from the paths
     int64_t nCells = diagonal_getWidth(diagonal2->diagonal);
@@ -967,6 +1100,13 @@ HDCell *dpDiagonal_getCell(DpDiagonal *dpDiagonal, int64_t xmy) {
 }
 
 void dpDiagonal_zeroValues(DpDiagonal *diagonal) {
+    if (diagonal->cellBuffer != NULL) {
+        double *cells = diagonal->cellBuffer;
+        for (int64_t i = 0; i < diagonal->cellBufferLength; i++) {
+            cells[i] = LOG_ZERO;
+        }
+        return;
+    }
     for (int64_t i = 0; i < diagonal_getWidth(diagonal->diagonal); i++) {
         HDCell *hdCell = diagonal->cells[i];
         for (int64_t p = 0; p < hdCell->numberOfPaths; p++) {
@@ -1037,6 +1177,7 @@ void dpDiagonal_destruct(DpDiagonal *dpDiagonal) {
     }
 
     free(dpDiagonal->cells);
+    free(dpDiagonal->cellMemory);
     free(dpDiagonal);
 }
 
@@ -1048,8 +1189,10 @@ struct _dpMatrix {
     DpDiagonal **diagonals;
     int64_t diagonalNumber;
     int64_t activeDiagonals;
+    int64_t activePaths;
     int64_t stateNumber;
     int64_t kmerLength;
+    bool contiguousCells;
 };
 
 DpMatrix *dpMatrix_construct(int64_t diagonalNumber, int64_t stateNumber, int64_t kmerLength) {
@@ -1058,6 +1201,8 @@ DpMatrix *dpMatrix_construct(int64_t diagonalNumber, int64_t stateNumber, int64_
     dpMatrix->diagonalNumber = diagonalNumber;
     dpMatrix->diagonals = st_calloc(dpMatrix->diagonalNumber + 1, sizeof(DpDiagonal *));
     dpMatrix->activeDiagonals = 0;
+    dpMatrix->activePaths = 0;
+    dpMatrix->contiguousCells = FALSE;
     dpMatrix->stateNumber = stateNumber;
     dpMatrix->kmerLength = kmerLength;
     return dpMatrix;
@@ -1079,6 +1224,14 @@ DpDiagonal *dpMatrix_getDiagonal(DpMatrix *dpMatrix, int64_t xay) {
 int64_t dpMatrix_getActiveDiagonalNumber(DpMatrix *dpMatrix) {
     return dpMatrix->activeDiagonals;
 }
+
+int64_t dpMatrix_getActivePathNumber(DpMatrix *dpMatrix) {
+    return dpMatrix->activePaths;
+}
+
+void dpMatrix_setContiguousCells(DpMatrix *dpMatrix, bool contiguousCells) {
+    dpMatrix->contiguousCells = contiguousCells;
+}
 // todo can add kmerLength here, percolate down to path
 DpDiagonal *dpMatrix_createDiagonal(DpMatrix *dpMatrix, Diagonal diagonal, Sequence *sX) {
     if (sX->type != kmer) {
@@ -1088,9 +1241,11 @@ DpDiagonal *dpMatrix_createDiagonal(DpMatrix *dpMatrix, Diagonal diagonal, Seque
     assert(diagonal.xay >= 0);
     assert(diagonal.xay <= dpMatrix->diagonalNumber);
     assert(dpMatrix_getDiagonal(dpMatrix, diagonal.xay) == NULL);
-    DpDiagonal *dpDiagonal = dpDiagonal_construct(diagonal, dpMatrix->stateNumber, dpMatrix->kmerLength, sX);
+    DpDiagonal *dpDiagonal = dpDiagonal_construct2(diagonal, dpMatrix->stateNumber, dpMatrix->kmerLength, sX,
+                                                   dpMatrix->contiguousCells);
     dpMatrix->diagonals[diagonal_getXay(diagonal)] = dpDiagonal;
     dpMatrix->activeDiagonals++;
+    dpMatrix->activePaths += dpDiagonal->totalPaths;
     return dpDiagonal;
 }
 
@@ -1100,6 +1255,7 @@ void dpMatrix_deleteDiagonal(DpMatrix *dpMatrix, int64_t xay) {
     if (dpMatrix->diagonals[xay] != NULL) {
         dpMatrix->activeDiagonals--;
         assert(dpMatrix->activeDiagonals >= 0);
+        dpMatrix->activePaths -= dpMatrix->diagonals[xay]->totalPaths;
         dpDiagonal_destruct(dpMatrix->diagonals[xay]);
         dpMatrix->diagonals[xay] = NULL;
     }
@@ -1275,6 +1431,159 @@ void diagonalCalculation_Expectations(StateMachine *sM, int64_t xay,
 }
 
 
+/////////////////////////////////////////////////////////////////////////////////////////////////////////
+//  Degenerate path pruning
+//  Cells with many degenerate positions have options^positions paths, pruning drops the unlikely ones from
+//  the forward matrix as it is computed so they aren't carried along the rest of the matrix.
+/////////////////////////////////////////////////////////////////////////////////////////////////////////
+
+typedef struct _pathPruning {
+    int64_t prunedCells; // cells that had at least one path dropped
+    int64_t prunedPaths;
+    double droppedMass; // sum over the pruned cells of the fraction of the cell's probability dropped
+    double maxDroppedMass;
+} PathPruning;
+
+static void dpMatrix_prunePaths(DpMatrix *dpMatrix, int64_t xay, PairwiseAlignmentParameters *p,
+                                PathPruning *pruning) {
+    if (p->pathPruneThreshold <= 0.0 && p->pathBeamWidth <= 0) {
+        return;
+    }
+    DpDiagonal *dpDiagonal = dpMatrix_getDiagonal(dpMatrix, xay);
+    for (int64_t i = 0; i < diagonal_getWidth(dpDiagonal->diagonal); i++) {
+        double droppedMass;
+        int64_t dropped = hdCell_prunePaths(dpDiagonal->cells[i], p->pathPruneThreshold, p->pathBeamWidth,
+                                            &droppedMass);
+        if (dropped > 0) {
+            dpDiagonal->totalPaths -= dropped;
+            dpMatrix->activePaths -= dropped;
+            pruning->prunedCells++;
+            pruning->prunedPaths += dropped;
+            pruning->droppedMass += droppedMass;
+            pruning->maxDroppedMass = droppedMass > pruning->maxDroppedMass ? droppedMass : pruning->maxDroppedMass;
+        }
+    }
+}
+
+/////////////////////////////////////////////////////////////////////////////////////////////////////////
+//  Forward-backward checkpointing
+//  With checkpointing on only every k-th pair of forward diagonals is kept during the forward pass, the
+//  diagonals in between are recomputed from the checkpoint below them when the traceback needs them.
+/////////////////////////////////////////////////////////////////////////////////////////////////////////
+
+ForwardBackwardStats *forwardBackwardStats_construct() {
+    ForwardBackwardStats *stats = st_malloc(sizeof(ForwardBackwardStats));
+    stats->forwardDiagonals = 0;
+    stats->forwardCells = 0;
+    stats->recomputedDiagonals = 0;
+    stats->checkpointedMatrices = 0;
+    stats->peakBytes = 0;
+    stats->bandedBlocks = 0;
+    stats->bandRetries = 0;
+    stats->widenedBlocks = 0;
+    stats->widestDiagonalExpansion = 0;
+    stats->prunedCells = 0;
+    stats->prunedPaths = 0;
+    stats->droppedMass = 0.0;
+    stats->maxDroppedMass = 0.0;
+    pthread_mutex_init(&stats->lock, NULL);
+    return stats;
+}
+
+void forwardBackwardStats_destruct(ForwardBackwardStats *stats) {
+    pthread_mutex_destroy(&stats->lock);
+    free(stats);
+}
+
+static void forwardBackwardStats_update(ForwardBackwardStats *stats, int64_t forwardDiagonals, int64_t forwardCells,
+                                        int64_t recomputedDiagonals, bool checkpointed, int64_t peakBytes,
+                                        PathPruning *pruning) {
+    if (stats == NULL) {
+        return;
+    }
+    pthread_mutex_lock(&stats->lock);
+    stats->forwardDiagonals += forwardDiagonals;
+    stats->forwardCells += forwardCells;
+    stats->recomputedDiagonals += recomputedDiagonals;
+    stats->checkpointedMatrices += checkpointed ? 1 : 0;
+    stats->peakBytes = peakBytes > stats->peakBytes ? peakBytes : stats->peakBytes;
+    stats->prunedCells += pruning->prunedCells;
+    stats->prunedPaths += pruning->prunedPaths;
+    stats->droppedMass += pruning->droppedMass;
+    stats->maxDroppedMass = pruning->maxDroppedMass > stats->maxDroppedMass ? pruning->maxDroppedMass
+                                                                            : stats->maxDroppedMass;
+    pthread_mutex_unlock(&stats->lock);
+}
+
+static int64_t dpMatrix_bytesPerPath(int64_t stateNumber, int64_t kmerLength) {
+    // path struct, its cells and kmer plus a share of the HDCell that holds it
+    return sizeof(Path) + sizeof(Path *) + stateNumber * sizeof(double) + (kmerLength + 1) + sizeof(HDCell);
+}
+
+static int64_t getSqrtCheckpointInterval(int64_t diagonalNumber) {
+    // the k that makes (2n / k + k), the checkpoints plus one recomputed segment, smallest
+    int64_t k = (int64_t) sqrt(2.0 * diagonalNumber);
+    return k < 3 ? 3 : k;
+}
+
+static int64_t getCheckpointInterval(Band *band, StateMachine *sM, PairwiseAlignmentParameters *p) {
+    /*
+     * Returns the number of diagonals between checkpoints, 0 means keep everything. If a memory ceiling is set and
+     * no interval is given, the interval is picked so that checkpoints plus one recomputed segment, about
+     * (2n / k + k) diagonals, is as small as it can be.
+     */
+    if (p->checkpointInterval > 0 || p->memoryCeiling <= 0) {
+        return p->checkpointInterval;
+    }
+    int64_t diagonalNumber = band->lXalY;
+    int64_t totalCells = 0;
+    for (int64_t i = 0; i <= diagonalNumber; i++) {
+        totalCells += diagonal_getWidth(band->diagonals[i]);
+    }
+    int64_t estimatedBytes = totalCells * dpMatrix_bytesPerPath(sM->stateNumber, sM->kmerLength);
+    if (estimatedBytes <= p->memoryCeiling) {
+        return 0;
+    }
+    int64_t k = getSqrtCheckpointInterval(diagonalNumber);
+    int64_t checkpointedBytes = (int64_t) (((2.0 * diagonalNumber) / k + k) *
+                                           ((double) estimatedBytes / (diagonalNumber + 1)));
+    if (checkpointedBytes > p->memoryCeiling) {
+        st_logInfo("getCheckpointInterval: checkpointed matrix (~%" PRIi64 " bytes) still over the memory ceiling "
+                   "(%" PRIi64 " bytes)\n", checkpointedBytes, p->memoryCeiling);
+    }
+    return k;
+}
+
+static int64_t dpMatrix_recomputeForwardDiagonals(StateMachine *sM, DpMatrix *forwardDpMatrix, Band *band,
+                                                  int64_t from, int64_t to, Sequence *sX, Sequence *sY,
+                                                  PairwiseAlignmentParameters *p) {
+    /*
+     * Makes sure the forward diagonals from..to are in the matrix. Missing diagonals are recomputed starting from
+     * the closest pair of diagonals below them, returns the number of diagonals recomputed.
+     */
+    int64_t top = to;
+    while (top >= from && dpMatrix_getDiagonal(forwardDpMatrix, top) != NULL) {
+        top--;
+    }
+    if (top < from) {
+        return 0;
+    }
+    int64_t bottom = top;
+    while (dpMatrix_getDiagonal(forwardDpMatrix, bottom - 1) == NULL) {
+        bottom--;
+        assert(bottom >= 2);
+    }
+    assert(dpMatrix_getDiagonal(forwardDpMatrix, bottom - 2) != NULL);
+    for (int64_t xay = bottom; xay <= top; xay++) {
+        dpDiagonal_zeroValues(dpMatrix_createDiagonal(forwardDpMatrix, band->diagonals[xay], sX));
+        diagonalCalculationForward(sM, xay, forwardDpMatrix, sX, sY);
+        // prune the same way as the first time around, the drops were already counted then
+        PathPruning uncounted = { 0, 0, 0.0, 0.0 };
+        dpMatrix_prunePaths(forwardDpMatrix, xay, p, &uncounted);
+    }
+    return top - bottom + 1;
+}
+
 /////////////////////////////////////////////////////////////////////////////////////////////////////////
 //  Banded alignment routine to calculate posterior match probs
 //  Test: Pass
@@ -1305,6 +1614,7 @@ void getPosteriorProbsWithBanding(StateMachine *sM,
 
     BandIterator *forwardBandIterator = bandIterator_construct(band);
     DpMatrix *forwardDpMatrix = dpMatrix_construct(diagonalNumber, sM->stateNumber, sM->kmerLength);
+    dpMatrix_setContiguousCells(forwardDpMatrix, p->contiguousCells);
 
     //Initialise forward matrix.
     dpDiagonal_initialiseValues(dpMatrix_createDiagonal(forwardDpMatrix, bandIterator_getNext(forwardBandIterator), sX),
@@ -1312,16 +1622,36 @@ void getPosteriorProbsWithBanding(StateMachine *sM,
 
     //Backward matrix.
     DpMatrix *backwardDpMatrix = dpMatrix_construct(diagonalNumber, sM->stateNumber, sM->kmerLength);
+    dpMatrix_setContiguousCells(backwardDpMatrix, p->contiguousCells);
 
     int64_t tracedBackTo = 0;
     int64_t totalPosteriorCalculations = 0;
 
+    //Checkpointing, and book keeping for the time/memory trade-off
+    int64_t checkpointInterval = getCheckpointInterval(band, sM, p);
+    int64_t forwardDiagonals = 1, forwardCells = 0, recomputedDiagonals = 0, peakPaths = 0;
+    PathPruning pruning = { 0, 0, 0.0, 0.0 };
+
     while (1) { //Loop that moves through the matrix forward
         Diagonal diagonal = bandIterator_getNext(forwardBandIterator);
 
         //Forward calculation
         dpDiagonal_zeroValues(dpMatrix_createDiagonal(forwardDpMatrix, diagonal, sX));
         diagonalCalculationForward(sM, diagonal_getXay(diagonal), forwardDpMatrix, sX, sY);
+        forwardCells += dpMatrix_getDiagonal(forwardDpMatrix, diagonal_getXay(diagonal))->totalPaths;
+        dpMatrix_prunePaths(forwardDpMatrix, diagonal_getXay(diagonal), p, &pruning);
+        forwardDiagonals++;
+
+        //Only keep the checkpoint diagonals, and the two the recursion needs
+        if (checkpointInterval > 0) {
+            int64_t d = diagonal_getXay(diagonal) - 2;
+            if (d > tracedBackTo + p->traceBackDiagonals + 1 && (d - tracedBackTo) % checkpointInterval > 1) {
+                dpMatrix_deleteDiagonal(forwardDpMatrix, d);
+            }
+        }
+        if (dpMatrix_getActivePathNumber(forwardDpMatrix) > peakPaths) {
+            peakPaths = dpMatrix_getActivePathNumber(forwardDpMatrix);
+        }
 
         //Condition true at the end of the matrix
         bool atEnd = diagonal_getXay(diagonal) == diagonalNumber;
@@ -1351,6 +1681,16 @@ void getPosteriorProbsWithBanding(StateMachine *sM,
             double totalProbability = LOG_ZERO;
             int64_t totalPosteriorCalculationsThisTraceback = 0;
             while (diagonal_getXay(diagonal2) > tracedBackTo) {
+                //Bring back any forward diagonals dropped between checkpoints
+                if (checkpointInterval > 0) {
+                    int64_t lowest = diagonal_getXay(diagonal2) - 2;
+                    recomputedDiagonals += dpMatrix_recomputeForwardDiagonals(
+                            sM, forwardDpMatrix, band, (lowest > tracedBackTo ? lowest : tracedBackTo),
+                            diagonal_getXay(diagonal2), sX, sY, p);
+                    int64_t livePaths = dpMatrix_getActivePathNumber(forwardDpMatrix) +
+                                        dpMatrix_getActivePathNumber(backwardDpMatrix);
+                    peakPaths = livePaths > peakPaths ? livePaths : peakPaths;
+                }
                 //Create the earlier diagonal
                 if (diagonal_getXay(diagonal2) > tracedBackTo + 2) {
                     DpDiagonal *j = dpMatrix_getDiagonal(forwardDpMatrix, diagonal_getXay(diagonal2) - 2);
@@ -1372,7 +1712,8 @@ void getPosteriorProbsWithBanding(StateMachine *sM,
                                 sM, diagonal_getXay(diagonal2),
                                 forwardDpMatrix, backwardDpMatrix, sX, sY
                         );
-                        if (totalPosteriorCalculationsThisTraceback != 1) {
+                        // pruned paths take their mass with them, so the totals drift when pruning
+                        if (totalPosteriorCalculationsThisTraceback != 1 && pruning.prunedPaths == 0) {
                             assert(totalProbability + 1.0 > newTotalProbability);
                             assert(newTotalProbability + 1.0 > newTotalProbability);
                         }
@@ -1412,6 +1753,8 @@ void getPosteriorProbsWithBanding(StateMachine *sM,
     assert(tracedBackTo == diagonalNumber);
     assert(dpMatrix_getActiveDiagonalNumber(backwardDpMatrix) == 0);
     assert(dpMatrix_getActiveDiagonalNumber(forwardDpMatrix) == 0);
+    forwardBackwardStats_update(p->stats, forwardDiagonals, forwardCells, recomputedDiagonals, checkpointInterval > 0,
+                                peakPaths * dpMatrix_bytesPerPath(sM->stateNumber, sM->kmerLength), &pruning);
     //Cleanup
     dpMatrix_destruct(forwardDpMatrix);
     dpMatrix_destruct(backwardDpMatrix);
@@ -1419,6 +1762,335 @@ void getPosteriorProbsWithBanding(StateMachine *sM,
     band_destruct(band);
 }
 
+/////////////////////////////////////////////////////////////////////////////////////////////////////////
+//  Banded Viterbi alignment
+//  Max-product version of the forward recursion with back pointers, there is no backward matrix and no
+//  posterior calculation. The diagonals are cut into segments of k, only the back pointers of one segment are
+//  kept at a time and only the two diagonals of scores below each segment are kept as its checkpoint. The
+//  traceback walks the last segment's pointers, then recomputes the segments before it from their checkpoints.
+/////////////////////////////////////////////////////////////////////////////////////////////////////////
+
+typedef struct _viterbiPointer {
+    int32_t path;       // path in the previous cell
+    int8_t neighbour;   // 0 lower (x - 1, y), 1 middle (x - 1, y - 1), 2 upper (x, y - 1), -1 no predecessor
+    int8_t state;       // state in the previous cell
+} ViterbiPointer;
+
+typedef struct _viterbiDiagonal {
+    Diagonal diagonal;
+    int64_t *pathOffsets;       // index of the first path of each cell
+    char **kmers;               // kmer of each path, they outlive the paths
+    ViterbiPointer *pointers;   // (pathOffset + path) * stateNumber + state
+    int64_t totalPaths;
+} ViterbiDiagonal;
+
+typedef struct _viterbiCellArgs {
+    HDCell *current;
+    HDCell *lower;
+    HDCell *middle;
+    HDCell *upper;
+    ViterbiPointer *pointers;   // pointers for the first path of the current cell
+    int64_t stateNumber;
+} ViterbiCellArgs;
+
+static ViterbiDiagonal *viterbiDiagonal_construct(DpDiagonal *dpDiagonal) {
+    // the dp diagonal has to be laid out contiguously, the paths are found from their cells by index arithmetic
+    assert(dpDiagonal->cellBuffer != NULL);
+    Diagonal diagonal = dpDiagonal->diagonal;
+    int64_t nCells = diagonal_getWidth(diagonal);
+    ViterbiDiagonal *viterbiDiagonal = st_malloc(sizeof(ViterbiDiagonal));
+    viterbiDiagonal->diagonal = diagonal;
+    viterbiDiagonal->totalPaths = dpDiagonal->totalPaths;
+    viterbiDiagonal->pathOffsets = st_malloc(sizeof(int64_t) * nCells);
+    viterbiDiagonal->kmers = st_malloc(sizeof(char *) * dpDiagonal->totalPaths);
+    viterbiDiagonal->pointers = st_malloc(sizeof(ViterbiPointer) * dpDiagonal->totalPaths * dpDiagonal->stateNumber);
+    for (int64_t c = 0; c < nCells; c++) {
+        HDCell *hdCell = dpDiagonal->cells[c];
+        int64_t offset = (hdCell->cells - dpDiagonal->cellBuffer) / dpDiagonal->stateNumber;
+        viterbiDiagonal->pathOffsets[c] = offset;
+        for (int64_t p = 0; p < hdCell->numberOfPaths; p++) {
+            viterbiDiagonal->kmers[offset + p] = hdCell_getPath(hdCell, p)->kmer;
+        }
+    }
+    for (int64_t i = 0; i < dpDiagonal->totalPaths * dpDiagonal->stateNumber; i++) {
+        viterbiDiagonal->pointers[i].path = 0;
+        viterbiDiagonal->pointers[i].neighbour = -1;
+        viterbiDiagonal->pointers[i].state = 0;
+    }
+    return viterbiDiagonal;
+}
+
+static void viterbiDiagonal_destruct(ViterbiDiagonal *viterbiDiagonal) {
+    free(viterbiDiagonal->pathOffsets);
+    free(viterbiDiagonal->kmers);
+    free(viterbiDiagonal->pointers);
+    free(viterbiDiagonal);
+}
+
+static int64_t viterbiDiagonal_bytes(ViterbiDiagonal *viterbiDiagonal, int64_t stateNumber) {
+    return sizeof(ViterbiDiagonal) + diagonal_getWidth(viterbiDiagonal->diagonal) * sizeof(int64_t) +
+           viterbiDiagonal->totalPaths * (sizeof(char *) + stateNumber * sizeof(ViterbiPointer));
+}
+
+static int64_t viterbiDiagonal_cellIndex(ViterbiDiagonal *viterbiDiagonal, int64_t xmy) {
+    assert(xmy >= viterbiDiagonal->diagonal.xmyL && xmy <= viterbiDiagonal->diagonal.xmyR);
+    return (xmy - viterbiDiagonal->diagonal.xmyL) / 2;
+}
+
+static inline bool hdCell_holdsCells(HDCell *hdCell, double *cells, int64_t stateNumber) {
+    return hdCell != NULL && cells >= hdCell->cells && cells < hdCell->cells + hdCell->numberOfPaths * stateNumber;
+}
+
+static void doTransitionViterbi(double *fromCells, double *toCells,
+                                int64_t from, int64_t to,
+                                double eP, double tP,
+                                void *extraArgs) {
+    double score = fromCells[from] + (eP + tP);
+    if (score <= toCells[to]) {
+        return;
+    }
+    toCells[to] = score;
+    ViterbiCellArgs *args = extraArgs;
+    assert(hdCell_holdsCells(args->current, toCells, args->stateNumber));
+    // the cells of a cell's paths are consecutive, so the path is the offset into them
+    HDCell *fromCell;
+    int8_t neighbour;
+    if (hdCell_holdsCells(args->lower, fromCells, args->stateNumber)) {
+        fromCell = args->lower;
+        neighbour = 0;
+    } else if (hdCell_holdsCells(args->upper, fromCells, args->stateNumber)) {
+        fromCell = args->upper;
+        neighbour = 2;
+    } else if (hdCell_holdsCells(args->middle, fromCells, args->stateNumber)) {
+        fromCell = args->middle;
+        neighbour = 1;
+    } else {
+        st_errAbort("doTransitionViterbi: didn't find the cell this transition came from\n");
+        return;
+    }
+    ViterbiPointer *pointer = &args->pointers[(toCells - args->current->cells) + to];
+    pointer->path = (int32_t) ((fromCells - fromCell->cells) / args->stateNumber);
+    pointer->neighbour = neighbour;
+    pointer->state = (int8_t) from;
+}
+
+static void diagonalCalculationViterbi(StateMachine *sM, int64_t xay, DpMatrix *dpMatrix,
+                                       ViterbiDiagonal *viterbiDiagonal, Sequence *sX, Sequence *sY) {
+    DpDiagonal *dpDiagonal = dpMatrix_getDiagonal(dpMatrix, xay);
+    DpDiagonal *dpDiagonalM1 = dpMatrix_getDiagonal(dpMatrix, xay - 1);
+    DpDiagonal *dpDiagonalM2 = dpMatrix_getDiagonal(dpMatrix, xay - 2);
+    Diagonal diagonal = dpDiagonal->diagonal;
+    int64_t xmy = diagonal_getMinXmy(diagonal);
+    ViterbiCellArgs args;
+    args.stateNumber = sM->stateNumber;
+
+    while (xmy <= diagonal_getMaxXmy(diagonal)) {
+        int64_t indexX = getXposition(sX, diagonal_getXay(diagonal), xmy) - 1;
+        int64_t indexY = getYposition(sY, diagonal_getXay(diagonal), xmy) - 1;
+
+        void* x = sX->get(sX->elements, indexX);
+        void* y = sY->get(sY->elements, indexY);
+
+        args.current = dpDiagonal_getCell(dpDiagonal, xmy);
+        args.lower = dpDiagonalM1 == NULL ? NULL : dpDiagonal_getCell(dpDiagonalM1, xmy - 1);
+        args.middle = dpDiagonalM2 == NULL ? NULL : dpDiagonal_getCell(dpDiagonalM2, xmy);
+        args.upper = dpDiagonalM1 == NULL ? NULL : dpDiagonal_getCell(dpDiagonalM1, xmy + 1);
+        args.pointers = viterbiDiagonal->pointers +
+                        viterbiDiagonal->pathOffsets[viterbiDiagonal_cellIndex(viterbiDiagonal, xmy)] * sM->stateNumber;
+
+        sM->cellCalculate(sM, args.current, args.lower, args.middle, args.upper, x, y, doTransitionViterbi, &args);
+        xmy += 2;
+    }
+}
+
+static bool viterbi_isCheckpoint(int64_t xay, int64_t segmentLength) {
+    // the first diagonal, and the two below the start of each segment, are needed to recompute the segments
+    return xay == 0 || (xay + 1) % segmentLength == 0 || (xay + 2) % segmentLength == 0;
+}
+
+static void viterbiSegment_clear(ViterbiDiagonal **segment, int64_t segmentLength, int64_t *segmentBytes) {
+    for (int64_t i = 0; i < segmentLength; i++) {
+        if (segment[i] != NULL) {
+            viterbiDiagonal_destruct(segment[i]);
+            segment[i] = NULL;
+        }
+    }
+    *segmentBytes = 0;
+}
+
+typedef struct _viterbiBookKeeping {
+    int64_t forwardDiagonals;
+    int64_t forwardCells;
+    int64_t recomputedDiagonals;
+    int64_t segmentBytes;   // back pointers of the live segment
+    int64_t peakBytes;      // live scores plus back pointers
+} ViterbiBookKeeping;
+
+static void viterbi_fillDiagonal(StateMachine *sM, DpMatrix *dpMatrix, Band *band, int64_t xay,
+                                 ViterbiDiagonal **segment, int64_t segmentLength, Sequence *sX, Sequence *sY,
+                                 ViterbiBookKeeping *book) {
+    DpDiagonal *dpDiagonal = dpMatrix_createDiagonal(dpMatrix, band->diagonals[xay], sX);
+    dpDiagonal_zeroValues(dpDiagonal);
+    ViterbiDiagonal *viterbiDiagonal = viterbiDiagonal_construct(dpDiagonal);
+    segment[xay % segmentLength] = viterbiDiagonal;
+    diagonalCalculationViterbi(sM, xay, dpMatrix, viterbiDiagonal, sX, sY);
+    book->segmentBytes += viterbiDiagonal_bytes(viterbiDiagonal, sM->stateNumber);
+    int64_t liveBytes = dpMatrix_getActivePathNumber(dpMatrix) * dpMatrix_bytesPerPath(sM->stateNumber, sM->kmerLength)
+                        + book->segmentBytes;
+    book->peakBytes = liveBytes > book->peakBytes ? liveBytes : book->peakBytes;
+}
+
+static void viterbi_recomputeSegment(StateMachine *sM, DpMatrix *dpMatrix, Band *band, int64_t segmentStart,
+                                     ViterbiDiagonal **segment, int64_t segmentLength, Sequence *sX, Sequence *sY,
+                                     ViterbiBookKeeping *book) {
+    /*
+     * Brings back the pointers of the diagonals segmentStart..segmentStart + segmentLength - 1 from the checkpoint
+     * below them. Scores above the segment aren't needed any more once the traceback is in it, they are dropped.
+     */
+    viterbiSegment_clear(segment, segmentLength, &book->segmentBytes);
+    for (int64_t xay = segmentStart; xay <= band->lXalY; xay++) {
+        if (xay > 0) {
+            dpMatrix_deleteDiagonal(dpMatrix, xay);
+        }
+    }
+    int64_t from = segmentStart;
+    if (segmentStart == 0) {
+        // the first diagonal is the initialised one, it has no predecessors
+        segment[0] = viterbiDiagonal_construct(dpMatrix_getDiagonal(dpMatrix, 0));
+        book->segmentBytes += viterbiDiagonal_bytes(segment[0], sM->stateNumber);
+        from = 1;
+    }
+    assert(segmentStart == 0 || dpMatrix_getDiagonal(dpMatrix, segmentStart - 1) != NULL);
+    assert(segmentStart == 0 || dpMatrix_getDiagonal(dpMatrix, segmentStart - 2) != NULL);
+    int64_t to = segmentStart + segmentLength - 1 < band->lXalY ? segmentStart + segmentLength - 1 : band->lXalY;
+    for (int64_t xay = from; xay <= to; xay++) {
+        viterbi_fillDiagonal(sM, dpMatrix, band, xay, segment, segmentLength, sX, sY, book);
+        if (xay - 2 >= segmentStart && xay - 2 > 0) {
+            dpMatrix_deleteDiagonal(dpMatrix, xay - 2);
+        }
+        book->recomputedDiagonals++;
+    }
+}
+
+double getViterbiPathWithBanding(StateMachine *sM,
+                                 stList *anchorPairs,
+                                 Sequence *sX, Sequence *sY,
+                                 PairwiseAlignmentParameters *p,
+                                 bool alignmentHasRaggedLeftEnd, bool alignmentHasRaggedRightEnd,
+                                 stList *alignedPairs) {
+    //Prerequisites
+    assert(p->diagonalExpansion >= 0);
+    assert(p->diagonalExpansion % 2 == 0);
+
+    int64_t diagonalNumber = sX->length + sY->length;
+    if (diagonalNumber == 0) { //Deal with trivial case
+        return 0.0;
+    }
+
+    Band *band = band_construct(anchorPairs, sX->length, sY->length, p->diagonalExpansion);
+    DpMatrix *dpMatrix = dpMatrix_construct(diagonalNumber, sM->stateNumber, sM->kmerLength);
+    // doTransitionViterbi finds the paths from their cells, that needs the cells in one buffer per diagonal
+    dpMatrix_setContiguousCells(dpMatrix, TRUE);
+
+    // the back pointers are kept for one segment at a time, by default about sqrt(2n) diagonals long
+    int64_t segmentLength = getCheckpointInterval(band, sM, p);
+    segmentLength = segmentLength > 0 ? (segmentLength < 3 ? 3 : segmentLength)
+                                      : getSqrtCheckpointInterval(diagonalNumber);
+    segmentLength = segmentLength > diagonalNumber + 1 ? diagonalNumber + 1 : segmentLength;
+    ViterbiDiagonal **segment = st_calloc(segmentLength, sizeof(ViterbiDiagonal *));
+    ViterbiBookKeeping book = { 1, 0, 0, 0, 0 };
+
+    //Initialise
+    DpDiagonal *dpDiagonal = dpMatrix_createDiagonal(dpMatrix, band->diagonals[0], sX);
+    dpDiagonal_initialiseValues(dpDiagonal, sM,
+                                alignmentHasRaggedLeftEnd ? sM->raggedStartStateProb : sM->startStateProb);
+    segment[0] = viterbiDiagonal_construct(dpDiagonal);
+    book.segmentBytes = viterbiDiagonal_bytes(segment[0], sM->stateNumber);
+
+    //Fill in the scores and pointers, only keeping the checkpoints and the diagonals needed for the recursion
+    for (int64_t xay = 1; xay <= diagonalNumber; xay++) {
+        if (xay % segmentLength == 0) {
+            viterbiSegment_clear(segment, segmentLength, &book.segmentBytes);
+        }
+        viterbi_fillDiagonal(sM, dpMatrix, band, xay, segment, segmentLength, sX, sY, &book);
+        book.forwardCells += dpMatrix_getDiagonal(dpMatrix, xay)->totalPaths;
+        book.forwardDiagonals++;
+        if (xay >= 2 && !viterbi_isCheckpoint(xay - 2, segmentLength)) {
+            dpMatrix_deleteDiagonal(dpMatrix, xay - 2);
+        }
+    }
+
+    //Pick the best end state
+    double (*endStateProb)(StateMachine *, int64_t) = alignmentHasRaggedRightEnd ? sM->raggedEndStateProb
+                                                                                 : sM->endStateProb;
+    int64_t xmy = sX->length - sY->length;
+    HDCell *endCell = dpDiagonal_getCell(dpMatrix_getDiagonal(dpMatrix, diagonalNumber), xmy);
+    assert(endCell != NULL);
+    double score = LOG_ZERO;
+    int64_t path = 0, state = 0;
+    for (int64_t q = 0; q < endCell->numberOfPaths; q++) {
+        double *cells = hdCell_getPathCells(endCell, q, sM->stateNumber);
+        for (int64_t s = 0; s < sM->stateNumber; s++) {
+            double endScore = cells[s] + endStateProb(sM, s);
+            if (endScore > score) {
+                score = endScore;
+                path = q;
+                state = s;
+            }
+        }
+    }
+
+    //Walk back along the pointers, collecting the matches
+    stList *pathPairs = stList_construct();
+    int64_t xay = diagonalNumber;
+    int64_t segmentStart = (diagonalNumber / segmentLength) * segmentLength;
+    while (score != LOG_ZERO) {
+        while (xay < segmentStart) {
+            segmentStart -= segmentLength;
+            viterbi_recomputeSegment(sM, dpMatrix, band, segmentStart, segment, segmentLength, sX, sY, &book);
+        }
+        ViterbiDiagonal *viterbiDiagonal = segment[xay % segmentLength];
+        assert(viterbiDiagonal != NULL && diagonal_getXay(viterbiDiagonal->diagonal) == xay);
+        int64_t offset = viterbiDiagonal->pathOffsets[viterbiDiagonal_cellIndex(viterbiDiagonal, xmy)] + path;
+        int64_t x = diagonal_getXCoordinate(xay, xmy);
+        int64_t y = diagonal_getYCoordinate(xay, xmy);
+        if (state == sM->matchState && x > 0 && y > 0) {
+            stList_append(pathPairs, stIntTuple_construct4(PAIR_ALIGNMENT_PROB_1, x - 1, y - 1,
+                                                           (int64_t) viterbiDiagonal->kmers[offset]));
+        }
+        ViterbiPointer pointer = viterbiDiagonal->pointers[offset * sM->stateNumber + state];
+        if (pointer.neighbour == -1) {
+            assert(xay == 0);
+            break;
+        }
+        xay -= pointer.neighbour == 1 ? 2 : 1;
+        xmy += pointer.neighbour == 0 ? -1 : (pointer.neighbour == 2 ? 1 : 0);
+        path = pointer.path;
+        state = pointer.state;
+    }
+    // the walk back found the matches from the end, put them in increasing order
+    stList_reverse(pathPairs);
+    for (int64_t i = 0; i < stList_length(pathPairs); i++) {
+        stList_append(alignedPairs, stList_get(pathPairs, i));
+    }
+    stList_destruct(pathPairs);
+
+    PathPruning noPruning = { 0, 0, 0.0, 0.0 };
+    forwardBackwardStats_update(p->stats, book.forwardDiagonals, book.forwardCells, book.recomputedDiagonals,
+                                diagonalNumber >= segmentLength, book.peakBytes, &noPruning);
+
+    //Cleanup
+    viterbiSegment_clear(segment, segmentLength, &book.segmentBytes);
+    free(segment);
+    for (int64_t i = 0; i <= diagonalNumber; i++) {
+        dpMatrix_deleteDiagonal(dpMatrix, i);
+    }
+    assert(dpMatrix_getActiveDiagonalNumber(dpMatrix) == 0);
+    dpMatrix_destruct(dpMatrix);
+    band_destruct(band);
+    return score;
+}
+
 /////////////////////////////////////////////////////////////////////////////////////////////////////////
 //  Blast anchoring functions
 //  Use lastz to get sets of anchors
@@ -1770,14 +2442,34 @@ static void convertAlignedPairs(stList *alignedPairs2, int64_t offsetX, int64_t
     }
 }
 
-void getPosteriorProbsWithBandingSplittingAlignmentsByLargeGaps(
-        StateMachine *sM, stList *anchorPairs, Sequence *SsX, Sequence *SsY,
-        PairwiseAlignmentParameters *p,
-        bool alignmentHasRaggedLeftEnd, bool alignmentHasRaggedRightEnd,
-        void (*diagonalPosteriorProbFn)(StateMachine *, int64_t, DpMatrix *,
-                                        DpMatrix *, Sequence*, Sequence*, double,
-                                        PairwiseAlignmentParameters *, void *),
-        void (*coordinateCorrectionFn)(), void *extraArgs) {
+typedef struct _splitAlignmentBlock {
+    Sequence *sX;
+    Sequence *sY;
+    stList *anchorPairs;
+    int64_t offsetX;
+    int64_t offsetY;
+    bool alignmentHasRaggedLeftEnd;
+    bool alignmentHasRaggedRightEnd;
+    stList *alignedPairs;
+} SplitAlignmentBlock;
+
+static void splitAlignmentBlock_destruct(SplitAlignmentBlock *block) {
+    stList_destruct(block->anchorPairs);
+    sequence_destruct(block->sX);
+    sequence_destruct(block->sY);
+    if (block->alignedPairs != NULL) {
+        stList_destruct(block->alignedPairs);
+    }
+    free(block);
+}
+
+static stList *getSplitAlignmentBlocks(stList *anchorPairs, Sequence *SsX, Sequence *SsY,
+                                       PairwiseAlignmentParameters *p,
+                                       bool alignmentHasRaggedLeftEnd, bool alignmentHasRaggedRightEnd) {
+    /*
+     * Cuts the sequences into the sub-problems between large gaps in the anchors, each block has its own slice of
+     * the sequences and its own anchors (in block coordinates). Blocks are returned in order along the diagonal.
+     */
     // you are going to cut the sequences into subSequences anyways, so not having the correct
     // number of elements in length, ie having it reflect the number of nucleotides might be ok?
     int64_t lX = SsX->length; // so here you want the total number of elements
@@ -1787,9 +2479,9 @@ void getPosteriorProbsWithBandingSplittingAlignmentsByLargeGaps(
                                          p->splitMatrixBiggerThanThis,
                                          alignmentHasRaggedLeftEnd,
                                          alignmentHasRaggedRightEnd);
+    stList *blocks = stList_construct3(0, (void (*)(void *)) splitAlignmentBlock_destruct);
     int64_t j = 0;
 
-    //Now to the actual alignments
     for (int64_t i = 0; i < stList_length(splitPoints); i++) {
         stIntTuple *subRegion = stList_get(splitPoints, i);
         int64_t x1 = stIntTuple_get(subRegion, 0);
@@ -1797,10 +2489,16 @@ void getPosteriorProbsWithBandingSplittingAlignmentsByLargeGaps(
         int64_t x2 = stIntTuple_get(subRegion, 2);
         int64_t y2 = stIntTuple_get(subRegion, 3);
 
-        Sequence *sX3 = SsX->sliceFcn(SsX, x1, x2 - x1);
-        Sequence *sY3 = SsY->sliceFcn(SsY, y1, y2 - y1);
+        SplitAlignmentBlock *block = st_malloc(sizeof(SplitAlignmentBlock));
+        block->sX = SsX->sliceFcn(SsX, x1, x2 - x1);
+        block->sY = SsY->sliceFcn(SsY, y1, y2 - y1);
+        block->offsetX = x1;
+        block->offsetY = y1;
+        block->alignmentHasRaggedLeftEnd = alignmentHasRaggedLeftEnd || i > 0;
+        block->alignmentHasRaggedRightEnd = alignmentHasRaggedRightEnd || i < stList_length(splitPoints) - 1;
+        block->alignedPairs = NULL;
         //List of anchor pairs
-        stList *subListOfAnchorPoints = stList_construct3(0, (void (*)(void *)) stIntTuple_destruct);
+        block->anchorPairs = stList_construct3(0, (void (*)(void *)) stIntTuple_destruct);
 
         while (j < stList_length(anchorPairs)) {
             stIntTuple *anchorPair = stList_get(anchorPairs, j);
@@ -1813,27 +2511,235 @@ void getPosteriorProbsWithBandingSplittingAlignmentsByLargeGaps(
             }
             assert(x >= x1 && x < x2);
             assert(y >= y1 && y < y2);
-            stList_append(subListOfAnchorPoints, stIntTuple_construct2(x - x1, y - y1));
+            stList_append(block->anchorPairs, stIntTuple_construct2(x - x1, y - y1));
             j++;
         }
+        stList_append(blocks, block);
+    }
+    assert(j == stList_length(anchorPairs));
+    stList_destruct(splitPoints);
+    return blocks;
+}
+
+void getPosteriorProbsWithBandingSplittingAlignmentsByLargeGaps(
+        StateMachine *sM, stList *anchorPairs, Sequence *SsX, Sequence *SsY,
+        PairwiseAlignmentParameters *p,
+        bool alignmentHasRaggedLeftEnd, bool alignmentHasRaggedRightEnd,
+        void (*diagonalPosteriorProbFn)(StateMachine *, int64_t, DpMatrix *,
+                                        DpMatrix *, Sequence*, Sequence*, double,
+                                        PairwiseAlignmentParameters *, void *),
+        void (*coordinateCorrectionFn)(), void *extraArgs) {
+    stList *blocks = getSplitAlignmentBlocks(anchorPairs, SsX, SsY, p,
+                                             alignmentHasRaggedLeftEnd, alignmentHasRaggedRightEnd);
+
+    //Now to the actual alignments
+    for (int64_t i = 0; i < stList_length(blocks); i++) {
+        SplitAlignmentBlock *block = stList_get(blocks, i);
 
         //Make the alignments
-        getPosteriorProbsWithBanding(sM, subListOfAnchorPoints, sX3, sY3, p,
-                                     (alignmentHasRaggedLeftEnd || i > 0),
-                                     (alignmentHasRaggedRightEnd || i < stList_length(splitPoints) - 1),
+        getPosteriorProbsWithBanding(sM, block->anchorPairs, block->sX, block->sY, p,
+                                     block->alignmentHasRaggedLeftEnd, block->alignmentHasRaggedRightEnd,
                                      diagonalPosteriorProbFn, extraArgs);
 
         if (coordinateCorrectionFn != NULL) {
-            coordinateCorrectionFn(x1, y1, extraArgs);
+            coordinateCorrectionFn(block->offsetX, block->offsetY, extraArgs);
+        }
+    }
+    //Clean up
+    stList_destruct(blocks);
+}
+
+/////////////////////////////////////////////////////////////////////////////////////////////////////////
+//Adaptive banding
+//Blocks are first aligned in a narrow band, if too much of the posterior mass ends up at the edges of the band
+//the alignment was probably held in by the band, so the block is aligned again with a wider one.
+/////////////////////////////////////////////////////////////////////////////////////////////////////////
+
+static int64_t bandEdgeZone(int64_t diagonalExpansion) {
+    // the width (in x-y units) at each side of the band counted as being at the edge
+    int64_t zone = diagonalExpansion / 5;
+    return zone < 2 ? 2 : zone;
+}
+
+double getBandEdgePosteriorMass(stList *alignedPairs, stList *anchorPairs, int64_t lX, int64_t lY,
+                                int64_t diagonalExpansion) {
+    /*
+     * Returns the fraction of the posterior mass in alignedPairs (block coordinates) that lies close to an edge of
+     * the band. Edges that are the edges of the matrix don't constrain the alignment, so they aren't counted.
+     */
+    Band *band = band_construct(anchorPairs, lX, lY, diagonalExpansion);
+    int64_t zone = bandEdgeZone(diagonalExpansion);
+    double totalMass = 0.0, edgeMass = 0.0;
+    for (int64_t i = 0; i < stList_length(alignedPairs); i++) {
+        stIntTuple *alignedPair = stList_get(alignedPairs, i);
+        double prob = (double) stIntTuple_get(alignedPair, 0) / PAIR_ALIGNMENT_PROB_1;
+        int64_t x = stIntTuple_get(alignedPair, 1) + 1; // matrix coordinates are +1 the sequence ones
+        int64_t y = stIntTuple_get(alignedPair, 2) + 1;
+        int64_t xay = x + y, xmy = x - y;
+        assert(xay <= band->lXalY);
+        Diagonal diagonal = band->diagonals[xay];
+        int64_t matrixMinXmy = -xay > xay - 2 * lY ? -xay : xay - 2 * lY;
+        int64_t matrixMaxXmy = xay < 2 * lX - xay ? xay : 2 * lX - xay;
+        bool atLeftEdge = diagonal_getMinXmy(diagonal) > matrixMinXmy && xmy - diagonal_getMinXmy(diagonal) < zone;
+        bool atRightEdge = diagonal_getMaxXmy(diagonal) < matrixMaxXmy && diagonal_getMaxXmy(diagonal) - xmy < zone;
+        totalMass += prob;
+        if (atLeftEdge || atRightEdge) {
+            edgeMass += prob;
         }
+    }
+    band_destruct(band);
+    return totalMass > 0.0 ? edgeMass / totalMass : 0.0;
+}
 
-        //Clean up
-        stList_destruct(subListOfAnchorPoints);
-        sequence_destruct(sX3);
-        sequence_destruct(sY3);
+#define MAX_BAND_RETRIES 8 // doublings from the smallest expansion of 2 reach 512
+
+static void getPosteriorProbsWithAdaptiveBanding(StateMachine *sM, SplitAlignmentBlock *block,
+                                                 PairwiseAlignmentParameters *p,
+                                                 void (*diagonalPosteriorProbFn)(StateMachine *, int64_t, DpMatrix *,
+                                                                                 DpMatrix *, Sequence*, Sequence*,
+                                                                                 double,
+                                                                                 PairwiseAlignmentParameters *,
+                                                                                 void *)) {
+    /*
+     * Aligns the block starting with p->diagonalExpansion, doubling the expansion (at least to 2, and up to
+     * p->maxDiagonalExpansion) while more than p->bandEdgeThreshold of the posterior mass is at the band edges, at
+     * most MAX_BAND_RETRIES times. The pairs from the last attempt are left in block->alignedPairs.
+     */
+    PairwiseAlignmentParameters blockP = *p;
+    int64_t retries = 0;
+    while (1) {
+        void *blockArgs[1] = { block->alignedPairs };
+        getPosteriorProbsWithBanding(sM, block->anchorPairs, block->sX, block->sY, &blockP,
+                                     block->alignmentHasRaggedLeftEnd, block->alignmentHasRaggedRightEnd,
+                                     diagonalPosteriorProbFn, blockArgs);
+        if (blockP.diagonalExpansion >= p->maxDiagonalExpansion || retries >= MAX_BAND_RETRIES) {
+            break;
+        }
+        double edgeMass = getBandEdgePosteriorMass(block->alignedPairs, block->anchorPairs, block->sX->length,
+                                                   block->sY->length, blockP.diagonalExpansion);
+        if (edgeMass <= p->bandEdgeThreshold) {
+            break;
+        }
+        // an expansion of 0 would stay 0 doubled
+        int64_t expansion = blockP.diagonalExpansion > 1 ? 2 * blockP.diagonalExpansion : 2;
+        expansion = expansion > p->maxDiagonalExpansion ? p->maxDiagonalExpansion : expansion;
+        st_logDebug("Band limited block (%f of the posterior mass at the edges), widening the expansion from %"
+                    PRIi64 " to %" PRIi64 "\n", edgeMass, blockP.diagonalExpansion, expansion);
+        blockP.diagonalExpansion = expansion + expansion % 2; // has to be even
+        retries++;
+        while (stList_length(block->alignedPairs) > 0) {
+            stIntTuple_destruct(stList_pop(block->alignedPairs));
+        }
     }
-    assert(j == stList_length(anchorPairs));
-    stList_destruct(splitPoints);
+    if (p->stats != NULL) {
+        pthread_mutex_lock(&p->stats->lock);
+        p->stats->bandedBlocks++;
+        p->stats->bandRetries += retries;
+        p->stats->widenedBlocks += retries > 0 ? 1 : 0;
+        if (blockP.diagonalExpansion > p->stats->widestDiagonalExpansion) {
+            p->stats->widestDiagonalExpansion = blockP.diagonalExpansion;
+        }
+        pthread_mutex_unlock(&p->stats->lock);
+    }
+}
+
+typedef struct _splitAlignmentPool {
+    StateMachine *sM;
+    PairwiseAlignmentParameters *p;
+    void (*diagonalPosteriorProbFn)(StateMachine *, int64_t, DpMatrix *,
+                                    DpMatrix *, Sequence*, Sequence*, double,
+                                    PairwiseAlignmentParameters *, void *);
+    stList *blocks;
+    int64_t nextBlock;
+    pthread_mutex_t lock;
+} SplitAlignmentPool;
+
+static void *splitAlignmentPool_worker(void *arg) {
+    SplitAlignmentPool *pool = arg;
+    while (1) {
+        pthread_mutex_lock(&pool->lock);
+        int64_t i = pool->nextBlock++;
+        pthread_mutex_unlock(&pool->lock);
+        if (i >= stList_length(pool->blocks)) {
+            break;
+        }
+        SplitAlignmentBlock *block = stList_get(pool->blocks, i);
+        if (pool->p->maxDiagonalExpansion > pool->p->diagonalExpansion) {
+            getPosteriorProbsWithAdaptiveBanding(pool->sM, block, pool->p, pool->diagonalPosteriorProbFn);
+        } else {
+            void *blockArgs[1] = { block->alignedPairs };
+            getPosteriorProbsWithBanding(pool->sM, block->anchorPairs, block->sX, block->sY, pool->p,
+                                         block->alignmentHasRaggedLeftEnd, block->alignmentHasRaggedRightEnd,
+                                         pool->diagonalPosteriorProbFn, blockArgs);
+        }
+    }
+    return NULL;
+}
+
+void getPosteriorProbsWithBandingSplittingAlignmentsByLargeGapsMultithreaded(
+        StateMachine *sM, stList *anchorPairs, Sequence *SsX, Sequence *SsY,
+        PairwiseAlignmentParameters *p,
+        bool alignmentHasRaggedLeftEnd, bool alignmentHasRaggedRightEnd,
+        void (*diagonalPosteriorProbFn)(StateMachine *, int64_t, DpMatrix *,
+                                        DpMatrix *, Sequence*, Sequence*, double,
+                                        PairwiseAlignmentParameters *, void *),
+        void (*coordinateCorrectionFn)(), void *extraArgs) {
+    /*
+     * Same as above, but the blocks are aligned on a pool of p->threads workers. The diagonalPosteriorProbFn must
+     * only append aligned pairs to ((void **)extraArgs)[0] (as diagonalCalculationPosteriorMatchProbs does), each
+     * block gets its own list. Once all of the blocks are done the pairs are handed back in block order and the
+     * coordinateCorrectionFn is called exactly as in the single threaded version, so the output is the same.
+     */
+    stList *blocks = getSplitAlignmentBlocks(anchorPairs, SsX, SsY, p,
+                                             alignmentHasRaggedLeftEnd, alignmentHasRaggedRightEnd);
+    for (int64_t i = 0; i < stList_length(blocks); i++) {
+        SplitAlignmentBlock *block = stList_get(blocks, i);
+        block->alignedPairs = stList_construct3(0, (void (*)(void *)) stIntTuple_destruct);
+    }
+
+    SplitAlignmentPool pool;
+    pool.sM = sM;
+    pool.p = p;
+    pool.diagonalPosteriorProbFn = diagonalPosteriorProbFn;
+    pool.blocks = blocks;
+    pool.nextBlock = 0;
+    pthread_mutex_init(&pool.lock, NULL);
+
+    int64_t nbThreads = p->threads < stList_length(blocks) ? p->threads : stList_length(blocks);
+    if (nbThreads < 1) {
+        nbThreads = 1;
+    }
+    pthread_t *workers = st_malloc(sizeof(pthread_t) * nbThreads);
+    int64_t nbStarted = 0;
+    for (int64_t t = 0; t < nbThreads && nbThreads > 1; t++) {
+        if (pthread_create(&workers[t], NULL, splitAlignmentPool_worker, &pool) != 0) {
+            st_logInfo("Could only start %" PRIi64 " alignment threads\n", nbStarted);
+            break;
+        }
+        nbStarted++;
+    }
+    if (nbStarted == 0) {
+        splitAlignmentPool_worker(&pool); // one thread, or fall back to doing the work here
+    }
+    for (int64_t t = 0; t < nbStarted; t++) {
+        pthread_join(workers[t], NULL);
+    }
+    pthread_mutex_destroy(&pool.lock);
+    free(workers);
+
+    //Merge the blocks in order
+    stList *subListOfAlignedPairs = ((void **) extraArgs)[0];
+    for (int64_t i = 0; i < stList_length(blocks); i++) {
+        SplitAlignmentBlock *block = stList_get(blocks, i);
+        for (int64_t k = 0; k < stList_length(block->alignedPairs); k++) {
+            stList_append(subListOfAlignedPairs, stList_get(block->alignedPairs, k));
+        }
+        stList_setDestructor(block->alignedPairs, NULL);
+        if (coordinateCorrectionFn != NULL) {
+            coordinateCorrectionFn(block->offsetX, block->offsetY, extraArgs);
+        }
+    }
+    stList_destruct(blocks);
 }
 
 /////////////////////////////////////////////////////////////////////////////////////////////////////////
@@ -1852,6 +2758,15 @@ PairwiseAlignmentParameters *pairwiseAlignmentBandingParameters_construct() {
     p->splitMatrixBiggerThanThis = (int64_t) 3000 * 3000;
     p->alignAmbiguityCharacters = 0;
     p->gapGamma = 0.5;
+    p->threads = 1;
+    p->checkpointInterval = 0;
+    p->memoryCeiling = 0;
+    p->stats = NULL;
+    p->maxDiagonalExpansion = 0;
+    p->bandEdgeThreshold = 0.05;
+    p->pathPruneThreshold = 0.0;
+    p->pathBeamWidth = 0;
+    p->contiguousCells = FALSE;
     return p;
 }
 
@@ -1883,14 +2798,26 @@ stList *getAlignedPairsUsingAnchors(StateMachine *sM,
     stList *alignedPairs = stList_construct3(0, (void (*)(void *)) stIntTuple_destruct);
     void *extraArgs[2] = { subListOfAlignedPairs, alignedPairs };
 
-    getPosteriorProbsWithBandingSplittingAlignmentsByLargeGaps(sM, anchorPairs,
-                                                               SsX, SsY,
-                                                               p,
-                                                               alignmentHasRaggedLeftEnd,
-                                                               alignmentHasRaggedRightEnd,
-                                                               diagonalPosteriorProbFn,
-                                                               alignedPairCoordinateCorrectionFn,
-                                                               extraArgs);
+    // adaptive banding needs the pairs of each block on their own, which the multithreaded version gives us
+    if (p->threads > 1 || p->maxDiagonalExpansion > p->diagonalExpansion) {
+        getPosteriorProbsWithBandingSplittingAlignmentsByLargeGapsMultithreaded(sM, anchorPairs,
+                                                                                SsX, SsY,
+                                                                                p,
+                                                                                alignmentHasRaggedLeftEnd,
+                                                                                alignmentHasRaggedRightEnd,
+                                                                                diagonalPosteriorProbFn,
+                                                                                alignedPairCoordinateCorrectionFn,
+                                                                                extraArgs);
+    } else {
+        getPosteriorProbsWithBandingSplittingAlignmentsByLargeGaps(sM, anchorPairs,
+                                                                   SsX, SsY,
+                                                                   p,
+                                                                   alignmentHasRaggedLeftEnd,
+                                                                   alignmentHasRaggedRightEnd,
+                                                                   diagonalPosteriorProbFn,
+                                                                   alignedPairCoordinateCorrectionFn,
+                                                                   extraArgs);
+    }
 
     assert(stList_length(subListOfAlignedPairs) == 0);
     stList_destruct(subListOfAlignedPairs);
@@ -1898,6 +2825,33 @@ stList *getAlignedPairsUsingAnchors(StateMachine *sM,
     return alignedPairs;
 }
 
+stList *getViterbiAlignedPairsUsingAnchors(StateMachine *sM,
+                                           Sequence *SsX, Sequence *SsY,
+                                           stList *anchorPairs,
+                                           PairwiseAlignmentParameters *p,
+                                           bool alignmentHasRaggedLeftEnd,
+                                           bool alignmentHasRaggedRightEnd,
+                                           double *score) {
+    // Aligned pairs along the single best path through each block, all with probability 1. The log probability of
+    // the path (summed over the blocks) is put into score.
+    stList *alignedPairs = stList_construct3(0, (void (*)(void *)) stIntTuple_destruct);
+    stList *blocks = getSplitAlignmentBlocks(anchorPairs, SsX, SsY, p,
+                                             alignmentHasRaggedLeftEnd, alignmentHasRaggedRightEnd);
+    *score = 0.0;
+    for (int64_t i = 0; i < stList_length(blocks); i++) {
+        SplitAlignmentBlock *block = stList_get(blocks, i);
+        stList *subListOfAlignedPairs = stList_construct();
+        *score += getViterbiPathWithBanding(sM, block->anchorPairs, block->sX, block->sY, p,
+                                            block->alignmentHasRaggedLeftEnd, block->alignmentHasRaggedRightEnd,
+                                            subListOfAlignedPairs);
+        convertAlignedPairs(subListOfAlignedPairs, block->offsetX, block->offsetY);
+        stList_appendAll(alignedPairs, subListOfAlignedPairs);
+        stList_destruct(subListOfAlignedPairs);
+    }
+    stList_destruct(blocks);
+    return alignedPairs;
+}
+
 stList *getAlignedPairs(StateMachine *sM, void *cX, void *cY, int64_t lX, int64_t lY,
                         PairwiseAlignmentParameters *p,
                         void *(*getXFcn)(void *, int64_t),
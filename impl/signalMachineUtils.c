@@ -1,4 +1,5 @@
 #include <stdio.h>
+#include <sys/time.h>
 #include "signalMachineUtils.h"
 
 #define REPORT_ADJUSTMENTS FALSE
@@ -45,10 +46,19 @@ static inline struct PairwiseAlignment *referenceSequence_copyPairwiseAlignment(
 }
 
 static inline void referenceSequence_setTrimmedSeqeuences(ReferenceSequence *self) {
-    self->trimmedForwardSequence = signalUtils_getSubSequence(self->reference, self->A->start1,
-                                                              self->A->end1, self->A->strand1);
+    // the reference files may only hold a window of the contig starting at referenceOffset, the guide alignment
+    // is still in contig coordinates
+    int64_t start = self->A->start1 - self->referenceOffset;
+    int64_t end = self->A->end1 - self->referenceOffset;
+    if ((start < 0) || (end < 0) || (start > (int64_t) strlen(self->reference)) ||
+        (end > (int64_t) strlen(self->reference))) {
+        st_errAbort("Guide alignment %" PRIi64 "-%" PRIi64 " isn't inside the reference window starting at %" PRIi64
+                    " (length %" PRIi64 ")", self->A->start1, self->A->end1, self->referenceOffset,
+                    (int64_t) strlen(self->reference));
+    }
+    self->trimmedForwardSequence = signalUtils_getSubSequence(self->reference, start, end, self->A->strand1);
     self->trimmedBackwardSequence = signalUtils_stringReverse(signalUtils_getSubSequence(self->complementOfReference,
-                                                                                         self->A->start1, self->A->end1,
+                                                                                         start, end,
                                                                                          self->A->strand1));
 
 }
@@ -71,10 +81,18 @@ char *referenceSequence_getComplementTarget(ReferenceSequence *self) {
 
 ReferenceSequence *signalUtils_ReferenceSequenceConstructFull(char *forwardReferencePath, char *backwardReferencePath,
                                                               struct PairwiseAlignment *pA) {
+    return signalUtils_ReferenceSequenceConstructWindow(forwardReferencePath, backwardReferencePath, pA, 0);
+}
+
+ReferenceSequence *signalUtils_ReferenceSequenceConstructWindow(char *forwardReferencePath,
+                                                                char *backwardReferencePath,
+                                                                struct PairwiseAlignment *pA,
+                                                                int64_t referenceOffset) {
     ReferenceSequence *R = st_malloc(sizeof(ReferenceSequence));
     referenceSequence_loadReference(R, forwardReferencePath, backwardReferencePath);
 
     R->A = referenceSequence_copyPairwiseAlignment(pA);
+    R->referenceOffset = referenceOffset;
 
     referenceSequence_setTrimmedSeqeuences(R);
 
@@ -89,6 +107,7 @@ ReferenceSequence *signalUtils_ReferenceSequenceConstructFull(char *forwardRefer
 ReferenceSequence *signalUtils_ReferenceSequenceConstructEmpty(struct PairwiseAlignment *pA) {
     ReferenceSequence *R = st_malloc(sizeof(ReferenceSequence));
     R->A = referenceSequence_copyPairwiseAlignment(pA);
+    R->referenceOffset = 0;
 
     R->reference = NULL;
     R->complementOfReference = NULL;
@@ -207,6 +226,14 @@ void signalUtils_estimateNanoporeParams(StateMachine *sM, NanoporeRead *npRead,
         st_uglyf("SENTINEL - After: scale_sd: %f var_sd: %f\n", params->scale_sd, params->var_sd);
     }
 
+    signalUtils_applyNanoporeParams(sM, npRead, params, driftAdjustmentFunction);
+
+    stList_destruct(map);
+    return;
+}
+
+void signalUtils_applyNanoporeParams(StateMachine *sM, NanoporeRead *npRead, NanoporeReadAdjustmentParameters *params,
+                                     void (*driftAdjustmentFunction)(NanoporeRead *)) {
     sM->scale = params->scale;
     sM->shift = params->shift;
     sM->var = params->var;
@@ -217,9 +244,6 @@ void signalUtils_estimateNanoporeParams(StateMachine *sM, NanoporeRead *npRead,
 
     driftAdjustmentFunction(npRead);
     emissions_signal_scaleNoise(sM, *params);
-
-    stList_destruct(map);
-    return;
 }
 
 void signalUtils_estimateNanoporeParamsFromTable(const char *modelPath,
@@ -236,3 +260,200 @@ void signalUtils_estimateNanoporeParamsFromTable(const char *modelPath,
     stateMachine_destruct(sM);
     return;
 }
+
+StateMachine *signalUtils_buildStateMachine(const char *modelFile, NanoporeReadAdjustmentParameters npp,
+                                            StateMachineType type, NanoporeHDP *nHdp) {
+    if ((type != threeState) && (type != threeStateHdp)) {
+        st_errAbort("signalAlign - incompatible stateMachine type request");
+    }
+    if (!stFile_exists(modelFile)) {
+        st_errAbort("signalAlign - ERROR: couldn't find model file here: %s\n", modelFile);
+    }
+
+    if (type == threeState) {
+        StateMachine *sM = getStateMachine3_descaled(modelFile, npp, !ESTIMATE_PARAMS);
+        return sM;
+    }
+    if (type == threeStateHdp) {
+        StateMachine *sM = getHdpStateMachine(nHdp, modelFile, npp);
+        return sM;
+    }
+    else {
+        st_errAbort("signalAlign - ERROR: buildStateMachine, didn't get correct input\n");
+    }
+    return 0;
+}
+
+static double totalScore(stList *alignedPairs) {
+    double score = 0.0;
+    for (int64_t i = 0; i < stList_length(alignedPairs); i++) {
+        stIntTuple *aPair = stList_get(alignedPairs, i);
+        score += stIntTuple_get(aPair, 0);
+    }
+    return score;
+}
+
+double signalUtils_scoreByPosteriorProbabilityIgnoringGaps(stList *alignedPairs) {
+    /*
+     * Gives the average posterior match probability per base of the two sequences, ignoring indels.
+     */
+    return 100.0 * totalScore(alignedPairs) / ((double) stList_length(alignedPairs) * PAIR_ALIGNMENT_PROB_1);
+}
+
+stList *signalUtils_performSignalAlignment(StateMachine *sM, Sequence *eventSequence, int64_t *eventMap,
+                                           int64_t mapOffset, char *target, PairwiseAlignmentParameters *p,
+                                           stList *unmappedAnchors, DegenerateType degenerate) {
+    if ((sM->type != threeState) && (sM->type != threeStateHdp)) {
+        st_errAbort("signalAlign - You're trying to do the wrong king of alignment");
+    }
+
+    int64_t lX = sequence_correctSeqLength(strlen(target), kmer, sM->kmerLength);
+
+    // remap anchor pairs
+    stList *filteredRemappedAnchors = signalUtils_getRemappedAnchorPairs(unmappedAnchors, eventMap, mapOffset);
+
+    // make sequences
+    Sequence *sX = sequence_constructReferenceKmerSequence(lX, target, sequence_getKmer,
+                                                           sequence_sliceNucleotideSequence, degenerate, kmer);
+
+    // do alignment
+    stList *alignedPairs = getAlignedPairsUsingAnchors(sM, sX, eventSequence, filteredRemappedAnchors, p,
+                                                       diagonalCalculationPosteriorMatchProbs, 1, 1);
+
+    return alignedPairs;
+}
+
+stList *signalUtils_performViterbiSignalAlignment(StateMachine *sM, Sequence *eventSequence, int64_t *eventMap,
+                                                  int64_t mapOffset, char *target, PairwiseAlignmentParameters *p,
+                                                  stList *unmappedAnchors, DegenerateType degenerate, double *score) {
+    if ((sM->type != threeState) && (sM->type != threeStateHdp)) {
+        st_errAbort("signalAlign - You're trying to do the wrong king of alignment");
+    }
+
+    int64_t lX = sequence_correctSeqLength(strlen(target), kmer, sM->kmerLength);
+
+    // remap anchor pairs
+    stList *filteredRemappedAnchors = signalUtils_getRemappedAnchorPairs(unmappedAnchors, eventMap, mapOffset);
+
+    // make sequences
+    Sequence *sX = sequence_constructReferenceKmerSequence(lX, target, sequence_getKmer,
+                                                           sequence_sliceNucleotideSequence, degenerate, kmer);
+
+    // do alignment, best path only
+    stList *alignedPairs = getViterbiAlignedPairsUsingAnchors(sM, sX, eventSequence, filteredRemappedAnchors, p,
+                                                              1, 1, score);
+    stList_destruct(filteredRemappedAnchors);
+    sequence_destruct(sX);
+
+    return alignedPairs;
+}
+
+void *signalUtils_alignStrand(void *arg) {
+    // builds the stateMachine for one strand, re-estimates the read's parameters and aligns, only touches the
+    // fields of npRead that belong to this strand so the template and complement can be run at the same time
+    StrandAlignment *job = arg;
+    bool isTemplate = job->strand == template;
+    fprintf(stderr, "signalAlign - starting %s alignment\n", isTemplate ? "template" : "complement");
+    struct timeval start, end;
+    gettimeofday(&start, NULL);
+
+    job->sM = signalUtils_buildStateMachine(job->modelFile,
+                                            (isTemplate ? job->npRead->templateParams
+                                                        : job->npRead->complementParams),
+                                            job->sMtype, job->nHdp);
+
+    // re-estimate the nanoporeAdjustment parameters, unless the npRead already has estimated ones
+    if (ESTIMATE_PARAMS) {
+        if (isTemplate && job->estimateParams) {
+            signalUtils_estimateNanoporeParams(job->sM, job->npRead, &job->npRead->templateParams,
+                                               ASSIGNMENT_THRESHOLD,
+                                               signalUtils_templateOneDAssignmentsFromRead,
+                                               nanopore_adjustTemplateEventsForDrift);
+        } else if (isTemplate) {
+            signalUtils_applyNanoporeParams(job->sM, job->npRead, &job->npRead->templateParams,
+                                            nanopore_adjustTemplateEventsForDrift);
+        } else if (job->estimateParams) {
+            signalUtils_estimateNanoporeParams(job->sM, job->npRead, &job->npRead->complementParams,
+                                               ASSIGNMENT_THRESHOLD,
+                                               signalUtils_complementOneDAssignmentsFromRead,
+                                               nanopore_adjustComplementEventsForDrift);
+        } else {
+            signalUtils_applyNanoporeParams(job->sM, job->npRead, &job->npRead->complementParams,
+                                            nanopore_adjustComplementEventsForDrift);
+        }
+    }
+    if (job->sMtype == threeStateHdp) {
+        stateMachine3_setModelToHdpExpectedValues(job->sM, job->nHdp);
+    }
+
+    // each strand gets its own copy of the parameters so the forward-backward stats aren't mixed up
+    PairwiseAlignmentParameters p = *job->p;
+    p.stats = forwardBackwardStats_construct();
+
+    if (job->viterbi) {
+        // the score is the log probability of the best path
+        job->alignedPairs = signalUtils_performViterbiSignalAlignment(job->sM, job->eventSequence, job->eventMap,
+                                                                      job->mapOffset, job->target, &p,
+                                                                      job->anchorPairs, job->degenerate,
+                                                                      &job->posteriorScore);
+    } else {
+        job->alignedPairs = signalUtils_performSignalAlignment(job->sM, job->eventSequence, job->eventMap,
+                                                               job->mapOffset, job->target, &p, job->anchorPairs,
+                                                               job->degenerate);
+        job->posteriorScore = signalUtils_scoreByPosteriorProbabilityIgnoringGaps(job->alignedPairs);
+    }
+
+    // report the time/memory trade-off made by checkpointing for this read
+    gettimeofday(&end, NULL);
+    double seconds = (end.tv_sec - start.tv_sec) + (end.tv_usec - start.tv_usec) / 1000000.0;
+    fprintf(stderr, "signalAlign - %s alignment took %.2f seconds (%.0f forward cells/sec), peak dp matrix ~%.1f MB, "
+                    "%"PRId64" forward diagonals, %"PRId64" recomputed (%.1f%% extra) in %"PRId64" checkpointed "
+                    "matrices\n", isTemplate ? "template" : "complement", seconds,
+            seconds > 0 ? p.stats->forwardCells / seconds : 0.0,
+            p.stats->peakBytes / (1024.0 * 1024.0), p.stats->forwardDiagonals, p.stats->recomputedDiagonals,
+            p.stats->forwardDiagonals > 0 ? 100.0 * p.stats->recomputedDiagonals / p.stats->forwardDiagonals : 0.0,
+            p.stats->checkpointedMatrices);
+    if (p.pathPruneThreshold > 0.0 || p.pathBeamWidth > 0) {
+        fprintf(stderr, "signalAlign - %s path pruning: %"PRId64" paths dropped from %"PRId64" cells, "
+                        "mean dropped mass per cell %f, max %f\n", isTemplate ? "template" : "complement",
+                p.stats->prunedPaths, p.stats->prunedCells,
+                p.stats->prunedCells > 0 ? p.stats->droppedMass / p.stats->prunedCells : 0.0,
+                p.stats->maxDroppedMass);
+    }
+    if (p.maxDiagonalExpansion > p.diagonalExpansion) {
+        fprintf(stderr, "signalAlign - %s adaptive banding: %"PRId64" blocks, %"PRId64" widened with %"PRId64" "
+                        "retries, diagonal expansion %"PRId64" to %"PRId64"\n",
+                isTemplate ? "template" : "complement", p.stats->bandedBlocks, p.stats->widenedBlocks,
+                p.stats->bandRetries, p.diagonalExpansion, p.stats->widestDiagonalExpansion);
+    }
+    forwardBackwardStats_destruct(p.stats);
+
+    // sort
+    stList_sort(job->alignedPairs, sortByXPlusYCoordinate2); //Ensure the coordinates are increasing
+    return NULL;
+}
+
+void signalUtils_alignStrands(StrandAlignment *templateJob, StrandAlignment *complementJob) {
+    // the template and complement alignments are independent until they are written, so with a complement each
+    // strand is aligned in its own thread
+    if (complementJob == NULL) {
+        signalUtils_alignStrand(templateJob);
+        return;
+    }
+    pthread_t templateThread, complementThread;
+    bool templateThreaded = pthread_create(&templateThread, NULL, signalUtils_alignStrand, templateJob) == 0;
+    bool complementThreaded = pthread_create(&complementThread, NULL, signalUtils_alignStrand, complementJob) == 0;
+    // if we couldn't get a thread just do the work here
+    if (!templateThreaded) {
+        signalUtils_alignStrand(templateJob);
+    }
+    if (!complementThreaded) {
+        signalUtils_alignStrand(complementJob);
+    }
+    if (templateThreaded) {
+        pthread_join(templateThread, NULL);
+    }
+    if (complementThreaded) {
+        pthread_join(complementThread, NULL);
+    }
+}
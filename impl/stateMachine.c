@@ -1211,8 +1211,8 @@ static void stateMachine3_cellCalculate(StateMachine *sM,
             for (int64_t q = 0; q < hdLower->numberOfPaths; q++) {
                 Path *pathL = hdCell_getPath(hdLower, q);
                 if (path_checkLegal(pathL, pathC)) {
-                    double *lowerCells = path_getCell(pathL);
-                    double *currentCells = path_getCell(pathC);
+                    double *lowerCells = hdCell_getPathCells(hdLower, q, sM->stateNumber);
+                    double *currentCells = hdCell_getPathCells(hdCurrent, p, sM->stateNumber);
                     double eP = sM3->getXGapProbFcn(sM, sM3->model.EMISSION_GAP_X_PROBS, pathC->kmer);
                     doTransition(lowerCells, currentCells, match, shortGapX, eP, sM3->TRANSITION_GAP_OPEN_X, extraArgs);
                     doTransition(lowerCells, currentCells, shortGapX, shortGapX, eP, sM3->TRANSITION_GAP_EXTEND_X, extraArgs);
@@ -1227,8 +1227,8 @@ static void stateMachine3_cellCalculate(StateMachine *sM,
             for (int64_t q = 0; q < hdMiddle->numberOfPaths; q++) {
                 Path *pathM = hdCell_getPath(hdMiddle, q);
                 if (path_checkLegal(pathM, pathC)) {
-                    double *middleCells = path_getCell(pathM);
-                    double *currentCells = path_getCell(pathC);
+                    double *middleCells = hdCell_getPathCells(hdMiddle, q, sM->stateNumber);
+                    double *currentCells = hdCell_getPathCells(hdCurrent, p, sM->stateNumber);
                     double eP = sM3->getMatchProbFcn(sM, pathC->kmer, cY, TRUE);
                     doTransition(middleCells, currentCells, match, match, eP, sM3->TRANSITION_MATCH_CONTINUE, extraArgs);
                     doTransition(middleCells, currentCells, shortGapX, match, eP, sM3->TRANSITION_MATCH_FROM_GAP_X, extraArgs);
@@ -1243,8 +1243,8 @@ static void stateMachine3_cellCalculate(StateMachine *sM,
             for (int64_t q = 0; q < hdUpper->numberOfPaths; q++) {
                 Path *pathU = hdCell_getPath(hdUpper, q);
                 if (stString_eq(pathC->kmer, pathU->kmer)) {
-                    double *upperCells = path_getCell(pathU);
-                    double *currentCells = path_getCell(pathC);
+                    double *upperCells = hdCell_getPathCells(hdUpper, q, sM->stateNumber);
+                    double *currentCells = hdCell_getPathCells(hdCurrent, p, sM->stateNumber);
                     double eP = sM3->getYGapProbFcn(sM, pathC->kmer, cY, FALSE);
                     doTransition(upperCells, currentCells, match, shortGapY, eP, sM3->TRANSITION_GAP_OPEN_Y, extraArgs);
                     doTransition(upperCells, currentCells, shortGapY, shortGapY, eP, sM3->TRANSITION_GAP_EXTEND_Y, extraArgs);
@@ -1277,8 +1277,8 @@ static void stateMachine3HDP_cellCalculate(StateMachine *sM,
                 Path *pathL = hdCell_getPath(hdLower, q);
                 if (path_checkLegal(pathL, pathC)) {
                     //st_uglyf("SENTINAL - legal LOWER : pathC kmer %s\n", pathC->kmer);
-                    double *lowerCells = path_getCell(pathL);
-                    double *currentCells = path_getCell(pathC);
+                    double *lowerCells = hdCell_getPathCells(hdLower, q, sM->stateNumber);
+                    double *currentCells = hdCell_getPathCells(hdCurrent, p, sM->stateNumber);
                     double eP = -2.3025850929940455; // log(0.1)
                     doTransition(lowerCells, currentCells, match, shortGapX, eP, sM3->TRANSITION_GAP_OPEN_X, extraArgs);
                     doTransition(lowerCells, currentCells, shortGapX, shortGapX, eP, sM3->TRANSITION_GAP_EXTEND_X, extraArgs);
@@ -1294,8 +1294,8 @@ static void stateMachine3HDP_cellCalculate(StateMachine *sM,
                 Path *pathM = hdCell_getPath(hdMiddle, q);
                 if (path_checkLegal(pathM, pathC)) {
                     //st_uglyf("SENTINAL - legal MIDDLE : pathC kmer %s\n", pathC->kmer);
-                    double *middleCells = path_getCell(pathM);
-                    double *curentCells = path_getCell(pathC);
+                    double *middleCells = hdCell_getPathCells(hdMiddle, q, sM->stateNumber);
+                    double *curentCells = hdCell_getPathCells(hdCurrent, p, sM->stateNumber);
                     double eP = sM3->getMatchProbFcn(sM, pathC->kmer, cY, TRUE);
                     doTransition(middleCells, curentCells, match, match, eP, sM3->TRANSITION_MATCH_CONTINUE, extraArgs);
                     doTransition(middleCells, curentCells, shortGapX, match, eP, sM3->TRANSITION_MATCH_FROM_GAP_X, extraArgs);
@@ -1311,8 +1311,8 @@ static void stateMachine3HDP_cellCalculate(StateMachine *sM,
                 Path *pathU = hdCell_getPath(hdUpper, q);
                 if (stString_eq(pathC->kmer, pathU->kmer)) {
                     //st_uglyf("SENTINAL - legal UPPER : pathC kmer %s\n", pathC->kmer);
-                    double *upperCells = path_getCell(pathU);
-                    double *currentCells = path_getCell(pathC);
+                    double *upperCells = hdCell_getPathCells(hdUpper, q, sM->stateNumber);
+                    double *currentCells = hdCell_getPathCells(hdCurrent, p, sM->stateNumber);
                     double eP = sM3->getMatchProbFcn(sM, pathC->kmer, cY, FALSE);
                     doTransition(upperCells, currentCells, match, shortGapY, eP, sM3->TRANSITION_GAP_OPEN_Y, extraArgs);
                     doTransition(upperCells, currentCells, shortGapY, shortGapY, eP, sM3->TRANSITION_GAP_EXTEND_Y, extraArgs);
@@ -0,0 +1,27 @@
+#ifndef BLOCK_COMPRESSED_OUTPUT_H_
+#define BLOCK_COMPRESSED_OUTPUT_H_
+#include "sonLibTypes.h"
+
+// Text output that can be written through a gzip compressor. The compressed output is a run of BGZF blocks
+// (gzip members of at most 64KB, with the block size in a 'BC' extra field, the same framing samtools uses), so it
+// can be read with any gzip reader, and a reader that wants to can jump from block to block and decompress them in
+// parallel. Blocks only hold whole records, a record is never split over two blocks. There's no empty EOF block
+// at the end, signalMachine appends a strand at a time to the same file.
+#define BLOCK_INPUT_SIZE 0xff00
+#define BLOCK_MAX_SIZE 0x10000
+
+typedef struct _blockWriter BlockWriter;
+
+// opens path for appending, compressed or as plain text
+BlockWriter *blockWriter_open(const char *path, bool compress);
+
+// adds a record, starts a new block if it doesn't fit in the current one
+void blockWriter_printf(BlockWriter *writer, const char *fmt, ...);
+
+// writes out the current block
+void blockWriter_flush(BlockWriter *writer);
+
+// flushes and closes the file
+void blockWriter_close(BlockWriter *writer);
+
+#endif
@@ -0,0 +1,69 @@
+#ifndef COLUMNAR_OUTPUT_H_
+#define COLUMNAR_OUTPUT_H_
+#include <stdio.h>
+#include "sonLibTypes.h"
+
+// Columnar binary alignment output. A file is a run of blocks, signalMachine appends one block per strand it
+// aligns. Each block is:
+//   magic "SAcb", uint32 version, uint32 header length, the header, then for each column a uint64 byte length
+//   and the column's bytes
+// The header is text, key=value lines, with the number of rows, the compression, the columns as name:type pairs
+// and whatever metadata the writer adds (contig, read label, strand, kmer alphabet). Numbers are little-endian,
+// types are i4 (int32), i8 (int64) and f8 (double). With zlib compression each column is deflated on its own.
+#define COLUMNAR_MAGIC "SAcb"
+#define COLUMNAR_VERSION 1
+
+typedef enum {
+    columnInt32 = 0,
+    columnInt64 = 1,
+    columnDouble = 2
+} ColumnType;
+
+typedef struct _columnarBlock ColumnarBlock;
+
+ColumnarBlock *columnarBlock_construct(const char *format);
+
+void columnarBlock_destruct(ColumnarBlock *block);
+
+void columnarBlock_addMetadata(ColumnarBlock *block, const char *key, const char *value);
+
+// returns the index of the new column
+int64_t columnarBlock_addColumn(ColumnarBlock *block, const char *name, ColumnType type);
+
+void columnarBlock_appendInt32(ColumnarBlock *block, int64_t column, int32_t value);
+
+void columnarBlock_appendInt64(ColumnarBlock *block, int64_t column, int64_t value);
+
+void columnarBlock_appendDouble(ColumnarBlock *block, int64_t column, double value);
+
+int64_t columnarBlock_getRowNumber(ColumnarBlock *block);
+
+// writes the block at the current position of fH
+void columnarBlock_write(ColumnarBlock *block, FILE *fH, bool compress);
+
+// reads the block at the current position of fH, NULL at the end of the file. The column data is read as it is
+// stored, so like the writer this assumes a little-endian machine
+ColumnarBlock *columnarBlock_read(FILE *fH);
+
+const char *columnarBlock_getFormat(ColumnarBlock *block);
+
+// value of a metadata key, NULL if the block doesn't have it
+char *columnarBlock_getMetadata(ColumnarBlock *block, const char *key);
+
+// index of the column, -1 if the block doesn't have it
+int64_t columnarBlock_getColumnIndex(ColumnarBlock *block, const char *name);
+
+// the values of a column, owned by the block
+int32_t *columnarBlock_getInt32s(ColumnarBlock *block, int64_t column);
+
+int64_t *columnarBlock_getInt64s(ColumnarBlock *block, int64_t column);
+
+double *columnarBlock_getDoubles(ColumnarBlock *block, int64_t column);
+
+// alphabet to use for kmer ids, the characters of baseAlphabet then any other characters in the sequences
+char *columnar_kmerAlphabet(const char *baseAlphabet, int64_t baseAlphabetSize, stList *sequences);
+
+// id of the kmer, most significant character first, -1 if it has characters outside the alphabet
+int64_t columnar_kmerId(const char *kmer, const char *alphabet, int64_t kmerLength);
+
+#endif
@@ -61,10 +61,16 @@ double get_nanopore_kmer_density(NanoporeHDP* nhdp, void *kmer, void *event);
 
 void update_nhdp_from_alignment(NanoporeHDP* nhdp, const char* alignment_filepath, bool has_header);
 
-// filter for only observations containing "strand_filter" in the strand column
+// filter for only observations containing "strand_filter" in the strand column, compact assignments files are
+// passed on to update_nhdp_from_assignments
 void update_nhdp_from_alignment_with_filter(NanoporeHDP* nhdp, const char* alignment_filepath,
                                             bool has_header, const char* strand_filter);
 
+// compact assignments, columnar blocks (see columnarOutput.h) with format=assignments, the strand, kmer_alphabet
+// and kmer_length in the header and kmer (id), event_mean and posterior_probability columns. strand_filter can
+// be NULL for all of them
+void update_nhdp_from_assignments(NanoporeHDP* nhdp, const char* assignments_filepath, const char* strand_filter);
+
 // computing metrics on distributions
 
 double get_kmer_distr_distance(NanoporeDistributionMetricMemo* memo, char* kmer_1, char* kmer_2);
@@ -14,6 +14,7 @@
 #ifndef PAIRWISEALIGNER_H_
 #define PAIRWISEALIGNER_H_
 
+#include <pthread.h>
 #include "bioioC.h"
 #include "sonLib.h"
 #include "stateMachine.h"
@@ -119,6 +120,28 @@ Sequence *sequence_constructEventSequence(int64_t length, void *events);
 
 int64_t sequence_correctSeqLength(int64_t length, SequenceType type, int64_t kmerLength);
 
+// Time/memory book keeping for the forward-backward, summed over every matrix aligned with the parameters
+typedef struct _forwardBackwardStats {
+    int64_t forwardDiagonals; //Diagonals computed in the forward pass
+    int64_t forwardCells; //Paths (over all of the cells) computed in the forward pass
+    int64_t recomputedDiagonals; //Forward diagonals recomputed from checkpoints during the traceback
+    int64_t checkpointedMatrices; //Number of matrices that were aligned with checkpointing on
+    int64_t peakBytes; //Largest estimated size of the live dp matrices
+    int64_t bandedBlocks; //Blocks aligned with adaptive banding
+    int64_t bandRetries; //Times a block was aligned again with a wider band
+    int64_t widenedBlocks; //Blocks that needed a wider band than the starting one
+    int64_t widestDiagonalExpansion; //Widest diagonal expansion used
+    int64_t prunedCells; //Cells that had degenerate paths pruned
+    int64_t prunedPaths; //Paths pruned from the forward matrices
+    double droppedMass; //Summed over the pruned cells, the fraction of the cell's probability that was dropped
+    double maxDroppedMass; //The biggest fraction dropped from a single cell
+    pthread_mutex_t lock;
+} ForwardBackwardStats;
+
+ForwardBackwardStats *forwardBackwardStats_construct();
+
+void forwardBackwardStats_destruct(ForwardBackwardStats *stats);
+
 // Pairwise alignment
 typedef struct _pairwiseAlignmentBandingParameters {
     double threshold; //Minimum posterior probability of a match to be added to the output
@@ -131,6 +154,15 @@ typedef struct _pairwiseAlignmentBandingParameters {
     int64_t splitMatrixBiggerThanThis; //Any matrix in the anchors bigger than this is split into two.
     bool alignAmbiguityCharacters;
     float gapGamma; //The AMAP gap-gamma parameter which controls the degree to which indel probabilities are factored into the alignment.
+    int64_t threads; //Number of threads used to align the blocks between large gaps in the anchors.
+    int64_t checkpointInterval; //Keep only every k-th pair of forward diagonals and recompute the rest, 0 keeps all.
+    int64_t memoryCeiling; //If no checkpointInterval is given, checkpoint matrices estimated to be bigger than this (bytes), 0 is no limit.
+    ForwardBackwardStats *stats; //If not NULL, collects the time/memory trade-off of the forward-backward.
+    int64_t maxDiagonalExpansion; //If bigger than diagonalExpansion, band limited blocks are realigned with up to this expansion.
+    double bandEdgeThreshold; //Fraction of the posterior mass at the band edges above which a block counts as band limited.
+    double pathPruneThreshold; //Drop forward paths with less than this fraction of their cell's probability, 0 is off.
+    int64_t pathBeamWidth; //Only keep this many of the most probable forward paths in a cell, 0 is off.
+    bool contiguousCells; //Keep the cells of each dp diagonal in one aligned buffer instead of one allocation per path.
 } PairwiseAlignmentParameters;
 
 PairwiseAlignmentParameters *pairwiseAlignmentBandingParameters_construct();
@@ -238,6 +270,7 @@ typedef struct _path {
     int64_t stateNumber;
     int64_t kmerLength;
     double *cells;
+    bool ownsCells; // FALSE when the cells are in a buffer shared by the diagonal
 } Path;
 
 
@@ -245,6 +278,8 @@ int64_t intPow(int64_t base, int64_t exp);
 
 Path *path_construct(char *kmer, int64_t stateNumber, int64_t kmerLength);
 
+Path *path_construct2(char *kmer, int64_t stateNumber, int64_t kmerLength, double *cells);
+
 bool path_checkLegal(Path *path1, Path *path2);
 
 stList *path_findDegeneratePositions(char *kmer, int64_t kmerLength);
@@ -264,13 +299,26 @@ typedef struct _hdcell {
     int64_t numberOfPaths;
     Path **paths;
     bool init;
+    double *cells; // contiguous layout only, the cells of the paths one after the other, NULL otherwise
 } HDCell;
 
 HDCell *hdCell_construct(void *nucleotideSequence, int64_t stateNumber, int64_t nbBaseOptions, char *baseOptions,
                          int64_t kmerLength);
 
+HDCell *hdCell_construct2(void *nucleotideSequence, int64_t stateNumber, int64_t nbBaseOptions, char *baseOptions,
+                          int64_t kmerLength, double *cells);
+
+int64_t hdCell_countPaths(void *nucleotideSequence, int64_t nbBaseOptions, int64_t kmerLength);
+
+// the cells of a path, indexed straight out of the cell's buffer with the contiguous layout
+static inline double *hdCell_getPathCells(HDCell *cell, int64_t pathNumber, int64_t stateNumber) {
+    return cell->cells != NULL ? cell->cells + pathNumber * stateNumber : cell->paths[pathNumber]->cells;
+}
+
 double hdCell_totalProbability(HDCell *cell1, HDCell *cell2);
 
+int64_t hdCell_prunePaths(HDCell *cell, double threshold, int64_t beamWidth, double *droppedMass);
+
 Path *hdCell_getPath(HDCell *cell, int64_t pathNumber);
 
 void hdCell_destruct(HDCell *cell);
@@ -298,10 +346,17 @@ typedef struct _dpDiagonal {
     int64_t totalPaths;
     Sequence *sequence;
     HDCell **cells;
+    double *cellBuffer; // contiguous layout only, paths x states x width, cell by cell and path by path
+    int64_t cellBufferLength;
+    void *cellMemory; // unaligned allocation holding cellBuffer
 } DpDiagonal;
 
 DpDiagonal *dpDiagonal_construct(Diagonal diagonal, int64_t stateNumber, int64_t kmerLength, Sequence *nucleotideSequence);
 
+// same as above but all of the path cells are kept in one aligned buffer
+DpDiagonal *dpDiagonal_constructContiguous(Diagonal diagonal, int64_t stateNumber, int64_t kmerLength,
+                                           Sequence *nucleotideSequence);
+
 DpDiagonal *dpDiagonal_clone(DpDiagonal *diagonal);
 
 bool dpDiagonal_equals(DpDiagonal *diagonal1, DpDiagonal *diagonal2);
@@ -334,6 +389,10 @@ DpDiagonal *dpMatrix_getDiagonal(DpMatrix *dpMatrix, int64_t xay);
 
 int64_t dpMatrix_getActiveDiagonalNumber(DpMatrix *dpMatrix);
 
+int64_t dpMatrix_getActivePathNumber(DpMatrix *dpMatrix);
+
+void dpMatrix_setContiguousCells(DpMatrix *dpMatrix, bool contiguousCells);
+
 DpDiagonal *dpMatrix_createDiagonal(DpMatrix *dpMatrix, Diagonal diagonal, Sequence *sX);
 
 void dpMatrix_deleteDiagonal(DpMatrix *dpMatrix, int64_t xay);
@@ -391,6 +450,23 @@ stList *getAlignedPairsUsingAnchors(StateMachine *sM,
                                     bool alignmentHasRaggedLeftEnd,
                                     bool alignmentHasRaggedRightEnd);
 
+// Viterbi (best path only) alignment, the back pointers are kept for segments of p->checkpointInterval diagonals
+// (about sqrt(2n) if it is 0) and recomputed from checkpoints during the traceback
+double getViterbiPathWithBanding(StateMachine *sM,
+                                 stList *anchorPairs,
+                                 Sequence *sX, Sequence *sY,
+                                 PairwiseAlignmentParameters *p,
+                                 bool alignmentHasRaggedLeftEnd, bool alignmentHasRaggedRightEnd,
+                                 stList *alignedPairs);
+
+stList *getViterbiAlignedPairsUsingAnchors(StateMachine *sM,
+                                           Sequence *SsX, Sequence *SsY,
+                                           stList *anchorPairs,
+                                           PairwiseAlignmentParameters *p,
+                                           bool alignmentHasRaggedLeftEnd,
+                                           bool alignmentHasRaggedRightEnd,
+                                           double *score);
+
 // EM stuff
 void getExpectationsUsingAnchors(StateMachine *sM, Hmm *hmmExpectations,
                                  Sequence *SsX, Sequence *SsY,
@@ -433,6 +509,21 @@ void getPosteriorProbsWithBandingSplittingAlignmentsByLargeGaps(
                                         PairwiseAlignmentParameters *, void *),
         void (*coordinateCorrectionFn)(), void *extraArgs);
 
+// aligns the blocks on p->threads threads, only for diagonalPosteriorProbFns that collect aligned pairs. Blocks that
+// look band limited are realigned with a wider band if p->maxDiagonalExpansion is set.
+void getPosteriorProbsWithBandingSplittingAlignmentsByLargeGapsMultithreaded(
+        StateMachine *sM, stList *anchorPairs, Sequence *SsX, Sequence *SsY,
+        PairwiseAlignmentParameters *p,
+        bool alignmentHasRaggedLeftEnd, bool alignmentHasRaggedRightEnd,
+        void (*diagonalPosteriorProbFn)(StateMachine *, int64_t, DpMatrix *,
+                                        DpMatrix *, Sequence*, Sequence*, double,
+                                        PairwiseAlignmentParameters *, void *),
+        void (*coordinateCorrectionFn)(), void *extraArgs);
+
+// fraction of the posterior mass of the aligned pairs that is close to a (non-matrix) edge of the band
+double getBandEdgePosteriorMass(stList *alignedPairs, stList *anchorPairs, int64_t lX, int64_t lY,
+                                int64_t diagonalExpansion);
+
 //Calculate posterior probabilities of being aligned to gaps
 
 int64_t *getIndelProbabilities(stList *alignedPairs, int64_t seqLength, bool xIfTrueElseY);
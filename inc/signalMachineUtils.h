@@ -4,6 +4,9 @@
 #include "pairwiseAlignment.h"
 #include "pairwiseAligner.h"
 
+#define ESTIMATE_PARAMS 1
+#define ASSIGNMENT_THRESHOLD 0.1
+
 typedef struct _referenceSequence ReferenceSequence;
 struct _referenceSequence {
     char *reference;
@@ -13,6 +16,7 @@ struct _referenceSequence {
     char *trimmedBackwardSequence;
 
     struct PairwiseAlignment *A;  // pairwise alignment
+    int64_t referenceOffset;  // contig position of the first base in the reference files, if they hold a window
 
     char *(*getTemplateTargetSequence)(ReferenceSequence *R);
     char *(*getComplementTargetSequence)(ReferenceSequence *R);
@@ -25,6 +29,12 @@ char *signalUtils_stringReverse(char *str);
 ReferenceSequence *signalUtils_ReferenceSequenceConstructFull(char *forwardReferencePath, char *backwardReferencePath,
                                                               struct PairwiseAlignment *pA);
 
+// the reference files hold the window of the contig that starts at referenceOffset
+ReferenceSequence *signalUtils_ReferenceSequenceConstructWindow(char *forwardReferencePath,
+                                                                char *backwardReferencePath,
+                                                                struct PairwiseAlignment *pA,
+                                                                int64_t referenceOffset);
+
 ReferenceSequence *signalUtils_ReferenceSequenceConstructEmpty(struct PairwiseAlignment *pA);
 
 void signalUtils_ReferenceSequenceSet(ReferenceSequence *self, char *forwardReferencePath, char *backwardReferencePath);
@@ -42,6 +52,12 @@ void signalUtils_estimateNanoporeParams(StateMachine *sM, NanoporeRead *npRead,
                                         stList *(*assignmentFunction)(NanoporeRead *, StateMachine *, double),
                                         void (*driftAdjustmentFunction)(NanoporeRead *));
 
+// updates the stateMachine with parameters that were already estimated for this read (eg. by a batch
+// estimation run) and adjusts the events for drift, the same as signalUtils_estimateNanoporeParams does after
+// estimating them
+void signalUtils_applyNanoporeParams(StateMachine *sM, NanoporeRead *npRead, NanoporeReadAdjustmentParameters *params,
+                                     void (*driftAdjustmentFunction)(NanoporeRead *));
+
 void signalUtils_estimateNanoporeParamsFromTable(const char *modelPath,
                                                  NanoporeRead *npRead, NanoporeReadAdjustmentParameters *params,
                                                  double assignmentThreshold,
@@ -54,6 +70,50 @@ stList *signalUtils_complementOneDAssignmentsFromRead(NanoporeRead *npRead, Stat
 
 void signalUtils_ReferenceSequenceDestruct(ReferenceSequence *self);
 
+StateMachine *signalUtils_buildStateMachine(const char *modelFile, NanoporeReadAdjustmentParameters npp,
+                                            StateMachineType type, NanoporeHDP *nHdp);
+
+double signalUtils_scoreByPosteriorProbabilityIgnoringGaps(stList *alignedPairs);
+
+stList *signalUtils_performSignalAlignment(StateMachine *sM, Sequence *eventSequence, int64_t *eventMap,
+                                           int64_t mapOffset, char *target, PairwiseAlignmentParameters *p,
+                                           stList *unmappedAnchors, DegenerateType degenerate);
+
+stList *signalUtils_performViterbiSignalAlignment(StateMachine *sM, Sequence *eventSequence, int64_t *eventMap,
+                                                  int64_t mapOffset, char *target, PairwiseAlignmentParameters *p,
+                                                  stList *unmappedAnchors, DegenerateType degenerate, double *score);
+
+// one strand of signalMachine's alignment. The template and complement jobs of a 2D read share npRead, p and
+// anchorPairs, which are only read while they run (each job only changes npRead's fields for its own strand and
+// copies p), and each has its own stateMachine and HDP
+typedef struct _strandAlignment {
+    // inputs
+    Strand strand;
+    const char *modelFile;
+    StateMachineType sMtype;
+    NanoporeHDP *nHdp;
+    NanoporeRead *npRead;
+    Sequence *eventSequence;
+    int64_t *eventMap;
+    int64_t mapOffset;
+    char *target;
+    PairwiseAlignmentParameters *p;
+    stList *anchorPairs;
+    DegenerateType degenerate;
+    bool viterbi;
+    bool estimateParams;
+    // results
+    StateMachine *sM;
+    stList *alignedPairs;
+    double posteriorScore;
+} StrandAlignment;
+
+// builds the strand's stateMachine, re-estimates the read's parameters for it and aligns, takes a StrandAlignment
+void *signalUtils_alignStrand(void *strandAlignment);
+
+// aligns the template and, if complementJob isn't NULL, the complement at the same time
+void signalUtils_alignStrands(StrandAlignment *templateJob, StrandAlignment *complementJob);
+
 void printFoo();
 
 #endif
\ No newline at end of file
@@ -8,5 +8,5 @@ libPath=${sonLibPath}
 
 include  ${sonLibRootPath}/include.mk
 
-basicLibs = ${sonLibPath}/sonLib.a ${sonLibPath}/cuTest.a ${dblibs}
+basicLibs = ${sonLibPath}/sonLib.a ${sonLibPath}/cuTest.a ${dblibs} -lpthread -lz
 basicLibsDependencies = ${sonLibPath}/sonLib.a ${sonLibPath}/cuTest.a 
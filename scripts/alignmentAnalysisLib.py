@@ -6,6 +6,8 @@ import pandas as pd
 import numpy as np
 from random import shuffle
 from serviceCourse.parsers import read_fasta
+from alignmentIO import is_columnar_alignment, columnar_alignment_frame, alignment_compression, \
+    iter_alignment_batches, read_alignment_frame, append_hdf5_rows
 
 
 def get_first_sequence(input_fasta):
@@ -15,22 +17,43 @@ def get_first_sequence(input_fasta):
         break
     return input_sequence
 
-def parse_alignment_file(alignment_file):
-    data = pd.read_table(alignment_file, usecols=(1, 4, 5, 9, 12, 13),
-                         dtype={'ref_pos': np.int64,
-                                'strand': np.str,
-                                'event_index': np.int64,
-                                'kmer': np.str,
-                                'posterior_prob': np.float64,
-                                'event_mean': np.float64},
-                         header=None,
-                         names=['ref_pos', 'strand', 'event_index', 'kmer', 'posterior_prob', 'event_mean'])
-    return data
+def parse_alignment_file(alignment_file, **predicates):
+    # only reads the columns we use, predicates (see iter_alignment_batches) drop rows while reading
+    return read_alignment_frame(alignment_file, [('ref_pos', 'ref_pos'),
+                                                 ('strand', 'strand'),
+                                                 ('event_index', 'event_index'),
+                                                 ('kmer', 'aligned_kmer'),
+                                                 ('posterior_prob', 'posterior_probability'),
+                                                 ('event_mean', 'descaled_event_mean')], **predicates)
+
+
+class ReferencePositionLookup(object):
+    """the rows of an alignment DataFrame by strand and reference position, sorted once so that getting the rows
+    that cover a site is a binary search rather than a pass over the whole table. For the rows of a whole run use
+    alignmentIO.ReferenceIndex
+    """
+    def __init__(self, data, position_column="ref_pos", strand_column="strand"):
+        self.empty = data.iloc[0:0]
+        self.data = {}
+        self.positions = {}
+        for strand, rows in data.groupby(strand_column):
+            rows = rows.iloc[np.argsort(rows[position_column].values, kind="mergesort")]
+            self.data[strand] = rows
+            self.positions[strand] = rows[position_column].values
+
+    def rows(self, strand, start, end=None):
+        """rows on strand with start <= reference position < end, end defaults to start + 1
+        """
+        if strand not in self.data:
+            return self.empty
+        end = start + 1 if end is None else end
+        lower, upper = np.searchsorted(self.positions[strand], [start, end], side="left")
+        return self.data[strand].iloc[lower:upper]
 
 
 def randomly_select_alignments(path_to_alignments):
     files = os.listdir(path_to_alignments)
-    files = [f for f in files if f.endswith(".tsv")]
+    files = [f for f in files if f.endswith(".tsv") or f.endswith(".tsv.gz") or f.endswith(".bin")]
     files = [path_to_alignments + f for f in files]
     files = [f for f in files if os.path.isfile(f)]
     shuffle(files)
@@ -70,26 +93,19 @@ class KmerHistogram(object):
         assert len(alignments) > 0, "Didn't find any alignments"
         for alignment in alignments:
             try:
-                data = parse_alignment_file(alignment)
-                if self.ignore_positions is not None:
-                    crit = data['ref_pos'].map(lambda p: p not in self.ignore_positions)
-                    selected_rows = data[crit].ix[(data['strand'] == self.strand) &
-                                                  (data['posterior_prob'] >= self.threshold) &
-                                                  (data['kmer'] == self.kmer)]
-                else:
-                    selected_rows = data.ix[(data['strand'] == self.strand) &
-                                            (data['posterior_prob'] >= self.threshold) &
-                                            (data['kmer'] == self.kmer)]
-
-                total += selected_rows.shape[0]
-                aln_kmer_hist = pd.DataFrame({"event_mean": selected_rows["event_mean"]})
-                add_to_hist(aln_kmer_hist)
+                # only the event means of the rows for our kmer get read, in batches
+                for batch in iter_alignment_batches(alignment, ["descaled_event_mean"], strand=self.strand,
+                                                    min_posterior=self.threshold, kmers=[self.kmer],
+                                                    exclude_positions=self.ignore_positions,
+                                                    max_rows=self.max_assignments - total):
+                    total += len(batch)
+                    add_to_hist(pd.DataFrame({"event_mean": batch["descaled_event_mean"]}))
             except Exception as e:
                 print("ERROR: {exc} {aln}".format(exc=e, aln=alignment))
                 continue
             if total >= self.max_assignments:
                     break
-        self.histogram = pd.concat(kmer_hist)
+        self.histogram = pd.concat(kmer_hist) if len(kmer_hist) > 0 else pd.DataFrame(columns=["event_mean"])
         self.n_points = self.histogram.shape[0]
         return
 
@@ -135,19 +151,32 @@ class CallMethylation(object):
 
     def parse_alignment(self):
         # todo make this try, except
-        self.data = pd.read_table(self.alignment_file,
-                                  usecols=(1, 2, 4, 5, 6, 7, 8),
-                                  header=None,
-                                  names=['ref_index', 'ref_kmer', 'strand', 'event_index',
-                                         'match_kmer', 'prob', 'path_kmer'],
-                                  dtype={'ref_index': np.int64,
-                                         'ref_kmer': np.str,
-                                         'strand': np.str,
-                                         'event_index': np.int64,
-                                         'match_kmer': np.str,
-                                         'prob': np.float64,
-                                         'path_kmer': np.str})
+        if is_columnar_alignment(self.alignment_file):
+            self.data = columnar_alignment_frame(self.alignment_file, {'ref_index': 'ref_pos',
+                                                                       'ref_kmer': 'ref_kmer',
+                                                                       'strand': 'strand',
+                                                                       'event_index': 'event_index',
+                                                                       'match_kmer': 'aligned_kmer',
+                                                                       'prob': 'posterior_probability',
+                                                                       'path_kmer': 'path_kmer'})
+            self.data = self.data[['ref_index', 'ref_kmer', 'strand', 'event_index', 'match_kmer', 'prob',
+                                   'path_kmer']]
+        else:
+            self.data = pd.read_table(self.alignment_file,
+                                      usecols=(1, 2, 4, 5, 6, 7, 8),
+                                      compression=alignment_compression(self.alignment_file),
+                                      header=None,
+                                      names=['ref_index', 'ref_kmer', 'strand', 'event_index',
+                                             'match_kmer', 'prob', 'path_kmer'],
+                                      dtype={'ref_index': np.int64,
+                                             'ref_kmer': np.str,
+                                             'strand': np.str,
+                                             'event_index': np.int64,
+                                             'match_kmer': np.str,
+                                             'prob': np.float64,
+                                             'path_kmer': np.str})
         assert self.data is not None, "problem parsing alignment file {}".format(self.alignment_file)
+        self.lookup = ReferencePositionLookup(self.data, position_column='ref_index')
 
     def find_occurences(self, ch):
         return [i for i, letter in enumerate(self.sequence) if letter == ch]
@@ -165,12 +194,10 @@ class CallMethylation(object):
 
         def get_calls(sites, strand, regular_offset):
             for site in sites:
-                # get the positions that an event can be aligned to and still report on this site
-                positions = self.get_range(site)
-
-                # select the rows in the dataFrame that have events aligned to this position
-                crit = self.data['ref_index'].map(lambda x: x in positions)
-                select = self.data[crit].ix[(self.data['strand'] == strand) & (self.data['prob'] >= threshold)]
+                # select the rows that have events aligned to the positions that still report on this site (see
+                # get_range)
+                select = self.lookup.rows(strand, site - (self.kmer_length - 1), site + 1)
+                select = select[select['prob'] >= threshold]
                 select = select.drop(select[['strand', 'ref_kmer']], axis=1)
 
                 if select.empty:
@@ -198,9 +225,9 @@ class CallMethylation(object):
         get_calls(template_sites, 't', template_offset)
         get_calls(complement_sites, 'c', complement_offset)
 
-    def write(self, out_file=None):
+    def write(self, out_file=None, fH=None):
+        # the calls go out in one write, to the open file fH if there is one (see variantCallingLib.variant_caller)
         self.call_methyls(positions=self.positions, threshold=self.threshold)
-        fH = open(out_file, 'a') if self.out_file is None else open(self.out_file, 'a')
 
         file_name = self.alignment_file.split("/")[-1]
 
@@ -209,18 +236,45 @@ class CallMethylation(object):
                 else "{site}\t{strand}\t{A}\t{C}\t{G}\t{T}\t{read}\n"
 
         line = output_line()
+        lines = []
 
         for strand, site, prob in self.probs:
             if self.degenerate in [1, 2]:
-                fH.write(line.format(site=site, strand=strand,
-                                     c=prob["C"], mc=prob["E"], hmc=prob["O"],
-                                     read=file_name))
+                lines.append(line.format(site=site, strand=strand,
+                                         c=prob["C"], mc=prob["E"], hmc=prob["O"],
+                                         read=file_name))
             elif self.degenerate == 3:
-                fH.write(line.format(site=site, strand=strand,
-                                     A=prob["A"], C=prob["C"], G=prob["G"], T=prob["T"],
-                                     read=file_name))
+                lines.append(line.format(site=site, strand=strand,
+                                         A=prob["A"], C=prob["C"], G=prob["G"], T=prob["T"],
+                                         read=file_name))
             else:
                 sys.exit(1)
+
+        if fH is not None:
+            fH.write("".join(lines))
+            return
+        with open(out_file if self.out_file is None else self.out_file, 'a') as out:
+            out.write("".join(lines))
+        return
+
+    def write_hdf5(self, fH):
+        # the calls of each strand go in the calls/<strand> rows of the open HDF5 file fH, with the read in the index
+        self.call_methyls(positions=self.positions, threshold=self.threshold)
+
+        file_name = self.alignment_file.split("/")[-1]
+
+        if self.degenerate in [1, 2]:
+            columns = [("c", "C"), ("mc", "E"), ("hmc", "O")]
+        elif self.degenerate == 3:
+            columns = [("A", "A"), ("C", "C"), ("G", "G"), ("T", "T")]
+        else:
+            sys.exit(1)
+        dtype = np.dtype([("site", "<i8")] + [(name, "<f8") for name, base in columns])
+
+        for strand in sorted(set([strand for strand, site, prob in self.probs])):
+            records = np.array([(site,) + tuple([prob[base] for name, base in columns])
+                                for s, site, prob in self.probs if s == strand], dtype=dtype)
+            append_hdf5_rows(fH, "calls/" + strand, records, file_name, "site")
         return
 
     def run(self):
@@ -0,0 +1,860 @@
+#!/usr/bin/env python
+"""Readers for the alignment outputs, the columnar binary format signalMachine writes with -s 3 (see
+columnarOutput.h), the block compressed text formats (see blockCompressedOutput.h) and the shards runSignalAlign
+--shards appends the alignments to. Also the compact assignments makeBuildAlignments.py writes for buildHdpUtil
+and the HDF5 files runSignalAlign --hdf5_output and the variant callers can write the alignments and calls to
+"""
+from __future__ import print_function, division
+import os
+import gzip
+import fnmatch
+import struct
+import zlib
+import h5py
+import numpy as np
+from collections import OrderedDict
+import pandas as pd
+
+COLUMNAR_MAGIC = "SAcb"
+COLUMNAR_VERSION = 1
+
+# column order of the full (tab separated) format, the columnar format has the same columns except that contig,
+# read_label and strand are in the block header
+FULL_COLUMNS = ["contig", "ref_pos", "ref_kmer", "read_label", "strand", "event_index", "event_mean", "event_noise",
+                "event_duration", "aligned_kmer", "scaled_mean_current", "scaled_noise", "posterior_probability",
+                "descaled_event_mean", "ont_model_mean", "path_kmer"]
+KMER_COLUMNS = ["ref_kmer", "aligned_kmer", "path_kmer"]
+HEADER_COLUMNS = ["contig", "read_label", "strand"]
+
+_column_dtypes = {"i4": np.dtype("<i4"), "i8": np.dtype("<i8"), "f8": np.dtype("<f8")}
+
+GZIP_MAGIC = "\x1f\x8b"
+BLOCK_INPUT_SIZE = 0xff00  # most text in a block, the same as blockCompressedOutput.h
+_block_header = struct.Struct("<BBBBIBBH2sHH")
+_block_footer = struct.Struct("<II")
+
+
+def is_columnar_alignment(alignment_file):
+    with open(alignment_file, "rb") as fH:
+        return fH.read(len(COLUMNAR_MAGIC)) == COLUMNAR_MAGIC
+
+
+def is_compressed_alignment(alignment_file):
+    with open(alignment_file, "rb") as fH:
+        return fH.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+
+
+def alignment_compression(alignment_file):
+    """the compression argument for pandas.read_table
+    """
+    return "gzip" if is_compressed_alignment(alignment_file) else None
+
+
+def open_alignment(alignment_file):
+    """opens a text alignment for reading, compressed or not
+    """
+    if is_compressed_alignment(alignment_file):
+        return gzip.open(alignment_file, "rb")
+    return open(alignment_file, "r")
+
+
+def alignment_header(alignment_file):
+    """the column names of a full format alignment written with only some of the columns (signalMachine
+    --outputColumns), those start with a line like #strand\taligned_kmer. None for the ones with all the columns
+    """
+    with open_alignment(alignment_file) as fH:
+        line = fH.readline()
+    if not line.startswith("#"):
+        return None
+    return line[1:].rstrip("\n").split("\t")
+
+
+def alignment_columns(alignment_file):
+    """the columns of a full format alignment in the order they are in the file
+    """
+    header = alignment_header(alignment_file)
+    return FULL_COLUMNS if header is None else header
+
+
+class BlockCompressedWriter(object):
+    """writes text in the same BGZF blocks as blockCompressedOutput.c, for the alignments the scripts put together
+    (stitched chunks, shards). Records go in whole, a block is written when the next record doesn't fit
+    """
+    def __init__(self, fH, level=6):
+        self.fH = fH
+        self.level = level
+        self.records = []
+        self.length = 0
+
+    def write(self, record):
+        if self.length + len(record) > BLOCK_INPUT_SIZE:
+            self.flush()
+        self.records.append(record)
+        self.length += len(record)
+
+    def flush(self):
+        if self.length == 0:
+            return
+        text = "".join(self.records)
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        data = compressor.compress(text) + compressor.flush()
+        block_size = _block_header.size + len(data) + _block_footer.size
+        self.fH.write(_block_header.pack(31, 139, 8, 4, 0, 0, 255, 6, "BC", 2, block_size - 1))
+        self.fH.write(data)
+        self.fH.write(_block_footer.pack(zlib.crc32(text) & 0xffffffff, len(text)))
+        self.records = []
+        self.length = 0
+
+    def close(self):
+        self.flush()
+
+
+def block_offsets(alignment_file, start=0, end=None):
+    """offsets of the blocks of a block compressed alignment, going by the block sizes in the headers, so that
+    the blocks can be handed out to workers and read with read_block. start has to be the offset of a block, eg.
+    where a read starts in a shard
+    """
+    offsets = []
+    size = os.path.getsize(alignment_file) if end is None else end
+    with open(alignment_file, "rb") as fH:
+        offset = start
+        while offset < size:
+            fH.seek(offset)
+            header = _block_header.unpack(fH.read(_block_header.size))
+            assert header[0:2] == (31, 139) and header[8] == "BC", \
+                "block_offsets: {} isn't block compressed".format(alignment_file)
+            offsets.append(offset)
+            offset += header[10] + 1
+    return offsets
+
+
+def read_block(fH, offset):
+    """the text in the block at offset, always whole records
+    """
+    fH.seek(offset)
+    header = _block_header.unpack(fH.read(_block_header.size))
+    block_size = header[10] + 1
+    data = fH.read(block_size - _block_header.size - _block_footer.size)
+    crc, length = _block_footer.unpack(fH.read(_block_footer.size))
+    text = zlib.decompress(data, -15)
+    assert len(text) == length and zlib.crc32(text) & 0xffffffff == crc, "read_block: corrupt block at {}".format(
+        offset)
+    return text
+
+
+def kmer_id(kmer, alphabet):
+    """the id columnar_kmerId gives a kmer, -1 if it has characters outside the alphabet
+    """
+    identifier = 0
+    for character in kmer:
+        if character not in alphabet:
+            return -1
+        identifier = identifier * len(alphabet) + alphabet.index(character)
+    return identifier
+
+
+def kmer_strings(kmer_ids, alphabet, kmer_length):
+    """turns kmer ids back into kmers, most significant character first like columnar_kmerId, in one go for the
+    whole array
+    """
+    kmer_ids = np.asarray(kmer_ids, dtype=np.int64)
+    base = len(alphabet)
+    powers = base ** np.arange(kmer_length - 1, -1, -1, dtype=np.int64)
+    letters = np.array(list(alphabet), dtype="S1")[(kmer_ids[:, np.newaxis] // powers) % base]
+    return np.ascontiguousarray(letters).view("S{}".format(kmer_length)).ravel()
+
+
+class ColumnarBlockHeader(object):
+    """the header of one block, rows, compression and the (name, type) of the columns, the rest of the key=value
+    lines go in metadata
+    """
+    def __init__(self, text):
+        fields = dict([line.split("=", 1) for line in text.split("\n") if "=" in line])
+        self.format = fields.pop("format")
+        self.rows = int(fields.pop("rows"))
+        self.compression = fields.pop("compression")
+        self.columns = [tuple(c.split(":")) for c in fields.pop("columns").split(",") if c != ""]
+        self.metadata = fields
+
+    def column_names(self):
+        return [name for name, column_type in self.columns]
+
+
+def read_columnar_block(fH, columns=None, header_filter=None):
+    """reads the block at the current position of fH, columns not in columns (None for all of them) are skipped
+    over, as is the whole block if header_filter(header) is False. Returns (header, {column name: array}), with
+    None for the arrays of a skipped block, or None at the end of the file
+    """
+    magic = fH.read(len(COLUMNAR_MAGIC))
+    if magic == "":
+        return None
+    assert magic == COLUMNAR_MAGIC, "read_columnar_block: not a columnar alignment block"
+    version, header_length = struct.unpack("<II", fH.read(8))
+    assert version == COLUMNAR_VERSION, "read_columnar_block: unsupported version {}".format(version)
+    header = ColumnarBlockHeader(fH.read(header_length))
+    skip = header_filter is not None and not header_filter(header)
+    arrays = None if skip else {}
+    for name, column_type in header.columns:
+        stored_length, = struct.unpack("<Q", fH.read(8))
+        if skip or (columns is not None and name not in columns):
+            fH.seek(stored_length, 1)
+            continue
+        data = fH.read(stored_length)
+        if header.compression == "zlib":
+            data = zlib.decompress(data)
+        arrays[name] = np.frombuffer(data, dtype=_column_dtypes[column_type])
+    return header, arrays
+
+
+def iter_columnar_blocks(alignment_file, columns=None, header_filter=None):
+    with open(alignment_file, "rb") as fH:
+        while True:
+            block = read_columnar_block(fH, columns, header_filter)
+            if block is None:
+                break
+            yield block
+
+
+def write_columnar_block(fH, block_format, columns, metadata=None, compress=False):
+    """writes a block the way columnarBlock_write does, columns is a list of (name, array) with the arrays int32,
+    int64 or float64 and all the same length, metadata a list of (key, value) pairs for the header
+    """
+    arrays = [(name, np.ascontiguousarray(array, dtype=np.dtype(array.dtype).newbyteorder("<")))
+              for name, array in columns]
+    rows = len(arrays[0][1]) if len(arrays) > 0 else 0
+    types = dict([(dtype.str, name) for name, dtype in _column_dtypes.items()])
+    lines = ["format=" + block_format, "rows={}".format(rows), "compression=" + ("zlib" if compress else "none"),
+             "columns=" + ",".join(["{name}:{type}".format(name=name, type=types[array.dtype.str])
+                                    for name, array in arrays])]
+    for key, value in (metadata or []):
+        assert "\n" not in str(value) and "=" not in key, \
+            "write_columnar_block: can't store {k}={v} in the header".format(k=key, v=value)
+        lines.append("{k}={v}".format(k=key, v=value))
+    header = "\n".join(lines) + "\n"
+    fH.write(COLUMNAR_MAGIC)
+    fH.write(struct.pack("<II", COLUMNAR_VERSION, len(header)))
+    fH.write(header)
+    for name, array in arrays:
+        assert len(array) == rows, "write_columnar_block: column {} has the wrong number of rows".format(name)
+        data = array.tostring()
+        if compress:
+            data = zlib.compress(data)
+        fH.write(struct.pack("<Q", len(data)))
+        fH.write(data)
+
+
+def kmer_ids(kmers, alphabet):
+    """kmer_id for an array of kmers (all the same length), alphabet has to be sorted
+    """
+    kmers = np.asarray(kmers, dtype=str)
+    if len(kmers) == 0:
+        return np.zeros(0, dtype=np.int64)
+    kmer_length = kmers.dtype.itemsize
+    characters = kmers.view("S1").reshape(len(kmers), kmer_length)
+    letters = np.array(list(alphabet), dtype="S1")
+    digits = np.searchsorted(letters, characters)
+    assert np.all(letters[np.minimum(digits, len(letters) - 1)] == characters), \
+        "kmer_ids: kmers with characters outside of {}".format(alphabet)
+    powers = len(alphabet) ** np.arange(kmer_length - 1, -1, -1, dtype=np.int64)
+    return digits.dot(powers)
+
+
+ASSIGNMENTS_FORMAT = "assignments"
+
+
+def write_assignments_block(fH, strand, kmers, event_means, posteriors, compress=True):
+    """writes a block of compact assignments (see update_nhdp_from_assignments in nanopore_hdp.h), the kmers are
+    stored as ids in the sorted alphabet of the characters they have, buildHdpUtil reads them without parsing text
+    """
+    kmers = np.asarray(kmers, dtype=str)
+    if len(kmers) == 0:
+        return
+    alphabet = "".join(sorted(set("".join(kmers))))
+    write_columnar_block(fH, ASSIGNMENTS_FORMAT,
+                         [("kmer", kmer_ids(kmers, alphabet)),
+                          ("event_mean", np.asarray(event_means, dtype=np.float64)),
+                          ("posterior_probability", np.asarray(posteriors, dtype=np.float64))],
+                         metadata=[("strand", strand), ("kmer_alphabet", alphabet),
+                                   ("kmer_length", kmers.dtype.itemsize)],
+                         compress=compress)
+
+
+def is_assignments_file(assignments_file):
+    if not is_columnar_alignment(assignments_file):
+        return False
+    with open(assignments_file, "rb") as fH:
+        header, arrays = read_columnar_block(fH, header_filter=lambda h: False)
+    return header.format == ASSIGNMENTS_FORMAT
+
+
+def count_assignments(assignments_file):
+    """the number of assignments, from the block headers
+    """
+    return sum([header.rows for header, arrays in iter_columnar_blocks(assignments_file,
+                                                                       header_filter=lambda h: False)])
+
+
+def read_assignments(assignments_file, strand=None):
+    """the assignments as a record array of kmer, strand, event_mean and posterior_probability, only the ones of
+    one strand if strand isn't None
+    """
+    pieces = []
+    for header, arrays in iter_columnar_blocks(assignments_file,
+                                               header_filter=lambda h: strand is None or
+                                               h.metadata["strand"] == strand):
+        if arrays is None or header.rows == 0:
+            continue
+        assert header.format == ASSIGNMENTS_FORMAT, "read_assignments: {} isn't an assignments file" \
+                                                    "".format(assignments_file)
+        pieces.append(np.rec.fromarrays([
+            kmer_strings(arrays["kmer"], header.metadata["kmer_alphabet"], int(header.metadata["kmer_length"])),
+            np.repeat(np.array([header.metadata["strand"]], dtype="S1"), header.rows),
+            arrays["event_mean"], arrays["posterior_probability"]],
+            names=["kmer", "strand", "event_mean", "posterior_probability"]))
+    if len(pieces) == 0:
+        return np.rec.fromarrays([np.array([], dtype="S1"), np.array([], dtype="S1"), np.array([]),
+                                  np.array([])], names=["kmer", "strand", "event_mean", "posterior_probability"])
+    return np.concatenate(pieces).view(np.recarray) if len(pieces) > 1 else pieces[0]
+
+
+def read_columnar_alignment(alignment_file, columns=None, decode_kmers=True):
+    """reads a columnar alignment into a dict of arrays, one per column, no text parsing involved. columns picks
+    the columns to read (default: all of FULL_COLUMNS), contig, read_label and strand are filled in from the block
+    headers. Kmers are turned back into strings unless decode_kmers is False, the ids are only comparable between
+    blocks with the same kmer_alphabet
+    """
+    wanted = FULL_COLUMNS if columns is None else columns
+    pieces = dict([(name, []) for name in wanted])
+    for header, arrays in iter_columnar_blocks(alignment_file, wanted):
+        for name in wanted:
+            if name in HEADER_COLUMNS:
+                value = header.metadata[name]
+                pieces[name].append(np.repeat(np.array([value], dtype="S{}".format(max(1, len(value)))),
+                                              header.rows))
+            elif name in KMER_COLUMNS and decode_kmers:
+                pieces[name].append(kmer_strings(arrays[name], header.metadata["kmer_alphabet"],
+                                                 int(header.metadata["kmer_length"])))
+            else:
+                pieces[name].append(arrays[name])
+    result = {}
+    for name in wanted:
+        if len(pieces[name]) == 0:
+            result[name] = np.array([])
+        elif len(pieces[name]) == 1:
+            result[name] = pieces[name][0]
+        else:
+            result[name] = np.concatenate(pieces[name])
+    return result
+
+
+def columnar_alignment_frame(alignment_file, names):
+    """DataFrame for code that works with the tab separated alignments, names maps the DataFrame's column names
+    to the columnar ones, eg. {"posterior_prob": "posterior_probability"}
+    """
+    arrays = read_columnar_alignment(alignment_file, columns=list(set(names.values())))
+    return pd.DataFrame(dict([(frame_name, arrays[name]) for frame_name, name in names.items()]))
+
+
+def read_shard_index(shard_file):
+    """the reads in a shard (see signalAlignLib.append_to_shard), as dicts with the read name, read label,
+    direction and the byte offset and length of the read's alignment in the shard
+    """
+    entries = []
+    with open(shard_file + ".index", "r") as fH:
+        for line in fH:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != 5:
+                continue
+            entries.append({"read_name": fields[0], "read_label": fields[1], "direction": fields[2],
+                            "offset": int(fields[3]), "length": int(fields[4])})
+    return entries
+
+
+def get_shard_files(directory):
+    """shards in a directory, the ones with an index
+    """
+    return sorted([directory + f[:-len(".index")] for f in os.listdir(directory)
+                   if f.startswith("shard") and f.endswith(".index")])
+
+
+def read_shard_entry(shard_file, entry):
+    """the bytes of one read's alignment in a shard, in the format it was written in
+    """
+    with open(shard_file, "rb") as fH:
+        fH.seek(entry["offset"])
+        return fH.read(entry["length"])
+
+
+def iter_shard_reads(shard_file, read_labels=None):
+    """yields (entry, alignment bytes) for the reads in a shard, or only the ones in read_labels
+    """
+    with open(shard_file, "rb") as fH:
+        for entry in read_shard_index(shard_file):
+            if read_labels is not None and entry["read_label"] not in read_labels:
+                continue
+            fH.seek(entry["offset"])
+            yield entry, fH.read(entry["length"])
+
+
+MANIFEST_FILE = "alignment_manifest.tsv"
+# a row for each alignment signalAlign wrote, see signalAlignLib.record_manifest_row
+MANIFEST_COLUMNS = ["read_label", "contig", "strand", "aligned_pairs", "mean_posterior", "events", "seconds",
+                    "peak_rss", "output"]
+
+
+def read_alignment_manifest(manifest_file):
+    """the rows of an alignment manifest as dicts, when a read was aligned again only its last row is kept
+    """
+    rows = OrderedDict()
+    with open(manifest_file, "r") as fH:
+        for line in fH:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != len(MANIFEST_COLUMNS):
+                continue
+            row = dict(zip(MANIFEST_COLUMNS, fields))
+            row["aligned_pairs"] = int(row["aligned_pairs"])
+            row["mean_posterior"] = float(row["mean_posterior"])
+            row["events"] = int(row["events"])
+            row["seconds"] = float(row["seconds"])
+            row["peak_rss"] = int(row["peak_rss"])
+            # sharded alignments share an output, they're told apart by the read and strand
+            rows.pop((row["output"], row["read_label"], row["strand"]), None)
+            rows[(row["output"], row["read_label"], row["strand"])] = row
+    return rows.values()
+
+
+def manifest_alignments(path_to_alignments, min_mean_posterior=None):
+    """the manifest rows of the alignments matching a glob pattern like /path/to/alignments/*.tsv, with the output
+    path made absolute, leaving out the ones without any aligned pairs or with a lower mean posterior than
+    min_mean_posterior. None when there isn't a manifest next to the alignments or none of its rows match, so
+    the caller can go back to looking at the files
+    """
+    directory, pattern = os.path.split(path_to_alignments)
+    manifest_file = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.isfile(manifest_file):
+        return None
+    rows = []
+    for row in read_alignment_manifest(manifest_file):
+        if not fnmatch.fnmatch(os.path.basename(row["output"]), pattern):
+            continue
+        row["output"] = os.path.join(directory, os.path.basename(row["output"]))
+        rows.append(row)
+    if len(rows) == 0:
+        return None
+    rows = [r for r in rows if r["aligned_pairs"] > 0]
+    if min_mean_posterior is not None:
+        rows = [r for r in rows if r["mean_posterior"] >= min_mean_posterior]
+    return rows
+
+
+REFERENCE_INDEX_EXTENSION = ".refidx"
+# one record for each row of an alignment, the offset is the byte offset of the row, or for block compressed
+# alignments the offset of its block shifted up 16 bits plus its offset in the block
+reference_index_dtype = np.dtype([("contig", "S64"), ("strand", "S1"), ("ref_pos", "<i8"), ("offset", "<i8")])
+
+
+def iter_alignment_lines(alignment_file, start=0, end=None):
+    """yields (offset, line) for the rows of a text alignment from byte start to end, the offsets are the ones the
+    reference index uses
+    """
+    if is_compressed_alignment(alignment_file):
+        with open(alignment_file, "rb") as fH:
+            for block_offset in block_offsets(alignment_file, start, end):
+                position = 0
+                for line in read_block(fH, block_offset).splitlines(True):
+                    yield (block_offset << 16) | position, line
+                    position += len(line)
+        return
+    with open(alignment_file, "rb") as fH:
+        fH.seek(start)
+        offset = start
+        while end is None or offset < end:
+            line = fH.readline()
+            if line == "":
+                break
+            yield offset, line
+            offset += len(line)
+
+
+def index_alignment_positions(alignment_file, contig, index_file=None, start=0, end=None):
+    """adds the rows of a full or variantCaller alignment (both have the reference position in the second column
+    and the strand in the fifth, unless a header says otherwise) to a reference index, by default the one next to
+    the alignment. start and end limit it to part of the file, eg. the read that was just appended to a shard
+    """
+    assert len(contig) <= reference_index_dtype["contig"].itemsize, \
+        "index_alignment_positions: contig name {} is too long for the index".format(contig)
+    columns = alignment_columns(alignment_file)
+    assert "ref_pos" in columns and "strand" in columns, \
+        "index_alignment_positions: {} doesn't have the reference positions".format(alignment_file)
+    position_field, strand_field = columns.index("ref_pos"), columns.index("strand")
+    if index_file is None:
+        index_file = alignment_file + REFERENCE_INDEX_EXTENSION
+    records = []
+    for offset, line in iter_alignment_lines(alignment_file, start, end):
+        if line.startswith("#"):
+            continue
+        fields = line.rstrip("\n").split("\t")
+        records.append((contig, fields[strand_field], int(fields[position_field]), offset))
+    with open(index_file, "ab") as fH:
+        np.array(records, dtype=reference_index_dtype).tofile(fH)
+    return len(records)
+
+
+class ReferenceIndex(object):
+    """which rows of a run's alignments cover each reference position, from the .refidx files written with the
+    alignments (see runSignalAlign --reference_index). The records are sorted by position once for each contig and
+    strand, so a query is a binary search plus reading the rows it finds
+    """
+    def __init__(self, alignment_files):
+        self.alignment_files = [f for f in alignment_files if os.path.isfile(f + REFERENCE_INDEX_EXTENSION)]
+        self.positions = {}  # (contig, strand): (sorted reference positions, alignment file ids, row offsets)
+        records = [np.fromfile(f + REFERENCE_INDEX_EXTENSION, dtype=reference_index_dtype)
+                   for f in self.alignment_files]
+        if sum([len(r) for r in records]) == 0:
+            return
+        file_ids = np.concatenate([np.repeat(np.int32(i), len(r)) for i, r in enumerate(records)])
+        records = np.concatenate(records)
+        order = np.lexsort((records["offset"], file_ids, records["ref_pos"]))
+        records, file_ids = records[order], file_ids[order]
+        for contig in np.unique(records["contig"]):
+            for strand in np.unique(records["strand"]):
+                mask = (records["contig"] == contig) & (records["strand"] == strand)
+                if mask.any():
+                    self.positions[(contig, strand)] = (records["ref_pos"][mask], file_ids[mask],
+                                                        records["offset"][mask])
+
+    @classmethod
+    def from_directory(cls, directory):
+        return cls(sorted([os.path.join(directory, f[:-len(REFERENCE_INDEX_EXTENSION)])
+                           for f in os.listdir(directory) if f.endswith(REFERENCE_INDEX_EXTENSION)]))
+
+    def contigs(self):
+        return sorted(set([contig for contig, strand in self.positions]))
+
+    def query(self, contig, strand, start, end=None):
+        """(alignment file, offset) of the rows on contig and strand with start <= reference position < end, end
+        defaults to start + 1
+        """
+        if (contig, strand) not in self.positions:
+            return []
+        end = start + 1 if end is None else end
+        positions, file_ids, offsets = self.positions[(contig, strand)]
+        lower, upper = np.searchsorted(positions, [start, end], side="left")
+        return [(self.alignment_files[i], o) for i, o in zip(file_ids[lower:upper], offsets[lower:upper])]
+
+    def query_rows(self, contig, strand, start, end=None):
+        """the rows query finds, as lists of fields, grouped by alignment file, each block of a compressed
+        alignment is only decompressed once
+        """
+        hits = {}
+        for alignment_file, offset in self.query(contig, strand, start, end):
+            hits.setdefault(alignment_file, []).append(offset)
+        rows = []
+        for alignment_file in sorted(hits.keys()):
+            compressed = is_compressed_alignment(alignment_file)
+            blocks = {}
+            with open(alignment_file, "rb") as fH:
+                for offset in hits[alignment_file]:
+                    if compressed:
+                        block_offset = offset >> 16
+                        if block_offset not in blocks:
+                            blocks[block_offset] = read_block(fH, block_offset)
+                        text = blocks[block_offset]
+                        position = offset & 0xffff
+                        line = text[position:text.index("\n", position)]
+                    else:
+                        fH.seek(offset)
+                        line = fH.readline().rstrip("\n")
+                    rows.append(line.split("\t"))
+        return rows
+
+
+DEFAULT_BATCH_SIZE = 100000
+FULL_COLUMN_TYPES = {"contig": np.str, "ref_pos": np.int64, "ref_kmer": np.str, "read_label": np.str,
+                     "strand": np.str, "event_index": np.int64, "event_mean": np.float64,
+                     "event_noise": np.float64, "event_duration": np.float64, "aligned_kmer": np.str,
+                     "scaled_mean_current": np.float64, "scaled_noise": np.float64,
+                     "posterior_probability": np.float64, "descaled_event_mean": np.float64,
+                     "ont_model_mean": np.float64, "path_kmer": np.str}
+
+
+def _predicate_columns(strand, min_posterior, kmers, kmer_column, exclude_positions):
+    columns = []
+    if strand is not None:
+        columns.append("strand")
+    if min_posterior is not None:
+        columns.append("posterior_probability")
+    if kmers is not None:
+        columns.append(kmer_column)
+    if exclude_positions is not None:
+        columns.append("ref_pos")
+    return columns
+
+
+def _iter_text_batches(alignment_file, columns, batch_size, strand, min_posterior, kmers, kmer_column,
+                       exclude_positions):
+    # files written with some of the columns name them in a header, the rest have them all in the usual order
+    file_columns = alignment_columns(alignment_file)
+    needed = set(columns + _predicate_columns(strand, min_posterior, kmers, kmer_column, exclude_positions))
+    missing = [name for name in needed if name not in file_columns]
+    assert len(missing) == 0, "iter_alignment_batches: {file} wasn't written with the column(s) {cols}" \
+                              "".format(file=alignment_file, cols=", ".join(missing))
+    needed = sorted(needed, key=file_columns.index)
+    reader = pd.read_table(alignment_file, usecols=[file_columns.index(name) for name in needed], names=needed,
+                           dtype=dict([(name, FULL_COLUMN_TYPES[name]) for name in needed]), header=None,
+                           skiprows=0 if file_columns is FULL_COLUMNS else 1,
+                           compression=alignment_compression(alignment_file), chunksize=batch_size)
+    for chunk in reader:
+        mask = np.ones(chunk.shape[0], dtype=bool)
+        if strand is not None:
+            mask &= chunk["strand"].values == strand
+        if min_posterior is not None:
+            mask &= chunk["posterior_probability"].values >= min_posterior
+        if kmers is not None:
+            mask &= np.in1d(chunk[kmer_column].values, kmers)
+        if exclude_positions is not None:
+            mask &= ~np.in1d(chunk["ref_pos"].values, exclude_positions)
+        yield np.rec.fromarrays([chunk[name].values[mask] for name in columns], names=columns)
+
+
+def _iter_columnar_batches(alignment_file, columns, batch_size, strand, min_posterior, kmers, kmer_column,
+                           exclude_positions):
+    needed = set(columns + _predicate_columns(strand, min_posterior, kmers, kmer_column, exclude_positions))
+
+    def strand_filter(header):
+        # the strand is in the header, blocks of the other strand don't get read at all
+        return strand is None or header.metadata["strand"] == strand
+
+    for header, arrays in iter_columnar_blocks(alignment_file, needed, strand_filter):
+        if arrays is None or header.rows == 0:
+            continue
+        alphabet = header.metadata["kmer_alphabet"]
+        kmer_length = int(header.metadata["kmer_length"])
+        mask = np.ones(header.rows, dtype=bool)
+        if min_posterior is not None:
+            mask &= arrays["posterior_probability"] >= min_posterior
+        if kmers is not None:
+            # compare the ids, only the rows we keep get turned back into kmers
+            mask &= np.in1d(arrays[kmer_column], [kmer_id(k, alphabet) for k in kmers])
+        if exclude_positions is not None:
+            mask &= ~np.in1d(arrays["ref_pos"], exclude_positions)
+        rows = np.nonzero(mask)[0]
+        for start in xrange(0, len(rows), batch_size):
+            selected = rows[start:start + batch_size]
+            fields = []
+            for name in columns:
+                if name in HEADER_COLUMNS:
+                    fields.append(np.repeat(header.metadata[name], len(selected)))
+                elif name in KMER_COLUMNS:
+                    fields.append(kmer_strings(arrays[name][selected], alphabet, kmer_length))
+                else:
+                    fields.append(arrays[name][selected])
+            yield np.rec.fromarrays(fields, names=columns)
+
+
+def iter_alignment_batches(alignment_file, columns, batch_size=DEFAULT_BATCH_SIZE, strand=None, min_posterior=None,
+                           kmers=None, kmer_column="aligned_kmer", exclude_positions=None, max_rows=None):
+    """reads a full format alignment (text, block compressed or columnar) as NumPy record arrays of at most
+    batch_size rows, so memory goes with the batch size and not the size of the file. Only the columns (names
+    from FULL_COLUMNS) asked for are parsed and returned. The rows can be limited to a strand, a minimum posterior
+    probability, a set of kmers (in kmer_column) and positions not in exclude_positions, rows that don't pass
+    don't make it into the batches. Stops once max_rows rows have been returned, the batch that reaches it is
+    returned whole
+    """
+    for name in columns:
+        assert name in FULL_COLUMNS, "iter_alignment_batches: unknown column {}".format(name)
+    if kmers is not None:
+        kmers = list(kmers)
+    if exclude_positions is not None:
+        exclude_positions = np.asarray(list(exclude_positions), dtype=np.int64)
+    if is_columnar_alignment(alignment_file):
+        batches = _iter_columnar_batches
+    else:
+        batches = _iter_text_batches
+    total = 0
+    for batch in batches(alignment_file, list(columns), batch_size, strand, min_posterior, kmers, kmer_column,
+                         exclude_positions):
+        if len(batch) == 0:
+            continue
+        yield batch
+        total += len(batch)
+        if max_rows is not None and total >= max_rows:
+            break
+
+
+def read_alignment_frame(alignment_file, names, **predicates):
+    """DataFrame of the rows iter_alignment_batches gives for the predicates, names is a list of
+    (DataFrame column, alignment column) pairs, eg. [("posterior_prob", "posterior_probability")]
+    """
+    columns = []
+    for frame_name, name in names:
+        if name not in columns:
+            columns.append(name)
+    batches = list(iter_alignment_batches(alignment_file, columns, **predicates))
+    if len(batches) == 0:
+        return pd.DataFrame(columns=[frame_name for frame_name, name in names])
+    data = np.concatenate(batches) if len(batches) > 1 else batches[0]
+    return pd.DataFrame(OrderedDict([(frame_name, data[name]) for frame_name, name in names]))
+
+
+HDF5_EXTENSION = ".h5"
+HDF5_ALIGNMENTS_FILE = "alignments.h5"
+HDF5_CHUNK_ROWS = 16384
+# the strings are fixed width in the HDF5 rows, so every batch (and every worker's part) has the same dtype, longer
+# ones are refused rather than cut short (see hdf5_records)
+HDF5_STRING_WIDTHS = {"contig": 64, "read_label": 128, "strand": 1, "ref_kmer": 16, "aligned_kmer": 16,
+                      "path_kmer": 16}
+# a row for each read appended to a group: where its rows are and the reference positions they cover
+hdf5_index_dtype = np.dtype([("read_label", "S128"), ("start", "<i8"), ("length", "<i8"), ("ref_start", "<i8"),
+                             ("ref_end", "<i8")])
+
+
+def hdf5_part(hdf5_file, worker):
+    """the file a worker (process id) appends to, merge_hdf5_parts puts them together in hdf5_file
+    """
+    return "{out}.part{worker}".format(out=hdf5_file, worker=worker)
+
+
+def hdf5_alignment_dtype(columns):
+    """the HDF5 row type for the full format columns
+    """
+    return np.dtype([(name, "S{}".format(HDF5_STRING_WIDTHS[name])) if FULL_COLUMN_TYPES[name] is np.str
+                     else (name, FULL_COLUMN_TYPES[name]) for name in columns])
+
+
+def _hdf5_columns(dtype):
+    # h5py marks the string fields of the dtypes it reads back with their encoding, so compare names and types
+    return [(name, dtype[name].str) for name in dtype.names]
+
+
+def hdf5_records(batch, dtype):
+    """a batch from iter_alignment_batches as HDF5 rows of dtype, the strings have to fit in its fields
+    """
+    for name in dtype.names:
+        if dtype[name].kind != "S" or len(batch) == 0:
+            continue
+        longest = np.asarray(batch[name]).astype(str).dtype.itemsize
+        assert longest <= dtype[name].itemsize, \
+            "hdf5_records: {column} values up to {length} characters don't fit in the HDF5 rows ({width})" \
+            "".format(column=name, length=longest, width=dtype[name].itemsize)
+    return np.array(batch, dtype=dtype)
+
+
+def append_hdf5_rows(fH, group_name, records, read_label, position_column):
+    """appends a read's records to the rows of a group in the open HDF5 file fH, and where they went to the
+    group's index. The rows are chunked and gzip compressed and grow as reads are added, the index has the
+    smallest and largest value of position_column so read_hdf5_region only has to read the reads that overlap
+    """
+    if len(records) == 0:
+        return
+    assert len(read_label) <= hdf5_index_dtype["read_label"].itemsize, \
+        "append_hdf5_rows: read label {} is too long for the index".format(read_label)
+    group = fH.require_group(group_name)
+    if "rows" not in group:
+        group.create_dataset("rows", shape=(0,), maxshape=(None,), dtype=records.dtype,
+                             chunks=(HDF5_CHUNK_ROWS,), compression="gzip", shuffle=True)
+        group.create_dataset("index", shape=(0,), maxshape=(None,), dtype=hdf5_index_dtype,
+                             chunks=(1024,), compression="gzip")
+        group.attrs["position_column"] = position_column
+    rows, index = group["rows"], group["index"]
+    assert _hdf5_columns(rows.dtype) == _hdf5_columns(records.dtype), \
+        "append_hdf5_rows: {group} has other columns".format(group=group_name)
+    start = rows.shape[0]
+    rows.resize((start + len(records),))
+    rows[start:] = records
+    positions = records[position_column] if position_column in records.dtype.names else None
+    entry = np.array([(read_label, start, len(records),
+                       positions.min() if positions is not None else -1,
+                       positions.max() if positions is not None else -1)], dtype=hdf5_index_dtype)
+    index.resize((index.shape[0] + 1,))
+    index[-1:] = entry
+
+
+def append_alignment_to_hdf5(alignment_file, hdf5_file, contig, direction, read_label,
+                             batch_size=DEFAULT_BATCH_SIZE):
+    """appends a read's full format alignment (any of the layouts iter_alignment_batches reads) to the
+    alignments/contig/direction group of hdf5_file
+    """
+    columns = alignment_columns(alignment_file)
+    dtype = hdf5_alignment_dtype(columns)
+    batches = [hdf5_records(batch, dtype) for batch in iter_alignment_batches(alignment_file, columns,
+                                                                               batch_size=batch_size)]
+    if len(batches) == 0:
+        return
+    records = np.concatenate(batches) if len(batches) > 1 else batches[0]
+    with h5py.File(hdf5_file, "a") as fH:
+        append_hdf5_rows(fH, "alignments/{contig}/{direction}".format(contig=contig, direction=direction),
+                         records, read_label, "ref_pos")
+
+
+def merge_hdf5_parts(hdf5_file, parts=None):
+    """puts the parts of hdf5_file (all the ones next to it by default) together. The rows of each group are a
+    virtual dataset over the parts' rows, one after the other, so nothing is copied and the parts have to stay
+    where they are, next to hdf5_file. The index is copied with the starts moved to where the part's rows are in
+    the virtual rows. Written to a temporary file that is renamed over hdf5_file
+    """
+    if parts is None:
+        directory = os.path.dirname(hdf5_file) or "."
+        prefix = os.path.basename(hdf5_part(hdf5_file, ""))
+        parts = sorted([os.path.join(directory, f) for f in os.listdir(directory) if f.startswith(prefix)])
+    groups = OrderedDict()
+
+    def collect(part):
+        def visit(name, item):
+            if isinstance(item, h5py.Group) and "rows" in item:
+                groups.setdefault(name, []).append((part, item["rows"].shape[0], item["rows"].dtype,
+                                                    item["index"][:], item.attrs["position_column"]))
+        return visit
+
+    for part in parts:
+        with h5py.File(part, "r") as fH:
+            fH.visititems(collect(part))
+    if len(groups) == 0:
+        return
+    temp_file = hdf5_file + ".tmp"
+    with h5py.File(temp_file, "w") as out:
+        for name, pieces in groups.items():
+            dtype = pieces[0][2]
+            layout = h5py.VirtualLayout(shape=(sum([n for _, n, _, _, _ in pieces]),), dtype=dtype)
+            offset, index = 0, []
+            for part, n, dt, part_index, position_column in pieces:
+                assert _hdf5_columns(dt) == _hdf5_columns(dtype), \
+                    "merge_hdf5_parts: {group} has other columns in {part}".format(group=name, part=part)
+                # a relative source is looked for next to the virtual dataset's file
+                layout[offset:offset + n] = h5py.VirtualSource(os.path.basename(part), name + "/rows", shape=(n,),
+                                                               dtype=dtype)
+                part_index["start"] += offset
+                index.append(part_index)
+                offset += n
+            group = out.require_group(name)
+            group.create_virtual_dataset("rows", layout)
+            group.create_dataset("index", data=np.concatenate(index), compression="gzip")
+            group.attrs["position_column"] = pieces[0][4]
+    os.rename(temp_file, hdf5_file)
+
+
+def read_hdf5_region(hdf5_file, group_name, start=None, end=None, read_labels=None):
+    """the rows of a group (eg. alignments/contig/forward or calls/t) with positions in [start, end), only
+    reading the reads the index says overlap the region, optionally only the reads in read_labels
+    """
+    with h5py.File(hdf5_file, "r") as fH:
+        group = fH[group_name]
+        index = group["index"][:]
+        position_column = group.attrs["position_column"]
+        keep = np.ones(len(index), dtype=bool)
+        if start is not None:
+            keep &= index["ref_end"] >= start
+        if end is not None:
+            keep &= index["ref_start"] < end
+        if read_labels is not None:
+            keep &= np.in1d(index["read_label"], list(read_labels))
+        rows = group["rows"]
+        records = [rows[entry["start"]:entry["start"] + entry["length"]] for entry in index[keep]]
+        if len(records) == 0:
+            return np.empty(0, dtype=rows.dtype)
+        records = np.concatenate(records)
+    if start is not None:
+        records = records[records[position_column] >= start]
+    if end is not None:
+        records = records[records[position_column] < end]
+    return records
@@ -4,10 +4,10 @@ from __future__ import print_function, division
 import sys
 sys.path.append("../")
 from argparse import ArgumentParser
-from alignmentAnalysisLib import CallMethylation
 from signalAlignLib import parse_substitution_file, degenerate_enum
-from variantCallingLib import get_alignments_labels_and_mask, get_reference_sequence
-from multiprocessing import Process, current_process, Manager
+from variantCallingLib import get_alignments_labels_and_mask, get_reference_sequence, variant_caller, \
+    merge_call_output
+from multiprocessing import Process, Manager
 
 
 def parse_args():
@@ -32,20 +32,13 @@ def parse_args():
                         help='Max number of alignments from each category to look at')
     parser.add_argument('--jobs', '-j', action='store', dest='nb_jobs', required=False,
                         default=4, type=int, help="number of jobs to run concurrently")
-    parser.add_argument('--out', '-o', action='store', type=str, required=True, dest='out')
+    parser.add_argument('--out', '-o', action='store', type=str, required=True, dest='out',
+                        help="file to write the calls to, tab separated or HDF5 (calls/<strand> with an index of "
+                             "the reads) if it ends with .h5")
 
     return parser.parse_args()
 
 
-def run_methyl_caller(work_queue, done_queue):
-    try:
-        for f in iter(work_queue.get, 'STOP'):
-            c = CallMethylation(**f)
-            c.write()
-    except Exception, e:
-        done_queue.put("%s failed with %s" % (current_process().name, e.message))
-
-
 def main(args):
     args = parse_args()
 
@@ -87,7 +80,7 @@ def main(args):
         work_queue.put(call_methyl_args)
 
     for w in xrange(workers):
-        p = Process(target=run_methyl_caller, args=(work_queue, done_queue))
+        p = Process(target=variant_caller, args=(work_queue, done_queue))
         p.start()
         jobs.append(p)
         work_queue.put('STOP')
@@ -97,5 +90,8 @@ def main(args):
 
     done_queue.put('STOP')
 
+    # the workers each wrote a part of the calls
+    merge_call_output(out_file, [p.pid for p in jobs])
+
 if __name__ == "__main__":
     sys.exit(main(sys.argv))
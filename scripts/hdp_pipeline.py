@@ -16,6 +16,7 @@ import sys
 from argparse import ArgumentParser
 from subprocess import check_call, Popen
 from shutil import copyfile
+from alignmentIO import is_assignments_file, count_assignments
 
 
 def parse_args():
@@ -107,6 +108,8 @@ def get_hdp_type(requested_type):
 
 
 def count_lines_in_build_alignment(build_alignment_path):
+    if is_assignments_file(build_alignment_path):
+        return count_assignments(build_alignment_path)
     count = 0
     for line in open(build_alignment_path, 'r').xreadlines():
         count += 1
@@ -183,8 +186,9 @@ pipeline_log = open(working_directory + "pipeline.log", 'a')
 command_line = " ".join(sys.argv[:])
 pipeline_log.write("[pipeline] Command Line: {}\n".format(command_line))
 signalAlign_directory = "../../signalAlign/"
-build_alignment_location = working_directory + "buildAlignment.tsv"
 if args.build_alignment is None:
+    # compact assignments, buildHdpUtil reads them without parsing any text
+    build_alignment_location = working_directory + "buildAlignment.assignments"
     # build alignment
     build_alignment_command = "{sA}scripts/makeBuildAlignments.py -o={bA} -t={threshold} -n={nbAssignments} " \
                               "".format(sA=signalAlign_directory, C=args.C_alns, mC=args.mC_alns,
@@ -207,6 +211,9 @@ if args.build_alignment is None:
 else:
     pipeline_log.write("[pipeline] NOTICE: using build alignment {}".format(args.build_alignment))
     assert os.path.isfile(args.build_alignment), "ERROR: Didn't find input BuildAlignment"
+    build_alignment_location = working_directory + ("buildAlignment.assignments"
+                                                    if is_assignments_file(args.build_alignment)
+                                                    else "buildAlignment.tsv")
     copyfile(args.build_alignment, build_alignment_location)
     approx_total_build_assignments = count_lines_in_build_alignment(build_alignment_location)
 
@@ -10,6 +10,7 @@ import pandas as pd
 import numpy as np
 from argparse import ArgumentParser
 from random import shuffle
+from alignmentIO import iter_alignment_batches, write_assignments_block, manifest_alignments
 
 
 def parse_args():
@@ -30,47 +31,83 @@ def parse_args():
                         help='total number of assignments to collect FOR EACH GROUP')
     parser.add_argument('--threshold', '-t', action='store', type=float, default=0.25, dest='threshold')
     parser.add_argument('--out', '-o', action='store', type=str, required=True, dest='out_file')
+    parser.add_argument('--text', action='store_true', default=False, dest='text',
+                        help="write the old tab separated build alignment instead of compact assignments")
 
     return parser.parse_args()
 
 
 def randomly_select_alignments(path_to_alignments):
-    alignments = [x for x in glob.glob(path_to_alignments) if os.stat(x).st_size != 0]
+    # the manifest has the alignments that got any aligned pairs, without it we look at the files
+    rows = manifest_alignments(path_to_alignments)
+    if rows is not None:
+        alignments = list(set([row["output"] for row in rows]))
+    else:
+        alignments = [x for x in glob.glob(path_to_alignments) if os.stat(x).st_size != 0]
     shuffle(alignments)
     return alignments
 
 
+def iter_assignments(alignments, strand, threshold, max_assignments, transtable):
+    """yields (kmers, event means, posteriors) a batch at a time until there are max_assignments of them
+    """
+    assert len(alignments) > 0, "Didn't find any alignments"
+    total = 0
+    for alignment in alignments:
+        try:
+            # the strand and threshold are applied as the batches are read, we stop once we have enough
+            for batch in iter_alignment_batches(alignment, ["aligned_kmer", "descaled_event_mean",
+                                                            "posterior_probability"],
+                                                strand=strand, min_posterior=threshold,
+                                                max_rows=max_assignments - total):
+                total += len(batch)
+                yield ([k.translate(transtable) for k in batch['aligned_kmer']], batch["descaled_event_mean"],
+                       batch["posterior_probability"])
+        except Exception:
+            print("ERROR: problem with alignment {}".format(alignment))
+            continue
+        if total >= max_assignments:
+            break
+
+
 def collect_assignments(alignments, strand, threshold, max_assignments, transtable):
     if alignments is None:
         return None
     else:
         assignments_list = []
         add_to_assignments = assignments_list.append
-        total = 0
-        assert len(alignments) > 0, "Didn't find any alignments"
-        for alignment in alignments:
-            try:
-                data = pd.read_table(alignment, usecols=(4, 9, 12, 13),
-                                     dtype={'strand': np.str,
-                                            'kmer': np.str,
-                                            'posterior_prob': np.float64,
-                                            'event_mean': np.float64},
-                                     header=None,
-                                     names=['strand', 'kmer', 'posterior_prob', 'event_mean'])
-                selected_rows = data.ix[(data['strand'] == strand) & (data['posterior_prob'] >= threshold)]
-                total += selected_rows.shape[0]
-                assignment_table = pd.DataFrame({"kmer": selected_rows['kmer'].str.translate(transtable),
-                                                 "event_mean": selected_rows["event_mean"]})
-                add_to_assignments(assignment_table)
-            except:
-                print("ERROR: problem with alignment {}".format(alignment))
-                continue
-            if total >= max_assignments:
-                break
+        for kmers, event_means, posteriors in iter_assignments(alignments, strand, threshold, max_assignments,
+                                                               transtable):
+            add_to_assignments(pd.DataFrame({"kmer": kmers, "event_mean": event_means}))
+        if len(assignments_list) == 0:
+            return pd.DataFrame(columns=["kmer", "event_mean"])
         assignments = pd.concat(assignments_list)
         return assignments
 
 
+def write_assignments(fH, c_alns, mc_alns, hmc_alns, strand, threshold, max_assignments):
+    """streams the assignments of a strand to fH as compact assignments blocks, a block for each batch, nothing
+    is kept in memory past the batch
+    """
+    counts = []
+    for alignments, trans_table in ((c_alns, string.maketrans("C", "C")), (mc_alns, string.maketrans("C", "E")),
+                                    (hmc_alns, string.maketrans("C", "O"))):
+        if alignments is None:
+            counts.append("None")
+            continue
+        count = 0
+        for kmers, event_means, posteriors in iter_assignments(alignments, strand, threshold, max_assignments,
+                                                               trans_table):
+            write_assignments_block(fH, strand, kmers, event_means, posteriors)
+            count += len(kmers)
+        counts.append(count)
+
+    print("[buildAlignments] NOTICE: I found {C} C-assignments, {mC} mC-assignments, and {hmC} hmC-assignments "
+          "for strand {strand}"
+          "".format(C=counts[0], mC=counts[1], hmC=counts[2], strand=strand),
+          file=sys.stderr)
+
+
 def make_build_alignment(c_alns, mc_alns, hmc_alns, strand, threshold, max_assignments):
     # translation tables for methylation
     C_trans_table = string.maketrans("C", "C")
@@ -107,6 +144,13 @@ def main(arguments):
     mC_alns = randomly_select_alignments(args.mC_alns) if args.mC_alns is not None else None
     hmC_alns = randomly_select_alignments(args.hmC_alns) if args.hmC_alns is not None else None
 
+    if not args.text:
+        # compact assignments, buildHdpUtil reads them as they are
+        with open(args.out_file, 'wb') as f:
+            for strand in ('t', 'c'):
+                write_assignments(f, C_alns, mC_alns, hmC_alns, strand, args.threshold, args.max_assignments)
+        return
+
     template_build_alignment = make_build_alignment(C_alns, mC_alns, hmC_alns, 't',
                                                     args.threshold, args.max_assignments)
 
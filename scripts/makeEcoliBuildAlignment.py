@@ -3,7 +3,7 @@
 """
 import sys
 import pandas as pd
-from alignmentAnalysisLib import parse_alignment_file, cull_list_of_alignment_files
+from alignmentAnalysisLib import parse_alignment_file, cull_list_of_alignment_files, ReferencePositionLookup
 from signalAlignLib import parse_substitution_file
 from argparse import ArgumentParser
 
@@ -58,11 +58,11 @@ def get_reverse_complement_hit_range(hit, kmer_length=6):
     return range(hit, hit + kmer_length)
 
 
-def get_assignments(data, hit_range, strand, substitution, threshold):
+def get_assignments(lookup, hit_range, strand, substitution, threshold):
     assignments = []
     for i, h in enumerate(hit_range):
-        crit = data['ref_pos'].map(lambda x: x == h)
-        selected = data[crit].ix[(data['strand'] == strand) & (data['posterior_prob'] >= threshold)]
+        selected = lookup.rows(strand, h)
+        selected = selected[selected['posterior_prob'] >= threshold]
         kmers = selected['kmer'].tolist()
         kmers = [substitute_kmer(kmer=x, i=i, sub=substitution) for x in kmers]
         assignment = pd.DataFrame({"kmer": kmers,
@@ -75,11 +75,11 @@ def get_assignments(data, hit_range, strand, substitution, threshold):
     return pd.concat(assignments)
 
 
-def get_assignment_table(data, hits, strand, get_range_function, substitution, threshold, kmer_length):
+def get_assignment_table(lookup, hits, strand, get_range_function, substitution, threshold, kmer_length):
     assignment_table = []
     for hit in hits:
         hit_range = get_range_function(hit, kmer_length=kmer_length)
-        assignments = get_assignments(data=data, hit_range=hit_range, strand=strand, substitution=substitution,
+        assignments = get_assignments(lookup=lookup, hit_range=hit_range, strand=strand, substitution=substitution,
                                       threshold=threshold)
         assignment_table.append(assignments)
     return assignment_table
@@ -94,18 +94,19 @@ def get_labeled_assignmets_from_alignment(alignment, positions, forward, thresho
 
     hits = set(data[crit].ix[data['strand'] == 't']['ref_pos'])
     rc_hits = set(data[rc_crit].ix[data['strand'] == 't']['ref_pos'])
+    lookup = ReferencePositionLookup(data)
 
     if forward is True:
-        assignments = get_assignment_table(data=data, hits=hits, strand='t', get_range_function=get_hit_range,
+        assignments = get_assignment_table(lookup=lookup, hits=hits, strand='t', get_range_function=get_hit_range,
                                            substitution=substitution, threshold=threshold, kmer_length=kmer_length)
-        rc_assignments = get_assignment_table(data=data, hits=rc_hits, strand='c',
+        rc_assignments = get_assignment_table(lookup=lookup, hits=rc_hits, strand='c',
                                               get_range_function=get_reverse_complement_hit_range,
                                               substitution=substitution, threshold=threshold, kmer_length=kmer_length)
     else:
-        assignments = get_assignment_table(data=data, hits=rc_hits, strand='t',
+        assignments = get_assignment_table(lookup=lookup, hits=rc_hits, strand='t',
                                            get_range_function=get_reverse_complement_hit_range,
                                            substitution=substitution, threshold=threshold, kmer_length=kmer_length)
-        rc_assignments = get_assignment_table(data=data, hits=hits, strand='c', get_range_function=get_hit_range,
+        rc_assignments = get_assignment_table(lookup=lookup, hits=hits, strand='c', get_range_function=get_hit_range,
                                               substitution=substitution, threshold=threshold, kmer_length=kmer_length)
 
     return assignments + rc_assignments
@@ -4,7 +4,8 @@ from __future__ import print_function
 import sys
 import os
 from random import shuffle
-from signalAlignLib import get_npRead_2dseq_and_models, exonerated_bwa, prepareOneD
+from signalAlignLib import get_npRead_2dseq_and_models, exonerated_bwa, prepareOneD, estimate_nanopore_params
+from processRunner import ProcessJob, ProcessRunner, run_process
 from argparse import ArgumentParser
 from serviceCourse.file_handlers import FolderHandler
 
@@ -31,11 +32,16 @@ def parse_args():
     #parser.add_argument('--constraintTrim', '-m', action='store', dest='trim', type=int,
     #                    required=False, default=14, help='amount to remove from an anchor constraint')
 
-    #parser.add_argument('--jobs', '-j', action='store', dest='nb_jobs', required=False,
-    #                    default=4, type=int, help="number of jobs to run concurrently")
+    parser.add_argument('--jobs', '-j', action='store', dest='nb_jobs', required=False,
+                        default=4, type=int, help="number of jobs to run concurrently")
     parser.add_argument('--nb_files', '-n', action='store', dest='nb_files', required=False,
                         default=500, type=int, help="maximum number of reads to align")
 
+    parser.add_argument('--params_table', action='store', dest='params_table', required=False, default=None,
+                        type=str, help="only estimate the adjustment parameters of each read and put them in this "
+                                       "table, for runSignalAlign/trainModels --nanopore_params")
+    parser.add_argument('--2d', action='store_true', dest='twoD', default=False)
+
     parser.add_argument('--output_location', '-o', action='store', dest='out',
                         required=True, type=str, default=None,
                         help="directory to put temp files")
@@ -72,17 +78,17 @@ def estimate_params_with_anchors(fast5, working_folder, bwa_index, forward_refer
 
     binary = "./estimateNanoporeParams"
 
-    command = "echo {cigar} | {bin} -T {tLuT} -C {cLuT} -q {npRead} -f {fRef} -b {bRef} -D {threshold}" \
-              "".format(cigar=cigar_string, bin=binary, tLuT=template_lookup_table, cLuT=complement_lookup_table,
-                        npRead=npRead_path, fRef=forward_reference_path, bRef=backward_reference_path,
-                        threshold=threshold)
-
-    print("running command {command}".format(command=command), file=sys.stderr)
+    argv = [binary, "-T", template_lookup_table, "-C", complement_lookup_table, "-q", npRead_path,
+            "-f", forward_reference_path, "-b", backward_reference_path, "-D", threshold]
 
-    os.system(command)
+    job = run_process(argv=argv, label=read_name, stdin=cigar_string)
+    return job.ok()
 
 
 def estimate_params(fast5, working_folder, twoD=False):
+    """makes the npRead for a read and returns the ProcessJob that estimates its parameters, or False if the read
+    couldn't be prepared. The npRead and sequence files are returned too so that they can be removed after
+    """
     assert (isinstance(working_folder, FolderHandler))
 
     read_name = fast5.split("/")[-1][:-6]  # get the name without the '.fast5'
@@ -95,7 +101,7 @@ def estimate_params(fast5, working_folder, twoD=False):
                                                                                         npRead_path=npRead_path,
                                                                                         twod_read_path=npRead_fasta)
     else:
-        success = prepareOneD(fast5=fast5, npRead_path=npRead_path, oneD_read_path=npRead_fasta)
+        success, version, pop1 = prepareOneD(fast5=fast5, npRead_path=npRead_path, oneD_read_path=npRead_fasta)
     if success is False:
         return False
 
@@ -105,15 +111,11 @@ def estimate_params(fast5, working_folder, twoD=False):
 
     binary = "./estimateNanoporeParams"
 
-    command = "{bin} -T {tLuT} -C {cLuT} -q {npRead}" \
-              "".format(bin=binary, tLuT=template_lookup_table, cLuT=complement_lookup_table, npRead=npRead_path)
+    argv = [binary, "-T", template_lookup_table, "-C", complement_lookup_table, "-q", npRead_path]
 
-    print("running command {command}".format(command=command), file=sys.stderr)
-
-    os.system(command)
-    working_folder.remove_file(npRead_path)
-    working_folder.remove_file(npRead_fasta)
-    return
+    # the estimates go to stdout, capture them so reads running at the same time don't get mixed up
+    job = ProcessJob(argv=argv, label=read_name, capture_stdout=True)
+    return job, npRead_path, npRead_fasta
 
 
 def main(args):
@@ -128,12 +130,34 @@ def main(args):
     if len(fast5s) > args.nb_files:
         shuffle(fast5s)
         fast5s = fast5s[:args.nb_files]
+    if args.params_table is not None:
+        table = estimate_nanopore_params(fast5s=[args.files_dir + x for x in fast5s], table_path=args.params_table,
+                                         working_directory=temp_dir_path, twoD=args.twoD, jobs=args.nb_jobs)
+        print("nanoporeParamRunner - {nb} reads in {table}".format(nb=len(table), table=args.params_table),
+              file=sys.stderr)
+        temp_folder.remove_folder()
+        return
+
+    prepared = []
     for fast5 in fast5s:
         #estimate_params(fast5=args.files_dir + fast5, working_folder=temp_folder, bwa_index=bwa_ref_index,
         #                forward_reference_path=plus_strand_sequence, backward_reference_path=minus_strand_sequence,
         #                threshold=args.threshold)
-        estimate_params(fast5=args.files_dir + fast5, working_folder=temp_folder)
-
+        estimate = estimate_params(fast5=args.files_dir + fast5, working_folder=temp_folder)
+        if estimate is not False:
+            prepared.append(estimate)
+
+    jobs = ProcessRunner(max_children=args.nb_jobs).run([job for job, npRead, fasta in prepared])
+    for job, npRead_path, npRead_fasta in prepared:
+        if job.ok():
+            print(job.stdout, end="", file=sys.stdout)
+        temp_folder.remove_file(npRead_path)
+        temp_folder.remove_file(npRead_fasta)
+
+    failed = [job.label for job in jobs if not job.ok()]
+    if len(failed) > 0:
+        print("nanoporeParamRunner - {nb} reads failed: {reads}".format(nb=len(failed), reads=" ".join(failed)),
+              file=sys.stderr)
     temp_folder.remove_folder()
     return
 
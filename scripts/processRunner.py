@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""Small layer for running the signalAlign binaries as child processes
+"""
+from __future__ import print_function, division
+import sys
+import os
+import time
+import resource
+import subprocess
+import tempfile
+
+# what a process says on stderr when an allocation fails, sonLib's st_malloc/st_calloc and the C library
+ALLOCATION_FAILURES = ("Malloc failed", "Calloc failed", "Cannot allocate memory", "out of memory", "MemoryError")
+
+
+class ProcessJob(object):
+    """One run of a binary. argv is the argument list, no shell is involved. stdin is text to feed the
+    process (eg. the guide alignment cigar), max_time is the wall-time limit in seconds and max_memory the address
+    space limit in MB, None means no limit. A process over the memory limit has its allocations fail, it shows
+    up as a non-zero exit status with out_of_memory set if it said so on stderr (see ALLOCATION_FAILURES) or was
+    killed with SIGKILL by someone else than us. stdout goes to our stdout unless capture_stdout is set. After
+    the job has run status, stderr (and stdout), elapsed, peak_rss, timed_out and out_of_memory are set.
+    """
+    def __init__(self, argv, label=None, stdin=None, max_time=None, max_memory=None, capture_stdout=False):
+        self.argv       = [str(x) for x in argv]
+        self.label      = label if label is not None else os.path.basename(self.argv[0])
+        self.stdin      = stdin
+        self.max_time   = max_time
+        self.max_memory = max_memory
+        self.capture_stdout = capture_stdout
+        self.status     = None   # exit status, negative is the signal that killed it
+        self.stderr     = ""     # everything the process wrote to stderr
+        self.stdout     = ""     # and to stdout, if we're capturing it
+        self.started    = None   # time.time() when the process started
+        self.elapsed    = None   # seconds the process ran for
+        self.timed_out  = False  # killed for going over max_time
+        self.out_of_memory = False  # failed for going over max_memory (or the kernel's OOM killer got it)
+        self.peak_rss   = None   # bytes, the most memory the process had resident
+
+        self._process     = None
+        self._stdin_file  = None
+        self._stderr_file = None
+        self._stdout_file = None
+
+    def command_line(self):
+        return " ".join(self.argv)
+
+    def ok(self):
+        return self.status == 0 and not self.timed_out
+
+    def failure_reason(self):
+        """timeout, memory or error for a failed job, None if it's ok
+        """
+        if self.ok():
+            return None
+        if self.timed_out:
+            return "timeout"
+        return "memory" if self.out_of_memory else "error"
+
+    def start(self):
+        def set_limits():
+            limit = int(self.max_memory) * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+        # stdin and stderr go through temp files, that way the process never blocks on a full pipe while we're
+        # polling it
+        if self.stdin is not None:
+            self._stdin_file = tempfile.TemporaryFile()
+            self._stdin_file.write(self.stdin if self.stdin.endswith("\n") else self.stdin + "\n")
+            self._stdin_file.seek(0)
+        self._stderr_file = tempfile.TemporaryFile()
+        if self.capture_stdout:
+            self._stdout_file = tempfile.TemporaryFile()
+        preexec_fn = set_limits if self.max_memory is not None and self.max_memory > 0 else None
+        self.started = time.time()
+        try:
+            self._process = subprocess.Popen(self.argv, stdin=self._stdin_file, stdout=self._stdout_file,
+                                             stderr=self._stderr_file,
+                                             preexec_fn=preexec_fn, close_fds=True)
+        except OSError as e:
+            # couldn't run the binary at all, eg. it isn't there
+            self.status = 127
+            self.stderr = "{label}: could not start {bin}: {err}\n".format(label=self.label, bin=self.argv[0],
+                                                                          err=e.strerror)
+            self.elapsed = 0.0
+            self._close()
+            return False
+        return True
+
+    def poll(self):
+        """checks on the process, kills it if it's over the time limit, returns True once it's done
+        """
+        if self._process is None:
+            return True
+        if not self._wait(block=False):
+            if self.max_time is not None and self.max_time > 0 and (time.time() - self.started) > self.max_time:
+                try:
+                    self._process.kill()
+                except OSError:
+                    pass  # finished in the meantime
+                self._wait(block=True)
+                self.timed_out = True
+            else:
+                return False
+        self.status = self._process.returncode
+        self.elapsed = time.time() - self.started
+        self._stderr_file.seek(0)
+        self.stderr = self._stderr_file.read()
+        if self.status != 0 and not self.timed_out:
+            self.out_of_memory = self.status == -9 or any([f in self.stderr for f in ALLOCATION_FAILURES])
+        if self._stdout_file is not None:
+            self._stdout_file.seek(0)
+            self.stdout = self._stdout_file.read()
+        self._process = None
+        self._close()
+        return True
+
+    def _wait(self, block):
+        """reaps the process with wait4 instead of through Popen so that we get its resource usage, returns False
+        if it's still running
+        """
+        pid, status, usage = os.wait4(self._process.pid, 0 if block else os.WNOHANG)
+        if pid == 0:
+            return False
+        if os.WIFSIGNALED(status):
+            self._process.returncode = -os.WTERMSIG(status)
+        else:
+            self._process.returncode = os.WEXITSTATUS(status)
+        self.peak_rss = usage.ru_maxrss * 1024  # kB on Linux
+        return True
+
+    def _close(self):
+        for f in (self._stdin_file, self._stderr_file, self._stdout_file):
+            if f is not None:
+                f.close()
+        self._stdin_file, self._stderr_file, self._stdout_file = None, None, None
+
+
+class ProcessRunner(object):
+    """Runs ProcessJobs with at most max_children going at once
+    """
+    def __init__(self, max_children=1, poll_interval=0.1, verbose=True):
+        assert max_children > 0, "[ProcessRunner]need to be able to run at least one child"
+        self.max_children  = max_children
+        self.poll_interval = poll_interval
+        self.verbose       = verbose
+
+    def run(self, jobs):
+        """runs the jobs, in order, and returns them once they're all done
+        """
+        pending = list(jobs)
+        pending.reverse()
+        running = []
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < self.max_children:
+                job = pending.pop()
+                if self.verbose:
+                    print("[ProcessRunner]running: {cmd}".format(cmd=job.command_line()), file=sys.stderr)
+                if job.start():
+                    running.append(job)
+                else:
+                    self._report(job)
+            still_running = []
+            for job in running:
+                if job.poll():
+                    self._report(job)
+                else:
+                    still_running.append(job)
+            if len(still_running) == len(running) and len(running) > 0:
+                time.sleep(self.poll_interval)
+            running = still_running
+        return jobs
+
+    def _report(self, job):
+        if job.ok():
+            if self.verbose:
+                print("[ProcessRunner]{label} finished in {t:.2f} seconds".format(label=job.label, t=job.elapsed),
+                      file=sys.stderr)
+        else:
+            if job.timed_out:
+                reason = "timed out"
+            elif job.out_of_memory:
+                reason = "ran out of memory (exit status {})".format(job.status)
+            else:
+                reason = "failed with exit status {}".format(job.status)
+            print("[ProcessRunner]{label} {reason} after {t:.2f} seconds, stderr:\n{err}"
+                  "".format(label=job.label, reason=reason, t=job.elapsed, err=job.stderr), file=sys.stderr)
+
+
+def run_process(argv, label=None, stdin=None, max_time=None, max_memory=None, capture_stdout=False, verbose=True):
+    """runs one command and waits for it, returns the finished ProcessJob
+    """
+    job = ProcessJob(argv=argv, label=label, stdin=stdin, max_time=max_time, max_memory=max_memory,
+                     capture_stdout=capture_stdout)
+    ProcessRunner(max_children=1, verbose=verbose).run([job])
+    return job
@@ -3,7 +3,9 @@
 """
 from __future__ import print_function
 import sys
+import glob
 from signalAlignLib import *
+from alignmentIO import merge_hdf5_parts, HDF5_ALIGNMENTS_FILE
 from multiprocessing import Process, Queue, current_process, Manager
 from serviceCourse.file_handlers import FolderHandler
 from argparse import ArgumentParser
@@ -55,12 +57,88 @@ def parse_args():
     #                    dest='substitution_file', help="Ambiguity positions")
     parser.add_argument('--jobs', '-j', action='store', dest='nb_jobs', required=False,
                         default=4, type=int, help="number of jobs to run in parallel")
+    parser.add_argument('--threads', action='store', dest='threads', required=False,
+                        default=1, type=int, help="number of threads each signalMachine uses to align the blocks "
+                                                  "between large gaps in the guide alignment, default: 1")
+    parser.add_argument('--viterbi', action='store_true', dest='viterbi', default=False,
+                        help="only find the most probable (Viterbi) path, skips the posterior calculation, "
+                             "faster but every assignment gets probability 1")
+    parser.add_argument('--max_diagonal_expansion', action='store', dest='max_diagonal_expansion', required=False,
+                        default=None, type=int, help="adaptive banding, start with the diagonal expansion and realign "
+                                                     "band limited regions with a wider band, up to this one")
+    parser.add_argument('--prune_threshold', action='store', dest='prune_threshold', required=False,
+                        default=None, type=float, help="drop degenerate paths with less than this fraction of their "
+                                                       "cell's probability in the forward pass")
+    parser.add_argument('--beam_width', action='store', dest='beam_width', required=False, default=None, type=int,
+                        help="keep at most this many degenerate paths per cell in the forward pass")
+    parser.add_argument('--contiguous_cells', action='store_true', dest='contiguous_cells', default=False,
+                        help="keep each dp diagonal's cells in one aligned buffer instead of one allocation per path")
+    parser.add_argument('--reference_window', action='store', dest='reference_window', required=False,
+                        default=None, type=int, help="only give signalMachine the part of the contig covered by the "
+                                                     "guide alignment, with this much padding on each side")
+    parser.add_argument('--checkpoint', action='store', dest='checkpoint_interval', required=False,
+                        default=None, type=int, help="only keep every k-th forward diagonal and recompute the rest "
+                                                     "in the traceback, lowers memory on long reads")
+    parser.add_argument('--memory_ceiling', action='store', dest='memory_ceiling', required=False,
+                        default=None, type=int, help="checkpoint any alignment matrix estimated to use more than "
+                                                     "this many MB")
+    parser.add_argument('--max_read_time', action='store', dest='max_read_time', required=False, default=None,
+                        type=int, help="kill the alignment of a read after this many seconds, the read goes in "
+                                       "failed_alignments.txt")
+    parser.add_argument('--max_read_memory', action='store', dest='max_read_memory', required=False, default=None,
+                        type=int, help="memory limit (MB) for the alignment of one read, reads over it go in "
+                                       "failed_alignments.txt as memory failures")
+    parser.add_argument('--chunk_size', action='store', dest='chunk_size', required=False, default=None, type=int,
+                        help="split reads with guide alignments longer than this many bases into chunks that are "
+                             "aligned in parallel, not used with the assignments output format")
+    parser.add_argument('--chunk_overlap', action='store', dest='chunk_overlap', required=False, default=500,
+                        type=int, help="number of bases neighboring chunks overlap by, default: 500")
+    parser.add_argument('--nanopore_params', action='store', dest='nanopore_params', required=False, default=None,
+                        type=str, help="table of per-read adjustment parameters (from --estimate_params or "
+                                       "nanoporeParamRunner), reads in it aren't re-estimated by signalMachine")
+    parser.add_argument('--estimate_params', action='store_true', dest='estimate_params', default=False,
+                        help="estimate the adjustment parameters of the reads that aren't in the --nanopore_params "
+                             "table (default: nanopore_params.tsv in the output location) before aligning")
+    parser.add_argument('--normalize_events', action='store_true', dest='normalize_events', default=False,
+                        help="with stored parameters, write drift/scale/shift corrected events into the npRead "
+                             "instead of passing the parameters to signalMachine, only for the threeState model "
+                             "(the HDP emissions depend on the scale)")
+    parser.add_argument('--memory_budget', action='store', dest='memory_budget', required=False, default=None,
+                        type=int, help="memory (MB) the alignments can use together, reads are started biggest first "
+                                       "as long as their estimated peak memory fits, with at most --jobs at a time")
+    parser.add_argument('--cost_table', action='store', dest='cost_table', required=False, default=None, type=str,
+                        help="alignment_costs.txt from an earlier run (eg. on the test reads) to calibrate the "
+                             "memory estimates with, default: the one in the output location, if it's there")
     parser.add_argument('--nb_files', '-n', action='store', dest='nb_files', required=False,
                         default=500, type=int, help="maximum number of reads to align")
     parser.add_argument('--ambig_char', '-X', action='store', required=False, default="X", type=str, dest='ambig_char',
                         help="Character to substitute at positions, default is 'X'.")
     parser.add_argument('--output_format', '-f', action='store', default="full", dest='outFmt',
-                        help="output format: full, variantCaller, or assignments. Default: full")
+                        help="output format: full, variantCaller, assignments, or binary (the full columns, "
+                             "column by column, see alignmentIO.py). Default: full")
+    parser.add_argument('--shards', action='store', dest='shards', required=False, default=None, type=int,
+                        help="append the alignments to this many shard files (shardN.tsv, with an index of where "
+                             "each read is in shardN.tsv.index) instead of writing a file per read, the reads go to "
+                             "the shards in turn")
+    parser.add_argument('--reference_index', action='store_true', dest='reference_index', default=False,
+                        help="index the rows of the full and variantCaller outputs by reference position as they're "
+                             "written (.refidx next to each output, see alignmentIO.ReferenceIndex)")
+    parser.add_argument('--compress_output', action='store_true', dest='compress_output', default=False,
+                        help="write the text output formats as block gzip (.gz, readable with zcat and in parallel "
+                             "block by block) and zlib compress the columns of the binary format")
+    parser.add_argument('--output_profile', action='store', dest='output_profile', default="full",
+                        choices=["full", "build", "analysis"],
+                        help="columns of the full output format to write: full (all of them), build (strand, "
+                             "kmer, posterior, event mean, what makeBuildAlignments reads) or analysis (adds the "
+                             "reference and event positions). Default: full")
+    parser.add_argument('--posterior_floor', action='store', dest='posterior_floor', required=False, default=None,
+                        type=float, help="don't write aligned pairs with a posterior probability lower than this, "
+                                         "the alignment itself still uses --threshold")
+    parser.add_argument('--hdf5_output', action='store_true', dest='hdf5_output', default=False,
+                        help="put the alignments (full or binary format) in alignments.h5 instead of a file per "
+                             "read, with chunked, compressed rows for each contig and direction and an index of "
+                             "the reads in them (see alignmentIO.read_hdf5_region). Each job writes a part of "
+                             "its own, the parts are merged with virtual datasets at the end and have to stay")
     parser.add_argument('--debug', action='store_true', dest="DEBUG", default=False)
 
     args = parser.parse_args()
@@ -101,18 +179,87 @@ def write_degenerate_reference_set(input_fasta, out_path):
             f.write("{seq}".format(seq=s[1]))
 
 
-def aligner(work_queue, done_queue):
+def aligner(work_queue, done_queue, chunk_queue=None, stitch_queue=None):
     try:
         for f in iter(work_queue.get, 'STOP'):
-            alignment = SignalAlignment(**f)
+            alignment = SignalAlignment(chunk_queue=chunk_queue, stitch_queue=stitch_queue, **f)
             alignment.run()
     except Exception, e:
         done_queue.put("%s failed with %s" % (current_process().name, e.message))
 
 
+def budget_aligner(work_queue, finished_queue, done_queue, chunk_queue=None, stitch_queue=None):
+    # like aligner, but says when each read is done so that run_under_memory_budget can hand its memory on
+    for index, alignment_args in iter(work_queue.get, 'STOP'):
+        try:
+            alignment = SignalAlignment(chunk_queue=chunk_queue, stitch_queue=stitch_queue, **alignment_args)
+            alignment.run()
+        except Exception, e:
+            done_queue.put("%s failed with %s" % (current_process().name, e.message))
+        finally:
+            finished_queue.put(index)
+
+
+def run_under_memory_budget(alignments, estimates, budget, workers, done_queue, chunk_queue=None, stitch_queue=None):
+    """aligns the reads with a pool of workers that last the whole run, so there's a fixed number of processes
+    (and of per-process outputs like the HDF5 parts). Reads are handed to the pool biggest first, as long as the
+    estimated peak memory (in bytes) of the ones being aligned stays under the budget, and each read's memory
+    goes back to the budget when a worker says it's done. A read that's over the budget on its own gets run by
+    itself
+    """
+    work_queue = Manager().Queue()
+    finished_queue = Manager().Queue()
+    jobs = []
+    for w in xrange(workers):
+        p = Process(target=budget_aligner, args=(work_queue, finished_queue, done_queue, chunk_queue, stitch_queue))
+        p.start()
+        jobs.append(p)
+
+    pending = sorted(zip(estimates, range(len(alignments))), reverse=True)
+    running = {}  # read index: estimated bytes
+    while len(pending) > 0 or len(running) > 0:
+        used = sum(running.values())
+        admitted = False
+        for i, (need, index) in enumerate(pending):
+            if len(running) >= workers:
+                break
+            if used + need <= budget or len(running) == 0:
+                work_queue.put((index, alignments[index]))
+                running[index] = need
+                pending.pop(i)
+                admitted = True
+                break
+        if not admitted:
+            # nothing else fits until a read is done
+            running.pop(finished_queue.get())
+
+    for p in jobs:
+        work_queue.put('STOP')
+    for p in jobs:
+        p.join()
+
+
+def chunk_aligner(chunk_queue, done_queue):
+    try:
+        for chunk in iter(chunk_queue.get, 'STOP'):
+            run_alignment_chunk(chunk)
+    except Exception, e:
+        done_queue.put("%s failed with %s" % (current_process().name, e.message))
+
+
 def concat_variant_call_files(path):
-    concat_command = "cat {path}/*.tsv > {path}/probs.tsv".format(path=path)
-    os.system(concat_command)
+    # the shards if there are any, otherwise the file for each read, compressed ones get decompressed
+    files = glob.glob(os.path.join(path, "shard*.tsv")) + glob.glob(os.path.join(path, "shard*.tsv.gz"))
+    if len(files) == 0:
+        files = glob.glob(os.path.join(path, "*.tsv")) + glob.glob(os.path.join(path, "*.tsv.gz"))
+    out_file = os.path.join(path, "probs.tsv")
+    with open(out_file + ".tmp", "wb") as out:
+        for f in sorted(files):
+            if f == out_file:
+                continue
+            with open_alignment(f) as fH:
+                shutil.copyfileobj(fH, out)
+    os.rename(out_file + ".tmp", out_file)
     return
 
 
@@ -149,6 +296,14 @@ def main(args):
         print("Did not find valid reference file, looked for it {here}".format(here=args.ref), file=sys.stderr)
         sys.exit(1)
 
+    if args.normalize_events and args.stateMachineType not in NORMALIZED_STATE_MACHINES:
+        print("--normalize_events is only for the {} models".format(", ".join(NORMALIZED_STATE_MACHINES)),
+              file=sys.stderr)
+        sys.exit(1)
+
+    # index and check the models once, before the workers start so that they share the registry
+    get_model_registry()
+
     # make directory to put temporary files
     temp_folder = FolderHandler()
     temp_dir_path = temp_folder.open_folder(args.out + "tempFiles_alignment")
@@ -177,6 +332,9 @@ def main(args):
     workers = args.nb_jobs
     work_queue = Manager().Queue()
     done_queue = Manager().Queue()
+    # chunks of long reads, aligned by the pool after the reads have been split
+    chunk_queue = Manager().Queue() if args.chunk_size is not None else None
+    stitch_queue = Manager().Queue() if args.chunk_size is not None else None
     jobs = []
 
     # list of read files
@@ -190,7 +348,33 @@ def main(args):
         shuffle(fast5s)
         fast5s = fast5s[:nb_files]
     print("[runSignalAlign]:NOTICE: Got {} files to align".format(len(fast5s)), file=sys.stdout)
-    for fast5 in fast5s:
+
+    # stored adjustment parameters, estimated in a batch so that alignment runs on the same reads can reuse them
+    nanopore_params_path = args.nanopore_params
+    if args.estimate_params and nanopore_params_path is None:
+        nanopore_params_path = args.out + "nanopore_params.tsv"
+    if args.estimate_params:
+        nanopore_params = estimate_nanopore_params(fast5s=fast5s, table_path=nanopore_params_path,
+                                                   working_directory=temp_dir_path, twoD=args.twoD,
+                                                   template_model=args.in_T_Hmm, complement_model=args.in_C_Hmm,
+                                                   jobs=args.nb_jobs)
+    elif nanopore_params_path is not None:
+        nanopore_params = NanoporeParamsTable(nanopore_params_path)
+    else:
+        nanopore_params = None
+    # the same output, aligner and job options for every read
+    output = OutputOptions(output_format=args.outFmt, compress=args.compress_output, profile=args.output_profile,
+                           posterior_floor=args.posterior_floor, shards=args.shards,
+                           reference_index=args.reference_index, hdf5=args.hdf5_output)
+    aligner_options = AlignerOptions(threads=args.threads, viterbi=args.viterbi,
+                                     checkpoint_interval=args.checkpoint_interval, memory_ceiling=args.memory_ceiling,
+                                     max_diagonal_expansion=args.max_diagonal_expansion,
+                                     prune_threshold=args.prune_threshold, beam_width=args.beam_width,
+                                     reference_window=args.reference_window, contiguous_cells=args.contiguous_cells)
+    limits = JobOptions(max_time=args.max_read_time, max_memory=args.max_read_memory, chunk_size=args.chunk_size,
+                        chunk_overlap=args.chunk_overlap)
+    alignments = []
+    for read_index, fast5 in enumerate(fast5s):
         alignment_args = {
             "reference_map": reference_map,
             "path_to_EC_refs": None,  # TODO refactor this out!
@@ -201,7 +385,6 @@ def main(args):
             "in_complementHmm": args.in_C_Hmm,
             "in_templateHdp": args.templateHDP,
             "in_complementHdp": args.complementHDP,
-            "output_format": args.outFmt,
             "in_fast5": fast5,
             "threshold": args.threshold,
             "diagonal_expansion": args.diag_expansion,
@@ -209,21 +392,74 @@ def main(args):
             "target_regions": target_regions,
             "degenerate": degenerate_enum(args.degenerate),
             "twoD_chemistry": args.twoD,
+            "output": output,
+            "aligner": aligner_options,
+            "limits": limits,
+            "nanopore_params": nanopore_params.get(fast5.split("/")[-1]) if nanopore_params is not None else None,
+            "normalize_events": args.normalize_events,
+            "read_index": read_index,
         }
         #alignment = SignalAlignment(**alignment_args)
         #alignment.run()
-        work_queue.put(alignment_args)
+        alignments.append(alignment_args)
+
+    if args.memory_budget is not None:
+        # pack the reads under the budget with their estimated peak memory, calibrated with the costs of
+        # alignments we've already done
+        cost_model = AlignmentCostModel()
+        cost_table = args.cost_table if args.cost_table is not None else temp_dir_path + "alignment_costs.txt"
+        nb_observations = cost_model.calibrate(parse_alignment_costs(cost_table))
+        diagonal_expansion = args.max_diagonal_expansion if args.max_diagonal_expansion is not None else \
+            (args.diag_expansion if args.diag_expansion is not None else 50)
+        estimates = []
+        for alignment_args in alignments:
+            estimate = estimate_fast5_alignment(alignment_args["in_fast5"], cost_model, diagonal_expansion,
+                                                twoD=args.twoD, threads=args.threads)
+            estimates.append(estimate["peak_bytes"] if estimate is not None else cost_model.base_bytes)
+        print("[runSignalAlign]:NOTICE: estimated peak memory {total:.1f} MB over {n} reads, largest {big:.1f} MB, "
+              "calibrated with {obs} alignments".format(total=sum(estimates) / 1048576.0, n=len(estimates),
+                                                        big=max(estimates + [0]) / 1048576.0, obs=nb_observations),
+              file=sys.stderr)
+        run_under_memory_budget(alignments, estimates, args.memory_budget * 1024 * 1024, workers, done_queue,
+                                chunk_queue, stitch_queue)
+    else:
+        for alignment_args in alignments:
+            work_queue.put(alignment_args)
+
+        for w in xrange(workers):
+            p = Process(target=aligner, args=(work_queue, done_queue, chunk_queue, stitch_queue))
+            p.start()
+            jobs.append(p)
+            work_queue.put('STOP')
+
+        for p in jobs:
+            p.join()
+
+    if chunk_queue is not None:
+        # align the chunks of the long reads with the whole pool, then stitch them
+        jobs = []
+        for w in xrange(workers):
+            p = Process(target=chunk_aligner, args=(chunk_queue, done_queue))
+            p.start()
+            jobs.append(p)
+            chunk_queue.put('STOP')
+
+        for p in jobs:
+            p.join()
+
+        stitch_queue.put('STOP')
+        for plan in iter(stitch_queue.get, 'STOP'):
+            finish_chunked_alignment(plan)
 
-    for w in xrange(workers):
-        p = Process(target=aligner, args=(work_queue, done_queue))
-        p.start()
-        jobs.append(p)
-        work_queue.put('STOP')
+    done_queue.put('STOP')
 
-    for p in jobs:
-        p.join()
+    if args.hdf5_output:
+        merge_hdf5_parts(temp_dir_path + HDF5_ALIGNMENTS_FILE)
 
-    done_queue.put('STOP')
+    failures = parse_alignment_failures(temp_dir_path + "failed_alignments.txt")
+    if len(failures) > 0:
+        print("[runSignalAlign]:NOTICE: {nb} reads failed to align, see {table}"
+              "".format(nb=len(failures), table=temp_dir_path + "failed_alignments.txt"), file=sys.stderr)
     print("\n#  signalAlign - finished alignments\n", file=sys.stderr)
     print("\n#  signalAlign - finished alignments\n", file=sys.stdout)
 
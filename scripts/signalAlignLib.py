@@ -6,11 +6,17 @@ import os
 import pysam
 import h5py
 import subprocess
+import shutil
 import re
+import fcntl
 import numpy as np
 from itertools import islice, izip
 from random import shuffle
 from motif import getMotif
+from processRunner import ProcessJob, ProcessRunner, run_process
+from alignmentIO import open_alignment, alignment_header, alignment_columns, BlockCompressedWriter, \
+    index_alignment_positions, is_compressed_alignment, is_columnar_alignment, read_columnar_block, \
+    write_columnar_block, FULL_COLUMNS, MANIFEST_FILE, HDF5_ALIGNMENTS_FILE, hdf5_part, append_alignment_to_hdf5
 from serviceCourse.sequenceTools import reverse_complement
 from serviceCourse.parsers import read_fasta
 from serviceCourse.file_handlers import FolderHandler
@@ -18,6 +24,7 @@ from serviceCourse.file_handlers import FolderHandler
 # Globals
 NORM_DIST_PARAMS = 2
 NB_MODEL_PARAMS = 5
+NB_EVENT_PARAMS = 4  # mean, stdv, length, delta_time per event in an npRead
 
 
 def parse_fofn(fofn_file):
@@ -120,6 +127,206 @@ def get_npRead_2dseq_and_models(fast5, npRead_path, twod_read_path):
         return False, None, False
 
 
+class NanoporeParamsTable(object):
+    """Per-read nanopore adjustment parameters, so that they only have to be estimated once for a read set. The
+    table is tab separated with the columns:
+    read_label  strand  scale  shift  var  scale_sd  var_sd  drift
+    read_label is the name of the .fast5 and strand is t (template) or c (complement)
+    """
+    param_names = ["scale", "shift", "var", "scale_sd", "var_sd", "drift"]
+
+    def __init__(self, table_path=None):
+        self.table_path = table_path
+        self.params = {}  # read_label -> {strand: [scale, shift, var, scale_sd, var_sd, drift]}
+        if table_path is not None and os.path.isfile(table_path):
+            with open(table_path, "r") as fH:
+                self.add_rows(fH)
+
+    def add_rows(self, lines):
+        for line in lines:
+            fields = line.split()
+            if len(fields) != 2 + len(self.param_names):
+                continue
+            self.params.setdefault(fields[0], {})[fields[1]] = map(float, fields[2:])
+
+    def get(self, read_label):
+        """the stored parameters for a read, {"t": [...], "c": [...]}, or None if we don't have them
+        """
+        return self.params.get(read_label)
+
+    def __contains__(self, read_label):
+        return read_label in self.params
+
+    def __len__(self):
+        return len(self.params)
+
+    def write(self, table_path=None):
+        table_path = self.table_path if table_path is None else table_path
+        with open(table_path, "w") as fH:
+            for read_label in sorted(self.params.keys()):
+                for strand in sorted(self.params[read_label].keys(), reverse=True):  # t before c
+                    fH.write("{read}\t{strand}\t{params}\n".format(
+                        read=read_label, strand=strand,
+                        params="\t".join(["%.10g" % x for x in self.params[read_label][strand]])))
+
+
+def set_npRead_params(npRead_path, params):
+    """writes stored adjustment parameters into the header of an npRead (see nanopore_loadNanoporeReadFromFile),
+    params is a row from NanoporeParamsTable, strands it doesn't have keep the values from the .fast5
+    """
+    with open(npRead_path, "r") as fH:
+        lines = fH.readlines()
+    header = lines[0].split()
+    assert len(header) == 18, "set_npRead_params - unexpected npRead header in {}".format(npRead_path)
+    for strand, offset in (("t", 5), ("c", 11)):
+        if strand in params:
+            header[offset:offset + 6] = [repr(x) for x in params[strand]]
+    lines[0] = " ".join(header) + "\n"
+    with open(npRead_path, "w") as fH:
+        fH.writelines(lines)
+
+
+def normalize_events(events, scale, shift, var, drift):
+    """Vectorized version of the adjustment signalMachine does for each event. events is an (n, 4) array of
+    [mean, stdv, length, delta_time] rows, as they are in an npRead. The means are drift corrected and descaled in
+    one array expression:
+        mean' = (mean - drift * delta_time - shift) / scale
+    the other columns are copied. Once the means are descaled the level spread of the model is var / scale, so
+    that is returned as the var to use with the normalized events. Returns (normalized_events, var)
+    """
+    events = np.asarray(events, dtype=np.float64)
+    assert events.ndim == 2 and events.shape[1] == NB_EVENT_PARAMS, "normalize_events - need (n, 4) events"
+    assert scale != 0, "normalize_events - scale can't be 0"
+    normalized = events.copy()
+    normalized[:, 0] = (events[:, 0] - drift * events[:, 3] - shift) / scale
+    return normalized, var / scale
+
+
+def normalize_npRead(npRead_path, params=None, out_path=None):
+    """normalizes the events of an npRead with normalize_events and writes them back into the npRead payload
+    (out_path, or in place). params is a row from NanoporeParamsTable, strands it doesn't have use the parameters
+    in the npRead header. The header gets scale 1, shift 0, drift 0 and the var from normalize_events for the
+    normalized strands. scale_sd and var_sd are for the noise, which isn't touched, so they're kept.
+    The threeState machine descales each event against the unscaled model before the Gaussian, and that gives
+    the same value for the normalized events, so its emissions don't change. The HDP machine also multiplies
+    the density by 1 / var, so its likelihoods do, which is why NORMALIZED_STATE_MACHINES only has threeState.
+    The event_mean and scaled_mean_current columns signalMachine writes are on the normalized scale, see
+    denormalize_alignment
+    """
+    with open(npRead_path, "r") as fH:
+        lines = fH.readlines()
+    header = lines[0].split()
+    assert len(header) == 18, "normalize_npRead - unexpected npRead header in {}".format(npRead_path)
+    # header offset of the strand's parameters, line with the strand's events
+    for strand, offset, event_line in (("t", 5, 7), ("c", 11, 9)):
+        event_fields = lines[event_line].split()
+        if len(event_fields) == 0:
+            continue
+        if params is not None and strand in params:
+            scale, shift, var, scale_sd, var_sd, drift = params[strand]
+        else:
+            scale, shift, var, scale_sd, var_sd, drift = map(float, header[offset:offset + 6])
+        events = np.array(event_fields, dtype=np.float64).reshape(-1, NB_EVENT_PARAMS)
+        normalized, var = normalize_events(events, scale=scale, shift=shift, var=var, drift=drift)
+        lines[event_line] = " ".join(map(repr, normalized.ravel().tolist())) + "\n"
+        header[offset:offset + 6] = [repr(x) for x in (1.0, 0.0, var, scale_sd, var_sd, 0.0)]
+    lines[0] = " ".join(header) + "\n"
+    with open(npRead_path if out_path is None else out_path, "w") as fH:
+        fH.writelines(lines)
+
+
+NORMALIZED_STATE_MACHINES = ("threeState",)  # the models normalize_npRead doesn't change the emissions of
+DENORMALIZED_COLUMNS = ("event_mean", "scaled_mean_current")
+
+
+def denormalize_alignment(alignment_file, params):
+    """puts the event_mean and scaled_mean_current columns of a full format alignment (text, block compressed or
+    columnar) of a normalize_npRead npRead back on the scale of the raw events, mean * scale + shift with the
+    strand's parameters, so the output is the same as for the raw npRead. params is the NanoporeParamsTable row
+    the npRead was normalized with. The file is rewritten in place, before it gets indexed or appended anywhere
+    """
+    temp_file = alignment_file + ".denormalized"
+    if is_columnar_alignment(alignment_file):
+        with open(alignment_file, "rb") as fH, open(temp_file, "wb") as out:
+            while True:
+                block = read_columnar_block(fH)
+                if block is None:
+                    break
+                header, arrays = block
+                scale, shift = params[header.metadata["strand"]][0:2]
+                columns = [(name, arrays[name] * scale + shift if name in DENORMALIZED_COLUMNS else arrays[name])
+                           for name in header.column_names()]
+                write_columnar_block(out, header.format, columns, metadata=header.metadata.items(),
+                                     compress=header.compression == "zlib")
+        os.rename(temp_file, alignment_file)
+        return
+    columns = alignment_columns(alignment_file)
+    fields = [columns.index(name) for name in DENORMALIZED_COLUMNS if name in columns]
+    if len(fields) == 0:
+        return
+    assert "strand" in columns, "denormalize_alignment: {} doesn't have the strands".format(alignment_file)
+    strand_field = columns.index("strand")
+    compressed = is_compressed_alignment(alignment_file)
+    with open_alignment(alignment_file) as fH, open(temp_file, "wb") as out:
+        writer = BlockCompressedWriter(out) if compressed else out
+        for line in fH:
+            if not line.startswith("#"):
+                row = line.rstrip("\n").split("\t")
+                scale, shift = params[row[strand_field]][0:2]
+                for i in fields:
+                    row[i] = "%f" % (float(row[i]) * scale + shift)
+                line = "\t".join(row) + "\n"
+            writer.write(line)
+        if compressed:
+            writer.close()
+    os.rename(temp_file, alignment_file)
+
+
+def estimate_nanopore_params(fast5s, table_path, working_directory, twoD=False, template_model=None,
+                             complement_model=None, jobs=4):
+    """estimates the adjustment parameters of the reads that aren't in the table yet with estimateNanoporeParams,
+    jobs at a time, and adds them to the table. The default models for each read's version are used unless
+    models are given. Returns the NanoporeParamsTable
+    """
+    table = NanoporeParamsTable(table_path)
+    estimation_jobs = []
+    prepared_files = []
+    for fast5 in fast5s:
+        read_label = fast5.split("/")[-1]
+        if read_label in table:
+            continue
+        npRead_path = os.path.join(working_directory, read_label + ".params.npRead")
+        fasta_path = os.path.join(working_directory, read_label + ".params.fa")
+        if twoD:
+            ok, version, pop1_complement = get_npRead_2dseq_and_models(fast5=fast5, npRead_path=npRead_path,
+                                                                       twod_read_path=fasta_path)
+        else:
+            ok, version, pop1_complement = prepareOneD(fast5=fast5, npRead_path=npRead_path,
+                                                       oneD_read_path=fasta_path)
+        prepared_files += [npRead_path, fasta_path]
+        if not ok:
+            continue
+        t_model = template_model if template_model is not None else default_template_model_from_version(version)
+        argv = ["./estimateNanoporeParams", "--paramsTable", "-L", read_label, "-T", t_model, "-q", npRead_path]
+        if twoD:
+            c_model = complement_model if complement_model is not None else \
+                default_complement_model_from_version(version, pop1_complement=pop1_complement)
+            argv += ["-C", c_model]
+        estimation_jobs.append(ProcessJob(argv=argv, label=read_label, capture_stdout=True))
+
+    print("[estimate_nanopore_params]estimating parameters for {new} reads, {old} already in {table}"
+          "".format(new=len(estimation_jobs), old=len(table), table=table_path), file=sys.stderr)
+    ProcessRunner(max_children=jobs, verbose=False).run(estimation_jobs)
+    for job in estimation_jobs:
+        if job.ok():
+            table.add_rows(job.stdout.splitlines())
+    for f in prepared_files:
+        if os.path.isfile(f):
+            os.remove(f)
+    table.write()
+    return table
+
+
 def parse_substitution_file(substitution_file):
     fH = open(substitution_file, 'r')
     line = fH.readline().split()
@@ -182,6 +389,179 @@ def process_reference_fasta(fasta, work_folder, motif_key=None, sub_char=None):
     return ref_sequence_map
 
 
+def write_reference_window(reference_path, start, end, out_path):
+    """copies reference[start:end] from one of the flat reference files made by process_reference_fasta into
+    out_path, without reading the rest of the contig. Returns the length of the window written
+    """
+    assert start >= 0 and end >= start, "write_reference_window: illegal window {s}-{e}".format(s=start, e=end)
+    with open(reference_path, 'r') as fH:
+        fH.seek(start)
+        window = fH.read(end - start).strip()
+    with open(out_path, 'w') as fH:
+        print(window, end='\n', file=fH)
+    return len(window)
+
+
+def get_reference_window(cigar_string, reference_length, padding):
+    """gets the window of the contig covered by the guide alignment in an exonerate cigar string, with padding
+    on both sides, returns (start, end) clipped to the contig
+    """
+    fields = cigar_string.split()
+    reference_start, reference_end = int(fields[6]), int(fields[7])
+    start = max(0, min(reference_start, reference_end) - padding)
+    end = min(reference_length, max(reference_start, reference_end) + padding)
+    return start, end
+
+
+def guide_alignment_operations(cigar_string):
+    """walks the operations of an exonerate cigar string, yields (operation, length, query position,
+    reference position) at the start of each operation. M and I move along the query, M and D move along the
+    reference, which goes backwards for reads mapped to the - strand
+    """
+    fields = cigar_string.split()
+    query_position, reference_position = int(fields[2]), int(fields[6])
+    reference_step = 1 if fields[8] == "+" else -1
+    for i in xrange(10, len(fields), 2):
+        operation, length = fields[i], int(fields[i + 1])
+        yield operation, length, query_position, reference_position
+        if operation == "M" or operation == "I":
+            query_position += length
+        if operation == "M" or operation == "D":
+            reference_position += reference_step * length
+
+
+def clip_guide_alignment(cigar_string, query_start, query_end):
+    """clips an exonerate cigar string to the part of the read between query_start and query_end, the clipped
+    guide alignment starts and ends with a match, returns None if there isn't a match in the region
+    """
+    fields = cigar_string.split()
+    reference_step = 1 if fields[8] == "+" else -1
+    operations = []
+    for operation, length, q, r in guide_alignment_operations(cigar_string):
+        if operation == "D":
+            if query_start <= q < query_end:
+                operations.append((operation, length, q, r))
+            continue
+        start, end = max(q, query_start), min(q + length, query_end)
+        if start >= end:
+            continue
+        r_start = r + reference_step * (start - q) if operation == "M" else r
+        operations.append((operation, end - start, start, r_start))
+
+    # trim the indels off of the ends
+    while len(operations) > 0 and operations[0][0] != "M":
+        operations.pop(0)
+    while len(operations) > 0 and operations[-1][0] != "M":
+        operations.pop()
+    if len(operations) == 0:
+        return None
+
+    first, last = operations[0], operations[-1]
+    clipped_query_start, clipped_reference_start = first[2], first[3]
+    clipped_query_end = last[2] + last[1]
+    clipped_reference_end = last[3] + reference_step * last[1]
+    return "cigar: {q} {qs} {qe} {qst} {t} {ts} {te} {tst} {score} {ops}".format(
+        q=fields[1], qs=clipped_query_start, qe=clipped_query_end, qst=fields[4], t=fields[5],
+        ts=clipped_reference_start, te=clipped_reference_end, tst=fields[8], score=fields[9],
+        ops=" ".join(["%s %i" % (op[0], op[1]) for op in operations]))
+
+
+def guide_alignment_reference_position(cigar_string, query_position):
+    """gets the reference position the guide alignment puts the query position at
+    """
+    fields = cigar_string.split()
+    reference_step = 1 if fields[8] == "+" else -1
+    reference_position = int(fields[6])
+    for operation, length, q, r in guide_alignment_operations(cigar_string):
+        reference_position = r
+        if operation == "D":
+            continue
+        if q <= query_position < q + length:
+            return r + reference_step * (query_position - q) if operation == "M" else r
+        if operation == "M":
+            reference_position = r + reference_step * length
+    return reference_position
+
+
+def split_guide_alignment(cigar_string, chunk_size, chunk_overlap):
+    """splits the guide alignment of a long read into chunks of chunk_size read bases that overlap by
+    chunk_overlap. Each chunk keeps the aligned pairs in the interior of its overlaps, the cut between two
+    chunks is at the reference position the guide alignment puts the middle of their overlap. Returns a list of
+    (clipped cigar string, lower, upper), a chunk keeps the reference positions in [lower, upper), None is no
+    bound. Reads shorter than chunk_size give one chunk with the whole guide alignment.
+    """
+    assert 0 <= chunk_overlap < chunk_size, "[split_guide_alignment]overlap needs to be smaller than the chunks"
+    fields = cigar_string.split()
+    query_start, query_end = int(fields[2]), int(fields[3])
+    forward = fields[8] == "+"
+    if query_end - query_start <= chunk_size:
+        return [(cigar_string, None, None)]
+
+    step = chunk_size - chunk_overlap
+    regions = []
+    start = query_start
+    while True:
+        end = min(start + chunk_size, query_end)
+        regions.append((start, end))
+        if end == query_end:
+            break
+        start += step
+
+    # reference positions where neighboring chunks hand over
+    cuts = [guide_alignment_reference_position(cigar_string, (regions[i + 1][0] + regions[i][1]) // 2)
+            for i in xrange(len(regions) - 1)]
+
+    chunks = []
+    for i, (start, end) in enumerate(regions):
+        clipped = clip_guide_alignment(cigar_string, start, end)
+        if clipped is None:
+            continue
+        before = cuts[i - 1] if i > 0 else None
+        after = cuts[i] if i < len(cuts) else None
+        # the reference goes backwards along - strand reads
+        lower, upper = (before, after) if forward else (after, before)
+        chunks.append((clipped, lower, upper))
+    return chunks
+
+
+def stitch_alignment_chunks(chunk_files, out_file):
+    """puts together the alignments of the chunks of a read, chunk_files is a list of (path, lower, upper) in read
+    order, only the aligned pairs with reference position in [lower, upper) are taken from each chunk. Works on
+    the full and variantCaller formats, both have the reference position in the second column and the strand in
+    the fifth, or in the columns named by the header of a full alignment with some of the columns. Template aligned
+    pairs go first like they do in the output of signalMachine. The chunks can be compressed, out_file is block
+    compressed if it ends in .gz
+    """
+    header = None
+    for path, lower, upper in chunk_files:
+        header = alignment_header(path)
+        if header is not None:
+            break
+    columns = FULL_COLUMNS if header is None else header
+    position_field, strand_field = columns.index("ref_pos"), columns.index("strand")
+    with open(out_file, "wb") as out_fH:
+        out = BlockCompressedWriter(out_fH) if out_file.endswith(".gz") else out_fH
+        if header is not None:
+            out.write("#" + "\t".join(header) + "\n")
+        for strand in ("t", "c"):
+            for path, lower, upper in chunk_files:
+                with open_alignment(path) as fH:
+                    for line in fH:
+                        if line.startswith("#"):
+                            continue
+                        fields = line.rstrip("\n").split("\t")
+                        if fields[strand_field] != strand:
+                            continue
+                        position = int(fields[position_field])
+                        if lower is not None and position < lower:
+                            continue
+                        if upper is not None and position >= upper:
+                            continue
+                        out.write(line)
+        if out is not out_fH:
+            out.close()
+
+
 def make_temp_sequence(fasta, sequence_outfile, rc_sequence_outfile):
     """extract the sequence from a fasta and put into a simple file that is used by signalAlign
     """
@@ -405,38 +785,153 @@ def exonerated_bwa_pysam(bwa_index, query, temp_sam_path, target_regions=None):
     return completeCigarString, strand, reference_name
 
 
+# directory with the models that come with signalAlign
+DEFAULT_MODEL_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "models")
+
+
+def parse_model_file(model_file):
+    """parses a .model file into NumPy arrays, see models/Note.md for the format. Returns a dict with the header
+    (state_number, alphabet, alphabet_size, kmer_length), the transitions, the likelihood and the event model
+    (means, SDs, noise_means, noise_SDs, noise_lambdas), asserts that the file is complete and has no 0 parameters
+    """
+    with open(model_file, "r") as fH:
+        header = fH.readline().split()
+        assert len(header) == 4, "parse_model_file - incorrect header in {}".format(model_file)
+        state_number, alphabet_size, alphabet, kmer_length = int(header[0]), int(header[1]), header[2], int(header[3])
+        assert alphabet_size == len(alphabet), "parse_model_file - alphabet size doesn't match the alphabet in " \
+                                               "{}".format(model_file)
+        transitions = np.fromstring(fH.readline(), sep=" ")
+        assert len(transitions) == state_number**2 + 1, "parse_model_file - incorrect transitions line in " \
+                                                          "{}".format(model_file)
+        event_model = np.fromstring(fH.readline(), sep=" ")
+    assert len(event_model) == (alphabet_size**kmer_length) * NB_MODEL_PARAMS, \
+        "parse_model_file - incorrect event model line in {}".format(model_file)
+    model = {
+        "state_number": state_number,
+        "alphabet": alphabet,
+        "alphabet_size": alphabet_size,
+        "kmer_length": kmer_length,
+        "transitions": transitions[:-1],
+        "likelihood": transitions[-1],
+        "means": event_model[::NB_MODEL_PARAMS],
+        "SDs": event_model[1::NB_MODEL_PARAMS],
+        "noise_means": event_model[2::NB_MODEL_PARAMS],
+        "noise_SDs": event_model[3::NB_MODEL_PARAMS],
+        "noise_lambdas": event_model[4::NB_MODEL_PARAMS],
+    }
+    for param in ("means", "SDs", "noise_means", "noise_SDs"):
+        assert not np.any(model[param] == 0.0), "parse_model_file - {f} has 0 {p}".format(f=model_file, p=param)
+    return model
+
+
+class ModelRegistry(object):
+    """Index of the .model files in a directory by pore, kmer length, alphabet and strand. The files are validated
+    when the registry is made so that reads don't have to check on them, parsed models are cached by path and
+    modification time.
+
+    The files are named testModel<pore>_[5mer_][alphabet_]<strand>[_variant].model, eg. testModelR9p4_acegt_template
+    the kmer length and alphabet are taken from the header
+    """
+    model_name_regex = re.compile(r"^testModel(R[0-9p]+)_(?:[0-9]mer_)?(?:[a-z]+_)?(template|complement)(?:_(\w+))?"
+                                  r"\.model$")
+
+    # ONT software versions (from the .fast5) to the default pore model, and the complement variant for pop1 reads
+    template_defaults = {
+        "1.15.0": "R73", "1.19.0": "R73", "1.20.0": "R73",
+        "1.22.2": "R9", "1.22.4": "R9",
+        "1.23.0": "R9p4",
+    }
+    complement_defaults = {
+        "1.15.0": "R73", "1.19.0": "R73", "1.20.0": "R73",
+        "1.22.2": "R9", "1.22.4": "R9",
+    }
+    default_files = {
+        ("R73", "template"): "testModelR73_acegot_template.model",
+        ("R9", "template"): "testModelR9_template.model",
+        ("R9p4", "template"): "testModelR9p4_acegt_template.model",
+        ("R73", "complement"): "testModelR73_acegot_complement.model",
+        ("R73", "complement", "pop1"): "testModelR9_complement_pop2.model",
+        ("R9", "complement"): "testModelR9_complement.model",
+        ("R9", "complement", "pop1"): "testModelR9_complement.model",
+    }
+
+    def __init__(self, model_directory=DEFAULT_MODEL_DIRECTORY, validate=True):
+        self.model_directory = os.path.abspath(model_directory)
+        self.models = {}  # path -> (pore, kmer_length, alphabet, strand, variant)
+        self.cache = {}   # path -> (mtime, parsed model)
+        for f in sorted(os.listdir(self.model_directory)):
+            match = self.model_name_regex.match(f)
+            if match is None:
+                continue
+            path = os.path.join(self.model_directory, f)
+            with open(path, "r") as fH:
+                header = fH.readline().split()
+            assert len(header) == 4, "ModelRegistry - incorrect header in {}".format(path)
+            pore, strand, variant = match.groups()
+            self.models[path] = (pore, int(header[3]), header[2], strand, variant)
+            if validate:
+                parse_model_file(path)
+
+        for name in self.default_files.values():
+            assert os.path.join(self.model_directory, name) in self.models, \
+                "ModelRegistry - didn't find default model {n} in {d}".format(n=name, d=self.model_directory)
+
+    def find(self, pore=None, kmer_length=None, alphabet=None, strand=None):
+        """paths to the models that match all of the given fields
+        """
+        found = []
+        for path, (p, k, a, s, v) in sorted(self.models.items()):
+            if pore is not None and p != pore:
+                continue
+            if kmer_length is not None and k != kmer_length:
+                continue
+            if alphabet is not None and a != alphabet.upper():
+                continue
+            if strand is not None and s != strand:
+                continue
+            found.append(path)
+        return found
+
+    def default_model(self, version, strand, pop1_complement=False):
+        """path to the default model for reads from this version of the ONT software
+        """
+        defaults = self.template_defaults if strand == "template" else self.complement_defaults
+        assert version in defaults, "got version {}".format(version)
+        key = (defaults[version], strand, "pop1") if pop1_complement else (defaults[version], strand)
+        return os.path.join(self.model_directory, self.default_files[key])
+
+    def load(self, model_file):
+        """parsed model (see parse_model_file), each file is only parsed again if it changed, the arrays are
+        shared so don't modify them
+        """
+        path = os.path.abspath(model_file)
+        mtime = os.path.getmtime(path)
+        cached = self.cache.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, parse_model_file(path))
+            self.cache[path] = cached
+        return cached[1]
+
+
+_model_registry = None
+
+
+def get_model_registry():
+    """the registry for the models that come with signalAlign, made the first time it's needed. Make it before
+    starting worker processes so that they all share it
+    """
+    global _model_registry
+    if _model_registry is None:
+        _model_registry = ModelRegistry()
+    return _model_registry
+
+
 def default_template_model_from_version(version):
-    supported_versions = ["1.15.0", "1.19.0", "1.20.0", "1.22.2", "1.22.4", "1.23.0"]
-    assert version in supported_versions, "got version {}".format(version)
-    version_index = supported_versions.index(version)
-    if version_index <= 2:
-        r7_3_default_template_model = "../models/testModelR73_acegot_template.model"
-        assert os.path.exists(r7_3_default_template_model), "Didn't find default template R7.3 model"
-        return r7_3_default_template_model
-    elif version_index == 5:
-        r94_default_template_model = "../models/testModelR9p4_acegt_template.model"
-        assert os.path.exists(r94_default_template_model), "Didn't find default R9.4 model"
-        return r94_default_template_model
-    else:
-        r9_default_template_model = "../models/testModelR9_template.model"
-        assert os.path.exists(r9_default_template_model), "Didn't find default template R9 model"
-        return r9_default_template_model
+    return get_model_registry().default_model(version=version, strand="template")
 
 
 def default_complement_model_from_version(version, pop1_complement=False):
-    supported_versions = ["1.15.0", "1.19.0", "1.20.0", "1.22.2", "1.22.4"]
-    assert version in supported_versions, "got version {}".format(version)
-    version_index = supported_versions.index(version)
-
-    if version_index <= 2:
-        r7_3_default_complement_model = "../models/testModelR73_acegot_complement.model" if not pop1_complement \
-            else "../models/testModelR9_complement_pop2.model"
-        assert os.path.exists(r7_3_default_complement_model), "Didn't find default complement R7.3 model"
-        return r7_3_default_complement_model
-    else:
-        r9_default_complement_model = "../models/testModelR9_complement.model"
-        assert os.path.exists(r9_default_complement_model), "Didn't find default complement R9 model"
-        return r9_default_complement_model
+    return get_model_registry().default_model(version=version, strand="complement", pop1_complement=pop1_complement)
 
 
 def degenerate_enum(degenerate_request_string):
@@ -837,22 +1332,15 @@ class NanoporeRead(object):
         return True
 
     def adjust_events_for_drift(self, events, drift):
-        """Adjust event means by drift
+        """Drift adjusted event means, the events are the event table from the .fast5, the table itself isn't
+        changed. Returns an array of the means or False
         """
         if events is None or drift is None:
             return False
 
-        # transform events by time
-        # events have format [[mean], [start_time], [std_dev], [length]]
-        # get the start time of the first event
-        start_time = events[0][1]
-        for event in events:
-            # time since first event
-            delta_time = event[1] - start_time
-            # drift adjust
-            # TODO change adjustment here
-            event[0] -= (delta_time * drift)
-        return True
+        # time since the first event, then the whole table in one go
+        start = np.asarray(events['start'], dtype=np.float64)
+        return np.asarray(events['mean'], dtype=np.float64) - drift * (start - start[0])
 
     def get_template_events(self):
         if self.template_event_table_address in self.fastFive:
@@ -1098,6 +1586,579 @@ class NanoporeRead(object):
         self.fastFive.close()
 
 
+def record_alignment_failure(failures_file, read_label, reason, elapsed, exit_status):
+    """Append a read that didn't align to the failures table, one line per read:
+    read_label  reason  seconds  exit_status
+    the reason is timeout, memory (over --max_read_memory) or error (see ProcessJob.failure_reason),
+    the line goes out in a single append so workers can share the table
+    """
+    line = "{read}\t{reason}\t{elapsed:.2f}\t{status}\n".format(read=read_label, reason=reason, elapsed=elapsed,
+                                                              status=exit_status)
+    fd = os.open(failures_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def parse_alignment_failures(failures_file):
+    """Read the failures table written by record_alignment_failure
+    :return list of (read_label, reason, seconds, exit_status)
+    """
+    failures = []
+    if not os.path.isfile(failures_file):
+        return failures
+    with open(failures_file, "r") as fH:
+        for line in fH:
+            fields = line.strip().split("\t")
+            if len(fields) != 4:
+                continue
+            failures.append((fields[0], fields[1], float(fields[2]), int(fields[3])))
+    return failures
+
+
+def record_failed_job(failures_file, read_label, job, partial_outputs=()):
+    """adds a read (or chunk) that signalMachine didn't align to the failures table and removes what it wrote of
+    its outputs, so the downstream tools don't see a partial alignment
+    """
+    record_alignment_failure(failures_file=failures_file, read_label=read_label, reason=job.failure_reason(),
+                             elapsed=job.elapsed, exit_status=job.status)
+    for partial in partial_outputs:
+        if os.path.isfile(partial):
+            os.remove(partial)
+
+
+def deliver_alignment(alignment_file, sink, normalized_params=None, manifest=None, summaries=()):
+    """puts a finished alignment where it goes: back on the raw event scale if the events were normalized, into
+    the sink, and into the manifest with what it got and cost. summaries has (aligned pairs, mean posterior,
+    seconds, peak rss) for each signalMachine run that made the alignment, one for a read or one for each chunk
+    """
+    if normalized_params is not None:
+        denormalize_alignment(alignment_file, normalized_params)
+    sink.append(alignment_file)
+    if manifest is None:
+        return
+    # the chunks overlap a little, so their pairs are a slight overcount
+    aligned_pairs, posterior_sum, seconds, peak_rss = 0, 0.0, 0.0, 0
+    for pairs, mean_posterior, elapsed, rss in summaries:
+        aligned_pairs += pairs
+        posterior_sum += pairs * mean_posterior if mean_posterior is not None else 0.0
+        seconds += elapsed
+        peak_rss = max(peak_rss, rss if rss is not None else 0)
+    record_manifest_row(aligned_pairs=aligned_pairs,
+                        mean_posterior=posterior_sum / aligned_pairs if aligned_pairs > 0 else None,
+                        seconds=seconds, peak_rss=peak_rss, output=sink.output, **manifest)
+
+
+def run_alignment_chunk(chunk):
+    """aligns one chunk of a long read, chunk is a dict with the signalMachine arguments, the cigar, the output
+    file and the limits, the output is removed if the alignment fails so that finish_chunked_alignment can tell
+    """
+    job = run_process(argv=chunk["argv"], label=chunk["label"], stdin=chunk["cigar"],
+                      max_time=chunk["max_time"], max_memory=chunk["max_memory"], capture_stdout=True)
+    if not job.ok():
+        record_failed_job(chunk["failures_file"], chunk["label"], job, partial_outputs=[chunk["output"]])
+        return False
+    print(job.stderr, end="", file=sys.stderr)  # ProcessRunner only shows it for failed jobs
+    print(job.stdout, end="")
+    # what the chunk cost and got, finish_chunked_alignment adds them up for the read's manifest row
+    aligned_pairs, mean_posterior = parse_signalMachine_summary(job.stdout)
+    with open(chunk["output"] + ".summary", "w") as fH:
+        fH.write("{pairs}\t{posterior}\t{seconds}\t{rss}\n".format(pairs=aligned_pairs, posterior=mean_posterior,
+                                                                   seconds=job.elapsed, rss=job.peak_rss))
+    return True
+
+
+def read_chunk_summary(chunk_output):
+    """what run_alignment_chunk wrote about a chunk, (aligned pairs, mean posterior, seconds, peak rss)
+    """
+    with open(chunk_output + ".summary", "r") as fH:
+        pairs, posterior, elapsed, rss = fH.readline().strip().split("\t")
+    return (int(pairs), float(posterior) if posterior != "None" else None, float(elapsed),
+            int(rss) if rss != "None" else None)
+
+
+def finish_chunked_alignment(plan):
+    """stitches the chunks of a read into its alignment once all of the chunks are done and delivers it to the
+    read's sink, the read doesn't get an alignment if any of its chunks failed
+    """
+    sink = plan["sink"]
+    ok = all([os.path.isfile(path) for path, lower, upper in plan["chunks"]])
+    if ok:
+        alignment_file = sink.open(plan["temp_folder"])
+        stitch_alignment_chunks(plan["chunks"], alignment_file)
+        summaries = [read_chunk_summary(path) for path, lower, upper in plan["chunks"]
+                     if os.path.isfile(path + ".summary")]
+        deliver_alignment(alignment_file, sink, normalized_params=plan.get("normalized_params"),
+                          manifest=plan.get("manifest"), summaries=summaries)
+    else:
+        print("[finish_chunked_alignment]{read} had chunks that failed to align, see {table}"
+              "".format(read=plan["read_label"], table=plan["failures_file"]), file=sys.stderr)
+    sink.close()
+    shutil.rmtree(plan["temp_folder"], ignore_errors=True)
+    return ok
+
+
+OUTPUT_FORMATS = {"full": 0, "variantCaller": 1, "assignments": 2, "binary": 3}  # signalMachine -s
+INDEXED_FORMATS = ("full", "variantCaller")  # the formats with reference positions, for the reference index
+HDF5_FORMATS = ("full", "binary")  # the formats alignmentIO.iter_alignment_batches reads, for the HDF5 output
+# columns signalMachine writes in the full format (--outputColumns), None is all of them. build is what
+# makeBuildAlignments.collect_assignments reads, analysis is what alignmentAnalysisLib.parse_alignment_file reads
+OUTPUT_PROFILES = {
+    "full": None,
+    "build": ["strand", "aligned_kmer", "posterior_probability", "descaled_event_mean"],
+    "analysis": ["ref_pos", "strand", "event_index", "aligned_kmer", "posterior_probability", "descaled_event_mean"],
+}
+SHARD_EXTENSIONS = {"full": ".tsv", "variantCaller": ".tsv", "assignments": ".assignments", "binary": ".bin"}
+
+
+def shard_file_path(destination, output_format, shard, compressed=False):
+    extension = SHARD_EXTENSIONS[output_format]
+    if compressed and output_format != "binary":
+        extension += ".gz"
+    return destination + "shard{n}{ext}".format(n=shard, ext=extension)
+
+
+def append_to_shard(alignment_file, shard_file, output_format, read_name, read_label, direction, contig=None):
+    """appends the alignment of a read to a shard and adds where it went to the shard's index (shard_file.index:
+    read name, read label, direction, byte offset, byte length). Reads go to the shards in turn, by their index in
+    the run, and the shard is locked while we write in case two workers get the same one. File names don't say which read or direction the rows are, so the full format rows get the
+    direction as an extra last column and the assignments rows get the read label and the direction, the
+    variantCaller rows have both already and the binary blocks have them in their headers. Compressed alignments
+    are copied as they are, or block compressed again if they need the extra columns. A full alignment with some
+    of the columns has a header naming them, the shard gets it once at the top, before the first read. With a
+    contig the rows also go in the shard's reference index
+    """
+    if output_format == "full":
+        extra_columns = "\t" + direction
+    elif output_format == "assignments":
+        extra_columns = "\t{label}\t{direction}".format(label=read_label, direction=direction)
+    else:
+        extra_columns = None
+    with open(shard_file, "ab") as shard:
+        fcntl.flock(shard, fcntl.LOCK_EX)
+        try:
+            shard.seek(0, 2)
+            header = alignment_header(alignment_file) if output_format == "full" else None
+            if header is not None and shard.tell() == 0:
+                out = BlockCompressedWriter(shard) if shard_file.endswith(".gz") else shard
+                out.write("#" + "\t".join(header + ["direction"]) + "\n")
+                if out is not shard:
+                    out.close()
+                shard.flush()
+            offset = shard.tell()
+            if extra_columns is None:
+                with open(alignment_file, "rb") as fH:
+                    shutil.copyfileobj(fH, shard)
+            else:
+                out = BlockCompressedWriter(shard) if shard_file.endswith(".gz") else shard
+                with open_alignment(alignment_file) as fH:
+                    for line in fH:
+                        if line.startswith("#"):
+                            continue
+                        out.write(line.rstrip("\n") + extra_columns + "\n")
+                if out is not shard:
+                    out.close()
+            shard.flush()
+            length = shard.tell() - offset
+            with open(shard_file + ".index", "a") as index:
+                index.write("{name}\t{label}\t{direction}\t{offset}\t{length}\n"
+                            "".format(name=read_name, label=read_label, direction=direction, offset=offset,
+                                      length=length))
+            if contig is not None and output_format in INDEXED_FORMATS:
+                index_alignment_positions(shard_file, contig, start=offset, end=offset + length)
+        finally:
+            fcntl.flock(shard, fcntl.LOCK_UN)
+    os.remove(alignment_file)
+
+
+class AlignmentSink(object):
+    """Where a read's alignment goes. open gives the file signalMachine should write, append takes the finished
+    alignment and close cleans up after the read, removing what signalMachine wrote if it never got appended (the
+    read failed). This one leaves the alignment in its own file in the destination, with the rows in the reference
+    index if there's a contig. The sinks go through the stitch queue with the plans of chunked reads, so they only
+    keep paths and labels
+    """
+    def __init__(self, out_file, contig=None):
+        self.out_file = out_file      # the read's alignment file in the destination
+        self.output = out_file        # where the alignment ends up, for the manifest
+        self.contig = contig          # index the rows by reference position on this contig
+        self.alignment_file = None    # what signalMachine writes
+        self.appended = False
+
+    def open(self, temp_folder):
+        self.alignment_file = self.out_file
+        return self.alignment_file
+
+    def append(self, alignment_file):
+        if self.contig is not None:
+            index_alignment_positions(alignment_file, self.contig)
+        self.appended = True
+
+    def close(self):
+        if not self.appended and self.alignment_file is not None and os.path.isfile(self.alignment_file):
+            os.remove(self.alignment_file)
+
+
+class ShardSink(AlignmentSink):
+    """appends the alignment to a shard (see append_to_shard), signalMachine writes it in the read's temp folder
+    """
+    def __init__(self, out_file, shard_file, output_format, read_name, read_label, direction, contig=None):
+        AlignmentSink.__init__(self, out_file, contig=contig)
+        self.output = shard_file
+        self.output_format = output_format
+        self.read_name = read_name
+        self.read_label = read_label
+        self.direction = direction
+
+    def open(self, temp_folder):
+        self.alignment_file = os.path.join(temp_folder, os.path.basename(self.out_file))
+        return self.alignment_file
+
+    def append(self, alignment_file):
+        append_to_shard(alignment_file=alignment_file, shard_file=self.output, output_format=self.output_format,
+                        read_name=self.read_name, read_label=self.read_label, direction=self.direction,
+                        contig=self.contig)
+        self.appended = True
+
+
+class Hdf5Sink(AlignmentSink):
+    """appends the alignment to the contig and direction's group in the worker's part of hdf5_file (see
+    append_alignment_to_hdf5 and merge_hdf5_parts), which has an index of its own, signalMachine writes it in the
+    read's temp folder
+    """
+    def __init__(self, out_file, hdf5_file, worker, contig, read_label, direction):
+        AlignmentSink.__init__(self, out_file)
+        self.output = hdf5_file
+        self.part = hdf5_part(hdf5_file, worker)
+        self.group_contig = contig
+        self.read_label = read_label
+        self.direction = direction
+
+    def open(self, temp_folder):
+        self.alignment_file = os.path.join(temp_folder, os.path.basename(self.out_file))
+        return self.alignment_file
+
+    def append(self, alignment_file):
+        append_alignment_to_hdf5(alignment_file=alignment_file, hdf5_file=self.part, contig=self.group_contig,
+                                 direction=self.direction, read_label=self.read_label)
+        self.appended = True
+
+
+def guide_alignment_anchor_count(cigar_string, constraint_trim=14):
+    """number of anchor pairs signalMachine gets from a guide alignment, each match of length n gives
+    n - 2 * constraint_trim of them (see convertPairwiseForwardStrandAlignmentToAnchorPairs)
+    """
+    return sum([max(0, length - 2 * constraint_trim)
+                for operation, length, q, r in guide_alignment_operations(cigar_string) if operation == "M"])
+
+
+class AlignmentCostModel(object):
+    """Predicts the size of the banded alignment signalMachine does for a strand of a read (see band_construct and
+    getPosteriorProbsWithBanding). Between two anchors dx reference bases apart and dy events apart the band covers
+    the dx by dy rectangle, plus diagonal_expansion cells around the anchors:
+        cells ~ X * Y / (A + 1) + (X + Y) * (diagonal_expansion + 1)
+    for X reference bases, Y events and A anchors. The forward matrix is kept from one traceback to the next,
+    tracebacks are at least min_traceback_diagonals apart and only happen at a narrow part of the band, so the peak
+    is about that many diagonals plus one anchor gap. The forward and backward matrices are both that big. Each cell
+    has paths_per_cell paths (more with degenerate characters) of bytes_per_path bytes.
+
+    The defaults are worked out from the sizes of the dp matrix structs, bytes_scale and cells_per_second get
+    calibrated with the observed peak matrix sizes and speeds signalMachine reports, see record_alignment_cost and
+    calibrate.
+    """
+    def __init__(self, state_number=3, kmer_length=6, paths_per_cell=1, bytes_scale=1.0, cells_per_second=1.0e6,
+                 base_bytes=64 * 1024 * 1024, bytes_per_event=64, min_traceback_diagonals=1000,
+                 anchor_density=0.5):
+        self.state_number = state_number
+        self.kmer_length = kmer_length
+        self.paths_per_cell = paths_per_cell
+        self.bytes_scale = bytes_scale              # observed / predicted dp matrix peak
+        self.cells_per_second = cells_per_second    # forward cells per second, as signalMachine reports it
+        self.base_bytes = base_bytes                # models, HDPs and the rest of signalMachine
+        self.bytes_per_event = bytes_per_event      # npRead, event sequence and aligned pairs, per event
+        self.min_traceback_diagonals = min_traceback_diagonals
+        self.anchor_density = anchor_density        # anchors per reference base, when there's no guide alignment yet
+
+    def bytes_per_path(self):
+        # Path struct, pointer to it, its cells, the kmer and a share of the HDCell, like dpMatrix_bytesPerPath
+        return 40 + 8 + self.state_number * 8 + (self.kmer_length + 1) + 24
+
+    def estimate(self, nb_events, reference_length, nb_anchors, diagonal_expansion, threads=1):
+        """predicted cost of aligning one strand, returns a dict with:
+        cells: forward cells (paths) computed, dp_peak_bytes: peak forward matrix size, comparable to the
+        'peak dp matrix' signalMachine reports, peak_bytes: peak size of the whole process, seconds: run time
+        """
+        x, y = max(0, int(reference_length)), max(0, int(nb_events))
+        diagonals = x + y
+        if diagonals == 0:
+            return {"cells": 0, "dp_peak_bytes": 0, "peak_bytes": self.base_bytes, "seconds": 0.0}
+        gaps = max(0, int(nb_anchors)) + 1
+        cells = (float(x) * y / gaps + diagonals * (diagonal_expansion + 1)) * self.paths_per_cell
+        window = min(diagonals, self.min_traceback_diagonals + float(diagonals) / gaps)
+        peak_cells = window * cells / diagonals * max(1, threads)
+        dp_peak_bytes = int(peak_cells * self.bytes_per_path() * self.bytes_scale)
+        return {
+            "cells": int(cells),
+            "dp_peak_bytes": dp_peak_bytes,
+            "peak_bytes": self.base_bytes + 2 * dp_peak_bytes + self.bytes_per_event * y,
+            "seconds": cells / self.cells_per_second,
+        }
+
+    def estimate_guide_alignment(self, cigar_string, nb_events, read_length, diagonal_expansion,
+                                 constraint_trim=14, threads=1):
+        """estimate for a strand once we have the guide alignment, the events outside of the aligned part of the
+        read are dropped by signalMachine
+        """
+        fields = cigar_string.split()
+        query_start, query_end = int(fields[2]), int(fields[3])
+        reference_length = abs(int(fields[7]) - int(fields[6]))
+        aligned_events = nb_events * float(query_end - query_start) / max(1, read_length)
+        return self.estimate(nb_events=aligned_events, reference_length=reference_length,
+                             nb_anchors=guide_alignment_anchor_count(cigar_string, constraint_trim),
+                             diagonal_expansion=diagonal_expansion, threads=threads)
+
+    def estimate_read(self, nb_events, read_length, diagonal_expansion, threads=1):
+        """estimate for a strand before it's been mapped, the read is taken to align over its whole length with
+        anchor_density anchors per base
+        """
+        return self.estimate(nb_events=nb_events, reference_length=read_length,
+                             nb_anchors=self.anchor_density * read_length, diagonal_expansion=diagonal_expansion,
+                             threads=threads)
+
+    def calibrate(self, observations):
+        """sets bytes_scale, cells_per_second and anchor_density from observed alignments, the rows of
+        parse_alignment_costs. Uses medians so that a few odd reads don't throw it off
+        """
+        byte_ratios, speeds, densities = [], [], []
+        for obs in observations:
+            predicted = self.estimate(nb_events=obs["nb_events"], reference_length=obs["reference_length"],
+                                      nb_anchors=obs["nb_anchors"], diagonal_expansion=obs["diagonal_expansion"])
+            if predicted["dp_peak_bytes"] > 0 and obs["dp_peak_bytes"] > 0:
+                byte_ratios.append(obs["dp_peak_bytes"] / (predicted["dp_peak_bytes"] / self.bytes_scale))
+            if obs["cells_per_second"] > 0:
+                speeds.append(obs["cells_per_second"])
+            if obs["reference_length"] > 0:
+                densities.append(float(obs["nb_anchors"]) / obs["reference_length"])
+        if len(byte_ratios) > 0:
+            self.bytes_scale = float(np.median(byte_ratios))
+        if len(speeds) > 0:
+            self.cells_per_second = float(np.median(speeds))
+        if len(densities) > 0:
+            self.anchor_density = float(np.median(densities))
+        return len(observations)
+
+
+alignment_cost_columns = ["read_label", "strand", "nb_events", "reference_length", "nb_anchors",
+                          "diagonal_expansion", "seconds", "cells_per_second", "dp_peak_bytes"]
+
+
+def parse_signalMachine_report(stderr):
+    """the per-strand time and peak dp matrix size signalMachine reports on stderr, {strand: (seconds,
+    forward cells per second, peak bytes)}
+    """
+    report = {}
+    pattern = re.compile(r"signalAlign - (template|complement) alignment took ([0-9.]+) seconds "
+                         r"\(([0-9.]+) forward cells/sec\), peak dp matrix ~([0-9.]+) MB")
+    for match in pattern.finditer(stderr):
+        report[match.group(1)] = (float(match.group(2)), float(match.group(3)),
+                                  int(float(match.group(4)) * 1024 * 1024))
+    return report
+
+
+def record_alignment_cost(cost_file, read_label, strand, nb_events, reference_length, nb_anchors,
+                          diagonal_expansion, seconds, cells_per_second, dp_peak_bytes):
+    """Append what an alignment cost to the cost table, one line per strand, in the order of
+    alignment_cost_columns. Like the failures table the line goes out in a single append
+    """
+    line = "\t".join(map(str, [read_label, strand, int(nb_events), int(reference_length), int(nb_anchors),
+                               int(diagonal_expansion), "%.2f" % seconds, "%.0f" % cells_per_second,
+                               int(dp_peak_bytes)])) + "\n"
+    fd = os.open(cost_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def parse_signalMachine_summary(stdout):
+    """the number of aligned pairs and their mean posterior probability from the line signalMachine prints when
+    it's done: read label, anchors, pairs(score) for each strand and then mean_posterior= with the mean posterior
+    probability of each strand's pairs. The score isn't used, with --viterbi it's the path's log probability.
+    Returns (aligned pairs, mean posterior), the mean is None without any pairs
+    """
+    aligned_pairs, posterior_sum = 0, 0.0
+    for line in stdout.splitlines():
+        means = re.search(r"\tmean_posterior=(\S+)", line)
+        if means is None:
+            continue
+        pairs = [int(p) for p in re.findall(r"\t([0-9]+)\([^)]*\)", line)]
+        for n, mean in zip(pairs, means.group(1).split(",")):
+            aligned_pairs += n
+            posterior_sum += n * float(mean)
+    return aligned_pairs, posterior_sum / aligned_pairs if aligned_pairs > 0 else None
+
+
+def record_manifest_row(manifest_file, read_label, contig, strand, aligned_pairs, mean_posterior, events, seconds,
+                        peak_rss, output):
+    """Append an alignment to the run's manifest, in the order of alignmentIO.MANIFEST_COLUMNS, so that picking
+    alignments later doesn't have to look at the files. Like the other tables the line goes out in a single append
+    """
+    line = "\t".join(map(str, [read_label, contig, strand, int(aligned_pairs),
+                               "nan" if mean_posterior is None else "%.4f" % mean_posterior, int(events),
+                               "%.2f" % seconds, int(peak_rss) if peak_rss is not None else 0, output])) + "\n"
+    fd = os.open(manifest_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def parse_alignment_costs(cost_file):
+    """Read the cost table written by record_alignment_cost
+    :return list of dicts keyed by alignment_cost_columns
+    """
+    costs = []
+    if cost_file is None or not os.path.isfile(cost_file):
+        return costs
+    with open(cost_file, "r") as fH:
+        for line in fH:
+            fields = line.strip().split("\t")
+            if len(fields) != len(alignment_cost_columns):
+                continue
+            row = dict(zip(alignment_cost_columns, fields))
+            for key in alignment_cost_columns[2:]:
+                row[key] = float(row[key])
+            costs.append(row)
+    return costs
+
+
+def estimate_fast5_alignment(fast5, cost_model, diagonal_expansion, twoD=False, threads=1):
+    """estimated cost of aligning a read before it's been mapped, the strands of 2D reads are aligned at the same
+    time so their peaks add up. Returns None if the .fast5 can't be read
+    """
+    try:
+        npRead = NanoporeRead(fast5, twoD)
+    except (KeyError, AttributeError, AssertionError):
+        return None
+    if not npRead.is_open:
+        return None
+    try:
+        strands = [(npRead.get_template_events, "template_events", "template_read")]
+        if twoD:
+            strands.append((npRead.get_complement_events, "complement_events", "complement_read"))
+        estimates = []
+        for get_events, events_attr, read_attr in strands:
+            if not get_events():
+                return None
+            estimates.append(cost_model.estimate_read(nb_events=len(getattr(npRead, events_attr)),
+                                                      read_length=len(getattr(npRead, read_attr)),
+                                                      diagonal_expansion=diagonal_expansion, threads=threads))
+    except (KeyError, AttributeError, AssertionError):
+        return None
+    finally:
+        npRead.close()
+    return {
+        "cells": sum([e["cells"] for e in estimates]),
+        "dp_peak_bytes": sum([e["dp_peak_bytes"] for e in estimates]),
+        "peak_bytes": sum([e["peak_bytes"] for e in estimates]) - (len(estimates) - 1) * cost_model.base_bytes,
+        "seconds": max([e["seconds"] for e in estimates]),
+    }
+
+
+class OutputOptions(object):
+    """How SignalAlignment writes the alignments: the format and what goes in it (compression, the columns of the
+    full format, the lowest posterior probability kept) and where it goes, a file for each read, the shards or the
+    worker's part of alignments.h5, with the rows in a reference index or not (see AlignmentSink)
+    """
+    def __init__(self, output_format="full", compress=False, profile="full", posterior_floor=None, shards=None,
+                 reference_index=False, hdf5=False):
+        self.output_format   = output_format    # full, variantCaller, assignments or binary
+        self.compress        = compress         # gzip blocks for the text formats, zlib columns for binary
+        self.profile         = profile          # columns of the full format to write, see OUTPUT_PROFILES
+        self.posterior_floor = posterior_floor  # don't write aligned pairs with a lower posterior probability
+        self.shards          = shards           # append to this many shard files instead of a file per read
+        self.reference_index = reference_index  # index the rows by reference position as they're written
+        self.hdf5            = hdf5             # append to the worker's part of alignments.h5 instead
+        assert output_format in OUTPUT_FORMATS, "[OutputOptions] unknown output format {}".format(output_format)
+        assert not hdf5 or output_format in HDF5_FORMATS, \
+            "[OutputOptions] HDF5 output is for the {} formats".format(", ".join(HDF5_FORMATS))
+
+    def columns(self):
+        """the columns of the full format to write, None is all of them (and the other formats)
+        """
+        return OUTPUT_PROFILES[self.profile] if self.output_format == "full" else None
+
+    def positioned(self):
+        """whether the alignment has the reference positions to index and stitch it with
+        """
+        columns = self.columns()
+        return columns is None or ("ref_pos" in columns and "strand" in columns)
+
+    def flags(self):
+        flags = ["-s", OUTPUT_FORMATS[self.output_format]]
+        if self.compress:
+            flags += ["--compressOutput"]
+        if self.columns() is not None:
+            flags += ["--outputColumns", ",".join(self.columns())]
+        if self.posterior_floor is not None and self.posterior_floor > 0:
+            flags += ["--posteriorFloor", self.posterior_floor]
+        return flags
+
+
+class AlignerOptions(object):
+    """How signalMachine aligns a read, beyond the banding and models every caller sets
+    """
+    def __init__(self, threads=1, viterbi=False, checkpoint_interval=None, memory_ceiling=None,
+                 max_diagonal_expansion=None, prune_threshold=None, beam_width=None, reference_window=None,
+                 contiguous_cells=False):
+        self.threads                = threads                 # threads to align the split blocks with
+        self.viterbi                = viterbi                 # only get the best path, no posteriors
+        self.checkpoint_interval    = checkpoint_interval     # keep every k-th forward diagonal, recompute the rest
+        self.memory_ceiling         = memory_ceiling          # MB, checkpoint the matrices bigger than this
+        self.max_diagonal_expansion = max_diagonal_expansion  # adaptive banding, widest band to retry with
+        self.prune_threshold        = prune_threshold         # drop unlikely degenerate paths, see --pruneThreshold
+        self.beam_width             = beam_width              # max degenerate paths kept per cell
+        self.reference_window       = reference_window        # only give signalMachine the guide region, plus this
+        self.contiguous_cells       = contiguous_cells        # one aligned cell buffer per dp diagonal
+
+    def flags(self):
+        flags = []
+        # threads for aligning the blocks between large anchor gaps
+        if self.threads is not None and self.threads > 1:
+            flags += ["--threads", self.threads]
+        # best path (Viterbi) alignment, assignments get probability 1
+        if self.viterbi:
+            flags += ["--viterbi"]
+        # adaptive banding, start with the diagonal expansion and widen band limited blocks up to this
+        if self.max_diagonal_expansion is not None and self.max_diagonal_expansion > 0:
+            flags += ["--maxDiagonalExpansion", self.max_diagonal_expansion]
+        # pruning of unlikely degenerate paths, for kmers with many ambiguous positions
+        if self.prune_threshold is not None and self.prune_threshold > 0:
+            flags += ["--pruneThreshold", self.prune_threshold]
+        if self.beam_width is not None and self.beam_width > 0:
+            flags += ["--beamWidth", self.beam_width]
+        # dp matrix cell layout
+        if self.contiguous_cells:
+            flags += ["--contiguousCells"]
+        # low memory forward-backward, trades recomputation for memory on long reads
+        if self.checkpoint_interval is not None and self.checkpoint_interval > 0:
+            flags += ["--checkpoint", self.checkpoint_interval]
+        if self.memory_ceiling is not None and self.memory_ceiling > 0:
+            flags += ["--memoryCeiling", self.memory_ceiling]
+        return flags
+
+
+class JobOptions(object):
+    """Limits on the signalMachine run of each read, and splitting long reads into chunks that run on their own
+    """
+    def __init__(self, max_time=None, max_memory=None, chunk_size=None, chunk_overlap=500):
+        self.max_time      = max_time       # seconds, kill signalMachine if the read takes longer
+        self.max_memory    = max_memory     # MB, address space limit for signalMachine
+        self.chunk_size    = chunk_size     # read bases per chunk when splitting long reads
+        self.chunk_overlap = chunk_overlap  # read bases neighboring chunks share
+
+
 class SignalAlignment(object):
     def __init__(self,
                  in_fast5,
@@ -1116,7 +2177,14 @@ class SignalAlignment(object):
                  degenerate,
                  twoD_chemistry,
                  target_regions=None,
-                 output_format="full"):
+                 output=None,
+                 aligner=None,
+                 limits=None,
+                 chunk_queue=None,
+                 stitch_queue=None,
+                 nanopore_params=None,
+                 normalize_events=False,
+                 read_index=None):
         self.in_fast5           = in_fast5            # fast5 file to align
         self.reference_map      = reference_map       # map with paths to reference sequences
         self.path_to_EC_refs    = path_to_EC_refs     # place where the reference sequence with ambiguous characters is
@@ -1127,9 +2195,23 @@ class SignalAlignment(object):
         self.diagonal_expansion = diagonal_expansion  # alignment algorithm param
         self.constraint_trim    = constraint_trim     # alignment algorithm param
         self.target_regions     = target_regions      # only signal-align reads that map to these positions
-        self.output_format      = output_format       # smaller output files
         self.degenerate         = degenerate          # set of nucleotides for degenerate characters
         self.twoD_chemistry     = twoD_chemistry      # flag for 2D sequencing runs
+        self.output             = output if output is not None else OutputOptions()     # see OutputOptions
+        self.aligner            = aligner if aligner is not None else AlignerOptions()  # see AlignerOptions
+        self.limits             = limits if limits is not None else JobOptions()        # see JobOptions
+        self.failures_file      = destination + "failed_alignments.txt"  # reads that went over the limits
+        self.cost_file          = destination + "alignment_costs.txt"    # time and memory each alignment took
+        self.manifest_file      = destination + MANIFEST_FILE            # a row for each alignment written
+        self.chunk_queue        = chunk_queue         # put chunks here for the worker pool, otherwise align them here
+        self.stitch_queue       = stitch_queue        # chunked reads to stitch once the pool is done with the chunks
+        self.nanopore_params    = nanopore_params     # stored adjustment parameters for this read, from a table
+        self.normalize_events   = normalize_events    # write the stored parameters into the events, not the header
+        self.read_index         = read_index          # where the read is in the run, picks its shard
+        assert not self.output.shards or read_index is not None, \
+            "[SignalAlignment] sharded output needs the read's index"
+        assert not normalize_events or stateMachineType in NORMALIZED_STATE_MACHINES, \
+            "[SignalAlignment] normalized events are for the {} models".format(", ".join(NORMALIZED_STATE_MACHINES))
 
         # if we're using an input hmm, make sure it exists
         if (in_templateHmm is not None) and os.path.isfile(in_templateHmm):
@@ -1151,6 +2233,27 @@ class SignalAlignment(object):
         else:
             self.in_complementHdp = None
 
+    def reference_flags(self, cigar_string, forward_reference, backward_reference, temp_folder, label):
+        """gets the reference flags for signalMachine, if we're using a reference window the guide aligned region
+        (and some padding) is cut out of the contig, signalMachine gets the offset so that the output is still in
+        contig coordinates
+        """
+        if self.aligner.reference_window is not None:
+            window_start, window_end = get_reference_window(cigar_string=cigar_string,
+                                                            reference_length=os.path.getsize(forward_reference),
+                                                            padding=self.aligner.reference_window)
+            forward_window = temp_folder.add_file_path("temp_forward_ref_{label}.txt".format(label=label))
+            backward_window = temp_folder.add_file_path("temp_backward_ref_{label}.txt".format(label=label))
+            write_reference_window(forward_reference, window_start, window_end, forward_window)
+            write_reference_window(backward_reference, window_start, window_end, backward_window)
+            forward_reference, backward_reference = forward_window, backward_window
+            reference_offset_flag = ["--referenceOffset", window_start]
+        else:
+            reference_offset_flag = []
+        forward_ref_flag = ["-f", forward_reference] + reference_offset_flag
+        backward_ref_flag = ["-b", backward_reference]
+        return forward_ref_flag, backward_ref_flag
+
     def run(self, get_expectations=False):
         print("[SignalAlign::run]Starting on {read}".format(read=self.in_fast5), file=sys.stderr)
         if get_expectations:
@@ -1187,20 +2290,35 @@ class SignalAlignment(object):
             temp_folder.remove_folder()
             return False
 
+        # use the stored parameters if we have them for all of the strands we're aligning
+        normalized_params = None
+        if self.nanopore_params is not None and "t" in self.nanopore_params and \
+                (not self.twoD_chemistry or "c" in self.nanopore_params):
+            if self.normalize_events:
+                normalize_npRead(temp_npRead, self.nanopore_params)
+                # the event means go back on the raw scale in the formats that have them
+                if self.output.output_format in ("full", "binary"):
+                    normalized_params = self.nanopore_params
+            else:
+                set_npRead_params(temp_npRead, self.nanopore_params)
+            param_estimation_flag = ["--noParamEstimation"]
+        else:
+            param_estimation_flag = []
+
         # add an indicator for the model being used
         if self.stateMachineType == "threeState":
             model_label = ".sm"
-            stateMachineType_flag = ""
+            stateMachineType_flag = []
         elif self.stateMachineType == "threeStateHdp":
             model_label = ".sm3Hdp"
-            stateMachineType_flag = "--sm3Hdp "
+            stateMachineType_flag = ["--sm3Hdp"]
             if self.twoD_chemistry:
                 assert (self.in_templateHdp is not None) and (self.in_complementHdp is not None), "Need to provide HDPs"
             else:
                 assert self.in_templateHdp is not None, "Need to provide Template HDP"
         else:  # make invalid stateMachine control?
             model_label = ".sm"
-            stateMachineType_flag = ""
+            stateMachineType_flag = []
 
         # get orientation and cigar from BWA this serves as the guide alignment
         cigar_string, strand, mapped_refernce = exonerated_bwa_pysam(bwa_index=self.bwa_index,
@@ -1219,29 +2337,8 @@ class SignalAlignment(object):
             temp_folder.remove_folder()
             return False
 
-        # this gives the format: /directory/for/files/file.model.orientation.tsv
-        posteriors_file_path = ''
-
-        # forward strand
-        if strand == "+":
-            if self.output_format == "full":
-                posteriors_file_path = self.destination + read_name + model_label + ".forward.tsv"
-            elif self.output_format == "variantCaller":
-                posteriors_file_path = self.destination + read_name + model_label + ".tsv"
-            else:
-                posteriors_file_path = self.destination + read_name + model_label + ".assignments"
-
-        # backward strand
-        if strand == "-":
-            if self.output_format == "full":
-                posteriors_file_path = self.destination + read_name + model_label + ".backward.tsv"
-            elif self.output_format == "variantCaller":
-                posteriors_file_path = self.destination + read_name + model_label + ".tsv"
-            else:
-                posteriors_file_path = self.destination + read_name + model_label + ".assignments"
-
-        # didn't map
-        elif (strand != "+") and (strand != "-"):
+        posteriors_file_path = self.alignment_file_path(read_name, model_label, strand)
+        if posteriors_file_path is None:
             print("[SignalAlignment::run]- {read} gave unrecognizable strand flag: {flag}".format(read=read_label, flag=strand),
                   file=sys.stderr)
             temp_folder.remove_folder()
@@ -1266,11 +2363,11 @@ class SignalAlignment(object):
         if self.twoD_chemistry:
             assert self.in_complementHmm is not None
 
-        template_model_flag = "-T {} ".format(self.in_templateHmm)
+        template_model_flag = ["-T", self.in_templateHmm]
         if self.twoD_chemistry:
-            complement_model_flag = "-C {} ".format(self.in_complementHmm)
+            complement_model_flag = ["-C", self.in_complementHmm]
         else:
-            complement_model_flag = ""
+            complement_model_flag = []
 
         print("signalAlign - NOTICE: template model {t} complement model {c}"
               "".format(t=self.in_templateHmm, c=self.in_complementHmm), file=sys.stderr)
@@ -1282,89 +2379,231 @@ class SignalAlignment(object):
         backward_reference = self.reference_map[mapped_refernce]["backward"]
         assert os.path.isfile(forward_reference)
         assert os.path.isfile(backward_reference)
-        forward_ref_flag = "-f {f_ref} ".format(f_ref=forward_reference)
-        backward_ref_flag = "-b {b_ref} ".format(b_ref=backward_reference)
+        forward_ref_flag, backward_ref_flag = self.reference_flags(cigar_string=cigar_string,
+                                                                   forward_reference=forward_reference,
+                                                                   backward_reference=backward_reference,
+                                                                   temp_folder=temp_folder,
+                                                                   label=read_label)
 
         # input HDPs
         if (self.in_templateHdp is not None) or (self.in_complementHdp is not None):
-            hdp_flags = "-v {tHdp_loc} ".format(tHdp_loc=self.in_templateHdp)
+            hdp_flags = ["-v", self.in_templateHdp]
             if self.twoD_chemistry and self.in_complementHdp is not None:
-                hdp_flags += "-w {cHdp_loc} ".format(cHdp_loc=self.in_complementHdp)
+                hdp_flags += ["-w", self.in_complementHdp]
         else:
-            hdp_flags = ""
+            hdp_flags = []
 
         # threshold
         if self.threshold is not None:
-            threshold_flag = "-D {threshold} ".format(threshold=self.threshold)
+            threshold_flag = ["-D", self.threshold]
         else:
-            threshold_flag = ""
+            threshold_flag = []
 
         # diagonal expansion
         if self.diagonal_expansion is not None:
-            diag_expansion_flag = "-x {expansion} ".format(expansion=self.diagonal_expansion)
+            diag_expansion_flag = ["-x", self.diagonal_expansion]
         else:
-            diag_expansion_flag = ""
+            diag_expansion_flag = []
 
         # constraint trim
         if self.constraint_trim is not None:
-            trim_flag = "-m {trim} ".format(trim=self.constraint_trim)
+            trim_flag = ["-m", self.constraint_trim]
         else:
-            trim_flag = ""
+            trim_flag = []
 
         # NOTE: to turn off banded alignment, uncomment this flag, it just trimms away all of the anchors
-        #trim_flag = "-m 9999"
+        #trim_flag = ["-m", 9999]
 
         # output format
-        fmts = {"full": 0, "variantCaller": 1, "assignments": 2}
-        if self.output_format not in fmts.keys():
-            temp_folder.remove_folder()
-            return False
-        out_fmt = "-s {fmt} ".format(fmt=fmts[self.output_format])
+        out_fmt = self.output.flags()
 
         # degenerate nucleotide information
         if self.degenerate is not None:
-            degenerate_flag = "-o {} ".format(self.degenerate)
+            degenerate_flag = ["-o", self.degenerate]
         else:
-            degenerate_flag = ""
+            degenerate_flag = []
 
         if self.twoD_chemistry:
-            twoD_flag = "--twoD"
+            twoD_flag = ["--twoD"]
         else:
-            twoD_flag = ""
-        # commands
+            twoD_flag = []
+
+        # commands, the guide alignment cigar goes to signalMachine on stdin
         if get_expectations:
             template_expectations_file_path = self.destination + read_name + ".template.expectations"
             complement_expectations_file_path = self.destination + read_name + ".complement.expectations"
 
-            command = \
-                "echo {cigar} | {vA} {td} {degen}{sparse}{model}{f_ref}{b_ref} -q {npRead} " \
-                "{t_model}{c_model}{thresh}{expansion}{trim} {hdp}-L {readLabel} " \
-                "-t {templateExpectations} -c {complementExpectations}"\
-                .format(cigar=cigar_string, vA=path_to_signalAlign, model=stateMachineType_flag,
-                        f_ref=forward_ref_flag, b_ref=backward_ref_flag,
-                        npRead=temp_npRead, readLabel=read_label, td=twoD_flag,
-                        templateExpectations=template_expectations_file_path, hdp=hdp_flags,
-                        complementExpectations=complement_expectations_file_path, t_model=template_model_flag,
-                        c_model=complement_model_flag, thresh=threshold_flag, expansion=diag_expansion_flag,
-                        trim=trim_flag, degen=degenerate_flag, sparse=out_fmt)
+            argv = [path_to_signalAlign] + twoD_flag + degenerate_flag + out_fmt + stateMachineType_flag + \
+                forward_ref_flag + backward_ref_flag + ["-q", temp_npRead] + template_model_flag + \
+                complement_model_flag + threshold_flag + diag_expansion_flag + trim_flag + param_estimation_flag + \
+                hdp_flags + ["-L", read_label, "-t", template_expectations_file_path,
+                             "-c", complement_expectations_file_path]
+            job = run_process(argv=argv, label=read_label, stdin=cigar_string,
+                              max_time=self.limits.max_time, max_memory=self.limits.max_memory)
+            if not job.ok():
+                record_failed_job(self.failures_file, read_label, job,
+                                  partial_outputs=[template_expectations_file_path, complement_expectations_file_path])
+                temp_folder.remove_folder()
+                return False
+            print(job.stderr, end="", file=sys.stderr)  # ProcessRunner only shows it for failed jobs
+            temp_folder.remove_folder()
+            return True
+
+        def alignment_argv(f_ref, b_ref, posteriors):
+            return [path_to_signalAlign] + twoD_flag + degenerate_flag + out_fmt + stateMachineType_flag + \
+                f_ref + b_ref + ["-q", temp_npRead] + template_model_flag + complement_model_flag + \
+                threshold_flag + diag_expansion_flag + trim_flag + self.aligner.flags() + param_estimation_flag + \
+                ["-u", posteriors] + hdp_flags + ["-L", read_label]
+
+        # where the alignment goes and its row in the manifest, filled in with what signalMachine reports
+        sink = self.alignment_sink(posteriors_file_path, read_name, read_label, strand, mapped_refernce)
+        manifest = {
+            "manifest_file": self.manifest_file,
+            "read_label": read_label,
+            "contig": mapped_refernce,
+            "strand": strand,
+            "events": sum(self.aligned_events(cigar_string, temp_npRead).values()),
+        }
+
+        # long reads get split into overlapping chunks along the guide alignment, the assignments format (and
+        # full alignments written without ref_pos) doesn't have reference positions to stitch the chunks with and
+        # the chunks are stitched as text
+        if self.limits.chunk_size is not None and self.output.output_format not in ("assignments", "binary") and \
+                self.output.positioned():
+            chunks = split_guide_alignment(cigar_string=cigar_string, chunk_size=self.limits.chunk_size,
+                                           chunk_overlap=self.limits.chunk_overlap)
         else:
-            command = \
-                "echo {cigar} | {vA} {td} {degen}{sparse}{model}{f_ref}{b_ref} -q {npRead} " \
-                "{t_model}{c_model}{thresh}{expansion}{trim} " \
-                "-u {posteriors} {hdp}-L {readLabel}"\
-                .format(cigar=cigar_string, vA=path_to_signalAlign, model=stateMachineType_flag, sparse=out_fmt,
-                        f_ref=forward_ref_flag, b_ref=backward_ref_flag,
-                        readLabel=read_label, npRead=temp_npRead, td=twoD_flag,
-                        t_model=template_model_flag, c_model=complement_model_flag,
-                        posteriors=posteriors_file_path, thresh=threshold_flag, expansion=diag_expansion_flag,
-                        trim=trim_flag, hdp=hdp_flags, degen=degenerate_flag)
+            chunks = [(cigar_string, None, None)]
+
+        if len(chunks) > 1:
+            print("[SignalAlignment::run]splitting {read} into {n} chunks"
+                  "".format(read=read_label, n=len(chunks)), file=sys.stderr)
+            chunk_jobs = []
+            for i, (chunk_cigar, lower, upper) in enumerate(chunks):
+                chunk_label = "{read}.chunk{i}".format(read=read_label, i=i)
+                chunk_output = temp_folder.add_file_path(chunk_label + (".tsv.gz" if self.output.compress else ".tsv"))
+                f_ref, b_ref = self.reference_flags(cigar_string=chunk_cigar,
+                                                    forward_reference=forward_reference,
+                                                    backward_reference=backward_reference,
+                                                    temp_folder=temp_folder,
+                                                    label=chunk_label)
+                chunk_jobs.append({
+                    "argv": alignment_argv(f_ref, b_ref, chunk_output),
+                    "cigar": chunk_cigar,
+                    "output": chunk_output,
+                    "label": chunk_label,
+                    "lower": lower,
+                    "upper": upper,
+                    "max_time": self.limits.max_time,
+                    "max_memory": self.limits.max_memory,
+                    "failures_file": self.failures_file,
+                })
+            plan = {
+                "read_label": read_label,
+                "chunks": [(job["output"], job["lower"], job["upper"]) for job in chunk_jobs],
+                "sink": sink,
+                "temp_folder": temp_dir_path,
+                "failures_file": self.failures_file,
+                "normalized_params": normalized_params,
+                "manifest": manifest,
+            }
+            if self.chunk_queue is not None and self.stitch_queue is not None:
+                # the worker pool aligns the chunks and the read gets stitched after
+                for job in chunk_jobs:
+                    self.chunk_queue.put(job)
+                self.stitch_queue.put(plan)
+                return True
+            for job in chunk_jobs:
+                if not run_alignment_chunk(job):
+                    break
+            return finish_chunked_alignment(plan)
 
         # run
-        print("signalAlign - running command: ", command, end="\n", file=sys.stderr)
-        os.system(command)
+        alignment_file = sink.open(temp_dir_path)
+        job = run_process(argv=alignment_argv(forward_ref_flag, backward_ref_flag, alignment_file),
+                          label=read_label, stdin=cigar_string, max_time=self.limits.max_time,
+                          max_memory=self.limits.max_memory, capture_stdout=True)
+        if not job.ok():
+            record_failed_job(self.failures_file, read_label, job)
+            sink.close()  # doesn't leave a partial alignment around for the downstream tools
+            temp_folder.remove_folder()
+            return False
+        print(job.stderr, end="", file=sys.stderr)  # ProcessRunner only shows it for failed jobs
+        print(job.stdout, end="")  # the summary line, captured for the manifest
+        self.record_costs(job.stderr, read_label, cigar_string, temp_npRead)
+        if os.path.isfile(alignment_file):
+            aligned_pairs, mean_posterior = parse_signalMachine_summary(job.stdout)
+            deliver_alignment(alignment_file, sink, normalized_params=normalized_params, manifest=manifest,
+                              summaries=[(aligned_pairs, mean_posterior, job.elapsed, job.peak_rss)])
+        sink.close()
         temp_folder.remove_folder()
         return True
 
+    def alignment_file_path(self, read_name, model_label, strand):
+        """the read's alignment file in the destination, /directory/for/files/file.model.orientation.tsv, with .gz
+        on the end of block compressed text. None if the strand isn't + or -
+        """
+        if strand not in ("+", "-"):
+            return None
+        direction = ".forward" if strand == "+" else ".backward"
+        extensions = {"full": direction + ".tsv", "variantCaller": ".tsv", "binary": direction + ".bin",
+                      "assignments": ".assignments"}
+        path = self.destination + read_name + model_label + extensions[self.output.output_format]
+        if self.output.compress and self.output.output_format != "binary":
+            path += ".gz"
+        return path
+
+    def alignment_sink(self, out_file, read_name, read_label, strand, contig):
+        """where the read's alignment goes, see AlignmentSink
+        """
+        direction = "forward" if strand == "+" else "backward"
+        if self.output.hdf5:
+            return Hdf5Sink(out_file, self.destination + HDF5_ALIGNMENTS_FILE, os.getpid(), contig, read_label,
+                            direction)
+        # the rows of the formats with reference positions go in the reference index if we're making one
+        if self.output.reference_index and self.output.output_format in INDEXED_FORMATS and self.output.positioned():
+            index_contig = contig
+        else:
+            index_contig = None
+        if self.output.shards is not None and self.output.shards > 0:
+            shard_file = shard_file_path(self.destination, self.output.output_format,
+                                         self.read_index % self.output.shards, compressed=self.output.compress)
+            return ShardSink(out_file, shard_file, self.output.output_format, read_name, read_label, direction,
+                             contig=index_contig)
+        return AlignmentSink(out_file, contig=index_contig)
+
+    def aligned_events(self, cigar_string, npRead_path):
+        """about how many events of each strand signalMachine aligns, {strand: events}
+        """
+        with open(npRead_path, "r") as fH:
+            header = fH.readline().split()
+        # the guide alignment is to the 2D read or the template read, the events outside of it aren't aligned
+        query_length = int(header[0]) if self.twoD_chemistry else int(header[3])
+        fields = cigar_string.split()
+        aligned_fraction = float(int(fields[3]) - int(fields[2])) / max(1, query_length)
+        events = {"template": int(header[1]) * aligned_fraction}
+        if self.twoD_chemistry:
+            events["complement"] = int(header[2]) * aligned_fraction
+        return events
+
+    def record_costs(self, stderr, read_label, cigar_string, npRead_path):
+        """adds what the alignment of each strand cost to the cost table, for calibrating AlignmentCostModel
+        """
+        report = parse_signalMachine_report(stderr)
+        if len(report) == 0:
+            return
+        nb_events = self.aligned_events(cigar_string, npRead_path)
+        fields = cigar_string.split()
+        diagonal_expansion = self.diagonal_expansion if self.diagonal_expansion is not None else 50
+        constraint_trim = self.constraint_trim if self.constraint_trim is not None else 14
+        for strand, (seconds, cells_per_second, dp_peak_bytes) in report.items():
+            record_alignment_cost(cost_file=self.cost_file, read_label=read_label, strand=strand,
+                                  nb_events=nb_events.get(strand, 0),
+                                  reference_length=abs(int(fields[7]) - int(fields[6])),
+                                  nb_anchors=guide_alignment_anchor_count(cigar_string, constraint_trim),
+                                  diagonal_expansion=diagonal_expansion, seconds=seconds,
+                                  cells_per_second=cells_per_second, dp_peak_bytes=dp_peak_bytes)
+
 
 class SignalHmm(object):
     def __init__(self, model_type):
@@ -1445,41 +2684,26 @@ class SignalHmm(object):
         # line 2: [level_mean] [level_sd] [noise_mean] [noise_sd] [noise_lambda ](.../kmer) \n
         assert os.path.exists(model_file), "signalHmm.load_model - didn't find model here{}?".format(model_file)
 
-        fH = open(model_file, 'r')
-
-        line = fH.readline().split()
-        # check for correct header length
-        assert len(line) == 4, "signalHmm.load_model - incorrect line length line:{}".format(''.join(line))
-        # check stateNumber
-        assert int(line[0]) == self.state_number, "signalHmm.load_model - incorrect stateNumber got {got} should be {exp}" \
-                                                  "".format(got=int(line[0]), exp=self.state_number)
+        model = get_model_registry().load(model_file)
+        assert model["state_number"] == self.state_number, "signalHmm.load_model - incorrect stateNumber got {got} " \
+                                                           "should be {exp}".format(got=model["state_number"],
+                                                                                    exp=self.state_number)
         # load model parameters
-        self.alphabet_size = int(line[1])
-        self.alphabet = line[2]
-        self.kmer_length = int(line[3])
+        self.alphabet_size = model["alphabet_size"]
+        self.alphabet = model["alphabet"]
+        self.kmer_length = model["kmer_length"]
         self.symbol_set_size = self.alphabet_size**self.kmer_length
         assert self.symbol_set_size > 0, "signalHmm.load_model - Got 0 for symbol_set_size"
         assert self.symbol_set_size <= 6**6, "signalHmm.load_model - Got more than 6^6 for symbol_set_size got {}" \
                                              "".format(self.symbol_set_size)
 
-        line = map(float, fH.readline().split())
-        assert len(line) == len(self.transitions) + 1, "signalHmm.load_model incorrect transitions line"
-        self.transitions = line[:-1]
-        self.likelihood = line[-1]
+        assert len(model["transitions"]) == len(self.transitions), "signalHmm.load_model incorrect transitions line"
+        self.transitions = list(model["transitions"])
+        self.likelihood = model["likelihood"]
 
-        line = map(float, fH.readline().split())
-        assert len(line) == self.symbol_set_size * NB_MODEL_PARAMS, \
-            "signalHmm.load_model incorrect event model line"
-        self.event_model["means"] = line[::NB_MODEL_PARAMS]
-        self.event_model["SDs"] = line[1::NB_MODEL_PARAMS]
-        self.event_model["noise_means"] = line[2::NB_MODEL_PARAMS]
-        self.event_model["noise_SDs"] = line[3::NB_MODEL_PARAMS]
-        self.event_model["noise_lambdas"] = line[4::NB_MODEL_PARAMS]
-
-        assert not np.any(self.event_model["means"] == 0.0), "signalHmm.load_model, this model has 0 E_means"
-        assert not np.any(self.event_model["SDs"] == 0.0), "signalHmm.load_model, this model has 0 E_means"
-        assert not np.any(self.event_model["noise_means"] == 0.0), "signalHmm.load_model, this model has 0 E_noise_means"
-        assert not np.any(self.event_model["noise_SDs"] == 0.0), "signalHmm.load_model, this model has 0 E_noise_SDs"
+        # copies, the cached arrays are shared
+        for param in ("means", "SDs", "noise_means", "noise_SDs", "noise_lambdas"):
+            self.event_model[param] = model[param].copy()
         self.has_model = True
 
     def write(self, out_file):
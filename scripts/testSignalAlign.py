@@ -5,15 +5,26 @@ import unittest
 import glob
 import os
 import shutil
+import time
+import gzip
 import pandas as pd
 import numpy as np
 from subprocess import call
 from alignmentAnalysisLib import get_first_sequence
-from signalAlignLib import get_bwa_index, exonerated_bwa, exonerated_bwa_pysam
+from signalAlignLib import get_bwa_index, exonerated_bwa, exonerated_bwa_pysam, split_guide_alignment, \
+    stitch_alignment_chunks, finish_chunked_alignment, run_alignment_chunk, parse_alignment_failures, \
+    AlignmentSink, ShardSink
+from alignmentIO import open_alignment, read_alignment_manifest, manifest_alignments, MANIFEST_FILE, \
+    BlockCompressedWriter, block_offsets, read_block, write_columnar_block, kmer_ids, iter_alignment_batches, \
+    index_alignment_positions, ReferenceIndex, append_alignment_to_hdf5, merge_hdf5_parts, read_hdf5_region, \
+    hdf5_part, read_shard_index, FULL_COLUMNS, HEADER_COLUMNS, KMER_COLUMNS
+from processRunner import ProcessJob, ProcessRunner, run_process
 
 SIGNALALIGN_ROOT = "../"
 ZYMO_C_READS = SIGNALALIGN_ROOT + "tests/minion_test_reads/C/"
 ZYMO_REFERENCE = SIGNALALIGN_ROOT + "tests/test_sequences/zymo_sequence.fasta"
+SIMPLE_ALIGNMENT = SIGNALALIGN_ROOT + "tests/test_alignments/simple_alignment.tsv"
+FULL_ALIGNMENT = SIGNALALIGN_ROOT + "tests/test_alignments/full_alignment.tsv"  # all the columns, both strands
 
 
 def parse_alignment_full(alignment_file):
@@ -62,6 +73,348 @@ class signalAlignLibTests(unittest.TestCase):
         self.assertTrue(pysam_strand == expected_strand)
 
 
+class chunkedAlignmentTests(unittest.TestCase):
+    FORWARD_CIGAR = "cigar: read 0 1000 + ref 100 1100 + 1000 M 1000"
+    BACKWARD_CIGAR = "cigar: read 0 1000 + ref 1100 100 - 1000 M 1000"
+
+    def setUp(self):
+        self.work_dir = "./signalAlign_chunkTest/"
+        os.makedirs(self.work_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    @staticmethod
+    def full_row(position, strand):
+        return "\t".join(["ref", str(position), "ACGTA", "read", strand, str(position), "80.0", "1.0", "0.01",
+                          "ACGTA", "80.0", "1.0", "0.9", "80.0", "80.0", "ACGTA"]) + "\n"
+
+    def write_chunk(self, name, positions):
+        path = self.work_dir + name
+        with open(path, "w") as fH:
+            for strand in ("t", "c"):
+                for position in positions:
+                    fH.write(self.full_row(position, strand))
+        return path
+
+    def check_cuts(self, chunks, reference_start, reference_end):
+        # every reference position goes to exactly one chunk
+        for position in xrange(reference_start, reference_end):
+            owners = [i for i, (cigar, lower, upper) in enumerate(chunks)
+                      if (lower is None or position >= lower) and (upper is None or position < upper)]
+            self.assertEqual(len(owners), 1, "position {p} is in chunks {o}".format(p=position, o=owners))
+
+    def test_split_forward(self):
+        chunks = split_guide_alignment(self.FORWARD_CIGAR, chunk_size=400, chunk_overlap=100)
+        self.assertEqual([(lower, upper) for cigar, lower, upper in chunks], [(None, 450), (450, 750), (750, None)])
+        self.assertEqual(chunks[0][0], "cigar: read 0 400 + ref 100 500 + 1000 M 400")
+        self.assertEqual(chunks[2][0], "cigar: read 600 1000 + ref 700 1100 + 1000 M 400")
+        self.check_cuts(chunks, 100, 1100)
+
+    def test_split_backward(self):
+        # along a - strand read the reference goes down, so the first chunk has the upper part of the reference
+        chunks = split_guide_alignment(self.BACKWARD_CIGAR, chunk_size=400, chunk_overlap=100)
+        self.assertEqual([(lower, upper) for cigar, lower, upper in chunks], [(750, None), (450, 750), (None, 450)])
+        self.assertEqual(chunks[0][0], "cigar: read 0 400 + ref 1100 700 - 1000 M 400")
+        self.assertEqual(chunks[2][0], "cigar: read 600 1000 + ref 500 100 - 1000 M 400")
+        self.check_cuts(chunks, 100, 1100)
+
+    def test_split_short_read(self):
+        self.assertEqual(split_guide_alignment(self.FORWARD_CIGAR, chunk_size=1000, chunk_overlap=100),
+                         [(self.FORWARD_CIGAR, None, None)])
+
+    def test_stitch_backward(self):
+        chunks = split_guide_alignment(self.BACKWARD_CIGAR, chunk_size=400, chunk_overlap=100)
+        # the chunks' alignments overlap around the cuts
+        files = [(self.write_chunk("chunk0.tsv", range(690, 1100)), chunks[0][1], chunks[0][2]),
+                 (self.write_chunk("chunk1.tsv", range(390, 810)), chunks[1][1], chunks[1][2]),
+                 (self.write_chunk("chunk2.tsv", range(100, 510)), chunks[2][1], chunks[2][2])]
+        out_file = self.work_dir + "stitched.tsv.gz"
+        stitch_alignment_chunks(files, out_file)
+        with open_alignment(out_file) as fH:
+            rows = [line.split("\t") for line in fH]
+        self.assertEqual(len(rows), 2 * 1000)
+        self.assertEqual([row[4] for row in rows], ["t"] * 1000 + ["c"] * 1000)
+        for strand in ("t", "c"):
+            self.assertEqual(sorted([int(row[1]) for row in rows if row[4] == strand]), range(100, 1100))
+
+    def chunk_plan(self, chunk_files, sink=None):
+        temp_folder = self.work_dir + "temp/"
+        if not os.path.isdir(temp_folder):
+            os.makedirs(temp_folder)
+        return {
+            "read_label": "read",
+            "chunks": chunk_files,
+            "sink": sink if sink is not None else AlignmentSink(self.work_dir + "read.backward.tsv"),
+            "temp_folder": temp_folder,
+            "failures_file": self.work_dir + "failed_alignments.txt",
+            "normalized_params": None,
+            "manifest": {"manifest_file": self.work_dir + MANIFEST_FILE, "read_label": "read", "contig": "ref",
+                         "strand": "-", "events": 2000},
+        }
+
+    def chunk_files(self):
+        chunks = split_guide_alignment(self.BACKWARD_CIGAR, chunk_size=600, chunk_overlap=100)
+        files = [(self.write_chunk("chunk0.tsv", range(540, 1100)), chunks[0][1], chunks[0][2]),
+                 (self.write_chunk("chunk1.tsv", range(100, 660)), chunks[1][1], chunks[1][2])]
+        for (path, lower, upper), pairs in zip(files, (1120, 1120)):
+            with open(path + ".summary", "w") as fH:
+                fH.write("{pairs}\t0.5\t1.0\t100\n".format(pairs=pairs))
+        return chunks, files
+
+    def test_finish_chunked_alignment(self):
+        chunks, files = self.chunk_files()
+        plan = self.chunk_plan(files)
+        self.assertTrue(finish_chunked_alignment(plan))
+        self.assertFalse(os.path.isdir(plan["temp_folder"]))
+        with open(plan["sink"].out_file, "r") as fH:
+            self.assertEqual(len(fH.readlines()), 2 * 1000)
+        rows = read_alignment_manifest(self.work_dir + MANIFEST_FILE)
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["aligned_pairs"], 2240)
+        self.assertEqual(rows[0]["mean_posterior"], 0.5)
+        self.assertEqual(rows[0]["output"], plan["sink"].out_file)
+
+    def test_finish_into_shard(self):
+        # the same read stitched into a shard, its rows get the direction and the shard's index has where they are
+        chunks, files = self.chunk_files()
+        shard_file = self.work_dir + "shard0.tsv"
+        sink = ShardSink(self.work_dir + "read.backward.tsv", shard_file, "full", "read", "read.fast5", "backward")
+        plan = self.chunk_plan(files, sink=sink)
+        self.assertTrue(finish_chunked_alignment(plan))
+        self.assertFalse(os.path.isfile(sink.out_file))
+        with open(shard_file, "r") as fH:
+            rows = [line.rstrip("\n").split("\t") for line in fH]
+        self.assertEqual(len(rows), 2 * 1000)
+        self.assertEqual(set([row[-1] for row in rows]), set(["backward"]))
+        entries = read_shard_index(shard_file)
+        self.assertEqual([(e["read_label"], e["offset"], e["length"]) for e in entries],
+                         [("read.fast5", 0, os.path.getsize(shard_file))])
+        self.assertEqual(read_alignment_manifest(self.work_dir + MANIFEST_FILE)[0]["output"], shard_file)
+
+    def test_failed_chunk(self):
+        chunks = split_guide_alignment(self.BACKWARD_CIGAR, chunk_size=600, chunk_overlap=100)
+        files = [(self.write_chunk("chunk0.tsv", range(540, 1100)), chunks[0][1], chunks[0][2]),
+                 (self.write_chunk("chunk1.tsv", range(100, 660)), chunks[1][1], chunks[1][2])]
+        # a chunk that fails leaves a failure row and no output
+        chunk = {"argv": ["false"], "cigar": chunks[1][0], "output": files[1][0], "label": "read.chunk1",
+                 "lower": chunks[1][1], "upper": chunks[1][2], "max_time": None, "max_memory": None,
+                 "failures_file": self.work_dir + "failed_alignments.txt"}
+        self.assertFalse(run_alignment_chunk(chunk))
+        self.assertFalse(os.path.isfile(files[1][0]))
+        failures = parse_alignment_failures(chunk["failures_file"])
+        self.assertEqual([(label, reason) for label, reason, seconds, status in failures], [("read.chunk1", "error")])
+        # and then the read doesn't get an alignment or a manifest row
+        plan = self.chunk_plan(files)
+        self.assertFalse(finish_chunked_alignment(plan))
+        self.assertFalse(os.path.isfile(plan["sink"].out_file))
+        self.assertFalse(os.path.isfile(self.work_dir + MANIFEST_FILE))
+        self.assertFalse(os.path.isdir(plan["temp_folder"]))
+
+
+class processRunnerTests(unittest.TestCase):
+    @staticmethod
+    def python(code):
+        return [sys.executable, "-c", code]
+
+    def test_exit_status(self):
+        job = run_process(["true"], verbose=False)
+        self.assertTrue(job.ok())
+        self.assertEqual(job.status, 0)
+        self.assertIsNone(job.failure_reason())
+        job = run_process(["sh", "-c", "echo oops >&2; exit 3"], verbose=False)
+        self.assertFalse(job.ok())
+        self.assertEqual(job.status, 3)
+        self.assertEqual(job.stderr, "oops\n")
+        self.assertEqual(job.failure_reason(), "error")
+        job = run_process(["./no_such_binary"], verbose=False)
+        self.assertEqual(job.status, 127)
+        self.assertEqual(job.failure_reason(), "error")
+
+    def test_stdin_stdout(self):
+        job = run_process(["cat"], stdin="cigar: read", capture_stdout=True, verbose=False)
+        self.assertTrue(job.ok())
+        self.assertEqual(job.stdout, "cigar: read\n")
+
+    def test_rusage(self):
+        # wait4 gives the peak resident memory of the child, not ours
+        small = run_process(self.python("pass"), verbose=False)
+        big = run_process(self.python("x = bytearray(200 * 1024 * 1024)"), verbose=False)
+        self.assertTrue(small.ok() and big.ok())
+        self.assertGreater(small.peak_rss, 0)
+        self.assertGreater(big.peak_rss, 200 * 1024 * 1024)
+        self.assertLess(small.peak_rss, big.peak_rss)
+        self.assertGreaterEqual(big.elapsed, 0.0)
+
+    def test_timeout(self):
+        start = time.time()
+        job = run_process(["sleep", "30"], max_time=0.5, verbose=False)
+        self.assertLess(time.time() - start, 10)
+        self.assertTrue(job.timed_out)
+        self.assertEqual(job.status, -9)
+        self.assertFalse(job.ok())
+        self.assertEqual(job.failure_reason(), "timeout")
+
+    def test_memory_limit(self):
+        allocate = self.python("x = bytearray(400 * 1024 * 1024)")
+        job = run_process(allocate, max_memory=200, verbose=False)
+        self.assertFalse(job.ok())
+        self.assertTrue(job.out_of_memory)
+        self.assertEqual(job.failure_reason(), "memory")
+        self.assertTrue(run_process(allocate, max_memory=2000, verbose=False).ok())
+
+    def test_runner(self):
+        jobs = [ProcessJob(["sleep", "0.5"], label="job{}".format(i)) for i in xrange(4)]
+        start = time.time()
+        finished = ProcessRunner(max_children=2, verbose=False).run(jobs)
+        self.assertLess(time.time() - start, 1.9)
+        self.assertEqual([job.label for job in finished], ["job0", "job1", "job2", "job3"])
+        self.assertTrue(all([job.ok() for job in finished]))
+
+
+class alignmentIOTests(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = "./signalAlign_alignmentIOTest/"
+        os.makedirs(self.work_dir)
+        self.rows = pd.read_table(FULL_ALIGNMENT, header=None, names=FULL_COLUMNS)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def block_compressed_copy(self, alignment_file, name):
+        path = self.work_dir + name
+        with open(alignment_file, "r") as fH, open(path, "wb") as out:
+            writer = BlockCompressedWriter(out)
+            for line in fH:
+                writer.write(line)
+            writer.close()
+        return path
+
+    def columnar_copy(self, name):
+        # a block for each strand, like signalMachine writes with -s 3
+        path = self.work_dir + name
+        with open(path, "wb") as fH:
+            for strand, rows in self.rows.groupby("strand", sort=False):
+                columns = []
+                for column in FULL_COLUMNS:
+                    if column in HEADER_COLUMNS:
+                        continue
+                    if column in KMER_COLUMNS:
+                        columns.append((column, kmer_ids(rows[column].values, "ACGT").astype(np.int32)))
+                    else:
+                        columns.append((column, rows[column].values))
+                write_columnar_block(fH, "full", columns, compress=True,
+                                     metadata=[("contig", rows["contig"].iloc[0]),
+                                               ("read_label", rows["read_label"].iloc[0]), ("strand", strand),
+                                               ("kmer_alphabet", "ACGT"), ("kmer_length", 6)])
+        return path
+
+    def test_block_compressed_round_trip(self):
+        path = self.block_compressed_copy(SIMPLE_ALIGNMENT, "simple_alignment.tsv.gz")
+        with open(SIMPLE_ALIGNMENT, "r") as fH:
+            text = fH.read()
+        offsets = block_offsets(path)
+        self.assertGreater(len(offsets), 1)
+        blocks = []
+        with open(path, "rb") as fH:
+            for offset in offsets:
+                blocks.append(read_block(fH, offset))
+        # records aren't split between blocks
+        self.assertTrue(all([block.endswith("\n") for block in blocks]))
+        self.assertEqual("".join(blocks), text)
+        # and it's still gzip
+        self.assertEqual(gzip.open(path, "rb").read(), text)
+
+    def test_iter_alignment_batches(self):
+        columns = ["ref_pos", "aligned_kmer", "posterior_probability", "descaled_event_mean"]
+        kmers = list(self.rows["aligned_kmer"].iloc[[0, 5, 160, 200]])
+        exclude = list(self.rows["ref_pos"].iloc[[1, 2, 170]])
+        expected = self.rows[(self.rows["strand"] == "c") & (self.rows["posterior_probability"] >= 0.1) &
+                             ~self.rows["ref_pos"].isin(exclude)]
+        expected_kmers = expected[expected["aligned_kmer"].isin(kmers)]
+        for path in (FULL_ALIGNMENT, self.block_compressed_copy(FULL_ALIGNMENT, "full_alignment.tsv.gz"),
+                     self.columnar_copy("full_alignment.bin")):
+            # all the rows, only the columns asked for
+            batches = list(iter_alignment_batches(path, columns, batch_size=64))
+            self.assertTrue(all([len(b) <= 64 for b in batches]))
+            data = np.concatenate(batches)
+            self.assertEqual(list(data.dtype.names), columns)
+            self.assertEqual(list(data["ref_pos"]), list(self.rows["ref_pos"]))
+            self.assertEqual(list(data["aligned_kmer"]), list(self.rows["aligned_kmer"]))
+            # rows that don't pass the predicates aren't returned
+            data = np.concatenate(list(iter_alignment_batches(path, columns, batch_size=16, strand="c",
+                                                              min_posterior=0.1, exclude_positions=exclude)))
+            self.assertEqual(list(data["ref_pos"]), list(expected["ref_pos"]))
+            self.assertTrue(np.allclose(data["descaled_event_mean"], expected["descaled_event_mean"]))
+            data = np.concatenate(list(iter_alignment_batches(path, ["aligned_kmer"], strand="c", min_posterior=0.1,
+                                                              exclude_positions=exclude, kmers=kmers)))
+            self.assertEqual(list(data["aligned_kmer"]), list(expected_kmers["aligned_kmer"]))
+            # the batch that reaches max_rows is returned whole
+            batches = list(iter_alignment_batches(path, ["ref_pos"], batch_size=20, max_rows=50))
+            self.assertEqual(sum([len(b) for b in batches]), 60)
+
+    def test_reference_index(self):
+        text = self.work_dir + "a.tsv"
+        shutil.copy(FULL_ALIGNMENT, text)
+        compressed = self.block_compressed_copy(FULL_ALIGNMENT, "b.tsv.gz")
+        self.assertEqual(index_alignment_positions(text, "zymo"), len(self.rows))
+        self.assertEqual(index_alignment_positions(compressed, "zymo"), len(self.rows))
+        index = ReferenceIndex.from_directory(self.work_dir)
+        self.assertEqual(index.contigs(), ["zymo"])
+        expected = self.rows[(self.rows["strand"] == "t") & (self.rows["ref_pos"] >= 100) &
+                             (self.rows["ref_pos"] < 200)]
+        hits = index.query("zymo", "t", 100, 200)
+        self.assertEqual(len(hits), 2 * len(expected))
+        rows = index.query_rows("zymo", "t", 100, 200)
+        self.assertEqual(sorted([int(r[1]) for r in rows]), sorted(list(expected["ref_pos"]) * 2))
+        self.assertTrue(all([r[4] == "t" and len(r) == len(FULL_COLUMNS) for r in rows]))
+        self.assertEqual(index.query("zymo", "t", 10000), [])
+        self.assertEqual(index.query("other", "t", 100), [])
+
+    def test_alignment_manifest(self):
+        manifest = self.work_dir + MANIFEST_FILE
+        with open(manifest, "w") as fH:
+            fH.write("read1\tzymo\t+\t100\t0.8000\t120\t1.00\t1000\t/elsewhere/read1.sm.forward.tsv\n")
+            fH.write("read2\tzymo\t-\t100\t0.3000\t120\t1.00\t1000\t/elsewhere/read2.sm.backward.tsv\n")
+            fH.write("read3\tzymo\t+\t0\tnan\t120\t1.00\t1000\t/elsewhere/read3.sm.forward.tsv\n")
+            # read2 was aligned again, its last row counts
+            fH.write("read2\tzymo\t-\t90\t0.6000\t120\t2.00\t1000\t/elsewhere/read2.sm.backward.tsv\n")
+        rows = read_alignment_manifest(manifest)
+        self.assertEqual([r["read_label"] for r in rows], ["read1", "read3", "read2"])
+        self.assertEqual(rows[2]["aligned_pairs"], 90)
+        rows = manifest_alignments(self.work_dir + "*.tsv")
+        self.assertEqual(sorted([r["output"] for r in rows]), [self.work_dir + "read1.sm.forward.tsv",
+                                                               self.work_dir + "read2.sm.backward.tsv"])
+        rows = manifest_alignments(self.work_dir + "*.tsv", min_mean_posterior=0.7)
+        self.assertEqual([r["read_label"] for r in rows], ["read1"])
+        self.assertIsNone(manifest_alignments(self.work_dir + "*.bin"))
+        self.assertIsNone(manifest_alignments("./no_such_directory/*.tsv"))
+
+    def test_hdf5_round_trip(self):
+        hdf5_file = self.work_dir + "alignments.h5"
+        for worker, path in ((1, FULL_ALIGNMENT), (2, self.columnar_copy("full_alignment.bin"))):
+            append_alignment_to_hdf5(path, hdf5_part(hdf5_file, worker), "zymo", "forward", "read{}".format(worker))
+        merge_hdf5_parts(hdf5_file)
+        group = "alignments/zymo/forward"
+        records = read_hdf5_region(hdf5_file, group)
+        self.assertEqual(len(records), 2 * len(self.rows))
+        for label in ("read1", "read2"):
+            records = read_hdf5_region(hdf5_file, group, read_labels=[label])
+            self.assertEqual(list(records["ref_pos"]), list(self.rows["ref_pos"]))
+            self.assertEqual(list(records["path_kmer"]), list(self.rows["path_kmer"]))
+            self.assertTrue(np.allclose(records["event_mean"], self.rows["event_mean"]))
+        records = read_hdf5_region(hdf5_file, group, 100, 200)
+        self.assertEqual(sorted(records["ref_pos"]),
+                         sorted(list(self.rows["ref_pos"][(self.rows["ref_pos"] >= 100) &
+                                                          (self.rows["ref_pos"] < 200)]) * 2))
+        self.assertEqual(len(read_hdf5_region(hdf5_file, group, 5000, 6000)), 0)
+        # strings that don't fit in the rows are refused, not cut short
+        long_contig = self.work_dir + "long_contig.tsv"
+        self.rows.assign(contig="c" * 100).to_csv(long_contig, sep="\t", header=False, index=False)
+        self.assertRaises(AssertionError, append_alignment_to_hdf5, long_contig, self.work_dir + "long.h5", "zymo",
+                          "forward", "read3")
+
+
 class SignalAlignAlignmentTest(unittest.TestCase):
     def setUp(self):
         os.makedirs("./signalAlign_unittest/")
@@ -181,6 +534,24 @@ def main():
     testSuite = unittest.TestSuite()
     testSuite.addTest(LibTest('test_signalAlign_library'))
     testSuite.addTest(signalAlignLibTests("test_pysam"))
+    testSuite.addTest(chunkedAlignmentTests("test_split_forward"))
+    testSuite.addTest(chunkedAlignmentTests("test_split_backward"))
+    testSuite.addTest(chunkedAlignmentTests("test_split_short_read"))
+    testSuite.addTest(chunkedAlignmentTests("test_stitch_backward"))
+    testSuite.addTest(chunkedAlignmentTests("test_finish_chunked_alignment"))
+    testSuite.addTest(chunkedAlignmentTests("test_finish_into_shard"))
+    testSuite.addTest(chunkedAlignmentTests("test_failed_chunk"))
+    testSuite.addTest(processRunnerTests("test_exit_status"))
+    testSuite.addTest(processRunnerTests("test_stdin_stdout"))
+    testSuite.addTest(processRunnerTests("test_rusage"))
+    testSuite.addTest(processRunnerTests("test_timeout"))
+    testSuite.addTest(processRunnerTests("test_memory_limit"))
+    testSuite.addTest(processRunnerTests("test_runner"))
+    testSuite.addTest(alignmentIOTests("test_block_compressed_round_trip"))
+    testSuite.addTest(alignmentIOTests("test_iter_alignment_batches"))
+    testSuite.addTest(alignmentIOTests("test_reference_index"))
+    testSuite.addTest(alignmentIOTests("test_alignment_manifest"))
+    testSuite.addTest(alignmentIOTests("test_hdf5_round_trip"))
     testSuite.addTest(SignalAlignAlignmentTest('test_zymo_reads'))
     testSuite.addTest(SignalAlignAlignmentTest('test_pUC_r9_reads_5mer'))
     testSuite.addTest(SignalAlignAlignmentTest('test_pUC_r9_reads_6mer'))
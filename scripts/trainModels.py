@@ -8,6 +8,7 @@ sys.path.append("../")
 from multiprocessing import Process, Queue, current_process, Manager
 from subprocess import check_output
 from signalAlignLib import *
+from processRunner import run_process
 from argparse import ArgumentParser
 from random import shuffle
 from shutil import copyfile
@@ -60,6 +61,12 @@ def parse_args():
                         help="path to complement HDP model to use")
     parser.add_argument('--jobs', '-j', action='store', dest='nb_jobs', required=False, default=4,
                         type=int, help="number of jobs to run concurrently")
+    parser.add_argument('--estimate_params', action='store_true', default=False, dest='estimate_params',
+                        help="estimate the adjustment parameters of each read once and reuse them in later "
+                             "iterations instead of re-estimating them every time the read is aligned")
+    parser.add_argument('--nanopore_params', action='store', default=None, dest='nanopore_params',
+                        help="table of per-read adjustment parameters to use and add to, default: "
+                             "nanopore_params.tsv in the working directory")
     parser.add_argument('--test', action='store_true', default=False, dest='test')
 
     # gibbs
@@ -219,21 +226,17 @@ def build_hdp(template_hdp_path, complement_hdp_path, template_assignments, comp
         "trainModels - ERROR: missing assignments"
 
     if verbose is True:
-        verbose_flag = "--verbose "
+        verbose_flag = ["--verbose"]
     else:
-        verbose_flag = ""
-
-    command = "./buildHdpUtil {verbose}-v {tHdpP} -w {cHdpP} -E {tExpectations} -W {cExpectations} " \
-              "-n {samples} -I {burnIn} -t {thinning}".format(tHdpP=template_hdp_path,
-                                                              cHdpP=complement_hdp_path,
-                                                              tExpectations=template_assignments,
-                                                              cExpectations=complement_assignments,
-                                                              samples=samples, burnIn=burn_in,
-                                                              thinning=thinning,
-                                                              verbose=verbose_flag)
-    print("[trainModels] Running command:{}".format(command), file=sys.stderr)
-    os.system(command)  # todo try checkoutput
-    print("trainModels - built HDP.", file=sys.stderr)
+        verbose_flag = []
+
+    argv = ["./buildHdpUtil"] + verbose_flag + ["-v", template_hdp_path, "-w", complement_hdp_path,
+                                                "-E", template_assignments, "-W", complement_assignments,
+                                                "-n", samples, "-I", burn_in, "-t", thinning]
+    job = run_process(argv=argv, label="buildHdpUtil")
+    assert job.ok(), "trainModels - ERROR: buildHdpUtil failed, exit status {}".format(job.status)
+    print(job.stderr, end="", file=sys.stderr)
+    print("trainModels - built HDP in {:.1f} seconds.".format(job.elapsed), file=sys.stderr)
     return
 
 
@@ -273,6 +276,9 @@ def main(args):
 
     print(start_message, file=sys.stdout)
 
+    # index and check the models once, before the workers start so that they share the registry
+    get_model_registry()
+
     # make directory to put the files we're using files
     working_folder = FolderHandler()
     working_directory_path = working_folder.open_folder(args.out + "tempFiles_expectations")
@@ -348,6 +354,24 @@ def main(args):
         # first cull a set of files to get expectations on
         training_files = cull_training_files(directories=args.files_dir, fofns=args.fofn, training_amount=args.amount,
                                              reference_maps=reference_maps, twoD=args.twoD)
+        # the parameters of reads we've seen in an earlier iteration are reused, they're estimated with the
+        # starting lookup tables so they don't change as the model is trained
+        if args.estimate_params or args.nanopore_params is not None:
+            nanopore_params_path = args.nanopore_params if args.nanopore_params is not None else \
+                working_directory_path + "nanopore_params.tsv"
+            if args.estimate_params:
+                nanopore_params = estimate_nanopore_params(fast5s=[x[0] for x in training_files],
+                                                           table_path=nanopore_params_path,
+                                                           working_directory=working_directory_path,
+                                                           twoD=args.twoD,
+                                                           template_model=template_model_path,
+                                                           complement_model=complement_model_path,
+                                                           jobs=args.nb_jobs)
+            else:
+                nanopore_params = NanoporeParamsTable(nanopore_params_path)
+        else:
+            nanopore_params = None
+
         # setup
         workers = args.nb_jobs
         work_queue = Manager().Queue()
@@ -374,6 +398,8 @@ def main(args):
                 "target_regions": None,
                 "degenerate": None,
                 "twoD_chemistry": args.twoD,
+                "nanopore_params": (nanopore_params.get(file_ref_tuple[0].split("/")[-1])
+                                    if nanopore_params is not None else None),
             }
             #alignment = SignalAlignment(**alignment_args)
             #alignment.run(get_expectations=True)
@@ -5,18 +5,41 @@ from __future__ import print_function
 import sys
 import os
 import glob
+import shutil
+import h5py
 import pandas as pd
 import numpy as np
 from random import shuffle
 from signalAlignLib import SignalAlignment
+from alignmentIO import manifest_alignments, merge_hdf5_parts, HDF5_EXTENSION
 from alignmentAnalysisLib import CallMethylation
 from multiprocessing import Process, Queue, current_process, Manager
 from serviceCourse.parsers import read_fasta
 from serviceCourse.sequenceTools import reverse_complement
 
 
-def randomly_select_alignments(path_to_alignments, max_alignments_to_use):
-    alignments = [x for x in glob.glob(path_to_alignments) if os.stat(x).st_size != 0]
+def manifest_strands(path_to_alignments, min_mean_posterior=None):
+    """{alignment: strand} from the manifest signalAlign left with the alignments, None without one. A shard holds
+    reads mapped to both strands, those get None
+    """
+    rows = manifest_alignments(path_to_alignments, min_mean_posterior=min_mean_posterior)
+    if rows is None:
+        return None
+    strands = {}
+    for row in rows:
+        strand = strands.setdefault(row["output"], row["strand"])
+        if strand != row["strand"]:
+            strands[row["output"]] = None
+    return strands
+
+
+def randomly_select_alignments(path_to_alignments, max_alignments_to_use, min_mean_posterior=None):
+    # the manifest has the alignments that got any aligned pairs, without it we look at the files
+    strands = manifest_strands(path_to_alignments, min_mean_posterior=min_mean_posterior)
+    if strands is not None:
+        alignments = strands.keys()
+    else:
+        alignments = [x for x in glob.glob(path_to_alignments) if os.stat(x).st_size != 0]
     if len(alignments) == 0:
         print("[error] Didn't find any alignment files here {}".format(path_to_alignments))
         sys.exit(1)
@@ -28,19 +51,28 @@ def randomly_select_alignments(path_to_alignments, max_alignments_to_use):
         return alignments[:max_alignments_to_use]
 
 
+def get_alignment_files(directory):
+    # the alignments signalAlign left in a directory, compressed or not
+    alignments = glob.glob(directory + "*.tsv") + glob.glob(directory + "*.tsv.gz")
+    return [x for x in alignments if os.stat(x).st_size != 0]
+
+
 def get_forward_mask(list_of_alignments, suffix):
     mask = []
     for alignment in list_of_alignments:
-        if alignment.endswith(".backward.tsv{}".format(suffix)):
+        if alignment.endswith(".backward.tsv{}".format(suffix)) or \
+                alignment.endswith(".backward.tsv.gz{}".format(suffix)):
             mask.append(False)
         else:
             mask.append(True)
     return mask
 
 
-def get_alignments_labels_and_mask(path_to_alignments, max, suffix=""):
-    alignments = randomly_select_alignments(path_to_alignments, max)
-    mask = get_forward_mask(alignments, suffix)
+def get_alignments_labels_and_mask(path_to_alignments, max, suffix="", min_mean_posterior=None):
+    alignments = randomly_select_alignments(path_to_alignments, max, min_mean_posterior=min_mean_posterior)
+    strands = manifest_strands(path_to_alignments, min_mean_posterior=min_mean_posterior) or {}
+    mask = [strands[a] == "+" if strands.get(a) is not None else get_forward_mask([a], suffix)[0]
+            for a in alignments]
     return alignments, mask
 
 
@@ -129,8 +161,8 @@ def call_sites_with_marginal_probs(data, reference_sequence_string, min_depth=0,
             continue
 
         for i, read in x.iterrows():
-            if ((read['read'].endswith(".forward.tsv") and read['strand'] == 't') or
-                    (read['read'].endswith(".backward.tsv") and read['strand'] == 'c')):
+            if ((read['read'].endswith((".forward.tsv", ".forward.tsv.gz")) and read['strand'] == 't') or
+                    (read['read'].endswith((".backward.tsv", ".backward.tsv.gz")) and read['strand'] == 'c')):
                 direction = True
             else:
                 direction = False
@@ -173,13 +205,53 @@ def aligner(work_queue, done_queue):
         done_queue.put("%s failed with %s" % (current_process().name, e.message))
 
 
+def call_output_part(out_file, worker):
+    # the same as alignmentIO.hdf5_part, so merge_hdf5_parts finds the parts of a .h5 out_file
+    return "{out}.part{worker}".format(out=out_file, worker=worker)
+
+
+def merge_call_output(out_file, workers):
+    """puts the parts of out_file the workers (process ids) wrote after whatever is in out_file already. The merge
+    goes to a temporary file that is renamed over out_file, so nobody sees out_file half written
+    """
+    parts = [call_output_part(out_file, worker) for worker in workers]
+    parts = [part for part in parts if os.path.isfile(part)]
+    if len(parts) == 0:
+        return
+    if out_file.endswith(HDF5_EXTENSION):
+        # the merged file only points at the parts, they stay (with the ones of earlier runs)
+        merge_hdf5_parts(out_file)
+        return
+    temp_file = out_file + ".tmp"
+    with open(temp_file, "w") as out:
+        for path in ([out_file] if os.path.isfile(out_file) else []) + parts:
+            with open(path, "r") as fH:
+                shutil.copyfileobj(fH, out, 1 << 20)
+    os.rename(temp_file, out_file)
+    for part in parts:
+        os.remove(part)
+
+
 def variant_caller(work_queue, done_queue):
+    # each worker opens its own part of the out_file once and writes the calls of an alignment in one go, so the
+    # workers never share a file, merge_call_output puts the parts together once they are all done
+    parts = {}
     try:
         for f in iter(work_queue.get, 'STOP'):
             c = CallMethylation(**f)
-            c.write()
+            hdf5 = f["out_file"].endswith(HDF5_EXTENSION)
+            if f["out_file"] not in parts:
+                part = call_output_part(f["out_file"], os.getpid())
+                parts[f["out_file"]] = h5py.File(part, "a") if hdf5 else open(part, "a")
+            if hdf5:
+                c.write_hdf5(fH=parts[f["out_file"]])
+            else:
+                c.write(fH=parts[f["out_file"]])
     except Exception, e:
         done_queue.put("%s failed with %s" % (current_process().name, e.message))
+    finally:
+        for fH in parts.values():
+            fH.close()
 
 
 def run_service(service, service_iterable, service_arguments, workers, iterable_argument):
@@ -204,6 +276,9 @@ def run_service(service, service_iterable, service_arguments, workers, iterable_
 
     done_queue.put('STOP')
 
+    if "out_file" in service_arguments:
+        merge_call_output(service_arguments["out_file"], [p.pid for p in jobs])
+
 
 def make_reference_files_and_alignment_args(working_folder, reference_sequence_string, alignment_args,
                                             n_positions=None):
@@ -239,7 +314,7 @@ def scan_for_proposals(working_folder, step, reference_sequence_string, list_of_
         run_service(aligner, list_of_fast5s, alignment_args, workers, "in_fast5")
 
         # alignments is the list of alignments to gather proposals from
-        alignments = [x for x in glob.glob(working_folder.path + "*.tsv") if os.stat(x).st_size != 0]
+        alignments = get_alignment_files(working_folder.path)
 
         if len(alignments) == 0:
             print("[error] Didn't find any alignment files here {}".format(working_folder.path))
@@ -263,7 +338,7 @@ def scan_for_proposals(working_folder, step, reference_sequence_string, list_of_
         proposals += call_sites_with_marginal_probs(marginal_probability_file, reference_sequence_string,
                                                     min_depth=0, get_sites=True)
         # remove old alignments
-        for f in glob.glob(working_folder.path + "*.tsv"):
+        for f in glob.glob(working_folder.path + "*.tsv") + glob.glob(working_folder.path + "*.tsv.gz"):
             os.remove(f)
     # proposals is a list of lists containing (position, delta_prob) where position in the position in the
     # reference sequence that is being proposed to be edited, and delta_prob is the difference in probability
@@ -278,7 +353,7 @@ def update_reference_with_marginal_probs(working_folder, proposals, reference_se
     assert check, "[update_reference_with_marginal_probs]: problem making reference files and args dict"
     run_service(aligner, list_of_fast5s, alignment_args, workers, "in_fast5")
 
-    alignments = [x for x in glob.glob(working_folder.path + "*.tsv") if os.stat(x).st_size != 0]
+    alignments = get_alignment_files(working_folder.path)
 
     marginal_probability_file = working_folder.add_file_path("proposals.calls")
 
@@ -301,7 +376,7 @@ def update_reference_with_marginal_probs(working_folder, proposals, reference_se
     working_folder.remove_file(marginal_probability_file)
 
     # remove old alignments
-    for f in glob.glob(working_folder.path + "*.tsv"):
+    for f in glob.glob(working_folder.path + "*.tsv") + glob.glob(working_folder.path + "*.tsv.gz"):
         os.remove(f)
 
     return updated_reference_sequence
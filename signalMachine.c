@@ -1,17 +1,20 @@
 #include <getopt.h>
 #include <string.h>
+#include <math.h>
+#include <stdint.h>
 #include "signalMachineUtils.h"
 #include "pairwiseAligner.h"
+#include "columnarOutput.h"
+#include "blockCompressedOutput.h"
 
 #define STEP 6  // space between degenerate nucleotides in for error correction
-#define ESTIMATE_PARAMS 1
-#define ASSIGNMENT_THRESHOLD 0.1
 
 
 typedef enum {
     full = 0,
     variantCaller = 1,
-    assignments = 2
+    assignments = 2,
+    binary = 3
 } OutputFormat;
 
 void usage() {
@@ -65,15 +68,100 @@ inline int64_t adjustQueryPosition(int64_t unadjustedQueryPosition, int64_t kmer
     }
 }
 
+// columns of the full format, --outputColumns picks from these
+#define NB_FULL_COLUMNS 16
+static const char *fullColumnNames[NB_FULL_COLUMNS] = {
+    "contig", "ref_pos", "ref_kmer", "read_label", "strand", "event_index", "event_mean", "event_noise",
+    "event_duration", "aligned_kmer", "scaled_mean_current", "scaled_noise", "posterior_probability",
+    "descaled_event_mean", "ont_model_mean", "path_kmer"
+};
+#define FULL_ROW_FORMAT "%s\t%"PRId64"\t%s\t%s\t%s\t%"PRId64"\t%f\t%f\t%f\t%s\t%f\t%f\t%f\t%f\t%f\t%s"
+
+stList *parseOutputColumns(char *columnString) {
+    stList *names = stString_splitByString(columnString, ",");
+    stList *columns = stList_construct3(0, free);
+    for (int64_t i = 0; i < stList_length(names); i++) {
+        char *name = stList_get(names, i);
+        int64_t column = -1;
+        for (int64_t c = 0; c < NB_FULL_COLUMNS; c++) {
+            if (stString_eq(name, fullColumnNames[c])) {
+                column = c;
+            }
+        }
+        if (column < 0) {
+            st_errAbort("signalAlign - unknown output column %s\n", name);
+        }
+        int64_t *columnPtr = st_malloc(sizeof(int64_t));
+        *columnPtr = column;
+        stList_append(columns, columnPtr);
+    }
+    stList_destruct(names);
+    return columns;
+}
+
+static bool fileIsEmpty(char *path) {
+    FILE *fH = fopen(path, "rb");
+    if (fH == NULL) {
+        return TRUE;
+    }
+    fseek(fH, 0, SEEK_END);
+    bool empty = ftell(fH) == 0;
+    fclose(fH);
+    return empty;
+}
+
+// takes the columns out of a full format row (without the newline), the row gets split up in place
+static char *selectColumns(char *row, stList *columns) {
+    char *fields[NB_FULL_COLUMNS];
+    int64_t nbFields = 1;
+    fields[0] = row;
+    for (char *c = row; *c != '\0'; c++) {
+        if (*c == '\t') {
+            *c = '\0';
+            if (nbFields == NB_FULL_COLUMNS) {
+                st_errAbort("selectColumns: row has more than %i columns\n", NB_FULL_COLUMNS);
+            }
+            fields[nbFields++] = c + 1;
+        }
+    }
+    int64_t length = 1;
+    for (int64_t i = 0; i < stList_length(columns); i++) {
+        length += strlen(fields[*(int64_t *) stList_get(columns, i)]) + 1;
+    }
+    char *selected = st_malloc(length * sizeof(char));
+    selected[0] = '\0';
+    for (int64_t i = 0; i < stList_length(columns); i++) {
+        if (i > 0) {
+            strcat(selected, "\t");
+        }
+        strcat(selected, fields[*(int64_t *) stList_get(columns, i)]);
+    }
+    return selected;
+}
+
 void writePosteriorProbsFull(char *posteriorProbsFile, char *readLabel, StateMachine *sM,
                              NanoporeReadAdjustmentParameters npp, double *events, char *target, bool forward,
                              char *contig, int64_t eventSequenceOffset, int64_t referenceSequenceOffset,
-                             stList *alignedPairs, Strand strand) {
+                             stList *alignedPairs, Strand strand, bool compress, stList *columns) {
     // label for tsv output
     char *strandLabel = strand == template ? "t" : "c";
 
+    // with a subset of the columns the file starts with a line naming them, eg. #strand\taligned_kmer...
+    bool writeHeader = columns != NULL && fileIsEmpty(posteriorProbsFile);
+
     // open the file for output
-    FILE *fH = fopen(posteriorProbsFile, "a");
+    BlockWriter *fH = blockWriter_open(posteriorProbsFile, compress);
+    if (writeHeader) {
+        char *header = stString_copy("#");
+        for (int64_t i = 0; i < stList_length(columns); i++) {
+            char *s = stString_print("%s%s%s", header, i == 0 ? "" : "\t",
+                                     fullColumnNames[*(int64_t *) stList_get(columns, i)]);
+            free(header);
+            header = s;
+        }
+        blockWriter_printf(fH, "%s\n", header);
+        free(header);
+    }
 
     // get some lengths outside the loop
     int64_t refLength = (int64_t )strlen(target);
@@ -121,26 +209,133 @@ void writePosteriorProbsFull(char *posteriorProbsFile, char *readLabel, StateMac
         char *refKmer = makeReferenceKmer(k_i, strand, forward);
 
         // write to file
-        fprintf(fH, "%s\t%"PRId64"\t%s\t%s\t%s\t%"PRId64"\t%f\t%f\t%f\t%s\t%f\t%f\t%f\t%f\t%f\t%s\n",
-                contig, x_adj, refKmer, readLabel, strandLabel, y, eventMean, eventNoise, eventDuration, k_i,
-                scaled_Emean, scaled_Enoise, p, descaledEventMean, E_mean, pathKmer);
+        if (columns == NULL) {
+            blockWriter_printf(fH, FULL_ROW_FORMAT"\n",
+                               contig, x_adj, refKmer, readLabel, strandLabel, y, eventMean, eventNoise,
+                               eventDuration, k_i, scaled_Emean, scaled_Enoise, p, descaledEventMean, E_mean,
+                               pathKmer);
+        } else {
+            char *row = stString_print(FULL_ROW_FORMAT, contig, x_adj, refKmer, readLabel, strandLabel, y,
+                                       eventMean, eventNoise, eventDuration, k_i, scaled_Emean, scaled_Enoise, p,
+                                       descaledEventMean, E_mean, pathKmer);
+            char *selected = selectColumns(row, columns);
+            blockWriter_printf(fH, "%s\n", selected);
+            free(selected);
+            free(row);
+        }
 
         // cleanup
         free(k_i);
         free(refKmer);
     }
+    blockWriter_close(fH);
+}
+
+void writePosteriorProbsBinary(char *posteriorProbsFile, char *readLabel, StateMachine *sM,
+                               NanoporeReadAdjustmentParameters npp, double *events, char *target, bool forward,
+                               char *contig, int64_t eventSequenceOffset, int64_t referenceSequenceOffset,
+                               stList *alignedPairs, Strand strand, bool compress) {
+    // same columns as the full format, as typed arrays with the kmers as ids, one block per strand
+    int64_t refLength = (int64_t )strlen(target);
+    int64_t refLengthInKmers = refLength - sM->kmerLength;
+
+    // the kmer alphabet has to cover the reference as well as the model, eg. for degenerate characters
+    stList *sequences = stList_construct();
+    char *reverseComplementTarget = stString_reverseComplementString(target);
+    stList_append(sequences, target);
+    stList_append(sequences, reverseComplementTarget);
+    char *kmerAlphabet = columnar_kmerAlphabet(sM->alphabet, sM->alphabetSize, sequences);
+    stList_destruct(sequences);
+    free(reverseComplementTarget);
+    if (pow((double) strlen(kmerAlphabet), (double) sM->kmerLength) > INT32_MAX) {
+        st_errAbort("signalAlign - kmer alphabet %s is too big for %"PRId64"-mer ids\n", kmerAlphabet,
+                    sM->kmerLength);
+    }
+
+    ColumnarBlock *block = columnarBlock_construct("full");
+    char *kmerLength = stString_print("%"PRId64"", sM->kmerLength);
+    columnarBlock_addMetadata(block, "contig", contig);
+    columnarBlock_addMetadata(block, "read_label", readLabel);
+    columnarBlock_addMetadata(block, "strand", strand == template ? "t" : "c");
+    columnarBlock_addMetadata(block, "forward", forward ? "1" : "0");
+    columnarBlock_addMetadata(block, "kmer_length", kmerLength);
+    columnarBlock_addMetadata(block, "kmer_alphabet", kmerAlphabet);
+    free(kmerLength);
+
+    int64_t refPosColumn = columnarBlock_addColumn(block, "ref_pos", columnInt64);
+    int64_t refKmerColumn = columnarBlock_addColumn(block, "ref_kmer", columnInt32);
+    int64_t eventIndexColumn = columnarBlock_addColumn(block, "event_index", columnInt64);
+    int64_t eventMeanColumn = columnarBlock_addColumn(block, "event_mean", columnDouble);
+    int64_t eventNoiseColumn = columnarBlock_addColumn(block, "event_noise", columnDouble);
+    int64_t eventDurationColumn = columnarBlock_addColumn(block, "event_duration", columnDouble);
+    int64_t kmerColumn = columnarBlock_addColumn(block, "aligned_kmer", columnInt32);
+    int64_t scaledMeanColumn = columnarBlock_addColumn(block, "scaled_mean_current", columnDouble);
+    int64_t scaledNoiseColumn = columnarBlock_addColumn(block, "scaled_noise", columnDouble);
+    int64_t posteriorColumn = columnarBlock_addColumn(block, "posterior_probability", columnDouble);
+    int64_t descaledMeanColumn = columnarBlock_addColumn(block, "descaled_event_mean", columnDouble);
+    int64_t modelMeanColumn = columnarBlock_addColumn(block, "ont_model_mean", columnDouble);
+    int64_t pathKmerColumn = columnarBlock_addColumn(block, "path_kmer", columnInt32);
+
+    for(int64_t i = 0; i < stList_length(alignedPairs); i++) {
+        stIntTuple *aPair = stList_get(alignedPairs, i);
+
+        if (stIntTuple_length(aPair) != 4) {
+            st_errAbort("Aligned pair tuples should have length 4, this one has length %lld\n",
+                        stIntTuple_length(aPair));
+        }
+
+        int64_t x_i = stIntTuple_get(aPair, 1);
+        int64_t x_adj = adjustReferenceCoordinate(x_i, referenceSequenceOffset, refLengthInKmers, refLength,
+                                                  strand, forward);
+        int64_t y = stIntTuple_get(aPair, 2) + eventSequenceOffset;
+        double p = ((double)stIntTuple_get(aPair, 0)) / PAIR_ALIGNMENT_PROB_1;
+        char *pathKmer = (char *)stIntTuple_get(aPair, 3);
+
+        char *k_i = kmerFromString(target, x_i, sM->kmerLength);
+        char *refKmer = makeReferenceKmer(k_i, strand, forward);
+
+        int64_t targetKmerIndex = kmer_id(pathKmer, sM->alphabet, sM->alphabetSize, sM->kmerLength);
+        double eventMean = sequence_getEventMean(events, y);
+        double E_mean = sM->EMISSION_MATCH_MATRIX[(targetKmerIndex * MODEL_PARAMS)];
+        double E_noise = sM->EMISSION_MATCH_MATRIX[(targetKmerIndex * MODEL_PARAMS + 2)];
+
+        columnarBlock_appendInt64(block, refPosColumn, x_adj);
+        columnarBlock_appendInt32(block, refKmerColumn, (int32_t) columnar_kmerId(refKmer, kmerAlphabet,
+                                                                                  sM->kmerLength));
+        columnarBlock_appendInt64(block, eventIndexColumn, y);
+        columnarBlock_appendDouble(block, eventMeanColumn, eventMean);
+        columnarBlock_appendDouble(block, eventNoiseColumn, sequence_getEventNoise(events, y));
+        columnarBlock_appendDouble(block, eventDurationColumn, sequence_getEventDuration(events, y));
+        columnarBlock_appendInt32(block, kmerColumn, (int32_t) columnar_kmerId(k_i, kmerAlphabet, sM->kmerLength));
+        columnarBlock_appendDouble(block, scaledMeanColumn, E_mean * npp.scale + npp.shift);
+        columnarBlock_appendDouble(block, scaledNoiseColumn, E_noise * npp.scale_sd);
+        columnarBlock_appendDouble(block, posteriorColumn, p);
+        columnarBlock_appendDouble(block, descaledMeanColumn,
+                                   emissions_signal_descaleEventMean_JordanStyle(eventMean, E_mean, npp.scale,
+                                                                                 npp.shift, npp.var));
+        columnarBlock_appendDouble(block, modelMeanColumn, E_mean);
+        columnarBlock_appendInt32(block, pathKmerColumn, (int32_t) columnar_kmerId(pathKmer, kmerAlphabet,
+                                                                                   sM->kmerLength));
+        free(k_i);
+        free(refKmer);
+    }
+
+    FILE *fH = fopen(posteriorProbsFile, "ab");
+    columnarBlock_write(block, fH, compress);
     fclose(fH);
+    columnarBlock_destruct(block);
+    free(kmerAlphabet);
 }
 
 void writePosteriorProbsVC(char *posteriorProbsFile, char *readLabel, StateMachine *sM, char *target, bool forward,
                            int64_t eventSequenceOffset, int64_t referenceSequenceOffset, stList *alignedPairs,
-                           Strand strand) {
+                           Strand strand, bool compress) {
     // label for tsv output
     char *strandLabel = strand == template ? "t" : "c";
     char *forwardLabel = forward ? "forward" : "backward";
 
     // open the file for output
-    FILE *fH = fopen(posteriorProbsFile, "a");
+    BlockWriter *fH = blockWriter_open(posteriorProbsFile, compress);
 
     // get some lengths outside the loop
     int64_t refLength = (int64_t )strlen(target);
@@ -189,23 +384,23 @@ void writePosteriorProbsVC(char *posteriorProbsFile, char *readLabel, StateMachi
             char base = pathKmer[queryPosition];
             // position in the reference we're reporting on
             int64_t reportPosition = x_adj + unadjustedQueryPosition;
-            fprintf(fH, "%"PRId64"\t%"PRId64"\t%c\t%f\t%s\t%s\t%s\n", y, reportPosition, base, p,
-                    strandLabel, forwardLabel, readLabel);
+            blockWriter_printf(fH, "%"PRId64"\t%"PRId64"\t%c\t%f\t%s\t%s\t%s\n", y, reportPosition, base, p,
+                               strandLabel, forwardLabel, readLabel);
         }
         free(k_i);
         free(refKmer);
         stList_destruct(queryPositions);
     }
-    fclose(fH);
+    blockWriter_close(fH);
 }
 
 void writeAssignments(char *posteriorProbsFile, StateMachine *sM, double *events, int64_t eventSequenceOffset,
-                      NanoporeReadAdjustmentParameters npp, stList *alignedPairs, Strand strand) {
+                      NanoporeReadAdjustmentParameters npp, stList *alignedPairs, Strand strand, bool compress) {
     // label for tsv output
     char *strandLabel = strand == template ? "t" : "c";
 
     // open the file for output
-    FILE *fH = fopen(posteriorProbsFile, "a");
+    BlockWriter *fH = blockWriter_open(posteriorProbsFile, compress);
 
     for(int64_t i = 0; i < stList_length(alignedPairs); i++) {
         // grab the aligned pair
@@ -232,54 +427,69 @@ void writeAssignments(char *posteriorProbsFile, StateMachine *sM, double *events
         // descale the observed mean
         double descaledEventMean = emissions_signal_descaleEventMean_JordanStyle(eventMean, E_mean,
                                                                                  npp.scale, npp.shift, npp.var);
-        fprintf(fH, "%s\t%s\t%lf\t%lf\n", pathKmer, strandLabel, descaledEventMean, p);
+        blockWriter_printf(fH, "%s\t%s\t%lf\t%lf\n", pathKmer, strandLabel, descaledEventMean, p);
     }
-    fclose(fH);
+    blockWriter_close(fH);
 }
 
-void outputAlignment(OutputFormat fmt,
-                     char *posteriorProbsFile, char *readLabel, StateMachine *sM, NanoporeReadAdjustmentParameters npp,
-                     double *events, char *target, bool forward, char *contig, int64_t eventSequenceOffset,
-                     int64_t referenceSequenceOffset, stList *alignedPairs, Strand strand) {
+double meanPairPosterior(stList *alignedPairs) {
+    // mean posterior probability of the aligned pairs, 0 without any. Viterbi pairs all have probability 1
+    if (stList_length(alignedPairs) == 0) {
+        return 0.0;
+    }
+    double posteriorSum = 0.0;
+    for (int64_t i = 0; i < stList_length(alignedPairs); i++) {
+        posteriorSum += ((double) stIntTuple_get(stList_get(alignedPairs, i), 0)) / PAIR_ALIGNMENT_PROB_1;
+    }
+    return posteriorSum / stList_length(alignedPairs);
+}
+
+int64_t outputAlignment(OutputFormat fmt,
+                        char *posteriorProbsFile, char *readLabel, StateMachine *sM,
+                        NanoporeReadAdjustmentParameters npp, double *events, char *target, bool forward,
+                        char *contig, int64_t eventSequenceOffset, int64_t referenceSequenceOffset,
+                        stList *alignedPairs, Strand strand, bool compress, stList *outputColumns,
+                        double posteriorFloor, double *meanPosterior) {
+    // returns the number of aligned pairs written and sets meanPosterior to their mean posterior probability.
+    // pairs under the write-time floor aren't written, the alignment itself only used the -D threshold
+    if (posteriorFloor > 0.0) {
+        stList *keptPairs = stList_construct();
+        for (int64_t i = 0; i < stList_length(alignedPairs); i++) {
+            stIntTuple *aPair = stList_get(alignedPairs, i);
+            if (((double) stIntTuple_get(aPair, 0)) / PAIR_ALIGNMENT_PROB_1 >= posteriorFloor) {
+                stList_append(keptPairs, aPair);
+            }
+        }
+        int64_t nKeptPairs = outputAlignment(fmt, posteriorProbsFile, readLabel, sM, npp, events, target, forward,
+                                             contig, eventSequenceOffset, referenceSequenceOffset, keptPairs, strand,
+                                             compress, outputColumns, 0.0, meanPosterior);
+        stList_destruct(keptPairs);
+        return nKeptPairs;
+    }
+    *meanPosterior = meanPairPosterior(alignedPairs);
     switch (fmt) {
         case full:
             writePosteriorProbsFull(posteriorProbsFile, readLabel, sM, npp, events, target, forward, contig,
-                                    eventSequenceOffset, referenceSequenceOffset, alignedPairs, strand);
+                                    eventSequenceOffset, referenceSequenceOffset, alignedPairs, strand, compress,
+                                    outputColumns);
             break;
         case variantCaller:
             writePosteriorProbsVC(posteriorProbsFile, readLabel, sM, target, forward, eventSequenceOffset,
-                                  referenceSequenceOffset, alignedPairs, strand);
+                                  referenceSequenceOffset, alignedPairs, strand, compress);
             break;
         case assignments:
-            writeAssignments(posteriorProbsFile, sM, events, eventSequenceOffset, npp, alignedPairs, strand);
+            writeAssignments(posteriorProbsFile, sM, events, eventSequenceOffset, npp, alignedPairs, strand,
+                             compress);
+            break;
+        case binary:
+            writePosteriorProbsBinary(posteriorProbsFile, readLabel, sM, npp, events, target, forward, contig,
+                                      eventSequenceOffset, referenceSequenceOffset, alignedPairs, strand, compress);
             break;
         default:
             fprintf(stderr, "signalAlign - No valid output format provided\n");
-            return;
-    }
-}
-
-StateMachine *buildStateMachine(const char *modelFile, NanoporeReadAdjustmentParameters npp, StateMachineType type,
-                                NanoporeHDP *nHdp) {
-    if ((type != threeState) && (type != threeStateHdp)) {
-        st_errAbort("signalAlign - incompatible stateMachine type request");
-    }
-    if (!stFile_exists(modelFile)) {
-        st_errAbort("signalAlign - ERROR: couldn't find model file here: %s\n", modelFile);
-    }
-
-    if (type == threeState) {
-        StateMachine *sM = getStateMachine3_descaled(modelFile, npp, !ESTIMATE_PARAMS);
-        return sM;
-    }
-    if (type == threeStateHdp) {
-        StateMachine *sM = getHdpStateMachine(nHdp, modelFile, npp);
-        return sM;
-    }
-    else {
-        st_errAbort("signalAlign - ERROR: buildStateMachine, didn't get correct input\n");
+            return 0;
     }
-    return 0;
+    return stList_length(alignedPairs);
 }
 
 inline void loadHmmRoutine(const char *hmmFile, StateMachine *sM, StateMachineType type, Hmm *expectations) {
@@ -291,7 +501,7 @@ inline void loadHmmRoutine(const char *hmmFile, StateMachine *sM, StateMachineTy
 
 StateMachine *buildStateMachineAndLoadHmm(const char *modelFile, NanoporeReadAdjustmentParameters npp,
                                           StateMachineType type, NanoporeHDP *nHdp) {
-    StateMachine *sM = buildStateMachine(modelFile, npp, type, nHdp);
+    StateMachine *sM = signalUtils_buildStateMachine(modelFile, npp, type, nHdp);
     // commented out because now the model file has the transitions and the event model, so no longer need to
     // load the .hmm into the stateMachine
     //if (HmmFile != NULL) {
@@ -314,45 +524,6 @@ void updateHdpFromAssignments(const char *nHdpFile, const char *expectationsFile
     destroy_nanopore_hdp(nHdp);
 }
 
-static double totalScore(stList *alignedPairs) {
-    double score = 0.0;
-    for (int64_t i = 0; i < stList_length(alignedPairs); i++) {
-        stIntTuple *aPair = stList_get(alignedPairs, i);
-        score += stIntTuple_get(aPair, 0);
-    }
-    return score;
-}
-
-double scoreByPosteriorProbabilityIgnoringGaps(stList *alignedPairs) {
-    /*
-     * Gives the average posterior match probability per base of the two sequences, ignoring indels.
-     */
-    return 100.0 * totalScore(alignedPairs) / ((double) stList_length(alignedPairs) * PAIR_ALIGNMENT_PROB_1);
-}
-
-stList *performSignalAlignment(StateMachine *sM, Sequence *eventSequence, int64_t *eventMap,
-                               int64_t mapOffset, char *target, PairwiseAlignmentParameters *p,
-                               stList *unmappedAnchors, DegenerateType degenerate) {
-    if ((sM->type != threeState) && (sM->type != threeStateHdp)) {
-        st_errAbort("signalAlign - You're trying to do the wrong king of alignment");
-    }
-
-    int64_t lX = sequence_correctSeqLength(strlen(target), kmer, sM->kmerLength);
-
-    // remap anchor pairs
-    stList *filteredRemappedAnchors = signalUtils_getRemappedAnchorPairs(unmappedAnchors, eventMap, mapOffset);
-
-    // make sequences
-    Sequence *sX = sequence_constructReferenceKmerSequence(lX, target, sequence_getKmer,
-                                                           sequence_sliceNucleotideSequence, degenerate, kmer);
-
-    // do alignment
-    stList *alignedPairs = getAlignedPairsUsingAnchors(sM, sX, eventSequence, filteredRemappedAnchors, p,
-                                                       diagonalCalculationPosteriorMatchProbs, 1, 1);
-
-    return alignedPairs;
-}
-
 Sequence *makeEventSequenceFromPairwiseAlignment(double *events, int64_t queryStart, int64_t queryEnd,
                                                  int64_t *eventMap) {
     // find the event mapped to the start and end of the 2D read alignment
@@ -397,15 +568,28 @@ int main(int argc, char *argv[]) {
     int64_t diagExpansion = 50;
     double threshold = 0.01;
     int64_t constraintTrim = 14;
+    int64_t nbThreads = 1;
+    int64_t checkpointInterval = 0;
+    int64_t memoryCeiling = 0;
+    int64_t maxDiagExpansion = 0;
+    double pruneThreshold = 0.0;
+    int64_t beamWidth = 0;
     int64_t degenerate;
     int64_t outFmt;
     bool twoD = FALSE;
+    bool viterbi = FALSE;
+    bool contiguousCells = FALSE;
+    bool estimateParams = TRUE;
+    bool compressOutput = FALSE;
+    stList *outputColumns = NULL;
+    double posteriorFloor = 0.0;
     char *templateModelFile = NULL;
     char *complementModelFile = NULL;
     char *readLabel = NULL;
     char *npReadFile = NULL;
     char *forwardReference = NULL;
     char *backwardReference = NULL;
+    int64_t referenceOffset = 0;
     char *errorCorrectPath = NULL;
     char *posteriorProbsFile = NULL;
     char *templateExpectationsFile = NULL;
@@ -436,11 +620,24 @@ int main(int argc, char *argv[]) {
                 {"diagonalExpansion",       required_argument,  0,  'x'},
                 {"threshold",               required_argument,  0,  'D'},
                 {"constraintTrim",          required_argument,  0,  'm'},
+                {"threads",                 required_argument,  0,  'n'},
+                {"viterbi",                 no_argument,        0,  'i'},
+                {"checkpoint",              required_argument,  0,  'k'},
+                {"memoryCeiling",           required_argument,  0,  'M'},
+                {"maxDiagonalExpansion",    required_argument,  0,  'X'},
+                {"pruneThreshold",          required_argument,  0,  'r'},
+                {"beamWidth",               required_argument,  0,  'B'},
+                {"referenceOffset",         required_argument,  0,  'R'},
+                {"noParamEstimation",       no_argument,        0,  'N'},
+                {"compressOutput",          no_argument,        0,  'Z'},
+                {"outputColumns",           required_argument,  0,  'O'},
+                {"posteriorFloor",          required_argument,  0,  'P'},
+                {"contiguousCells",         no_argument,        0,  'g'},
                 {0, 0, 0, 0} };
 
         int option_index = 0;
 
-        key = getopt_long(argc, argv, "h:d:e:s:o:p:a:T:C:L:q:f:b:p:u:v:w:t:c:x:D:m:",
+        key = getopt_long(argc, argv, "h:d:e:s:o:p:a:T:C:L:q:f:b:p:u:v:w:t:c:x:D:m:n:k:M:X:r:B:R:iNZO:P:g",
                           long_options, &option_index);
 
         if (key == -1) {
@@ -458,6 +655,25 @@ int main(int argc, char *argv[]) {
             case 'e':
                 twoD = TRUE;
                 break;
+            case 'i':
+                viterbi = TRUE;
+                break;
+            case 'g':
+                contiguousCells = TRUE;
+                break;
+            case 'N':
+                estimateParams = FALSE;
+                break;
+            case 'Z':
+                compressOutput = TRUE;
+                break;
+            case 'O':
+                outputColumns = parseOutputColumns(optarg);
+                break;
+            case 'P':
+                j = sscanf(optarg, "%lf", &posteriorFloor);
+                assert (j == 1);
+                break;
             case 'o':
                 j = sscanf(optarg, "%" PRIi64 "", &degenerate);
                 assert (j == 1);
@@ -483,6 +699,11 @@ int main(int argc, char *argv[]) {
             case 'b':
                 backwardReference= stString_copy(optarg);
                 break;
+            case 'R':
+                j = sscanf(optarg, "%" PRIi64 "", &referenceOffset);
+                assert (j == 1);
+                assert (referenceOffset >= 0);
+                break;
             case 'p':
                 errorCorrectPath = stString_copy(optarg);
                 break;
@@ -518,6 +739,38 @@ int main(int argc, char *argv[]) {
                 assert (constraintTrim >= 0);
                 constraintTrim = (int64_t)constraintTrim;
                 break;
+            case 'n':
+                j = sscanf(optarg, "%" PRIi64 "", &nbThreads);
+                assert (j == 1);
+                assert (nbThreads >= 1);
+                break;
+            case 'k':
+                j = sscanf(optarg, "%" PRIi64 "", &checkpointInterval);
+                assert (j == 1);
+                assert (checkpointInterval >= 0);
+                break;
+            case 'M':
+                // given in megabytes
+                j = sscanf(optarg, "%" PRIi64 "", &memoryCeiling);
+                assert (j == 1);
+                assert (memoryCeiling >= 0);
+                memoryCeiling = memoryCeiling * 1024 * 1024;
+                break;
+            case 'X':
+                j = sscanf(optarg, "%" PRIi64 "", &maxDiagExpansion);
+                assert (j == 1);
+                assert (maxDiagExpansion >= 0);
+                break;
+            case 'r':
+                j = sscanf(optarg, "%lf", &pruneThreshold);
+                assert (j == 1);
+                assert (pruneThreshold >= 0 && pruneThreshold < 1);
+                break;
+            case 'B':
+                j = sscanf(optarg, "%" PRIi64 "", &beamWidth);
+                assert (j == 1);
+                assert (beamWidth >= 0);
+                break;
             default:
                 usage();
                 return 1;
@@ -544,6 +797,13 @@ int main(int argc, char *argv[]) {
     p->threshold = threshold;
     p->constraintDiagonalTrim = constraintTrim;
     p->diagonalExpansion = diagExpansion;
+    p->threads = nbThreads;
+    p->checkpointInterval = checkpointInterval;
+    p->memoryCeiling = memoryCeiling;
+    p->maxDiagonalExpansion = maxDiagExpansion;
+    p->pathPruneThreshold = pruneThreshold;
+    p->pathBeamWidth = beamWidth;
+    p->contiguousCells = contiguousCells;
 
     // HDP routines //
     // load HDPs
@@ -577,7 +837,7 @@ int main(int argc, char *argv[]) {
             st_errAbort("[signalAlign] - ERROR: did not get reference files %s %s\n",
                         forwardReference, backwardReference);
         }
-        R = signalUtils_ReferenceSequenceConstructFull(forwardReference, backwardReference, pA);
+        R = signalUtils_ReferenceSequenceConstructWindow(forwardReference, backwardReference, pA, referenceOffset);
     } else {
         R = signalUtils_ReferenceSequenceConstructEmpty(pA);
     }
@@ -617,13 +877,16 @@ int main(int argc, char *argv[]) {
     if ((templateExpectationsFile != NULL) || (complementExpectationsFile != NULL)) {
         st_uglyf("Starting expectations routine\n");
         // Expectation Routine //
-        StateMachine *sMt = buildStateMachine(templateModelFile, npRead->templateParams, sMtype, nHdpT);
+        StateMachine *sMt = signalUtils_buildStateMachine(templateModelFile, npRead->templateParams, sMtype, nHdpT);
 
         // temporary way to 'turn off' estimates if I want to
-        if (ESTIMATE_PARAMS) {                                                     //todo remove threshold, not used
+        if (ESTIMATE_PARAMS && estimateParams) {                                   //todo remove threshold, not used
             signalUtils_estimateNanoporeParams(sMt, npRead, &npRead->templateParams, ASSIGNMENT_THRESHOLD,
                                                signalUtils_templateOneDAssignmentsFromRead,
                                                nanopore_adjustTemplateEventsForDrift);
+        } else if (ESTIMATE_PARAMS) {
+            signalUtils_applyNanoporeParams(sMt, npRead, &npRead->templateParams,
+                                            nanopore_adjustTemplateEventsForDrift);
         }
         // make empty HMM to collect expectations
         Hmm *templateExpectations = hmmContinuous_getExpectationsHmm(sMt, p->threshold, 0.001, 0.001);
@@ -653,12 +916,15 @@ int main(int argc, char *argv[]) {
         if (twoD) {
             fprintf(stderr, "signalAlign - getting expectations for complement\n");
 
-            sMc = buildStateMachine(complementModelFile, npRead->complementParams, sMtype, nHdpC);
+            sMc = signalUtils_buildStateMachine(complementModelFile, npRead->complementParams, sMtype, nHdpC);
 
-            if (ESTIMATE_PARAMS) {
+            if (ESTIMATE_PARAMS && estimateParams) {
                 signalUtils_estimateNanoporeParams(sMc, npRead, &npRead->complementParams, ASSIGNMENT_THRESHOLD,
                                                    signalUtils_complementOneDAssignmentsFromRead,
                                                    nanopore_adjustComplementEventsForDrift);
+            } else if (ESTIMATE_PARAMS) {
+                signalUtils_applyNanoporeParams(sMc, npRead, &npRead->complementParams,
+                                                nanopore_adjustComplementEventsForDrift);
             }
 
             complementExpectations = hmmContinuous_getExpectationsHmm(sMc, p->threshold, 0.001, 0.001);
@@ -694,83 +960,66 @@ int main(int argc, char *argv[]) {
         return 0;
     } else {
         // Alignment Procedure //
-        // Template alignment
-        fprintf(stderr, "signalAlign - starting template alignment\n");
-
-        // make template stateMachine
-        StateMachine *sMt = buildStateMachine(templateModelFile, npRead->templateParams, sMtype, nHdpT);
-
-        // re-estimate the nanoporeAdjustment parameters
-        if (ESTIMATE_PARAMS) {
-            signalUtils_estimateNanoporeParams(sMt, npRead, &npRead->templateParams, ASSIGNMENT_THRESHOLD,
-                                               signalUtils_templateOneDAssignmentsFromRead,
-                                               nanopore_adjustTemplateEventsForDrift);
-        }
-        if (sMtype == threeStateHdp) {
-            stateMachine3_setModelToHdpExpectedValues(sMt, nHdpT);
-        }
-
-        stList *templateAlignedPairs = performSignalAlignment(sMt, tEventSequence, 
-                                                              (twoD ? npRead->templateEventMap : npRead->templateStrandEventMap),
-                                                              pA->start2, R->getTemplateTargetSequence(R),
-                                                              p, anchorPairs,
-                                                              degenerate);
-        double templatePosteriorScore = scoreByPosteriorProbabilityIgnoringGaps(templateAlignedPairs);
-
-        // sort
-        stList_sort(templateAlignedPairs, sortByXPlusYCoordinate2); //Ensure the coordinates are increasing
-
-        // write to file
+        // the template and complement alignments are independent until they are written, so each strand is
+        // aligned in its own thread and the results are written out afterwards in the usual order
+        StrandAlignment templateJob = {
+                .strand = template, .modelFile = templateModelFile, .sMtype = sMtype, .nHdp = nHdpT,
+                .npRead = npRead, .eventSequence = tEventSequence,
+                .eventMap = (twoD ? npRead->templateEventMap : npRead->templateStrandEventMap),
+                .mapOffset = pA->start2, .target = R->getTemplateTargetSequence(R), .p = p,
+                .anchorPairs = anchorPairs, .degenerate = degenerate, .viterbi = viterbi,
+                .estimateParams = estimateParams,
+                .sM = NULL, .alignedPairs = NULL, .posteriorScore = 0.0 };
+        StrandAlignment complementJob = {
+                .strand = complement, .modelFile = complementModelFile, .sMtype = sMtype, .nHdp = nHdpC,
+                .npRead = npRead, .eventSequence = cEventSequence, .eventMap = npRead->complementEventMap,
+                .mapOffset = pA->start2, .target = (twoD ? R->getComplementTargetSequence(R) : NULL), .p = p,
+                .anchorPairs = anchorPairs, .degenerate = degenerate, .viterbi = viterbi,
+                .estimateParams = estimateParams,
+                .sM = NULL, .alignedPairs = NULL, .posteriorScore = 0.0 };
+
+        signalUtils_alignStrands(&templateJob, twoD ? &complementJob : NULL);
+
+        StateMachine *sMt = templateJob.sM;
+        stList *templateAlignedPairs = templateJob.alignedPairs;
+        double templatePosteriorScore = templateJob.posteriorScore;
+        StateMachine *sMc = complementJob.sM;
+        stList *complementAlignedPairs = complementJob.alignedPairs;
+        double complementPosteriorScore = complementJob.posteriorScore;
+
+        // write to file, the summary reports the pairs that were written
+        int64_t nTemplatePairs = stList_length(templateAlignedPairs);
+        double templateMeanPosterior = meanPairPosterior(templateAlignedPairs);
+        int64_t nComplementPairs = twoD ? stList_length(complementAlignedPairs) : 0;
+        double complementMeanPosterior = twoD ? meanPairPosterior(complementAlignedPairs) : 0.0;
         if (posteriorProbsFile != NULL) {
-            outputAlignment(outFmt, posteriorProbsFile, readLabel, sMt, npRead->templateParams, npRead->templateEvents,
-                            R->getTemplateTargetSequence(R), forward, pA->contig1, tCoordinateShift, rCoordinateShift_t,
-                            templateAlignedPairs, template);
-        }
-
-        stList *complementAlignedPairs;
-        double complementPosteriorScore = 0.0;
-        StateMachine *sMc;
-        if (twoD) {
-            // Complement alignment
-            fprintf(stderr, "signalAlign - starting complement alignment\n");
-            sMc = buildStateMachine(complementModelFile, npRead->complementParams, sMtype, nHdpC);
-
-            if (ESTIMATE_PARAMS) {
-                signalUtils_estimateNanoporeParams(sMc, npRead, &npRead->complementParams, ASSIGNMENT_THRESHOLD,
-                                                   signalUtils_complementOneDAssignmentsFromRead,
-                                                   nanopore_adjustComplementEventsForDrift);
-            }
-
-            if (sMtype == threeStateHdp) {
-                stateMachine3_setModelToHdpExpectedValues(sMc, nHdpC);
-            }
-
-            complementAlignedPairs = performSignalAlignment(sMc, cEventSequence,
-                                                            npRead->complementEventMap, pA->start2,
-                                                            R->getComplementTargetSequence(R),
-                                                            p, anchorPairs, degenerate);
-
-            complementPosteriorScore = scoreByPosteriorProbabilityIgnoringGaps(complementAlignedPairs);
-
-            // sort
-            stList_sort(complementAlignedPairs, sortByXPlusYCoordinate2); //Ensure the coordinates are increasing
-
-            // write to file
-            if (posteriorProbsFile != NULL) {
-                outputAlignment(outFmt, posteriorProbsFile, readLabel, sMc, npRead->complementParams,
-                                npRead->complementEvents, R->getComplementTargetSequence(R), forward, pA->contig1,
-                                cCoordinateShift, rCoordinateShift_c, complementAlignedPairs, complement);
+            nTemplatePairs = outputAlignment(outFmt, posteriorProbsFile, readLabel, sMt, npRead->templateParams,
+                                             npRead->templateEvents, R->getTemplateTargetSequence(R), forward,
+                                             pA->contig1, tCoordinateShift, rCoordinateShift_t, templateAlignedPairs,
+                                             template, compressOutput, outputColumns, posteriorFloor,
+                                             &templateMeanPosterior);
+            if (twoD) {
+                nComplementPairs = outputAlignment(outFmt, posteriorProbsFile, readLabel, sMc,
+                                                   npRead->complementParams, npRead->complementEvents,
+                                                   R->getComplementTargetSequence(R), forward, pA->contig1,
+                                                   cCoordinateShift, rCoordinateShift_c, complementAlignedPairs,
+                                                   complement, compressOutput, outputColumns, posteriorFloor,
+                                                   &complementMeanPosterior);
             }
-
         }
 
+        // read label, anchors, pairs(alignment score) for each strand, then the mean posterior probability of
+        // each strand's pairs. The score is the percent posterior or, with --viterbi, the path's log probability
         fprintf(stdout, "%s %"PRId64"\t%"PRId64"(%f)\t", readLabel, stList_length(anchorPairs),
-                stList_length(templateAlignedPairs), templatePosteriorScore);
+                nTemplatePairs, templatePosteriorScore);
         if (twoD) {
-            fprintf(stdout, "%"PRId64"(%f)\n", stList_length(complementAlignedPairs), complementPosteriorScore);
-        } else {
-            fprintf(stdout, "\n");
+            fprintf(stdout, "%"PRId64"(%f)\t", nComplementPairs, complementPosteriorScore);
+        }
+        fprintf(stdout, "mean_posterior=%f", templateMeanPosterior);
+        if (twoD) {
+            fprintf(stdout, ",%f", complementMeanPosterior);
         }
+        fprintf(stdout, "\n");
 
         // final alignment clean up
         destructPairwiseAlignment(pA);
@@ -784,6 +1033,9 @@ int main(int argc, char *argv[]) {
             sequence_destruct(cEventSequence);
             stList_destruct(complementAlignedPairs);
         }
+        if (outputColumns != NULL) {
+            stList_destruct(outputColumns);
+        }
         fprintf(stderr, "signalAlign - SUCCESS: finished alignment of query %s, exiting\n", readLabel);
     }
     return 0;
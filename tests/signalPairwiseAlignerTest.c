@@ -580,6 +580,61 @@ static void test_hdCellConstructWorstCase(CuTest *testCase) {
     hdCell_destruct(cell);
 }
 
+static void test_hdCellPrunePaths(CuTest *testCase) {
+    char *ambigKmer = "ATGXAXAAAAAA";
+    int64_t nbCytosines = 3;
+    char *cytosines = "CEO";
+    HDCell *cell = hdCell_construct(ambigKmer, 3, nbCytosines, cytosines, KMER_LENGTH);
+    // give path 4 most of the probability, 8 a little and the rest almost nothing
+    for (int64_t p = 0; p < cell->numberOfPaths; p++) {
+        Path *path = hdCell_getPath(cell, p);
+        for (int64_t s = 0; s < path->stateNumber; s++) {
+            path->cells[s] = p == 4 ? log(0.3) : (p == 8 ? log(0.02) : log(0.0001));
+        }
+    }
+    double droppedMass;
+    CuAssertIntEquals(testCase, 7, (int) hdCell_prunePaths(cell, 0.01, 0, &droppedMass));
+    CuAssertIntEquals(testCase, 2, (int) cell->numberOfPaths);
+    CuAssertStrEquals(testCase, "ATGEAE", hdCell_getPath(cell, 0)->kmer);
+    CuAssertStrEquals(testCase, "ATGOAO", hdCell_getPath(cell, 1)->kmer);
+    // the masses are summed with logAdd's lookup table, which is only good to about 1e-5
+    CuAssertDblEquals(testCase, 0.0007 / 0.3207, droppedMass, 1e-5);
+    // the beam keeps the best path
+    CuAssertIntEquals(testCase, 1, (int) hdCell_prunePaths(cell, 0.0, 1, &droppedMass));
+    CuAssertIntEquals(testCase, 1, (int) cell->numberOfPaths);
+    CuAssertStrEquals(testCase, "ATGEAE", hdCell_getPath(cell, 0)->kmer);
+    CuAssertIntEquals(testCase, 0, (int) hdCell_prunePaths(cell, 0.5, 1, &droppedMass));
+    CuAssertDblEquals(testCase, 0.0, droppedMass, 0.0);
+    hdCell_destruct(cell);
+}
+
+static void test_hdCellPrunePathsContiguous(CuTest *testCase) {
+    // with the contiguous layout the kept paths' cells are moved down so the buffer is still indexed by path
+    char *ambigKmer = "ATGXAXAAAAAA";
+    int64_t nbCytosines = 3;
+    char *cytosines = "CEO";
+    double *buffer = st_malloc(sizeof(double) * 9 * 3);
+    HDCell *cell = hdCell_construct2(ambigKmer, 3, nbCytosines, cytosines, KMER_LENGTH, buffer);
+    CuAssertIntEquals(testCase, 9, (int) hdCell_countPaths(ambigKmer, nbCytosines, KMER_LENGTH));
+    for (int64_t p = 0; p < cell->numberOfPaths; p++) {
+        CuAssertTrue(testCase, hdCell_getPathCells(cell, p, 3) == hdCell_getPath(cell, p)->cells);
+        for (int64_t s = 0; s < 3; s++) {
+            buffer[p * 3 + s] = p == 4 ? log(0.3) : (p == 8 ? log(0.02) : log(0.0001));
+        }
+    }
+    double droppedMass;
+    CuAssertIntEquals(testCase, 7, (int) hdCell_prunePaths(cell, 0.01, 0, &droppedMass));
+    CuAssertIntEquals(testCase, 2, (int) cell->numberOfPaths);
+    CuAssertStrEquals(testCase, "ATGEAE", hdCell_getPath(cell, 0)->kmer);
+    CuAssertStrEquals(testCase, "ATGOAO", hdCell_getPath(cell, 1)->kmer);
+    for (int64_t p = 0; p < cell->numberOfPaths; p++) {
+        CuAssertTrue(testCase, hdCell_getPathCells(cell, p, 3) == hdCell_getPath(cell, p)->cells);
+        CuAssertDblEquals(testCase, p == 0 ? log(0.3) : log(0.02), buffer[p * 3 + 2], 0.0);
+    }
+    hdCell_destruct(cell);
+    free(buffer);
+}
+
 static void test_dpDiagonal(CuTest *testCase) {
     // load model and make stateMachine
     char *testModelPath = stString_print("../../signalAlign/models/testModelR73_acegot_template.model");
@@ -805,6 +860,8 @@ CuSuite *signalPairwiseAlignerTestSuite(void) {
     SUITE_ADD_TEST(suite, test_getSplitPoints);
     SUITE_ADD_TEST(suite, test_hdCellConstruct);
     SUITE_ADD_TEST(suite, test_hdCellConstructWorstCase);
+    SUITE_ADD_TEST(suite, test_hdCellPrunePaths);
+    SUITE_ADD_TEST(suite, test_hdCellPrunePathsContiguous);
     SUITE_ADD_TEST(suite, test_dpDiagonal);
     SUITE_ADD_TEST(suite, test_dpMatrix);
     SUITE_ADD_TEST(suite, test_getBlastPairs);
@@ -3,6 +3,7 @@
 #include <string.h>
 #include <math.h>
 #include <inttypes.h>
+#include <time.h>
 #include "stateMachine.h"
 #include "CuTest.h"
 #include "pairwiseAligner.h"
@@ -232,6 +233,43 @@ static void test_checkTestNanoporeReads(CuTest *testCase) {
     CuAssertIntEquals(testCase, npRead->complementReadLength, 766);
 }
 
+static void writeReferenceFile(const char *path, const char *sequence, int64_t start, int64_t end) {
+    FILE *fH = fopen(path, "w");
+    fprintf(fH, "%.*s\n", (int) (end - start), sequence + start);
+    fclose(fH);
+}
+
+static void test_referenceWindow(CuTest *testCase) {
+    // a window of the reference plus its offset should give the same targets as the whole contig
+    char *forward = "ACGTTGCATGCATCGATCGATCGGGCTAGCTAGCATCGATCGACTAGCTAGCATGCATCGATCGTAGCTAGCTAGCTAGCAT";
+    char *backward = "TGCAACGTACGTAGCTAGCTAGCCCGATCGATCGTAGCTAGCTGATCGATCGTACGTAGCTAGCATCGATCGATCGATCGTA";
+    int64_t length = strlen(forward);
+    writeReferenceFile("./tempReference.forward.txt", forward, 0, length);
+    writeReferenceFile("./tempReference.backward.txt", backward, 0, length);
+    writeReferenceFile("./tempWindow.forward.txt", forward, 20, 70);
+    writeReferenceFile("./tempWindow.backward.txt", backward, 20, 70);
+
+    for (int64_t strand = 0; strand < 2; strand++) {
+        struct PairwiseAlignment *pA = constructPairwiseAlignment("contig", strand ? 30 : 60, strand ? 60 : 30,
+                                                                  strand, "read", 0, 30, 1, 1.0, NULL);
+        ReferenceSequence *full = signalUtils_ReferenceSequenceConstructFull("./tempReference.forward.txt",
+                                                                            "./tempReference.backward.txt", pA);
+        ReferenceSequence *window = signalUtils_ReferenceSequenceConstructWindow("./tempWindow.forward.txt",
+                                                                                "./tempWindow.backward.txt", pA, 20);
+        CuAssertIntEquals(testCase, 30, strlen(window->getTemplateTargetSequence(window)));
+        CuAssertStrEquals(testCase, full->getTemplateTargetSequence(full),
+                          window->getTemplateTargetSequence(window));
+        CuAssertStrEquals(testCase, full->getComplementTargetSequence(full),
+                          window->getComplementTargetSequence(window));
+        signalUtils_ReferenceSequenceDestruct(full);
+        signalUtils_ReferenceSequenceDestruct(window);
+    }
+    stFile_rmrf("./tempReference.forward.txt");
+    stFile_rmrf("./tempReference.backward.txt");
+    stFile_rmrf("./tempWindow.forward.txt");
+    stFile_rmrf("./tempWindow.backward.txt");
+}
+
 static void test_poreModel(CuTest *testCase, int64_t kmerLength, char *alphabet, int64_t alphabetSize) {
     char *tempFile = stString_print("./tempModel.model");
     CuAssertTrue(testCase, !stFile_exists(tempFile));
@@ -420,6 +458,33 @@ static void test_nanoporeScaleParamsFromStrandRead(CuTest *testCase) {
     CuAssertTrue(testCase, absPercentDiff(params->var, npRead->templateParams.var) < 50.0);
 }
 
+static void test_applyStoredNanoporeParams(CuTest *testCase) {
+    // estimate the params on one copy of the read, then apply them to a second copy, the state machines and the
+    // drift-adjusted events should come out the same
+    NanoporeRead *npRead = loadTestR9NanoporeRead();
+    StateMachine *sM = loadR9DescaledStateMachine3(npRead);
+    signalUtils_estimateNanoporeParams(sM, npRead, &npRead->templateParams, 0.0,
+                                       signalUtils_templateOneDAssignmentsFromRead,
+                                       nanopore_adjustTemplateEventsForDrift);
+
+    NanoporeRead *npRead_stored = loadTestR9NanoporeRead();
+    npRead_stored->templateParams = npRead->templateParams;
+    StateMachine *sM_stored = loadR9DescaledStateMachine3(npRead_stored);
+    signalUtils_applyNanoporeParams(sM_stored, npRead_stored, &npRead_stored->templateParams,
+                                    nanopore_adjustTemplateEventsForDrift);
+
+    CuAssertDblEquals(testCase, sM->scale, sM_stored->scale, 0.0);
+    CuAssertDblEquals(testCase, sM->shift, sM_stored->shift, 0.0);
+    CuAssertDblEquals(testCase, sM->var, sM_stored->var, 0.0);
+    for (int64_t i = 0; i < npRead->nbTemplateEvents * NB_EVENT_PARAMS; i++) {
+        CuAssertDblEquals(testCase, npRead->templateEvents[i], npRead_stored->templateEvents[i], 0.0);
+    }
+    stateMachine_destruct(sM);
+    stateMachine_destruct(sM_stored);
+    nanopore_nanoporeReadDestruct(npRead);
+    nanopore_nanoporeReadDestruct(npRead_stored);
+}
+
 static void test_adjustForDrift(CuTest *testCase) {
     NanoporeRead *npRead = loadTestR9NanoporeRead();
     StateMachine *sM = loadR9DescaledStateMachine3(npRead);
@@ -805,6 +870,273 @@ static void test_r94FivemerStateMachineWithBanding(CuTest *testCase) {
 }
 
 
+static void test_multithreadedSplitAlignment(CuTest *testCase) {
+    NanoporeRead *npRead = loadTestR9NanoporeRead();
+    StateMachine *sM = loadR9DescaledStateMachine3(npRead);
+    Sequence *refSeq = getEcoliReferenceSequence(sM->kmerLength);
+    signalUtils_estimateNanoporeParams(sM, npRead, &npRead->templateParams, 0.0,
+                                       signalUtils_templateOneDAssignmentsFromRead,
+                                       nanopore_adjustTemplateEventsForDrift);
+    PairwiseAlignmentParameters *p = pairwiseAlignmentBandingParameters_construct();
+    p->threshold = 0.01;
+    // make the blocks small so that there is something to split up
+    p->splitMatrixBiggerThanThis = 500 * 500;
+    stList *filteredRemappedAnchors = getRemappedAnchors(refSeq, npRead, p);
+    Sequence *eventSequence = sequence_construct2(npRead->nbTemplateEvents, npRead->templateEvents, sequence_getEvent,
+                                                  sequence_sliceEventSequence, event);
+
+    stList *alignedPairs = getAlignedPairsUsingAnchors(sM, refSeq, eventSequence, filteredRemappedAnchors, p,
+                                                       diagonalCalculationPosteriorMatchProbs,
+                                                       1, 1);
+    p->threads = 4;
+    stList *alignedPairs_threaded = getAlignedPairsUsingAnchors(sM, refSeq, eventSequence, filteredRemappedAnchors, p,
+                                                                diagonalCalculationPosteriorMatchProbs,
+                                                                1, 1);
+    // the threaded alignment should give the same pairs in the same order
+    CuAssertIntEquals(testCase, stList_length(alignedPairs), stList_length(alignedPairs_threaded));
+    for (int64_t i = 0; i < stList_length(alignedPairs); i++) {
+        stIntTuple *pair = stList_get(alignedPairs, i);
+        stIntTuple *threadedPair = stList_get(alignedPairs_threaded, i);
+        CuAssertIntEquals(testCase, stIntTuple_get(pair, 0), stIntTuple_get(threadedPair, 0));
+        CuAssertIntEquals(testCase, stIntTuple_get(pair, 1), stIntTuple_get(threadedPair, 1));
+        CuAssertIntEquals(testCase, stIntTuple_get(pair, 2), stIntTuple_get(threadedPair, 2));
+        CuAssertStrEquals(testCase, (char *) stIntTuple_get(pair, 3), (char *) stIntTuple_get(threadedPair, 3));
+    }
+
+    stList_destruct(alignedPairs);
+    stList_destruct(alignedPairs_threaded);
+    stList_destruct(filteredRemappedAnchors);
+    sequence_destruct(eventSequence);
+    pairwiseAlignmentBandingParameters_destruct(p);
+    stateMachine_destruct(sM);
+    nanopore_nanoporeReadDestruct(npRead);
+    sequence_destruct(refSeq);
+}
+
+static void test_viterbiAlignment(CuTest *testCase) {
+    NanoporeRead *npRead = loadTestR9NanoporeRead();
+    StateMachine *sM = loadR9DescaledStateMachine3(npRead);
+    Sequence *refSeq = getEcoliReferenceSequence(sM->kmerLength);
+    signalUtils_estimateNanoporeParams(sM, npRead, &npRead->templateParams, 0.0,
+                                       signalUtils_templateOneDAssignmentsFromRead,
+                                       nanopore_adjustTemplateEventsForDrift);
+    PairwiseAlignmentParameters *p = pairwiseAlignmentBandingParameters_construct();
+    stList *filteredRemappedAnchors = getRemappedAnchors(refSeq, npRead, p);
+    Sequence *eventSequence = sequence_construct2(npRead->nbTemplateEvents, npRead->templateEvents, sequence_getEvent,
+                                                  sequence_sliceEventSequence, event);
+
+    double score;
+    stList *alignedPairs = getViterbiAlignedPairsUsingAnchors(sM, refSeq, eventSequence, filteredRemappedAnchors, p,
+                                                              1, 1, &score);
+    checkAlignedPairs(testCase, alignedPairs, refSeq->length, npRead->nbTemplateEvents);
+    CuAssertTrue(testCase, stList_length(alignedPairs) > 0);
+    CuAssertTrue(testCase, score < 0.0 && score > LOG_ZERO);
+
+    // a single path, so every event is matched at most once and the coordinates only go up
+    for (int64_t i = 1; i < stList_length(alignedPairs); i++) {
+        stIntTuple *pair = stList_get(alignedPairs, i);
+        stIntTuple *prevPair = stList_get(alignedPairs, i - 1);
+        CuAssertIntEquals(testCase, PAIR_ALIGNMENT_PROB_1, stIntTuple_get(pair, 0));
+        CuAssertTrue(testCase, stIntTuple_get(pair, 1) >= stIntTuple_get(prevPair, 1));
+        CuAssertTrue(testCase, stIntTuple_get(pair, 2) > stIntTuple_get(prevPair, 2));
+    }
+
+    stList_destruct(alignedPairs);
+    stList_destruct(filteredRemappedAnchors);
+    sequence_destruct(eventSequence);
+    pairwiseAlignmentBandingParameters_destruct(p);
+    stateMachine_destruct(sM);
+    nanopore_nanoporeReadDestruct(npRead);
+    sequence_destruct(refSeq);
+}
+
+static StrandAlignment makeTestStrandAlignment(Strand strand, NanoporeRead *npRead, char *target,
+                                               PairwiseAlignmentParameters *p, stList *anchorPairs) {
+    // what signalMachine sets up for each strand of a 2D read, the events are cut down to the ones in the 2D read
+    int64_t *eventMap = strand == template ? npRead->templateEventMap : npRead->complementEventMap;
+    double *events = strand == template ? npRead->templateEvents : npRead->complementEvents;
+    Sequence *eventSequence = sequence_constructEventSequence(eventMap[npRead->readLength - 1] - eventMap[0],
+                                                              events + eventMap[0] * NB_EVENT_PARAMS);
+    StrandAlignment job = {
+            .strand = strand, .sMtype = threeState, .nHdp = NULL, .npRead = npRead,
+            .modelFile = strand == template ? "../models/testModelR73_acegot_template.model"
+                                            : "../models/testModelR73_acegot_complement.model",
+            .eventSequence = eventSequence, .eventMap = eventMap, .mapOffset = 0, .target = target, .p = p,
+            .anchorPairs = anchorPairs, .degenerate = cytosineMethylation2, .viterbi = FALSE,
+            .estimateParams = TRUE, .sM = NULL, .alignedPairs = NULL, .posteriorScore = 0.0 };
+    return job;
+}
+
+static void strandAlignment_destruct(StrandAlignment *job) {
+    stateMachine_destruct(job->sM);
+    stList_destruct(job->alignedPairs);
+    sequence_destruct(job->eventSequence);
+}
+
+static void checkSameStrandAlignment(CuTest *testCase, StrandAlignment *job, StrandAlignment *concurrentJob) {
+    CuAssertTrue(testCase, stList_length(job->alignedPairs) > 0);
+    CuAssertDblEquals(testCase, job->posteriorScore, concurrentJob->posteriorScore, 0.0);
+    CuAssertIntEquals(testCase, stList_length(job->alignedPairs), stList_length(concurrentJob->alignedPairs));
+    for (int64_t i = 0; i < stList_length(job->alignedPairs); i++) {
+        stIntTuple *pair = stList_get(job->alignedPairs, i);
+        stIntTuple *concurrentPair = stList_get(concurrentJob->alignedPairs, i);
+        CuAssertIntEquals(testCase, stIntTuple_get(pair, 0), stIntTuple_get(concurrentPair, 0));
+        CuAssertIntEquals(testCase, stIntTuple_get(pair, 1), stIntTuple_get(concurrentPair, 1));
+        CuAssertIntEquals(testCase, stIntTuple_get(pair, 2), stIntTuple_get(concurrentPair, 2));
+        CuAssertStrEquals(testCase, (char *) stIntTuple_get(pair, 3), (char *) stIntTuple_get(concurrentPair, 3));
+    }
+}
+
+static void test_concurrentTwoDAlignment(CuTest *testCase) {
+    // signalMachine aligns the strands of a 2D read at the same time, it should give the same pairs as one after
+    // the other. Each run gets its own copy of the read because aligning re-estimates its parameters
+    NanoporeRead *npRead = loadTestNanoporeRead();
+    NanoporeRead *concurrentNpRead = loadTestNanoporeRead();
+    Sequence *refSeq = getZymoReferenceSequence(KMER_LENGTH);
+    PairwiseAlignmentParameters *p = pairwiseAlignmentBandingParameters_construct();
+    stList *anchorPairs = getBlastPairsForPairwiseAlignmentParameters((char *) refSeq->elements, npRead->twoDread, p);
+    stList *anchorPairsCopy = stList_construct3(0, (void (*)(void *)) stIntTuple_destruct);
+    for (int64_t i = 0; i < stList_length(anchorPairs); i++) {
+        stIntTuple *pair = stList_get(anchorPairs, i);
+        stList_append(anchorPairsCopy, stIntTuple_construct2(stIntTuple_get(pair, 0), stIntTuple_get(pair, 1)));
+    }
+
+    StrandAlignment templateJob = makeTestStrandAlignment(template, npRead, refSeq->elements, p, anchorPairs);
+    StrandAlignment complementJob = makeTestStrandAlignment(complement, npRead, refSeq->elements, p, anchorPairs);
+    signalUtils_alignStrand(&templateJob);
+    signalUtils_alignStrand(&complementJob);
+
+    StrandAlignment concurrentTemplateJob = makeTestStrandAlignment(template, concurrentNpRead, refSeq->elements,
+                                                                    p, anchorPairs);
+    StrandAlignment concurrentComplementJob = makeTestStrandAlignment(complement, concurrentNpRead, refSeq->elements,
+                                                                      p, anchorPairs);
+    signalUtils_alignStrands(&concurrentTemplateJob, &concurrentComplementJob);
+
+    checkSameStrandAlignment(testCase, &templateJob, &concurrentTemplateJob);
+    checkSameStrandAlignment(testCase, &complementJob, &concurrentComplementJob);
+    // both strands estimated their own parameters on the shared read
+    CuAssertDblEquals(testCase, npRead->templateParams.scale, concurrentNpRead->templateParams.scale, 0.0);
+    CuAssertDblEquals(testCase, npRead->complementParams.scale, concurrentNpRead->complementParams.scale, 0.0);
+    for (int64_t i = 0; i < npRead->nbTemplateEvents * NB_EVENT_PARAMS; i++) {
+        CuAssertDblEquals(testCase, npRead->templateEvents[i], concurrentNpRead->templateEvents[i], 0.0);
+    }
+    for (int64_t i = 0; i < npRead->nbComplementEvents * NB_EVENT_PARAMS; i++) {
+        CuAssertDblEquals(testCase, npRead->complementEvents[i], concurrentNpRead->complementEvents[i], 0.0);
+    }
+    // the shared inputs are only read
+    CuAssertTrue(testCase, p->stats == NULL);
+    CuAssertIntEquals(testCase, stList_length(anchorPairsCopy), stList_length(anchorPairs));
+    for (int64_t i = 0; i < stList_length(anchorPairs); i++) {
+        CuAssertTrue(testCase, stIntTuple_cmpFn(stList_get(anchorPairs, i), stList_get(anchorPairsCopy, i)) == 0);
+    }
+
+    strandAlignment_destruct(&templateJob);
+    strandAlignment_destruct(&complementJob);
+    strandAlignment_destruct(&concurrentTemplateJob);
+    strandAlignment_destruct(&concurrentComplementJob);
+    stList_destruct(anchorPairs);
+    stList_destruct(anchorPairsCopy);
+    pairwiseAlignmentBandingParameters_destruct(p);
+    sequence_destruct(refSeq);
+    nanopore_nanoporeReadDestruct(npRead);
+    nanopore_nanoporeReadDestruct(concurrentNpRead);
+}
+
+static void test_checkpointedForwardBackward(CuTest *testCase) {
+    NanoporeRead *npRead = loadTestR9NanoporeRead();
+    StateMachine *sM = loadR9DescaledStateMachine3(npRead);
+    Sequence *refSeq = getEcoliReferenceSequence(sM->kmerLength);
+    signalUtils_estimateNanoporeParams(sM, npRead, &npRead->templateParams, 0.0,
+                                       signalUtils_templateOneDAssignmentsFromRead,
+                                       nanopore_adjustTemplateEventsForDrift);
+    PairwiseAlignmentParameters *p = pairwiseAlignmentBandingParameters_construct();
+    p->threshold = 0.01;
+    stList *filteredRemappedAnchors = getRemappedAnchors(refSeq, npRead, p);
+    Sequence *eventSequence = sequence_construct2(npRead->nbTemplateEvents, npRead->templateEvents, sequence_getEvent,
+                                                  sequence_sliceEventSequence, event);
+
+    p->stats = forwardBackwardStats_construct();
+    stList *alignedPairs = getAlignedPairsUsingAnchors(sM, refSeq, eventSequence, filteredRemappedAnchors, p,
+                                                       diagonalCalculationPosteriorMatchProbs,
+                                                       1, 1);
+    int64_t fullPeakBytes = p->stats->peakBytes;
+    CuAssertIntEquals(testCase, 0, p->stats->recomputedDiagonals);
+    forwardBackwardStats_destruct(p->stats);
+
+    p->stats = forwardBackwardStats_construct();
+    p->checkpointInterval = 50;
+    stList *alignedPairs_checkpointed = getAlignedPairsUsingAnchors(sM, refSeq, eventSequence,
+                                                                    filteredRemappedAnchors, p,
+                                                                    diagonalCalculationPosteriorMatchProbs,
+                                                                    1, 1);
+    // recomputing the dropped diagonals gives exactly the same posteriors with less memory
+    CuAssertTrue(testCase, p->stats->recomputedDiagonals > 0);
+    CuAssertTrue(testCase, p->stats->peakBytes < fullPeakBytes);
+    CuAssertIntEquals(testCase, stList_length(alignedPairs), stList_length(alignedPairs_checkpointed));
+    for (int64_t i = 0; i < stList_length(alignedPairs); i++) {
+        stIntTuple *pair = stList_get(alignedPairs, i);
+        stIntTuple *checkpointedPair = stList_get(alignedPairs_checkpointed, i);
+        CuAssertIntEquals(testCase, stIntTuple_get(pair, 0), stIntTuple_get(checkpointedPair, 0));
+        CuAssertIntEquals(testCase, stIntTuple_get(pair, 1), stIntTuple_get(checkpointedPair, 1));
+        CuAssertIntEquals(testCase, stIntTuple_get(pair, 2), stIntTuple_get(checkpointedPair, 2));
+    }
+    forwardBackwardStats_destruct(p->stats);
+    p->stats = NULL;
+
+    stList_destruct(alignedPairs);
+    stList_destruct(alignedPairs_checkpointed);
+    stList_destruct(filteredRemappedAnchors);
+    sequence_destruct(eventSequence);
+    pairwiseAlignmentBandingParameters_destruct(p);
+    stateMachine_destruct(sM);
+    nanopore_nanoporeReadDestruct(npRead);
+    sequence_destruct(refSeq);
+}
+
+static void test_adaptiveBanding(CuTest *testCase) {
+    NanoporeRead *npRead = loadTestR9NanoporeRead();
+    StateMachine *sM = loadR9DescaledStateMachine3(npRead);
+    Sequence *refSeq = getEcoliReferenceSequence(sM->kmerLength);
+    signalUtils_estimateNanoporeParams(sM, npRead, &npRead->templateParams, 0.0,
+                                       signalUtils_templateOneDAssignmentsFromRead,
+                                       nanopore_adjustTemplateEventsForDrift);
+    PairwiseAlignmentParameters *p = pairwiseAlignmentBandingParameters_construct();
+    p->threshold = 0.01;
+    stList *filteredRemappedAnchors = getRemappedAnchors(refSeq, npRead, p);
+    Sequence *eventSequence = sequence_construct2(npRead->nbTemplateEvents, npRead->templateEvents, sequence_getEvent,
+                                                  sequence_sliceEventSequence, event);
+
+    // a band this narrow holds the alignment in, so it should get widened
+    p->diagonalExpansion = 2;
+    stList *narrowAlignedPairs = getAlignedPairsUsingAnchors(sM, refSeq, eventSequence, filteredRemappedAnchors, p,
+                                                             diagonalCalculationPosteriorMatchProbs, 1, 1);
+    double narrowEdgeMass = getBandEdgePosteriorMass(narrowAlignedPairs, filteredRemappedAnchors, refSeq->length,
+                                              eventSequence->length, p->diagonalExpansion);
+    CuAssertTrue(testCase, narrowEdgeMass > p->bandEdgeThreshold);
+
+    p->maxDiagonalExpansion = 64;
+    p->stats = forwardBackwardStats_construct();
+    stList *alignedPairs = getAlignedPairsUsingAnchors(sM, refSeq, eventSequence, filteredRemappedAnchors, p,
+                                                       diagonalCalculationPosteriorMatchProbs, 1, 1);
+    checkAlignedPairs(testCase, alignedPairs, refSeq->length, eventSequence->length);
+    CuAssertTrue(testCase, p->stats->bandedBlocks > 0);
+    CuAssertTrue(testCase, p->stats->widenedBlocks > 0);
+    CuAssertTrue(testCase, p->stats->bandRetries >= p->stats->widenedBlocks);
+    CuAssertTrue(testCase, p->stats->widestDiagonalExpansion > p->diagonalExpansion);
+    CuAssertTrue(testCase, p->stats->widestDiagonalExpansion <= p->maxDiagonalExpansion);
+    forwardBackwardStats_destruct(p->stats);
+    p->stats = NULL;
+
+    stList_destruct(narrowAlignedPairs);
+    stList_destruct(alignedPairs);
+    stList_destruct(filteredRemappedAnchors);
+    sequence_destruct(eventSequence);
+    pairwiseAlignmentBandingParameters_destruct(p);
+    stateMachine_destruct(sM);
+    nanopore_nanoporeReadDestruct(npRead);
+    sequence_destruct(refSeq);
+}
+
 static void test_r9_5merModel(CuTest *testCase) {
     NanoporeRead *npRead = loadTestR9NanoporeRead();
     StateMachine *sM = load5merR9DescaledStateMachine3(npRead);
@@ -972,6 +1304,143 @@ static void test_cpHmmEmissionsAgainstStateMachine(CuTest *testCase, StateMachin
     }
 }
 
+static stList *benchmarkCellLayout(CuTest *testCase, StateMachine *sM, Sequence *refSeq, Sequence *eventSequence,
+                                   stList *anchorPairs, PairwiseAlignmentParameters *p, const char *layout,
+                                   int64_t *forwardCells) {
+    p->stats = forwardBackwardStats_construct();
+    clock_t start = clock();
+    stList *alignedPairs = getAlignedPairsUsingAnchors(sM, refSeq, eventSequence, anchorPairs, p,
+                                                       diagonalCalculationPosteriorMatchProbs, 0, 0);
+    double seconds = (double) (clock() - start) / CLOCKS_PER_SEC;
+    CuAssertTrue(testCase, p->stats->forwardCells > 0);
+    *forwardCells = p->stats->forwardCells;
+    st_logInfo("%s cell layout: %" PRIi64 " forward cells in %f seconds, %f cells/sec\n", layout,
+               p->stats->forwardCells, seconds, seconds > 0 ? p->stats->forwardCells / seconds : 0.0);
+    forwardBackwardStats_destruct(p->stats);
+    p->stats = NULL;
+    return alignedPairs;
+}
+
+static void test_contiguousCellLayout(CuTest *testCase) {
+    // also the before/after benchmark, run the tests with logging at info to see the cells/sec of each layout
+    NanoporeRead *npRead = loadTestNanoporeRead();
+    StateMachine *sM = loadDescaledStateMachine3(npRead);
+    Sequence *refSeq = getZymoReferenceSequence(sM->kmerLength);
+    PairwiseAlignmentParameters *p = pairwiseAlignmentBandingParameters_construct();
+    stList *filteredRemappedAnchors = getRemappedAnchors(refSeq, npRead, p);
+    Sequence *eventSequence = sequence_construct2(npRead->nbTemplateEvents, npRead->templateEvents, sequence_getEvent,
+                                                  sequence_sliceEventSequence, event);
+    // degenerate positions so that there are lots of paths per cell
+    Sequence *degenerateSequence = replaceBasesInSequence(refSeq, "C", "X");
+
+    int64_t forwardCells, forwardCells_contiguous;
+    p->contiguousCells = FALSE;
+    stList *alignedPairs = benchmarkCellLayout(testCase, sM, degenerateSequence, eventSequence,
+                                               filteredRemappedAnchors, p, "per path", &forwardCells);
+    p->contiguousCells = TRUE;
+    stList *alignedPairs_contiguous = benchmarkCellLayout(testCase, sM, degenerateSequence, eventSequence,
+                                                          filteredRemappedAnchors, p, "contiguous",
+                                                          &forwardCells_contiguous);
+
+    // the layout shouldn't change anything
+    CuAssertIntEquals(testCase, forwardCells, forwardCells_contiguous);
+    CuAssertIntEquals(testCase, stList_length(alignedPairs), stList_length(alignedPairs_contiguous));
+    for (int64_t i = 0; i < stList_length(alignedPairs); i++) {
+        stIntTuple *pair = stList_get(alignedPairs, i);
+        stIntTuple *contiguousPair = stList_get(alignedPairs_contiguous, i);
+        CuAssertIntEquals(testCase, stIntTuple_get(pair, 0), stIntTuple_get(contiguousPair, 0));
+        CuAssertIntEquals(testCase, stIntTuple_get(pair, 1), stIntTuple_get(contiguousPair, 1));
+        CuAssertIntEquals(testCase, stIntTuple_get(pair, 2), stIntTuple_get(contiguousPair, 2));
+        CuAssertStrEquals(testCase, (char *) stIntTuple_get(pair, 3), (char *) stIntTuple_get(contiguousPair, 3));
+    }
+
+    stList_destruct(alignedPairs);
+    stList_destruct(alignedPairs_contiguous);
+    stList_destruct(filteredRemappedAnchors);
+    sequence_destruct(eventSequence);
+    sequence_destruct(degenerateSequence);
+    sequence_destruct(refSeq);
+    pairwiseAlignmentBandingParameters_destruct(p);
+    stateMachine_destruct(sM);
+    nanopore_nanoporeReadDestruct(npRead);
+}
+
+static stList *benchmarkViterbi(CuTest *testCase, StateMachine *sM, Sequence *refSeq, Sequence *eventSequence,
+                                stList *anchorPairs, PairwiseAlignmentParameters *p, const char *label,
+                                double *score, int64_t *peakBytes) {
+    p->stats = forwardBackwardStats_construct();
+    clock_t start = clock();
+    stList *alignedPairs = getViterbiAlignedPairsUsingAnchors(sM, refSeq, eventSequence, anchorPairs, p, 1, 1, score);
+    double seconds = (double) (clock() - start) / CLOCKS_PER_SEC;
+    *peakBytes = p->stats->peakBytes;
+    st_logInfo("%s viterbi: %f seconds, peak %" PRIi64 " bytes, %" PRIi64 " of %" PRIi64 " diagonals recomputed\n",
+               label, seconds, p->stats->peakBytes, p->stats->recomputedDiagonals, p->stats->forwardDiagonals);
+    forwardBackwardStats_destruct(p->stats);
+    p->stats = NULL;
+    return alignedPairs;
+}
+
+static void test_viterbiCheckpointedTraceback(CuTest *testCase) {
+    // also the time/memory comparison with the posteriors, run the tests with logging at info to see it
+    NanoporeRead *npRead = loadTestNanoporeRead();
+    StateMachine *sM = loadDescaledStateMachine3(npRead);
+    Sequence *refSeq = getZymoReferenceSequence(sM->kmerLength);
+    PairwiseAlignmentParameters *p = pairwiseAlignmentBandingParameters_construct();
+    stList *filteredRemappedAnchors = getRemappedAnchors(refSeq, npRead, p);
+    Sequence *eventSequence = sequence_construct2(npRead->nbTemplateEvents, npRead->templateEvents, sequence_getEvent,
+                                                  sequence_sliceEventSequence, event);
+    // degenerate positions so the pointers have to pick between the paths of a cell
+    Sequence *degenerateSequence = replaceBasesInSequence(refSeq, "C", "X");
+
+    p->stats = forwardBackwardStats_construct();
+    clock_t start = clock();
+    stList *posteriorPairs = getAlignedPairsUsingAnchors(sM, degenerateSequence, eventSequence, filteredRemappedAnchors, p,
+                                                         diagonalCalculationPosteriorMatchProbs, 1, 1);
+    double seconds = (double) (clock() - start) / CLOCKS_PER_SEC;
+    int64_t posteriorPeakBytes = p->stats->peakBytes;
+    st_logInfo("posterior alignment: %f seconds, peak %" PRIi64 " bytes\n", seconds, posteriorPeakBytes);
+    forwardBackwardStats_destruct(p->stats);
+    p->stats = NULL;
+
+    // one segment, the back pointers for the whole band are kept
+    double score, score_checkpointed;
+    int64_t peakBytes, peakBytes_checkpointed;
+    p->checkpointInterval = INT32_MAX;
+    stList *alignedPairs = benchmarkViterbi(testCase, sM, degenerateSequence, eventSequence, filteredRemappedAnchors, p,
+                                            "one segment", &score, &peakBytes);
+    // the default, segments of about sqrt(2n) diagonals
+    p->checkpointInterval = 0;
+    stList *alignedPairs_checkpointed = benchmarkViterbi(testCase, sM, degenerateSequence, eventSequence,
+                                                         filteredRemappedAnchors, p, "segmented", &score_checkpointed,
+                                                         &peakBytes_checkpointed);
+
+    // recomputing the segments gives back exactly the same path with less memory
+    checkAlignedPairs(testCase, alignedPairs_checkpointed, refSeq->length, npRead->nbTemplateEvents);
+    CuAssertTrue(testCase, stList_length(alignedPairs_checkpointed) > 0);
+    CuAssertDblEquals(testCase, score, score_checkpointed, 0.0);
+    CuAssertTrue(testCase, peakBytes_checkpointed < peakBytes);
+    CuAssertTrue(testCase, peakBytes_checkpointed < posteriorPeakBytes);
+    CuAssertIntEquals(testCase, stList_length(alignedPairs), stList_length(alignedPairs_checkpointed));
+    for (int64_t i = 0; i < stList_length(alignedPairs); i++) {
+        stIntTuple *pair = stList_get(alignedPairs, i);
+        stIntTuple *checkpointedPair = stList_get(alignedPairs_checkpointed, i);
+        CuAssertIntEquals(testCase, stIntTuple_get(pair, 1), stIntTuple_get(checkpointedPair, 1));
+        CuAssertIntEquals(testCase, stIntTuple_get(pair, 2), stIntTuple_get(checkpointedPair, 2));
+        CuAssertStrEquals(testCase, (char *) stIntTuple_get(pair, 3), (char *) stIntTuple_get(checkpointedPair, 3));
+    }
+
+    stList_destruct(posteriorPairs);
+    stList_destruct(alignedPairs);
+    stList_destruct(alignedPairs_checkpointed);
+    stList_destruct(filteredRemappedAnchors);
+    sequence_destruct(eventSequence);
+    sequence_destruct(degenerateSequence);
+    sequence_destruct(refSeq);
+    pairwiseAlignmentBandingParameters_destruct(p);
+    stateMachine_destruct(sM);
+    nanopore_nanoporeReadDestruct(npRead);
+}
+
 static void test_makeAndCheckModels(CuTest *testCase) {
     // this is the lookup table with default values
     const char *templateLookupTableFile = "../models/testModelR73_acegot_template.model";
@@ -1313,10 +1782,12 @@ CuSuite *stateMachineAlignmentTestSuite(void) {
     CuSuite *suite = CuSuiteNew();
 
     SUITE_ADD_TEST(suite, test_checkTestNanoporeReads);
+    SUITE_ADD_TEST(suite, test_referenceWindow);
     SUITE_ADD_TEST(suite, test_nanoporeScaleParamsFromAnchorPairs);
     SUITE_ADD_TEST(suite, test_nanoporeScaleParamsFromOneDAssignments);
     SUITE_ADD_TEST(suite, test_nanoporeScaleParamsFromStrandRead);
     SUITE_ADD_TEST(suite, test_adjustForDrift);
+    SUITE_ADD_TEST(suite, test_applyStoredNanoporeParams);
     SUITE_ADD_TEST(suite, test_loadPoreModel);
     SUITE_ADD_TEST(suite, test_models);
     SUITE_ADD_TEST(suite, test_sm3_diagonalDPCalculations);
@@ -1325,10 +1796,17 @@ CuSuite *stateMachineAlignmentTestSuite(void) {
     SUITE_ADD_TEST(suite, test_r9StateMachineWithBanding);
     SUITE_ADD_TEST(suite, test_r94StateMachineWithBanding);
     SUITE_ADD_TEST(suite, test_r94FivemerStateMachineWithBanding);
+    SUITE_ADD_TEST(suite, test_multithreadedSplitAlignment);
+    SUITE_ADD_TEST(suite, test_concurrentTwoDAlignment);
+    SUITE_ADD_TEST(suite, test_viterbiAlignment);
+    SUITE_ADD_TEST(suite, test_checkpointedForwardBackward);
+    SUITE_ADD_TEST(suite, test_adaptiveBanding);
     SUITE_ADD_TEST(suite, test_r9_5merModel);
     SUITE_ADD_TEST(suite, test_sm3Hdp_getAlignedPairsWithBanding);
     SUITE_ADD_TEST(suite, test_sm3Hdp_setModelToHdpExpectedValues);
     SUITE_ADD_TEST(suite, test_DegenerateNucleotides);
+    SUITE_ADD_TEST(suite, test_contiguousCellLayout);
+    SUITE_ADD_TEST(suite, test_viterbiCheckpointedTraceback);
     SUITE_ADD_TEST(suite, test_makeAndCheckModels);
     SUITE_ADD_TEST(suite, test_hdpHmmWithoutAssignments);
     SUITE_ADD_TEST(suite, test_continuousPairHmm);
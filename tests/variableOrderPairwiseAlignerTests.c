@@ -8,6 +8,8 @@
 #include "CuTest.h"
 #include "pairwiseAligner.h"
 #include "randomSequences.h"
+#include "columnarOutput.h"
+#include "blockCompressedOutput.h"
 
 // helper functions
 /*
@@ -177,6 +179,114 @@ static void test_substitutedKmers(CuTest *testCase) {
     free(kmer);
 }
 
+static void test_columnarKmerIds(CuTest *testCase) {
+    stList *sequences = stList_construct();
+    stList_append(sequences, "ACGTNA");
+    char *alphabet = columnar_kmerAlphabet("ACGTE", 5, sequences);
+    CuAssertStrEquals(testCase, alphabet, "ACGTEN");
+    CuAssertIntEquals(testCase, 0, (int) columnar_kmerId("AAA", alphabet, 3));
+    CuAssertIntEquals(testCase, 1 * 36 + 2 * 6 + 5, (int) columnar_kmerId("CGN", alphabet, 3));
+    CuAssertIntEquals(testCase, -1, (int) columnar_kmerId("CGX", alphabet, 3));
+    CuAssertIntEquals(testCase, -1, (int) columnar_kmerId("CG", alphabet, 3));
+
+    ColumnarBlock *block = columnarBlock_construct("full");
+    columnarBlock_addMetadata(block, "contig", "test");
+    int64_t position = columnarBlock_addColumn(block, "ref_pos", columnInt64);
+    int64_t mean = columnarBlock_addColumn(block, "event_mean", columnDouble);
+    for (int64_t i = 0; i < 2000; i++) {
+        columnarBlock_appendInt64(block, position, i);
+        columnarBlock_appendDouble(block, mean, 0.5 * i);
+    }
+    CuAssertIntEquals(testCase, 2000, (int) columnarBlock_getRowNumber(block));
+    FILE *fH = tmpfile();
+    columnarBlock_write(block, fH, FALSE);
+    char magic[5] = { 0 };
+    rewind(fH);
+    CuAssertIntEquals(testCase, 4, (int) fread(magic, 1, 4, fH));
+    CuAssertStrEquals(testCase, magic, COLUMNAR_MAGIC);
+    fseek(fH, 0, SEEK_END);
+    int64_t uncompressedSize = ftell(fH);
+    // two 2000 row columns, with their lengths, after the header
+    CuAssertTrue(testCase, uncompressedSize > 2 * (8 + 2000 * 8));
+    fclose(fH);
+    fH = tmpfile();
+    columnarBlock_write(block, fH, TRUE);
+    CuAssertTrue(testCase, ftell(fH) < uncompressedSize);
+    fclose(fH);
+
+    columnarBlock_destruct(block);
+    stList_destruct(sequences);
+    free(alphabet);
+}
+
+static void test_columnarBlockRead(CuTest *testCase) {
+    FILE *fH = tmpfile();
+    for (int64_t b = 0; b < 2; b++) {
+        ColumnarBlock *block = columnarBlock_construct("assignments");
+        columnarBlock_addMetadata(block, "strand", b == 0 ? "t" : "c");
+        columnarBlock_addMetadata(block, "kmer_alphabet", "ACGT");
+        int64_t kmer = columnarBlock_addColumn(block, "kmer", columnInt64);
+        int64_t mean = columnarBlock_addColumn(block, "event_mean", columnDouble);
+        for (int64_t i = 0; i < 1000; i++) {
+            columnarBlock_appendInt64(block, kmer, i + b);
+            columnarBlock_appendDouble(block, mean, 0.5 * i);
+        }
+        // one plain and one compressed block in the same file
+        columnarBlock_write(block, fH, b == 1);
+        columnarBlock_destruct(block);
+    }
+    rewind(fH);
+    for (int64_t b = 0; b < 2; b++) {
+        ColumnarBlock *block = columnarBlock_read(fH);
+        CuAssertTrue(testCase, block != NULL);
+        CuAssertStrEquals(testCase, "assignments", columnarBlock_getFormat(block));
+        CuAssertStrEquals(testCase, b == 0 ? "t" : "c", columnarBlock_getMetadata(block, "strand"));
+        CuAssertStrEquals(testCase, "ACGT", columnarBlock_getMetadata(block, "kmer_alphabet"));
+        CuAssertTrue(testCase, columnarBlock_getMetadata(block, "kmer") == NULL);
+        CuAssertIntEquals(testCase, 1000, (int) columnarBlock_getRowNumber(block));
+        CuAssertIntEquals(testCase, -1, (int) columnarBlock_getColumnIndex(block, "ref_pos"));
+        int64_t *kmers = columnarBlock_getInt64s(block, columnarBlock_getColumnIndex(block, "kmer"));
+        double *means = columnarBlock_getDoubles(block, columnarBlock_getColumnIndex(block, "event_mean"));
+        CuAssertIntEquals(testCase, (int) (999 + b), (int) kmers[999]);
+        CuAssertDblEquals(testCase, 250.0, means[500], 0.0);
+        columnarBlock_destruct(block);
+    }
+    CuAssertTrue(testCase, columnarBlock_read(fH) == NULL);
+    fclose(fH);
+}
+
+static void test_blockCompressedOutput(CuTest *testCase) {
+    char *path = stString_print("./blockCompressedOutputTest.tsv.gz");
+    BlockWriter *writer = blockWriter_open(path, TRUE);
+    for (int64_t i = 0; i < 20000; i++) {
+        blockWriter_printf(writer, "%"PRId64"\tACGTAA\t%f\n", i, 0.25 * i);
+    }
+    blockWriter_close(writer);
+
+    // walk the blocks by their sizes, each one is a gzip member with the BC extra field
+    FILE *fH = fopen(path, "rb");
+    fseek(fH, 0, SEEK_END);
+    int64_t size = ftell(fH);
+    int64_t offset = 0;
+    int64_t nbBlocks = 0;
+    unsigned char header[18];
+    while (offset < size) {
+        fseek(fH, offset, SEEK_SET);
+        CuAssertIntEquals(testCase, 18, (int) fread(header, 1, 18, fH));
+        CuAssertIntEquals(testCase, 31, header[0]);
+        CuAssertIntEquals(testCase, 139, header[1]);
+        CuAssertIntEquals(testCase, 'B', header[12]);
+        CuAssertIntEquals(testCase, 'C', header[13]);
+        offset += (header[16] | (header[17] << 8)) + 1;
+        nbBlocks += 1;
+    }
+    fclose(fH);
+    CuAssertTrue(testCase, offset == size);
+    CuAssertTrue(testCase, nbBlocks > 1);
+    remove(path);
+    free(path);
+}
+
 CuSuite *variableOrderPairwiseAlignerTestSuite(void) {
     CuSuite *suite = CuSuiteNew();
     SUITE_ADD_TEST(suite, test_findDegeneratePositions);
@@ -186,5 +296,8 @@ CuSuite *variableOrderPairwiseAlignerTestSuite(void) {
     SUITE_ADD_TEST(suite, test_substitutedKmers);
     SUITE_ADD_TEST(suite, test_getKmerIndex);
     SUITE_ADD_TEST(suite, test_getKmerWithBoundsCheck);
+    SUITE_ADD_TEST(suite, test_columnarKmerIds);
+    SUITE_ADD_TEST(suite, test_columnarBlockRead);
+    SUITE_ADD_TEST(suite, test_blockCompressedOutput);
     return suite;
 }
\ No newline at end of file